@@ -1,10 +1,12 @@
 import os
+import gzip
 import json
 import time
 import uuid
 import boto3
 import traceback
 import sys
+from collections import namedtuple
 
 try:
     sys.path.insert(1, './lib')
@@ -13,12 +15,16 @@ try:
     import pt_poster
     import pcc_poster
     import environment_params as env
-    from multiprocessing import Process
-    from edge_sqs_utility_layer import sqs_send_message
+    from concurrent.futures import ThreadPoolExecutor
 
-    from update_scheduler import update_scheduler_table, get_request_id_from_consumption_view
+    from update_scheduler import coalesce_scheduler_update, flush_scheduler_updates, \
+        get_request_id_from_consumption_view
 
-    from edge_db_lambda_client import EdgeDbLambdaClient
+    from utilities.edge_db_singleflight import EDGE_DB_CLIENT
+    from utilities.json_stream_utility import read_json_file, read_json_lines
+    from utilities.metadata_emitter import MetadataEvent, emit_metadata_event, flush_metadata_events
+    from file_idempotency import get_file_idempotency_key, get_line_idempotency_key, claim_file, complete_files, \
+        release_file, get_completed_files, FILE_STATE_DONE, FILE_STATE_IN_PROGRESS
 except Exception as e:
     traceback.print_exc()
     raise e
@@ -39,18 +45,26 @@ PowerGenValue = os.environ["PowerGenValue"]
 mapTspFromOwner = os.environ["mapTspFromOwner"]
 process_data_quality = os.environ["ProcessDataQuality"]
 data_quality_lambda = os.environ["DataQualityLambda"]
+DATA_QUALITY_MAX_PAYLOAD_BYTES = 256 * 1024  # Asynchronous invocation payload limit
+# 'Y' merges the S3 events of the batch into multi-Record payloads, which the data quality lambda has to support.
+# By default every S3 event is still sent as its own invocation, as the data quality lambda has always received it,
+# so the number of invocations per batch only goes down with 'Y'.
+DATA_QUALITY_MERGE_EVENTS = os.getenv("DataQualityMergeEvents", "N").lower() == "y"
 MAX_ATTEMPTS = int(os.environ["MaxAttempts"])
+# The workers mostly wait on S3, EdgeDB, Redis and the targets. The JSON parsing and the transformation of the files
+# run one at a time under the GIL, so more threads only help while the files wait on the network.
+MAX_WORKERS = int(os.getenv("MaxWorkers", 25))
 s3_client = boto3.client('s3')
 ssm_client = boto3.client('ssm')
-EDGE_DB_CLIENT = EdgeDbLambdaClient()
+lambda_client = boto3.client('lambda')
 
-
-def delete_message_from_sqs_queue(receipt_handle):
-    queue_url = os.environ["QueueUrl"]
-    sqs_client = boto3.client('sqs')  # noqa
-    sqs_message_deletion_response = sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-    LOGGER.debug(f"SQS message deletion response: '{sqs_message_deletion_response}'. . .")
-    return sqs_message_deletion_response
+# What a worker hands back to the handler for its SQS record: whether the message can be acknowledged, the
+# idempotency key of the S3 object and the files routed from it. The key is completed by the handler once the data
+# buffered for the files has been sent, so that a redelivery after a failed flush processes the files again.
+RecordResult = namedtuple("RecordResult", ["processed", "idempotency_key", "routed_files"])
+# 'idempotency_key' is set for the lines of a compacted file only, 'scheduler_update' is the (request_id, device_id)
+# the file moved to 'Data Rx In Progress', None if there was none
+RoutedFile = namedtuple("RoutedFile", ["idempotency_key", "scheduler_update"])
 
 
 def get_device_info(device_id):
@@ -89,40 +103,124 @@ def get_business_partner(device_type):
 def retrieve_and_process_file(s3_event_body, receipt_handle):
     LOGGER.info(f"s3_event_body: {s3_event_body}")
     LOGGER.info(f"receipt_handle: {receipt_handle}")
-    event_json = json.dumps(s3_event_body)
-    print(f"event_json: {event_json}")
-
-    if process_data_quality.lower() == 'yes':
-        LOGGER.debug("Initiating data quality...")
-        # Invoke data quality lambda - start
-        try:
-            data_quality(event_json)
-        except Exception as e:
-            LOGGER.error(f"ERROR Invoking data quality - {e}")
-        # Invoke data quality lambda - end
-    else:
-        LOGGER.debug("data quality skipped...")
 
     print(s3_event_body['Records'])
     bucket_name = s3_event_body['Records'][0]['s3']['bucket']['name']
     file_key = s3_event_body['Records'][0]['s3']['object']['key']
     file_size = s3_event_body['Records'][0]['s3']['object']['size']
+    file_etag = s3_event_body['Records'][0]['s3']['object'].get('eTag')
     LOGGER.info(f"Bucket Name: {bucket_name} File Key: {file_key}")
     file_key = file_key.replace("%3A", ":")
     LOGGER.info(f"New FileKey: {file_key}")
 
+    # A file delivered again (duplicate S3 event or SQS redelivery) is acknowledged after this single Redis call
+    idempotency_key = get_file_idempotency_key(bucket_name, file_key, file_etag)
+    file_state = claim_file(idempotency_key) if idempotency_key else None
+    if file_state == FILE_STATE_DONE:
+        LOGGER.info(f"The file: '{file_key}' was already processed, acknowledging the duplicate message.")
+        return RecordResult(True, None, [])
+    if file_state == FILE_STATE_IN_PROGRESS:
+        LOGGER.warning(f"The file: '{file_key}' is being processed by another invocation, "
+                       f"leaving the message to be redelivered after the visibility timeout.")
+        return RecordResult(False, None, [])
+
+    record_result = None
+    try:
+        record_result = process_file(bucket_name, file_key, file_size, receipt_handle, idempotency_key)
+    finally:
+        if idempotency_key and not (record_result and record_result.processed):
+            release_file(idempotency_key)
+    return record_result._replace(idempotency_key=idempotency_key if record_result.processed else None)
+
+
+def process_file(bucket_name, file_key, file_size, receipt_handle, idempotency_key=None):
     file_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
     LOGGER.debug(f"Get File Object Response: {file_object}")
 
     file_date_time = str(file_object['LastModified'])[:19]
-    file_object_stream = file_object['Body'].read()
-    json_body = json.loads(file_object_stream)
-    LOGGER.debug(f"File as JSON: {json_body}")
+    file_stream = file_object['Body']
+    if file_object.get('ContentEncoding') == 'gzip':
+        # The GPS obfuscation lambda can store the HB files compressed
+        file_stream = gzip.GzipFile(fileobj=file_stream)
 
     file_metadata = file_object["Metadata"]
     LOGGER.debug(f"File Metadata: {file_metadata}")
+    if file_metadata.get("compacted") == "Y":
+        return process_compacted_file(bucket_name, file_key, file_date_time, file_metadata, file_stream,
+                                      receipt_handle, idempotency_key)
+
+    # Parse the body as it is downloaded instead of holding the raw bytes, the decoded text and the dict at once
+    json_body, samples = read_json_file(file_stream)
+    if samples is not None:
+        json_body["samples"] = list(samples)
+    LOGGER.debug(f"Number of Samples in the File: {len(json_body.get('samples') or [])}")
+
+    routed_file = route_file(bucket_name, file_key, file_size, file_date_time, file_metadata, json_body,
+                             receipt_handle)
+    return RecordResult(bool(routed_file), None, [routed_file] if routed_file else [])
+
+
+def process_compacted_file(bucket_name, file_key, file_date_time, file_metadata, file_stream, receipt_handle,
+                           idempotency_key=None):
+    """
+    Routes the HB files that the GPS obfuscation lambda compacted into one newline-delimited object, each of them as
+    <file name>_<line index>.json. The SQS message is acknowledged once all of them are routed. If some are not, the
+    lines that were are completed on their own, so that the redelivered message skips them.
+    """
+    file_name_prefix = file_key[:-len(".json")]
+    line_keys = [get_line_idempotency_key(idempotency_key, index)
+                 for index in range(int(file_metadata.get("messages", 0)))] if idempotency_key else []
+    completed_line_keys = get_completed_files(line_keys) if line_keys else set()
+    routed_files = []
+    number_of_files = 0
+    number_of_routed_files = 0
+    for index, json_body in enumerate(read_json_lines(file_stream)):
+        number_of_files += 1
+        line_key = line_keys[index] if index < len(line_keys) else None
+        if line_key in completed_line_keys:
+            LOGGER.info(f"The file: {index} of the compacted file: {file_key} was already routed, skipping it.")
+            number_of_routed_files += 1
+            continue
+        try:
+            routed_file = route_file(bucket_name, f"{file_name_prefix}_{index}.json",
+                                     len(json.dumps(json_body).encode()), file_date_time, file_metadata, json_body,
+                                     receipt_handle)
+            if routed_file:
+                routed_files.append(routed_file._replace(idempotency_key=line_key))
+                number_of_routed_files += 1
+        except Exception as e:
+            error_message = f"An error occurred while routing the file: {index} of the compacted file: {file_key}: {e}"
+            LOGGER.error(error_message)
+            write_to_audit_table("J1939_HB", error_message, json_body.get("telematicsDeviceId"))
+
+    LOGGER.info(f"Routed {number_of_routed_files} of the {number_of_files} files of the compacted file: {file_key}")
+    return RecordResult(number_of_routed_files == number_of_files, None, routed_files)
+
+
+def process_converted_file(converted_file_event):
+    # The CSV converter hands the converted FC file off in the invocation payload, instead of writing it to S3
+    converted_file = converted_file_event["converted_file"]
+    LOGGER.info(f"Received the converted file: '{converted_file['file_key']}' from the CSV converter")
+    return route_file(converted_file["bucket_name"], converted_file["file_key"], converted_file["file_size"],
+                      converted_file["file_date_time"], converted_file["metadata"], converted_file_event["json_body"],
+                      None)
+
+
+def log_routing_latency(file_metadata, file_key, receipt_handle):
+    # Set by the CSV converter, to compare the routing of the FC files handed off with the ones going through S3
+    if "convertedat" not in file_metadata:
+        return
+    LOGGER.info(json.dumps({
+        "event": "FcRoutingLatency",
+        "mode": "fused" if receipt_handle is None else "s3",
+        "file_key": file_key,
+        "latency_ms": round((time.time() - float(file_metadata["convertedat"])) * 1000)
+    }))
+
 
+def route_file(bucket_name, file_key, file_size, file_date_time, file_metadata, json_body, receipt_handle):
     j1939_type = file_metadata["j1939type"] if "j1939type" in file_metadata else 'HB'
+    scheduler_update = None
 
     # If the file contains a UUID, then use it moving forward else:
     # Set the UUID to None for FC and get a new UUID for HB
@@ -141,8 +239,7 @@ def retrieve_and_process_file(s3_event_body, receipt_handle):
     file_name = file_key.split('/')[-1]
 
     if j1939_type.lower() == "fc":
-        config_spec_name_fc, req_id_fc = post.get_cspec_req_id(file_key.split('_')[3])
-        config_spec_and_req_id = str(config_spec_name_fc) + "," + str(req_id_fc)
+        config_spec_name, request_id = post.get_cspec_req_id(file_key.split('_')[3])
         j1939_data_type = 'J1939_FC'
         file_uuid = fc_uuid
     elif j1939_type.lower() == 'hb':
@@ -150,32 +247,24 @@ def retrieve_and_process_file(s3_event_body, receipt_handle):
         config_spec_name, req_id = post.get_cspec_req_id(json_body['dataSamplingConfigId'])
         data_config_filename = '_'.join(['EDGE', device_id, esn, config_spec_name])
         request_id = get_request_id_from_consumption_view('J1939_HB', data_config_filename, device_info)
-        config_spec_and_req_id = str(config_spec_name) + "," + str(request_id)
         file_uuid = hb_uuid
 
         # Updating scheduler lambda based on the request_id
         if request_id:
-            update_scheduler_table(request_id, device_id, device_info)
+            coalesce_scheduler_update(request_id, device_id, device_info)
+            scheduler_update = (request_id, device_id)
     else:
         raise RuntimeError(f"Invalid 'j1939type': '{j1939_type}' received! "
                            "The 'j1939type' S3 object metadata for FC files should be 'FC'!")
 
-    sqs_message = file_uuid + "," + str(device_id) + "," + str(file_name) + "," + str(file_size) + "," + str(
-        file_date_time) + "," + str(j1939_data_type) + "," + str('FILE_RECEIVED') + "," + str(
-        esn) + "," + config_spec_and_req_id + "," + str(None) + "," + " " + "," + " "
-
-    sqs_message_template = \
-        f"{file_uuid},{device_id},{file_name},{str(file_size)}," \
-        f"{'{FILE_METADATA_CURRENT_DATE_TIME}'},{j1939_data_type}," \
-        f"{'{FILE_METADATA_FILE_STAGE}'},{esn},{config_spec_and_req_id},,,"
+    metadata_event = MetadataEvent(file_uuid, device_id, file_name, file_size, file_date_time, j1939_data_type,
+                                   "FILE_RECEIVED", esn, config_spec_name, request_id)
+    # The FILE_RECEIVED message of the HB files and the FILE_SENT message of PCC leave the last columns empty
+    metadata_template = metadata_event._replace(consumption_per_request="", reserved_1="", reserved_2="")
 
     if j1939_type.lower() == 'hb':
-        file_received_sqs_message = sqs_message_template \
-            .replace("{FILE_METADATA_CURRENT_DATE_TIME}", str(file_date_time)) \
-            .replace("{FILE_METADATA_FILE_STAGE}", "FILE_RECEIVED")
-        # fielsent and fildatetime
-        LOGGER.debug(f"Sending Metadata message for HB with: {file_received_sqs_message}")
-        sqs_send_message(os.environ["metaWriteQueueUrl"], file_received_sqs_message)
+        LOGGER.debug(f"Sending Metadata message for HB with: {metadata_template.to_message()}")
+        emit_metadata_event(metadata_template)
 
     if device_info:
         device_owner = device_info["device_owner"] if "device_owner" in device_info else None
@@ -202,10 +291,10 @@ def retrieve_and_process_file(s3_event_body, receipt_handle):
         LOGGER.info(f"Retrieved TSP name is {tsp_name}")
         if device_owner in json.loads(os.environ["cd_device_owners"]):
             LOGGER.info("Inside CD device owner case")
-            sqs_message = sqs_message.replace("FILE_RECEIVED", "CD_PT_POSTED")
-            LOGGER.debug(f"Metadata Message sent to CD: {sqs_message}")
+            metadata_event = metadata_event._replace(data_pipeline_stage="CD_PT_POSTED")
+            LOGGER.debug(f"Metadata Message sent to CD: {metadata_event.to_message()}")
             post.send_to_cd(bucket_name, file_key, JSONFormat, s3_client, j1939_type, EndpointBucket, endpointFile,
-                            UseEndpointBucket, json_body, file_uuid, sqs_message, j1939_data_type)
+                            UseEndpointBucket, json_body, file_uuid, metadata_event, j1939_data_type)
 
         elif device_owner in json.loads(os.environ["psbu_device_owner"]):
             parameter = ssm_client.get_parameter(Name='da-edge-j1939-content-spec-value', WithDecryption=False)
@@ -235,16 +324,16 @@ def retrieve_and_process_file(s3_event_body, receipt_handle):
                 json_body['telematicsPartnerName'] = config_spec_value['PT_TSP']
 
             LOGGER.info(f"Json_body before calling SEND_TO_PT function: {json_body}")
-            sqs_message = sqs_message.replace("FILE_RECEIVED", "FILE_SENT")
+            metadata_event = metadata_event._replace(data_pipeline_stage="FILE_SENT")
 
             # check whether pcc_claim_status is claimed or not
             if pcc_claim_status and ("claimed" == pcc_claim_status.lower() or "claimed@pcc2.0" == pcc_claim_status.lower()):
                     service_engine_model = device_info[
                         "service_engine_model"] if "service_engine_model" in device_info else None
-                    pcc_poster.send_to_pcc(json_body, device_id, j1939_data_type, sqs_message_template,
+                    pcc_poster.send_to_pcc(json_body, device_id, j1939_data_type, metadata_template,
                                         service_engine_model,pcc_claim_status)
             else:
-                    pt_poster.send_to_pt(PTJ1939PostURL, PTJ1939Header, json_body, sqs_message, j1939_data_type,
+                    pt_poster.send_to_pt(PTJ1939PostURL, PTJ1939Header, json_body, metadata_event, j1939_data_type,
                                         j1939_type.lower(), file_uuid, device_id, esn)
         else:
             error_message = f"The boxApplication value is not recorded in the EDGE DB for the device: {device_id}"
@@ -257,12 +346,56 @@ def retrieve_and_process_file(s3_event_body, receipt_handle):
         LOGGER.error(error_message)
         write_to_audit_table(j1939_data_type, error_message, device_id)
         return
-    delete_message_from_sqs_queue(receipt_handle)
+    log_routing_latency(file_metadata, file_key, receipt_handle)
+    return RoutedFile(None, scheduler_update)
+
+
+def chunk_data_quality_events(s3_event_bodies):
+    # Group the S3 events of the batch into payloads that fit in the asynchronous invocation limit
+    chunks = []
+    chunk = []
+    chunk_size = len(json.dumps({"Records": []}))
+    for s3_event_body in s3_event_bodies:
+        if not DATA_QUALITY_MERGE_EVENTS:
+            chunks.append([s3_event_body])
+            continue
+        s3_event_size = len(json.dumps(s3_event_body["Records"])) - 1  # Without the surrounding brackets, with a comma
+        if chunk and chunk_size + s3_event_size > DATA_QUALITY_MAX_PAYLOAD_BYTES:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = len(json.dumps({"Records": []}))
+        chunk.append(s3_event_body)
+        chunk_size += s3_event_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def invoke_data_quality(s3_event_bodies):
+    """
+    Hands the S3 events of the whole SQS batch to the data quality lambda, from the handler thread. With
+    DATA_QUALITY_MERGE_EVENTS they are merged into as few S3 event payloads as the payload limit allows. A body that
+    is not an S3 event, e.g. an s3:TestEvent, is skipped. A failed invocation is only logged, as it always was.
+    """
+    s3_events = []
+    for s3_event_body in s3_event_bodies:
+        if isinstance(s3_event_body, dict) and isinstance(s3_event_body.get("Records"), list):
+            s3_events.append(s3_event_body)
+        else:
+            LOGGER.warning(f"Skipping the data quality of the message body without S3 event records: {s3_event_body}")
+
+    for chunk in chunk_data_quality_events(s3_events):
+        event_json = json.dumps(chunk[0]) if len(chunk) == 1 else \
+            json.dumps({"Records": [record for s3_event_body in chunk for record in s3_event_body["Records"]]})
+        try:
+            data_quality(event_json)
+        except Exception as e:
+            for s3_event_body in chunk:
+                LOGGER.error(f"ERROR Invoking data quality for the S3 event: {s3_event_body} - {e}")
 
 
 # Invoke the Data Quality Lambda
 def data_quality(event):
-    lambda_client = boto3.client('lambda')  # noqa
     response = lambda_client.invoke(
         FunctionName=data_quality_lambda,
         InvocationType='Event',
@@ -275,22 +408,98 @@ def data_quality(event):
     LOGGER.debug("Successfully invoked the Data Quality lambda!")
 
 
+def flush_batch():
+    """
+    Sends what the workers of the batch buffered: the PCC records, the PT Kafka messages and files, the NGDI archives,
+    the scheduler updates and, last as the other flushes emit the FILE_SENT events, the metadata events. Every flush
+    runs even if one fails. Returns False if any of them raised, and the scheduler updates that failed.
+    """
+    flushes_succeeded = True
+    failed_scheduler_updates = set()
+    for flush in [pcc_poster.flush_kinesis_producers, pt_poster.flush_kafka_producer, pt_poster.flush_pt_files,
+                  post.flush_ngdi_archives, flush_scheduler_updates, flush_and_audit_metadata_events]:
+        try:
+            flush_result = flush()
+        except Exception as e:
+            LOGGER.error(f"An exception occurred while sending the data buffered for the batch: {e}")
+            traceback.print_exc()
+            flushes_succeeded = False
+            continue
+        if flush is flush_scheduler_updates:
+            failed_scheduler_updates.update(flush_result)
+    return flushes_succeeded, failed_scheduler_updates
+
+
+def flush_and_audit_metadata_events():
+    for lost_event in flush_metadata_events():
+        write_to_audit_table(lost_event.data_protocol, f"The metadata event: {lost_event.to_message()} could not be "
+                                                       f"sent to the metaWrite queue", lost_event.device_id)
+
+
 def lambda_handler(event, _):  # noqa
     records = event.get("Records", [])
-    processes = []
     LOGGER.debug(f"Received SQS Records: {records}.")
-    for record in records:
-        s3_event_body = json.loads(record["body"])
-        receipt_handle = record["receiptHandle"]
-        # Retrieve the uploaded file from the s3 bucket and process the uploaded file
-        process = Process(target=retrieve_and_process_file, args=(s3_event_body, receipt_handle))
-
-        # Make a list of all process to wait and terminate at the end
-        processes.append(process)
 
-        # Start process
-        process.start()
-
-    # Make sure that all processes have finished
-    for process in processes:
-        process.join()
+    # The records are processed on threads (instead of forked processes) so that the per container caches, e.g. the
+    # STS credentials and Kinesis clients, are shared by every record and survive across warm invocations
+    with ThreadPoolExecutor(max_workers=max(min(len(records), MAX_WORKERS), 1)) as executor:
+        futures = {}  # future -> SQS message ID, None for the file handed off by the CSV converter
+        if "converted_file" in event:
+            futures[executor.submit(process_converted_file, event)] = None
+        s3_event_bodies = []
+        for record in records:
+            s3_event_body = json.loads(record["body"])
+            receipt_handle = record["receiptHandle"]
+            s3_event_bodies.append(s3_event_body)
+            # Retrieve the uploaded file from the s3 bucket and process the uploaded file
+            futures[executor.submit(retrieve_and_process_file, s3_event_body, receipt_handle)] = record["messageId"]
+
+        # Invoke the data quality lambda for the batch while the workers process the files
+        if process_data_quality.lower() == 'yes' and s3_event_bodies:
+            LOGGER.debug("Initiating data quality...")
+            invoke_data_quality(s3_event_bodies)
+        else:
+            LOGGER.debug("data quality skipped...")
+
+    flushes_succeeded, failed_scheduler_updates = flush_batch()
+    EDGE_DB_CLIENT.log_metrics()
+
+    # Make sure that the failure of a record is not lost now that it is not raised in a separate process
+    batch_item_failures = []
+    completed_idempotency_keys = []
+    converted_file_failed = False
+    for future, message_id in futures.items():
+        exception = future.exception()
+        if exception:
+            LOGGER.error(f"An exception occurred while processing the record: {exception}")
+            traceback.print_exception(type(exception), exception, exception.__traceback__)
+        if message_id is None:
+            routed_file = None if exception else future.result()
+            converted_file_failed = not (routed_file and flushes_succeeded and
+                                         routed_file.scheduler_update not in failed_scheduler_updates)
+            continue
+        record_result = None if exception else future.result()
+        routed_files = record_result.routed_files if record_result else []
+        # Unless the data of the file was sent, and its request moved to 'Data Rx In Progress'
+        sent_files = [routed_file for routed_file in routed_files
+                      if flushes_succeeded and routed_file.scheduler_update not in failed_scheduler_updates]
+        if record_result and record_result.processed and flushes_succeeded and len(sent_files) == len(routed_files):
+            if record_result.idempotency_key:
+                completed_idempotency_keys.append(record_result.idempotency_key)
+            continue
+
+        # The redelivered message has to process the files again, except the lines of a compacted file that were sent
+        if record_result and record_result.idempotency_key:
+            release_file(record_result.idempotency_key)
+        completed_idempotency_keys.extend(sent_file.idempotency_key for sent_file in sent_files
+                                          if sent_file.idempotency_key)
+        batch_item_failures.append({"itemIdentifier": message_id})
+    complete_files(completed_idempotency_keys)
+
+    # The converted file is not backed by an SQS message, raise so that the asynchronous invocation is retried and then
+    # sent to the on failure destination
+    if converted_file_failed:
+        raise RuntimeError(f"Failed to route the converted file: '{event['converted_file']['file_key']}'")
+
+    # Partial batch response, SQS deletes the messages of the files that were processed
+    return {"batchItemFailures": batch_item_failures}
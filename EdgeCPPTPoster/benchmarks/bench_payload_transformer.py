@@ -0,0 +1,88 @@
+"""
+Benchmark of payload_transformer.transform_payload() on 1,000 sample HB files.
+
+Run from the EdgeCPPTPoster folder: python -m benchmarks.bench_payload_transformer [--files N] [--samples N]
+The Lambda layers are replaced by in-process fakes, the GPS de-obfuscation returns the co-ordinates unchanged so that
+only the transformation itself is measured.
+"""
+import sys
+import time
+import argparse
+import statistics
+from unittest.mock import MagicMock, patch
+
+sys.path.append(".")
+sys.path.append("..")  # edge_shared_utilities
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context:
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("edge_gps_utility_layer")
+
+    import payload_transformer
+
+
+def build_hb_file(number_of_samples):
+    return {
+        "messageFormatVersion": "1.1.1",
+        "telematicsDeviceId": "192999999999954",
+        "componentSerialNumber": "64200027",
+        "vin": "TESTVIN19299954",
+        "dataSamplingConfigId": "SC8091",
+        "numberOfSamples": number_of_samples,
+        "samples": [{
+            "convertedDeviceParameters": {
+                "messageID": f"8c5a1650-048e-4620-9950-{index:012d}",
+                "CPU_Usage_Level": "2.02", "LTE_RSRP": "-107", "LTE_RSRQ": "-6", "Latitude": "39.202938",
+                "CPU_temperature": "40.3", "Satellites_Used": "20", "Longitude": "-85.88672", "PDOP": "1.159999967",
+                "LTE_RSCP": "255", "PMIC_temperature": "33.25", "LTE_RSSI": "99", "Altitude": "165.236"
+            },
+            "rawEquipmentParameters": [],
+            "convertedEquipmentParameters": [{
+                "protocol": "J1939", "networkId": "CAN1", "deviceId": "0",
+                "parameters": {spn: str(index) for spn in ["190", "174", "175", "110", "100", "101", "102", "168"]}
+            }],
+            "convertedEquipmentFaultCodes": [{
+                "protocol": "J1939", "networkId": "CAN1", "deviceId": "0",
+                "activeFaultCodes": [{"spn": "100", "fmi": "4", "count": "1"}, {"spn": "101", "fmi": "4", "count": "1"}],
+                "inactiveFaultCodes": [{"spn": "102", "fmi": "4", "count": "2"}],
+                "pendingFaultCodes": [{"spn": "103", "fmi": "4", "count": "3"}]
+            }],
+            "dateTimestamp": f"2024-01-17T05:{index // 60 % 60:02d}:{index % 60:02d}.503Z"
+        } for index in range(number_of_samples)]
+    }
+
+
+def run(target, files, samples):
+    hb_files = [build_hb_file(samples) for _ in range(files)]
+    durations = []
+    health_rows = 0
+    for hb_file in hb_files:
+        start = time.perf_counter()
+        health_rows += len(payload_transformer.transform_payload(hb_file, target, "X15"))
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+    print(f"{target:>3}: {files} files x {samples} samples, "
+          f"{files * samples / sum(durations):,.0f} samples/sec, "
+          f"p50: {statistics.median(durations) * 1000:.2f} ms/file, p99: {p99 * 1000:.2f} ms/file, "
+          f"health rows: {health_rows}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    with patch("edge_shared_utilities.gps_utility.handle_gps_coordinates",
+               lambda latitude, longitude, deobfuscate: (latitude, longitude)), \
+            patch("payload_transformer.LOGGER", MagicMock()):
+        for target in [payload_transformer.TARGET_PT, payload_transformer.TARGET_PCC]:
+            run(target, args.files, args.samples)
+
+
+if __name__ == '__main__':
+    main()
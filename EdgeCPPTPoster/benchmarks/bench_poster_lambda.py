@@ -0,0 +1,498 @@
+"""
+Benchmark of PosterLambda.lambda_handler() on synthetic SQS batches of HB files, per route: EBU/CD (SDK), PSBU/PT over
+HTTP and over Kafka, PCC and PCC2 Kinesis.
+
+Run from the EdgeCPPTPoster folder:
+    python -m benchmarks.bench_poster_lambda [--routes cd pt-http ...] [--batches N] [--batch-size N] [--samples N]
+                                             [--devices N] [--latency-ms N] [--latency edgedb=20 pt=150 ...]
+
+S3, SQS, SSM, STS, Kinesis, Secrets Manager, Kafka, Redis, EdgeDB, the PT endpoint and the Lambda layers are replaced
+by in-process fakes. Every call to a fake is counted and sleeps for the injected latency of its dependency, so that a
+caching or batching change shows up in the files/sec, the p50/p99 and the calls per file of the routes it affects.
+"""
+import io
+import re
+import os
+import sys
+import json
+import time
+import types
+import logging
+import argparse
+import datetime
+import threading
+import statistics
+import contextlib
+from collections import Counter
+from unittest.mock import patch
+
+sys.path.append(".")
+sys.path.append("..")  # edge_shared_utilities
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+ROUTES = {
+    "cd": {"device_owner": "EBU"},
+    "pt-http": {"device_owner": "PSBU", "publish_kafka": "false"},
+    "pt-kafka": {"device_owner": "PSBU", "publish_kafka": "true"},
+    "pcc": {"device_owner": "PSBU", "pcc_claim_status": "Claimed"},
+    "pcc2": {"device_owner": "PSBU", "pcc_claim_status": "Claimed@PCC2.0"},
+}
+
+ENVIRONMENT = {
+    "AWS_LAMBDA_FUNCTION_NAME": "EdgeCPPTPoster-bench",
+    "LoggingLevel": "warning",
+    "EndpointFile": "EndpointJson.json",
+    "CPPostBucket": "edge-j1939-bench",
+    "EndpointBucket": "endpoint-bucket-bench",
+    "JSONFormat": "SDK",
+    "PSBUSpecifier": "psbu",
+    "EBUSpecifier": "onhighway",
+    "UseEndpointBucket": "Y",
+    "PTJ1939PostURL": "https://pt.bench/ngdi",
+    "PTJ1939Header": json.dumps({"Content-Type": "application/json", "x-api-key": ""}),
+    "CDPTJ1939PostURL": "https://cd-pt.bench/ngdi",
+    "CDPTJ1939Header": json.dumps({"Content-Type": "application/json"}),
+    "PowerGenValue": "powerGen",
+    "mapTspFromOwner": json.dumps({"EBU": "Cummins", "PSBU": "Cummins"}),
+    "cd_device_owners": json.dumps({"EBU": "EBU"}),
+    "psbu_device_owner": json.dumps({"PSBU": "PSBU"}),
+    "ProcessDataQuality": "no",
+    "DataQualityLambda": "DataQuality-bench",
+    "MaxAttempts": "3",
+    "QueueUrl": "https://sqs.bench/CPPTPosterQueue",
+    "metaWriteQueueUrl": "https://sqs.bench/DatalogMetadata",
+    "AuditTrailQueueUrl": "https://sqs.bench/AuditTrailerQueue",
+    "PTxAPIKey": "pt_xapi_key",
+    "Region": "us-east-1",
+    "region": "us-east-1",
+    "RedisSecretName": "redis-secret",
+    "ptTopicInfo": json.dumps({"topicName": "nimbuspt-j1939-{j1939_type}", "bu": "PSBU", "file_type": "JSON"}),
+    "publishKafka": "false",
+    "mskSecretArn": "msk-secret",
+    "mskClusterArn": "msk-cluster",
+    "KafkaApiVersionTuple": "(2, 8, 1)",
+    "pcc_role_arn": "arn:aws:iam::000000000000:role/EdgeKinesisProducerRole",
+    "j1939_stream_arn": "arn:aws:kinesis:us-east-1:000000000000:stream/J1939Events",
+    "pcc_region": "us-east-1",
+    "pcc2_role_arn": "arn:aws:iam::000000000001:role/PccInputStreamRole",
+    "pcc2_j1939_stream_arn": "arn:aws:kinesis:us-east-1:000000000001:stream/j1939-telemetry-inputstream",
+    "pcc2_region": "us-east-1",
+}
+
+CONTENT_SPEC_VALUE = {"EngineStatOverride": "EngineStat_9", "LoadFactorOverride": "LoadFactor_9",
+                      "EngineStatSc": "SC8091", "LoadFactorSc": "SC8093", "FC": "SC9000", "Periodic": "SC9001",
+                      "PT_TSP": "Cummins"}
+SECRET_VALUE = {"x-api-key": "bench-key", "redis_host": "redis.bench", "redis_port": 6379,
+                "username": "bench", "password": "bench"}
+DEVICE_ID_PATTERN = re.compile(r"DEVICE_ID\s*=\s*'(\w+)'", re.IGNORECASE)
+REQUEST_ID_LOOKUP_PATTERN = re.compile(r"\('(\w+)','(\w+)','(\w+)','(\w+)'\)")
+
+
+class Dependencies:
+    """
+    Counts the calls made to the fakes, per '<dependency>.<operation>', and injects the latency of the dependency.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.default_latency = 0.0
+        self.latencies = {}  # dependency -> seconds
+
+    def call(self, dependency, operation):
+        with self._lock:
+            self.calls[f"{dependency}.{operation}"] += 1
+        latency = self.latencies.get(dependency, self.default_latency)
+        if latency:
+            time.sleep(latency)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+
+DEPENDENCIES = Dependencies()
+S3_OBJECTS = {}  # (bucket, key) -> (body, metadata)
+DEVICES = {}  # device_id -> device_info
+
+
+class FakeAwsClient:
+    """
+    boto3 client of one service, each operation is answered by the handler of the same name.
+    """
+
+    def __init__(self, service_name, handlers):
+        self._service_name = service_name
+        self._handlers = handlers
+
+    def __getattr__(self, operation):
+        handler = self._handlers.get(operation, lambda **_: {})
+
+        def _call(*args, **kwargs):
+            DEPENDENCIES.call(self._service_name, operation)
+            return handler(*args, **kwargs)
+        return _call
+
+
+def _get_object(Bucket, Key):  # noqa
+    body, metadata = S3_OBJECTS[(Bucket, Key)]
+    return {"Body": io.BytesIO(body), "LastModified": "2024-01-17 05:54:03+00:00", "Metadata": dict(metadata)}
+
+
+def _put_records(StreamARN, Records):  # noqa
+    return {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1", "ShardId": "0"} for _ in Records]}
+
+
+def _assume_role(RoleArn, RoleSessionName):  # noqa
+    return {"Credentials": {"AccessKeyId": "bench", "SecretAccessKey": "bench", "SessionToken": "bench",
+                            "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+
+
+AWS_HANDLERS = {
+    "s3": {"get_object": _get_object,
+           "put_object": lambda **_: {"ResponseMetadata": {"HTTPStatusCode": 200}}},
+    "ssm": {"get_parameter": lambda **_: {"Parameter": {"Value": json.dumps(CONTENT_SPEC_VALUE)}}},
+    "sts": {"assume_role": _assume_role},
+    "kinesis": {"put_records": _put_records},
+    "secretsmanager": {"get_secret_value": lambda **_: {"SecretString": json.dumps(SECRET_VALUE), "VersionId": "v1"},
+                       "describe_secret": lambda **_: {"VersionIdsToStages": {"v1": ["AWSCURRENT"]}}},
+    "kafka": {"get_bootstrap_brokers": lambda **_: {"BootstrapBrokerStringSaslScram": "broker-1:9096,broker-2:9096"}},
+    "lambda": {"invoke": lambda **_: {"StatusCode": 202}},
+}
+
+
+def _create_boto3_module():
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda service_name, **_: FakeAwsClient(service_name, AWS_HANDLERS.get(service_name, {}))
+    boto3.resource = boto3.client
+    return boto3
+
+
+class FakePtResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+def _post_to_pt(url, data, headers):
+    DEPENDENCIES.call("pt", "post")
+    payload = json.loads(data)
+    if isinstance(payload, list):
+        return FakePtResponse([{"statusCode": 200} for _ in payload])
+    return FakePtResponse({"statusCode": 200})
+
+
+def _create_requests_module():
+    requests = types.ModuleType("requests")
+    requests.post = _post_to_pt
+    return requests
+
+
+class FakeRedisCluster:
+    """
+    Single in-memory store behind every connection, a pipeline is one round trip however many commands it holds.
+    """
+
+    _lock = threading.Lock()
+    _values = {}
+    _hashes = {}
+
+    def __init__(self, **_):
+        pass
+
+    def _get(self, key):
+        return self._values.get(key)
+
+    def _execute_command(self, command, *keys):
+        # Only the MGET of the keys of one hash slot is sent as a raw command
+        assert command == "MGET"
+        return [self._values.get(key) for key in keys]
+
+    def _set(self, key, value, ex=None, nx=False):
+        if nx and key in self._values:
+            return None
+        self._values[key] = value
+        return True
+
+    def _delete(self, key):
+        return int(self._values.pop(key, None) is not None or self._hashes.pop(key, None) is not None)
+
+    def _hgetall(self, key):
+        return dict(self._hashes.get(key, {}))
+
+    def _hset(self, key, field, value):
+        self._hashes.setdefault(key, {})[field] = value
+        return 1
+
+    def _hdel(self, key, *fields):
+        return sum(self._hashes.get(key, {}).pop(field, None) is not None for field in fields)
+
+    def _expire(self, key, seconds):
+        return int(key in self._values or key in self._hashes)
+
+    def _run(self, command, *args, **kwargs):
+        with self._lock:
+            return getattr(self, f"_{command}")(*args, **kwargs)
+
+    def __getattr__(self, command):
+        def _call(*args, **kwargs):
+            DEPENDENCIES.call("redis", command)
+            return self._run(command, *args, **kwargs)
+        return _call
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline:
+
+    def __init__(self, redis_cluster):
+        self._redis_cluster = redis_cluster
+        self._commands = []
+
+    def __getattr__(self, command):
+        def _queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+        return _queue
+
+    def execute(self):
+        DEPENDENCIES.call("redis", "pipeline")
+        commands, self._commands = self._commands, []
+        return [self._redis_cluster._run(command, *args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakeKafkaFuture:
+
+    def __init__(self):
+        self.is_done = False
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def add_errback(self, errback):
+        pass
+
+    def succeed(self):
+        self.is_done = True
+        for callback in self._callbacks:
+            callback(types.SimpleNamespace(partition=0, offset=0))
+
+
+class FakeKafkaProducer:
+    """
+    Sends are buffered in the process like the real producer, the latency is paid once per flush.
+    """
+
+    def __init__(self, **_):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def send(self, topic, key=None, value=None):
+        DEPENDENCIES.call("kafka", "send_buffered")
+        future = FakeKafkaFuture()
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def flush(self, timeout=None):
+        DEPENDENCIES.call("kafka", "flush")
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.succeed()
+
+    def close(self, timeout=None):
+        pass
+
+
+class FakeEdgeDbLambdaClient:
+
+    def execute(self, query, method=None, **_):
+        DEPENDENCIES.call("edgedb", "write" if str(method).upper() == "WRITE" else "read")
+        if str(method).upper() == "WRITE":
+            return []
+        device_id_match = DEVICE_ID_PATTERN.search(str(query))
+        if "device_information" in str(query).lower() and device_id_match:
+            device_info = DEVICES.get(device_id_match.group(1))
+            return [dict(device_info)] if device_info else []
+        request_id_lookups = REQUEST_ID_LOOKUP_PATTERN.findall(str(query))
+        if request_id_lookups:
+            # Every (data type, device, ESN, config spec) of a batched request ID query has an active request
+            return [{"request_id": "REQ001", "data_type": data_type, "device_id": device_id,
+                     "engine_serial_number": esn, "config_spec_prefix": config_spec_prefix}
+                    for data_type, device_id, esn, config_spec_prefix in request_id_lookups]
+        return [{"request_id": "REQ001"}]
+
+
+def _create_layer_modules():
+    logging.basicConfig(format="%(levelname)s %(name)s: %(message)s")
+    edge_simple_logging_layer = types.ModuleType("edge_simple_logging_layer")
+    edge_simple_logging_layer.get_logger = logging.getLogger
+
+    edge_sqs_utility_layer = types.ModuleType("edge_sqs_utility_layer")
+    edge_sqs_utility_layer.sqs_send_message = lambda queue_url, message: DEPENDENCIES.call("sqs", "send_message")
+    edge_sqs_utility_layer.send_error_to_audit_trail_queue = \
+        lambda queue_url, error_params: DEPENDENCIES.call("sqs", "send_audit_message")
+
+    edge_kafka_utility_layer = types.ModuleType("edge_kafka_utility_layer")
+    edge_kafka_utility_layer.create_irs_message = \
+        lambda file_uuid, json_body, device_id, esn, topic, file_type, bu, sqs_message: \
+        {"uuid": file_uuid, "telematicsDeviceId": device_id, "esn": esn, "topic": topic, "fileType": file_type,
+         "bu": bu, "metadata": sqs_message, "payload": json_body}
+
+    edge_db_simple_layer = types.ModuleType("edge_db_simple_layer")
+    edge_db_simple_layer.write_health_parameter_to_database_v2 = \
+        lambda *health_row: DEPENDENCIES.call("edgedb", "write_health_parameters")
+
+    edge_db_lambda_client = types.ModuleType("edge_db_lambda_client")
+    edge_db_lambda_client.EdgeDbLambdaClient = FakeEdgeDbLambdaClient
+
+    # The co-ordinates are de-obfuscated locally, there is no call to count
+    edge_gps_utility_layer = types.ModuleType("edge_gps_utility_layer")
+    edge_gps_utility_layer.handle_gps_coordinates = lambda latitude, longitude, deobfuscate=False: (latitude, longitude)
+
+    kafka = types.ModuleType("kafka")
+    kafka.KafkaProducer = FakeKafkaProducer
+
+    rediscluster = types.ModuleType("rediscluster")
+    rediscluster.RedisCluster = FakeRedisCluster
+
+    return {module.__name__: module for module in [
+        edge_simple_logging_layer, edge_sqs_utility_layer, edge_kafka_utility_layer, edge_db_simple_layer,
+        edge_db_lambda_client, edge_gps_utility_layer, kafka, rediscluster, _create_boto3_module(),
+        _create_requests_module()]}
+
+
+os.environ.update(ENVIRONMENT)
+with CDAModuleMockingContext(sys) as cda_module_mock_context:
+    for module_name, fake_module in _create_layer_modules().items():
+        cda_module_mock_context.mock_module(module_name, fake_module)
+
+    import PosterLambda
+    from benchmarks.bench_payload_transformer import build_hb_file
+
+
+class FileTimer:
+    """
+    Wraps retrieve_and_process_file() to time each file, the end of batch flushes are only in the batch time.
+    """
+
+    def __init__(self, retrieve_and_process_file):
+        self._retrieve_and_process_file = retrieve_and_process_file
+        self._lock = threading.Lock()
+        self.durations = []
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._retrieve_and_process_file(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.durations.append(time.perf_counter() - start)
+
+
+def register_devices(route_name, route, number_of_devices, number_of_samples):
+    route_index = list(ROUTES).index(route_name) + 1
+    device_bodies = []
+    for index in range(number_of_devices):
+        device_id = f"{route_index}9{index:013d}"
+        esn = f"{route_index}{index:07d}"
+        DEVICES[device_id] = {"device_owner": route["device_owner"], "dom": "2020-01-01", "cust_ref": "Cummins",
+                              "equip_id": f"EQ{esn}", "vin": f"VIN{esn}",
+                              "pcc_claim_status": route.get("pcc_claim_status"), "service_engine_model": "X15"}
+        hb_file = build_hb_file(number_of_samples)
+        hb_file.update(telematicsDeviceId=device_id, componentSerialNumber=esn)
+        device_bodies.append((device_id, esn, json.dumps(hb_file).encode()))
+    return device_bodies
+
+
+def build_batch(device_bodies, batch_size, file_counter):
+    records = []
+    for _ in range(batch_size):
+        file_number = next(file_counter)
+        device_id, esn, body = device_bodies[file_number % len(device_bodies)]
+        file_key = f"ConvertedFiles/{esn}/{device_id}/2024/01/17/EDGE_{device_id}_{esn}_SC8091_{file_number}.json"
+        S3_OBJECTS[(ENVIRONMENT["CPPostBucket"], file_key)] = (body, {"j1939type": "HB",
+                                                                      "uuid": f"bench-{file_number}"})
+        s3_event_body = {"Records": [{"s3": {"bucket": {"name": ENVIRONMENT["CPPostBucket"]},
+                                             "object": {"key": file_key, "size": len(body),
+                                                        "eTag": f"{file_number:032x}"}}}]}
+        records.append({"body": json.dumps(s3_event_body), "receiptHandle": f"receipt-handle-{file_number}",
+                        "messageId": f"message-{file_number}"})
+    return {"Records": records}
+
+
+def percentile(durations, fraction):
+    durations = sorted(durations)
+    return durations[min(len(durations) - 1, int(len(durations) * fraction))]
+
+
+def run(route_name, batches, batch_size, samples, devices, warmup_batches, file_counter):
+    route = ROUTES[route_name]
+    os.environ["publishKafka"] = route.get("publish_kafka", "false")
+    device_bodies = register_devices(route_name, route, devices, samples)
+    events = [build_batch(device_bodies, batch_size, file_counter) for _ in range(warmup_batches + batches)]
+
+    file_timer = FileTimer(PosterLambda.retrieve_and_process_file)
+    batch_durations = []
+    # retrieve_and_process_file() prints every S3 event, it is not what is being measured
+    with patch("PosterLambda.retrieve_and_process_file", file_timer), contextlib.redirect_stdout(io.StringIO()):
+        for batch_number, event in enumerate(events):
+            if batch_number == warmup_batches:
+                DEPENDENCIES.reset()
+                file_timer.durations.clear()
+            start = time.perf_counter()
+            PosterLambda.lambda_handler(event, None)
+            if batch_number >= warmup_batches:
+                batch_durations.append(time.perf_counter() - start)
+
+    files = batches * batch_size
+    print(f"{route_name:>8}: {batches} batches x {batch_size} files x {samples} samples, "
+          f"{files / sum(batch_durations):,.1f} files/sec, "
+          f"batch p50: {statistics.median(batch_durations) * 1000:.1f} ms, "
+          f"p99: {percentile(batch_durations, 0.99) * 1000:.1f} ms, "
+          f"file p50: {statistics.median(file_timer.durations) * 1000:.1f} ms, "
+          f"p99: {percentile(file_timer.durations, 0.99) * 1000:.1f} ms")
+    for dependency_call, count in sorted(DEPENDENCIES.calls.items()):
+        print(f"{'':>10}{dependency_call:<40} {count:>7} ({count / files:.2f}/file)")
+
+
+def parse_latencies(latencies):
+    parsed_latencies = {}
+    for latency in latencies:
+        dependency, _, milliseconds = latency.partition("=")
+        parsed_latencies[dependency] = float(milliseconds) / 1000
+    return parsed_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", nargs="+", choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=60)
+    parser.add_argument("--devices", type=int, default=25, help="distinct devices the files of a route belong to")
+    parser.add_argument("--warmup-batches", type=int, default=1,
+                        help="batches run before the measurement, like a warm container")
+    parser.add_argument("--latency-ms", type=float, default=5, help="latency of every dependency call")
+    parser.add_argument("--latency", nargs="*", default=[], metavar="DEPENDENCY=MS",
+                        help="latency of one dependency: s3, sqs, ssm, sts, kinesis, secretsmanager, kafka, redis, "
+                             "edgedb, pt")
+    args = parser.parse_args()
+
+    DEPENDENCIES.default_latency = args.latency_ms / 1000
+    DEPENDENCIES.latencies = parse_latencies(args.latency)
+    file_counter = iter(range(sys.maxsize))
+    for route_name in args.routes:
+        run(route_name, args.batches, args.batch_size, args.samples, args.devices, args.warmup_batches,
+            file_counter)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import os
+import time
+
+import utility as util
+from utilities.redis_utility import set_redis_value_if_absent, set_redis_values, get_redis_values, delete_redis_key
+
+LOGGER = util.get_logger(__name__)
+
+# How long a processed file is remembered, duplicate S3 events and SQS redeliveries arrive well within a day
+FILE_DONE_TTL = int(os.getenv("FileIdempotencyTtl", 24 * 60 * 60))
+# A claim left by an invocation that died expires with the lambda timeout, when SQS makes the message visible again
+FILE_IN_PROGRESS_TTL = int(os.getenv("FileInProgressTtl", 15 * 60))
+
+FILE_STATE_CLAIMED = "CLAIMED"
+FILE_STATE_IN_PROGRESS = "IN_PROGRESS"
+FILE_STATE_DONE = "DONE"
+
+
+def get_file_idempotency_key(bucket_name, file_key, etag):
+    # The ETag identifies the content, so that a file overwritten with new data is processed again
+    if not etag:
+        return None
+    etag = etag.strip('"')
+    return f"poster_file@@{bucket_name}/{file_key}@@{etag}"
+
+
+def get_line_idempotency_key(idempotency_key, index):
+    # A line of a compacted file, only completed when the message of the file is retried, see get_completed_files()
+    return f"{idempotency_key}#{index}"
+
+
+def get_completed_files(idempotency_keys):
+    """
+    Returns the keys of the files already processed, with one round trip. An empty set if Redis is unavailable.
+    """
+    file_states = get_redis_values(idempotency_keys)
+    return {idempotency_key for idempotency_key, file_state in file_states.items()
+            if file_state.get("state") == FILE_STATE_DONE}
+
+
+def claim_file(idempotency_key):
+    """
+    Claims the file for this invocation with an atomic set-if-absent. Returns FILE_STATE_CLAIMED if the file is to be
+    processed, else the state left by the delivery that claimed it first: FILE_STATE_IN_PROGRESS or FILE_STATE_DONE.
+    """
+    claim = set_redis_value_if_absent(idempotency_key, {"state": FILE_STATE_IN_PROGRESS, "claimed_at": int(time.time())},
+                                      FILE_IN_PROGRESS_TTL)
+    if claim is None:
+        LOGGER.warning(f"Redis is unavailable, processing the file: '{idempotency_key}' without the duplicate check.")
+        return FILE_STATE_CLAIMED
+
+    claimed, file_state = claim
+    if claimed or not file_state:
+        return FILE_STATE_CLAIMED
+    return file_state["state"]
+
+
+def complete_files(idempotency_keys):
+    # Called for the files of the whole batch once their data was sent, with one pipelined SET
+    completed_at = int(time.time())
+    set_redis_values({idempotency_key: {"state": FILE_STATE_DONE, "completed_at": completed_at}
+                      for idempotency_key in idempotency_keys}, FILE_DONE_TTL)
+
+
+def release_file(idempotency_key):
+    # The file was not processed, let the next delivery of the message claim it again
+    delete_redis_key(idempotency_key)
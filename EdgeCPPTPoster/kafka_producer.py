@@ -0,0 +1,132 @@
+import os
+import ast
+import json
+import threading
+
+import boto3
+import utility as util
+from kafka import KafkaProducer
+from utilities.secrets_utility import get_cached_secret
+
+LOGGER = util.get_logger(__name__)
+
+MSK_SECRET_ARN = os.environ['mskSecretArn']
+MSK_CLUSTER_ARN = os.environ['mskClusterArn']
+KAFKA_API_VERSION_TUPLE = ast.literal_eval(os.environ["KafkaApiVersionTuple"])
+KAFKA_LINGER_MS = int(os.getenv("KafkaLingerMs", 50))
+KAFKA_BATCH_SIZE = int(os.getenv("KafkaBatchSize", 256 * 1024))
+KAFKA_COMPRESSION_TYPE = os.getenv("KafkaCompressionType", "lz4")
+KAFKA_FLUSH_TIMEOUT = int(os.getenv("KafkaFlushTimeout", 30))
+# How the producer authenticates to the MSK cluster, the broker string is the key of the GetBootstrapBrokers response
+# that matches the security protocol and the SASL mechanism
+KAFKA_SECURITY_PROTOCOL = os.getenv("KafkaSecurityProtocol", "SASL_SSL")
+KAFKA_SASL_MECHANISM = os.getenv("KafkaSaslMechanism", "SCRAM-SHA-512")
+KAFKA_BOOTSTRAP_BROKER_STRING = os.getenv("KafkaBootstrapBrokerString", "BootstrapBrokerStringSaslScram")
+
+# One producer per container, it is thread safe and is shared by the worker threads of the batch
+PRODUCER_LOCK = threading.Lock()
+PRODUCER = None
+PENDING_DELIVERIES = []  # [(future, _KafkaDelivery)] of the messages sent since the last flush
+
+
+def _create_producer():
+    # MSK only accepts SCRAM secrets made of the 'username' and 'password' of the cluster user
+    secret = get_cached_secret(MSK_SECRET_ARN)
+    kafka_client = boto3.client('kafka')
+    bootstrap_brokers = kafka_client.get_bootstrap_brokers(ClusterArn=MSK_CLUSTER_ARN)[KAFKA_BOOTSTRAP_BROKER_STRING]
+
+    LOGGER.info(f"Creating Kafka producer with security_protocol: {KAFKA_SECURITY_PROTOCOL}, sasl_mechanism: "
+                f"{KAFKA_SASL_MECHANISM}, linger_ms: {KAFKA_LINGER_MS}, batch_size: {KAFKA_BATCH_SIZE}, "
+                f"compression_type: {KAFKA_COMPRESSION_TYPE}")
+    return KafkaProducer(bootstrap_servers=bootstrap_brokers.split(","),
+                         security_protocol=KAFKA_SECURITY_PROTOCOL,
+                         sasl_mechanism=KAFKA_SASL_MECHANISM,
+                         sasl_plain_username=secret['username'],
+                         sasl_plain_password=secret['password'],
+                         api_version=KAFKA_API_VERSION_TUPLE,
+                         linger_ms=KAFKA_LINGER_MS,
+                         batch_size=KAFKA_BATCH_SIZE,
+                         compression_type=KAFKA_COMPRESSION_TYPE,
+                         key_serializer=lambda key: str(key).encode('utf-8'),
+                         value_serializer=lambda value: json.dumps(value).encode('utf-8'))
+
+
+def get_kafka_producer():
+    global PRODUCER
+    with PRODUCER_LOCK:
+        if PRODUCER is None:
+            PRODUCER = _create_producer()
+        return PRODUCER
+
+
+def reset_kafka_producer():
+    global PRODUCER
+    with PRODUCER_LOCK:
+        producer, PRODUCER = PRODUCER, None
+    if producer is not None:
+        try:
+            producer.close(timeout=0)
+        except Exception as close_exception:
+            LOGGER.error(f"An error occurred while closing the Kafka producer: {close_exception}")
+
+
+def publish_to_kafka(topic, device_id, message, on_delivery):
+    """
+    Sends the message keyed by the device ID, so that the messages of one device stay in order within a partition.
+    'on_delivery' is called with None once the message is acknowledged or with the error message if it failed.
+    """
+    try:
+        future = get_kafka_producer().send(topic, key=device_id, value=message)
+    except Exception as send_exception:
+        reset_kafka_producer()
+        on_delivery(f"Error while publishing the message to cluster: {send_exception}")
+        return
+
+    delivery = _KafkaDelivery(on_delivery)
+    future.add_callback(delivery.succeeded)
+    future.add_errback(delivery.failed)
+    with PRODUCER_LOCK:
+        PENDING_DELIVERIES.append((future, delivery))
+
+
+def flush_kafka_producer():
+    with PRODUCER_LOCK:
+        producer = PRODUCER
+        pending_deliveries = PENDING_DELIVERIES[:]
+        del PENDING_DELIVERIES[:]
+    if producer is None or not pending_deliveries:
+        return
+
+    try:
+        producer.flush(timeout=KAFKA_FLUSH_TIMEOUT)
+    except Exception as flush_exception:
+        LOGGER.error(f"An error occurred while flushing the Kafka producer: {flush_exception}")
+        reset_kafka_producer()
+
+    # Messages still not acknowledged after the flush are reported as failed
+    for future, delivery in pending_deliveries:
+        if not future.is_done:
+            delivery.failed(f"the message was not acknowledged within {KAFKA_FLUSH_TIMEOUT} seconds")
+
+
+class _KafkaDelivery:
+
+    def __init__(self, on_delivery):
+        self._on_delivery = on_delivery
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def _report(self, error_message):
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+        self._on_delivery(error_message)
+
+    def succeeded(self, record_metadata):
+        LOGGER.debug(f"Kafka message delivered to partition: {record_metadata.partition}, "
+                     f"offset: {record_metadata.offset}")
+        self._report(None)
+
+    def failed(self, error):
+        self._report(f"Error while publishing the message to cluster: {error}")
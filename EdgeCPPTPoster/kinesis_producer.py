@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import threading
+
+import utility as util
+from utilities.kinesis_utility import get_kinesis_client, invalidate_role_credentials
+
+LOGGER = util.get_logger(__name__)
+
+# Kinesis PutRecords limits, the partition key counts towards the size of each record
+MAX_RECORD_BYTES = 1024 * 1024
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_ATTEMPTS = int(os.getenv("MaxAttempts", 3))
+
+PRODUCERS_LOCK = threading.Lock()
+PRODUCERS = {}  # (stream_arn, role_arn, region) -> KinesisProducer
+
+
+def serialize_payload(json_body):
+    # Compact separators, pretty printing only inflates the record size
+    return json.dumps(json_body, separators=(",", ":")).encode('utf-8')
+
+
+def split_payload(json_body, partition_key):
+    """
+    Serializes the file into one or more records that each fit in a Kinesis record. Files that are too large are split
+    by their samples, every part keeps the file's metadata and the same partition key.
+    """
+    payload = serialize_payload(json_body)
+    if len(payload) + len(partition_key.encode('utf-8')) <= MAX_RECORD_BYTES:
+        return [payload]
+
+    samples = json_body["samples"] if "samples" in json_body else []
+    if len(samples) < 2:
+        raise ValueError(f"The payload of {len(payload)} bytes exceeds the Kinesis record limit and cannot be split")
+
+    LOGGER.info(f"Splitting the payload of {len(payload)} bytes with {len(samples)} samples")
+    middle = len(samples) // 2
+    payloads = []
+    for samples_part in [samples[:middle], samples[middle:]]:
+        json_body_part = dict(json_body, samples=samples_part)
+        if "numberOfSamples" in json_body_part:
+            json_body_part["numberOfSamples"] = len(samples_part)
+        payloads.extend(split_payload(json_body_part, partition_key))
+    return payloads
+
+
+class _FileDelivery:
+    """
+    Tracks the records of one file, the callback is called once all of them are delivered or have failed.
+    """
+
+    def __init__(self, on_delivery, record_count):
+        self._on_delivery = on_delivery
+        self._pending = record_count
+        self._error_message = None
+        self._lock = threading.Lock()
+
+    def record_done(self, error_message=None):
+        with self._lock:
+            self._pending -= 1
+            self._error_message = self._error_message or error_message
+            if self._pending:
+                return
+        self._on_delivery(self._error_message)
+
+
+class KinesisProducer:
+    """
+    Buffers the records of an SQS batch and sends them with PutRecords, retrying only the entries that failed.
+    """
+
+    def __init__(self, stream_arn, role_arn, region, max_attempts=MAX_ATTEMPTS):
+        self.stream_arn = stream_arn
+        self.role_arn = role_arn
+        self.region = region
+        self.max_attempts = max_attempts
+        self._buffer = []  # [(payload, partition_key, _FileDelivery)]
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, json_body, partition_key, on_delivery):
+        try:
+            payloads = split_payload(json_body, partition_key)
+        except ValueError as error:
+            on_delivery(str(error))
+            return
+
+        delivery = _FileDelivery(on_delivery, len(payloads))
+        full_batches = []
+        with self._lock:
+            for payload in payloads:
+                record_bytes = len(payload) + len(partition_key.encode('utf-8'))
+                if len(self._buffer) >= MAX_BATCH_RECORDS or self._buffer_bytes + record_bytes > MAX_BATCH_BYTES:
+                    full_batches.append(self._drain())
+                self._buffer.append((payload, partition_key, delivery))
+                self._buffer_bytes += record_bytes
+
+        # The full batches are sent outside the lock so the other workers can keep buffering
+        for batch in full_batches:
+            self._send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._drain()
+        self._send(batch)
+
+    def _drain(self):
+        batch = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        return batch
+
+    def _send(self, batch):
+        attempts = 0
+        error_message = None
+
+        while batch and attempts < self.max_attempts:
+            time.sleep(2 * attempts / 10)  # Sleep for 200 ms exponentially
+            attempts += 1
+            try:
+                kinesis = get_kinesis_client(self.role_arn, self.region)
+                response = kinesis.put_records(
+                    StreamARN=self.stream_arn,
+                    Records=[{"Data": payload, "PartitionKey": partition_key} for payload, partition_key, _ in batch])
+            except Exception as put_records_exception:
+                error_message = f"An Error Occurred while Streaming Data to Kinesis: {put_records_exception}"
+                LOGGER.error(error_message)
+                if "ExpiredToken" in str(put_records_exception):
+                    invalidate_role_credentials(self.role_arn)
+                continue
+
+            LOGGER.info(f"Kinesis PutRecords sent {len(batch)} records, "
+                        f"failed record count: {response.get('FailedRecordCount', 0)}")
+            failed_records = []
+            for record, record_response in zip(batch, response["Records"]):
+                if record_response.get("ErrorCode"):
+                    error_message = f"An Error Occurred while Streaming Data to Kinesis: " \
+                                    f"{record_response['ErrorCode']} {record_response.get('ErrorMessage')}"
+                    failed_records.append(record)
+                else:
+                    record[2].record_done()
+            batch = failed_records
+
+        for _, _, delivery in batch:
+            delivery.record_done(error_message)
+
+
+def get_kinesis_producer(stream_arn, role_arn, region):
+    with PRODUCERS_LOCK:
+        producer_key = (stream_arn, role_arn, region)
+        if producer_key not in PRODUCERS:
+            PRODUCERS[producer_key] = KinesisProducer(stream_arn, role_arn, region)
+        return PRODUCERS[producer_key]
+
+
+def flush_kinesis_producers():
+    with PRODUCERS_LOCK:
+        producers = list(PRODUCERS.values())
+    for producer in producers:
+        producer.flush()
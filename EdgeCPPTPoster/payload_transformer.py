@@ -0,0 +1,118 @@
+import re
+import datetime
+
+import utility as util
+from edge_shared_utilities.gps_utility import transform_gps_coordinate
+
+LOGGER = util.get_logger(__name__)
+
+TARGET_PT = "PT"
+TARGET_PCC = "PCC"
+TARGET_CD = "CD"
+
+FAULT_CODE_TYPES = ("activeFaultCodes", "inactiveFaultCodes", "pendingFaultCodes")
+PT_DEVICE_PARAMS = ("Latitude", "Longitude", "Altitude")
+# The order of the health parameters is the order of the write_health_parameter_to_database_v2() arguments
+HEALTH_PARAMS = ("CPU_temperature", "PMIC_temperature", "Latitude", "Longitude", "Altitude", "PDOP", "Satellites_Used",
+                 "LTE_RSSI", "LTE_RSCP", "LTE_RSRQ", "LTE_RSRP", "CPU_Usage_Level", "RAM_Usage_Level",
+                 "SNR_per_Satellite")
+SAMPLE_TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{1,6}Z")
+
+
+def set_extra_params(json_body, service_engine_model):
+    json_body['rel_smn'] = service_engine_model
+    if not ('equipmentId' in json_body and json_body['equipmentId']) and 'vin' in json_body and json_body['vin']:
+        json_body['equipmentId'] = json_body['vin']
+
+
+def _to_health_timestamp(sample_time_stamp):
+    # Same result as strptime('%Y-%m-%dT%H:%M:%S.%fZ') -> strftime('%Y-%m-%d %H:%M:%S') without parsing every sample
+    if SAMPLE_TIMESTAMP_PATTERN.fullmatch(sample_time_stamp):
+        return sample_time_stamp[:10] + " " + sample_time_stamp[11:19]
+    convert_timestamp = datetime.datetime.strptime(sample_time_stamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return datetime.datetime.strftime(convert_timestamp, '%Y-%m-%d %H:%M:%S')
+
+
+def get_device_health_row(converted_device_params, sample_time_stamp, device_id, esn):
+    """
+    Returns the arguments of write_health_parameter_to_database_v2() for the sample, None if it has no messageID.
+    """
+    if 'messageID' not in converted_device_params:
+        return None
+    return (converted_device_params['messageID'],
+            *[converted_device_params.get(health_param) for health_param in HEALTH_PARAMS],
+            _to_health_timestamp(sample_time_stamp), device_id, esn)
+
+
+def _transform_fault_codes(converted_fc_params, target):
+    for fc_param in converted_fc_params:
+        if target == TARGET_PT:
+            # PT only takes the active fault codes
+            fc_param.pop("inactiveFaultCodes", None)
+            fc_param.pop("pendingFaultCodes", None)
+        for fault_code_type in FAULT_CODE_TYPES:
+            for fault_code in fc_param.get(fault_code_type, ()):
+                if "count" in fault_code:
+                    fault_code["occurenceCount"] = str(fault_code.pop("count"))
+    return converted_fc_params
+
+
+def _has_gps_coordinates(converted_device_params):
+    return "Latitude" in converted_device_params and "Longitude" in converted_device_params
+
+
+def _transform_device_params(converted_device_params, target):
+    # The repeated co-ordinates of a file are de-obfuscated once, the others are served by the cache
+    if _has_gps_coordinates(converted_device_params):
+        converted_device_params["Latitude"], converted_device_params["Longitude"] = transform_gps_coordinate(
+            converted_device_params["Latitude"], converted_device_params["Longitude"], deobfuscate=True)
+
+    # PT only takes the position of the device
+    if target == TARGET_PT:
+        return {device_param.lower(): converted_device_params[device_param] for device_param in PT_DEVICE_PARAMS
+                if device_param in converted_device_params}
+    return converted_device_params
+
+
+def transform_payload(json_body, target, service_engine_model=None):
+    """
+    Applies the rules of the target to the file in place, visiting every sample once and de-obfuscating its GPS
+    co-ordinates on the way:
+    - PT: drops the inactive and pending fault codes and keeps only the latitude, longitude and altitude
+    - PCC: renames the fault code counts of every type, keeps all the device parameters and sets the extra params
+    - CD: leaves the samples as they are
+    Returns the device health rows collected on the same pass.
+    """
+    health_rows = []
+    if target == TARGET_PCC:
+        set_extra_params(json_body, service_engine_model)
+    if target == TARGET_CD or "samples" not in json_body:
+        return health_rows
+
+    device_id = json_body.get("telematicsDeviceId")
+    esn = json_body.get("componentSerialNumber")
+    for sample in json_body["samples"]:
+        if "convertedEquipmentFaultCodes" in sample:
+            fault_codes_params = _transform_fault_codes(sample["convertedEquipmentFaultCodes"], target)
+            if fault_codes_params:
+                sample["convertedEquipmentFaultCodes"] = fault_codes_params
+            else:
+                sample.pop("convertedEquipmentFaultCodes")
+
+        if "convertedDeviceParameters" in sample:
+            converted_device_params = sample["convertedDeviceParameters"]
+            # The health row takes the parameters as received, before the GPS co-ordinates are de-obfuscated
+            health_row = get_device_health_row(converted_device_params, sample["dateTimestamp"], device_id, esn)
+            if health_row:
+                health_rows.append(health_row)
+            else:
+                LOGGER.info(f"There is no messageId in Converted Device Parameter.")
+
+            device_params = _transform_device_params(converted_device_params, target)
+            if device_params:
+                sample["convertedDeviceParameters"] = device_params
+            else:
+                sample.pop("convertedDeviceParameters")
+
+    LOGGER.debug(f"Transformed {len(json_body['samples'])} samples for {target}")
+    return health_rows
@@ -1,17 +1,32 @@
 import os
 import json
 import boto3
+import datetime
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from utility import get_logger, write_to_audit_table
 import pt_poster
-from edge_sqs_utility_layer import sqs_send_message
+from utilities.metadata_emitter import emit_metadata_event
 
 LOGGER = get_logger(__name__)
 
-s3_resource = boto3.resource('s3')
 CDPTJ1939PostURL = os.environ["CDPTJ1939PostURL"]
 CDPTJ1939Header = os.environ["CDPTJ1939Header"]
 
+# 's3' writes the SDK files to the NGDI folder for the conversion lambda, 'invoke' hands them off to it directly
+CD_HANDOFF_MODE = os.getenv("CDHandoffMode", "s3").lower()
+NGDI_CONVERSION_LAMBDA = os.getenv("NGDIConversionLambda")
+# Keep a copy of the handed off files, outside of the NGDI folder so that it does not trigger the conversion again
+ARCHIVE_HANDED_OFF_FILES = os.getenv("ArchiveHandedOffFiles", "N").lower() == "y"
+# Lambda limits the payload of an asynchronous invocation to 256 KB, larger files still go through the NGDI folder
+CD_HANDOFF_MAX_PAYLOAD_BYTES = 256 * 1024
+
+lambda_client = boto3.client('lambda')
+NGDI_ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+NGDI_ARCHIVE_LOCK = threading.Lock()
+PENDING_NGDI_ARCHIVES = []  # (future, archive_key, j1939_data_type, device_id) waited for at the next flush
+
 
 def check_endpoint_file_exists(endpoint_bucket, endpoint_file):
     LOGGER.debug(f"Checking if endpoint file: '{endpoint_file}' exists in the bucket: '{endpoint_bucket}'...")
@@ -28,8 +43,60 @@ def get_cspec_req_id(sc_number):
     return config_spec_name, req_id
 
 
+def handoff_to_ngdi_conversion(bucket_name, ngdi_key, j1939_type, uuid, file_body):
+    """
+    Invokes the NGDI to CD conversion lambda asynchronously with the file in the payload, in place of the S3 write
+    and the S3 event that would trigger it. Returns False if the file has to go through the NGDI folder instead.
+    """
+    handoff = {
+        "source_bucket_name": bucket_name,
+        "file_key": ngdi_key,
+        "file_size": len(file_body),
+        "file_date_time": datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "metadata": {"j1939type": j1939_type, "uuid": uuid}
+    }
+    # The file is already serialized, it is spliced into the payload instead of being serialized again
+    payload = b'{"handoff": ' + json.dumps(handoff).encode() + b', "j1939_file": ' + file_body + b'}'
+    if len(payload) > CD_HANDOFF_MAX_PAYLOAD_BYTES:
+        LOGGER.info(f"The file: '{ngdi_key}' is too large to be handed off, posting it to the NGDI folder . . .")
+        return False
+
+    try:
+        response = lambda_client.invoke(FunctionName=NGDI_CONVERSION_LAMBDA, InvocationType='Event', Payload=payload)
+        if response['StatusCode'] != 202:
+            raise RuntimeError(f"The invocation returned the status code: {response['StatusCode']}")
+    except Exception as e:
+        LOGGER.warning(f"An Exception occurred while handing off the file: '{ngdi_key}', "
+                       f"posting it to the NGDI folder instead: {e}")
+        return False
+
+    LOGGER.info(f"Handed off the file: '{ngdi_key}' to the NGDI to CD conversion lambda")
+    return True
+
+
+def archive_ngdi_file(client, bucket_name, archive_key, file_body, metadata, j1939_data_type, device_id):
+    # The copy is not needed by the conversion, it is written in the background and waited for at the end of the batch
+    future = NGDI_ARCHIVE_EXECUTOR.submit(client.put_object, Bucket=bucket_name, Key=archive_key, Body=file_body,
+                                          Metadata=metadata)
+    with NGDI_ARCHIVE_LOCK:
+        PENDING_NGDI_ARCHIVES.append((future, archive_key, j1939_data_type, device_id))
+
+
+def flush_ngdi_archives():
+    with NGDI_ARCHIVE_LOCK:
+        pending_archives = list(PENDING_NGDI_ARCHIVES)
+        PENDING_NGDI_ARCHIVES.clear()
+
+    for future, archive_key, j1939_data_type, device_id in pending_archives:
+        exception = future.exception()
+        if exception:
+            error_message = f"An Exception occurred while archiving the file: '{archive_key}': {exception}"
+            LOGGER.error(error_message)
+            write_to_audit_table(j1939_data_type, error_message, device_id)
+
+
 def send_to_cd(bucket_name, key, json_format, client, j1939_type, endpoint_bucket, endpoint_file, use_endpoint_bucket,
-               json_body, uuid, sqs_message, j1939_data_type):
+               json_body, uuid, metadata_event, j1939_data_type):
     LOGGER.info(f"Received CD file for posting!")
 
     ngdi_key = key.replace("ConvertedFiles", "NGDI")
@@ -38,14 +105,25 @@ def send_to_cd(bucket_name, key, json_format, client, j1939_type, endpoint_bucke
         LOGGER.info(f"Posting to the bucket: '{bucket_name}' with key: '{ngdi_key}', "
                     f"for further processing to the CD Pipeline...")
 
+        # The NGDI to CD conversion streams the samples, so they have to come after the rest of the file
+        if "samples" in json_body:
+            json_body["samples"] = json_body.pop("samples")
+
         try:
-            post_to_ngdi_response = client.put_object(Bucket=bucket_name, Key=ngdi_key,
-                                                      Body=json.dumps(json_body).encode(),
-                                                      Metadata={'j1939type': j1939_type, 'uuid': uuid})
+            file_body = json.dumps(json_body).encode()
+            file_metadata = {'j1939type': j1939_type, 'uuid': uuid}
 
-            sqs_send_message(os.environ["metaWriteQueueUrl"], sqs_message)
+            if CD_HANDOFF_MODE == "invoke" and handoff_to_ngdi_conversion(bucket_name, ngdi_key, j1939_type, uuid,
+                                                                          file_body):
+                if ARCHIVE_HANDED_OFF_FILES:
+                    archive_ngdi_file(client, bucket_name, key.replace("ConvertedFiles", "ArchivedNGDI"), file_body,
+                                      file_metadata, j1939_data_type, json_body["telematicsDeviceId"])
+            else:
+                post_to_ngdi_response = client.put_object(Bucket=bucket_name, Key=ngdi_key, Body=file_body,
+                                                          Metadata=file_metadata)
+                LOGGER.info(f"Post CD File to NGDI Folder Response:{post_to_ngdi_response}")
 
-            LOGGER.info(f"Post CD File to NGDI Folder Response:{post_to_ngdi_response}")
+            emit_metadata_event(metadata_event)
         except Exception as e:
             error_message = f"An Exception occurred while posting the file to the NGDI folder: {e}"
             LOGGER.error(error_message)
@@ -59,6 +137,6 @@ def send_to_cd(bucket_name, key, json_format, client, j1939_type, endpoint_bucke
             endpoint_file_exists = check_endpoint_file_exists(endpoint_bucket, endpoint_file)
             LOGGER.debug(f"Endpoint File Exists: {endpoint_file_exists}")
         else:
-            sqs_message = sqs_message.replace("CD_PT_POSTED", "FILE_SENT")
-            pt_poster.send_to_pt(CDPTJ1939PostURL, CDPTJ1939Header, json_body, sqs_message, j1939_data_type, j1939_type, uuid, json_body["telematicsDeviceId"],
+            metadata_event = metadata_event._replace(data_pipeline_stage="FILE_SENT")
+            pt_poster.send_to_pt(CDPTJ1939PostURL, CDPTJ1939Header, json_body, metadata_event, j1939_data_type, j1939_type, uuid, json_body["telematicsDeviceId"],
                json_body["componentSerialNumber"])
@@ -1,15 +1,18 @@
 import os
 import json
 import boto3
-import datetime
+import functools
+import threading
 import requests
 import traceback
+from collections import namedtuple
 from utility import get_logger, write_to_audit_table
-from edge_sqs_utility_layer import sqs_send_message
-from edge_kafka_utility_layer import publish_message, create_irs_message
-from edge_secretsmanager_utility_layer import get_json_value_from_secrets_manager
+from utilities.metadata_emitter import emit_metadata_event
+from edge_kafka_utility_layer import create_irs_message
+from kafka_producer import publish_to_kafka, flush_kafka_producer  # noqa
+from utilities.secrets_utility import get_cached_secret
 
-from edge_gps_utility_layer import handle_gps_coordinates
+from payload_transformer import transform_payload, TARGET_PT
 from edge_db_simple_layer import write_health_parameter_to_database_v2
 
 LOGGER = get_logger(__name__)
@@ -17,114 +20,133 @@ secret_name = os.environ['PTxAPIKey']
 region_name = os.environ['Region']
 
 PT_TOPIC_INFO = os.environ["ptTopicInfo"]
-MSK_SECRET_ARN = os.environ['mskSecretArn']
-MSK_CLUSTER_ARN = os.environ['mskClusterArn']
-KAFKA_API_VERSION_TUPLE = os.environ["KafkaApiVersionTuple"]
-
-
-def handle_fc_params(converted_fc_params):
-    for fc_param in converted_fc_params:
-        if "activeFaultCodes" in fc_param:
-            for afc in fc_param["activeFaultCodes"]:
-                if "count" in afc:
-                    afc["occurenceCount"] = str(afc["count"])
-                    afc.pop("count")
-        if "inactiveFaultCodes" in fc_param:
-            fc_param.pop("inactiveFaultCodes")
-        if "pendingFaultCodes" in fc_param:
-            fc_param.pop("pendingFaultCodes")
-    LOGGER.debug(f"Converted FC Params: {converted_fc_params}")
-    return converted_fc_params
-
-
-def handle_hb_params(converted_device_params, ignore_params=True):
-    # De-obfuscate GPS co-ordinates
-    if "Latitude" in converted_device_params and "Longitude" in converted_device_params:
-        latitude = converted_device_params["Latitude"]
-        longitude = converted_device_params["Longitude"]
-        converted_device_params["Latitude"], converted_device_params["Longitude"] = \
-            handle_gps_coordinates(latitude, longitude, deobfuscate=True)
-
-    # Remove unnecessary params from device parameters for PT payload
-    if ignore_params:
-        converted_device_params = {key.lower(): value for key, value in converted_device_params.items() if
-                                   key in ["Latitude", "Longitude", "Altitude"]}
-    LOGGER.debug(f"Converted Device Params: {converted_device_params}")
-    return converted_device_params
-
-
-def store_device_health_params(converted_device_params, sample_time_stamp, device_id, esn):
-    if 'messageID' in converted_device_params:
-        message_id = converted_device_params['messageID']
-        cpu_temperature = converted_device_params['CPU_temperature'] \
-            if 'CPU_temperature' in converted_device_params else None
-        pmic_temperature = converted_device_params['PMIC_temperature'] \
-            if 'PMIC_temperature' in converted_device_params else None
-        latitude = converted_device_params['Latitude'] if 'Latitude' in converted_device_params else None
-        longitude = converted_device_params['Longitude'] if 'Longitude' in converted_device_params else None
-        altitude = converted_device_params['Altitude'] if 'Altitude' in converted_device_params else None
-        pdop = converted_device_params['PDOP'] if 'PDOP' in converted_device_params else None
-        satellites_used = converted_device_params['Satellites_Used'] \
-            if 'Satellites_Used' in converted_device_params else None
-        lte_rssi = converted_device_params['LTE_RSSI'] if 'LTE_RSSI' in converted_device_params else None
-        lte_rscp = converted_device_params['LTE_RSCP'] if 'LTE_RSCP' in converted_device_params else None
-        lte_rsrq = converted_device_params['LTE_RSRQ'] if 'LTE_RSRQ' in converted_device_params else None
-        lte_rsrp = converted_device_params['LTE_RSRP'] if 'LTE_RSRP' in converted_device_params else None
-        cpu_usage_level = converted_device_params['CPU_Usage_Level'] \
-            if 'CPU_Usage_Level' in converted_device_params else None
-        ram_usage_level = converted_device_params['RAM_Usage_Level'] \
-            if 'RAM_Usage_Level' in converted_device_params else None
-        snr_per_satellite = converted_device_params['SNR_per_Satellite'] \
-            if 'SNR_per_Satellite' in converted_device_params else None
-        convert_timestamp = datetime.datetime.strptime(sample_time_stamp, '%Y-%m-%dT%H:%M:%S.%fZ')
-        new_timestamp = datetime.datetime.strftime(convert_timestamp, '%Y-%m-%d %H:%M:%S')
-        write_health_parameter_to_database_v2(message_id, cpu_temperature, pmic_temperature, latitude, longitude,
-                                           altitude, pdop, satellites_used, lte_rssi, lte_rscp, lte_rsrq, lte_rsrp,
-                                           cpu_usage_level, ram_usage_level, snr_per_satellite, new_timestamp,
-                                           device_id, esn)
+PT_BATCH_SIZE = int(os.getenv("PTBatchSize", 10))
+PT_BATCH_MAX_BYTES = int(os.getenv("PTBatchMaxBytes", 5 * 1024 * 1024))
+
+# The PT-bound files of the SQS batch are posted together as one JSON array, grouped by the URL and the headers
+PendingPtFile = namedtuple("PendingPtFile", ["payload", "payload_size", "metadata_event", "j1939_data_type",
+                                             "device_id"])
+PT_BATCH_LOCK = threading.Lock()
+PENDING_PT_FILES = {}  # (post_url, headers) -> [PendingPtFile] posted at the next flush
+
+
+def write_device_health_rows(health_rows):
+    for health_row in health_rows:
+        write_health_parameter_to_database_v2(*health_row)
+
+
+def set_pt_api_key(headers_json, force_refresh=False):
+    get_secret_value_response = get_cached_secret(secret_name, force_refresh=force_refresh)
+    if get_secret_value_response:
+        headers_json['x-api-key'] = get_secret_value_response['x-api-key']
     else:
-        LOGGER.info(f"There is no messageId in Converted Device Parameter.")
+        LOGGER.error(f"PT x-api-key not exist in secret manager")
 
 
-def send_to_pt(post_url, headers, json_body, sqs_message_template, j1939_data_type, j1939_type, file_uuid, device_id,
-               esn):
+def _post_to_pt(post_url, headers_json, pt_payload):
+    pt_response = requests.post(url=post_url, data=pt_payload, headers=headers_json)
+    if pt_response.status_code in [401, 403]:
+        # The cached x-api-key was rejected, it may have been rotated
+        LOGGER.info(f"PT rejected the x-api-key with {pt_response.status_code}, refreshing it . . .")
+        set_pt_api_key(headers_json, force_refresh=True)
+        pt_response = requests.post(url=post_url, data=pt_payload, headers=headers_json)
+    pt_response_body = pt_response.json()
+    LOGGER.debug(f"Post to PT response code: {pt_response.status_code}, body: {pt_response_body}")
+    return pt_response_body
+
+
+def _is_pt_success(pt_response_body):
+    return isinstance(pt_response_body, dict) and pt_response_body.get("statusCode") == 200
+
+
+def post_pt_files(post_url, headers, pt_files):
+    """
+    Posts the files as one JSON array, then sends the FILE_SENT metadata message or writes the audit entry of each
+    file. A response holding one result per file is mapped back to the files by position, otherwise the result of
+    the request applies to all of them. If PT rejects a batch as a whole, its files are posted one at a time so that
+    only the failing ones are audited.
+    """
     try:
         headers_json = json.loads(headers)
-        get_secret_value_response = get_json_value_from_secrets_manager(secret_name)
-        if get_secret_value_response:
-            api_key = get_secret_value_response['x-api-key']
-            headers_json['x-api-key'] = api_key
+        set_pt_api_key(headers_json)
+        pt_response_body = _post_to_pt(post_url, headers_json,
+                                       "[" + ",".join(pt_file.payload for pt_file in pt_files) + "]")
+    except Exception as e:
+        error_message = f"An exception occurred while posting to PT endpoint: {e}"
+        LOGGER.error(error_message)
+        traceback.print_exc()
+        for pt_file in pt_files:
+            write_to_audit_table(pt_file.j1939_data_type, error_message, pt_file.device_id)
+        return
+
+    if isinstance(pt_response_body, list) and len(pt_response_body) == len(pt_files):
+        pt_results = pt_response_body
+    elif len(pt_files) > 1 and not _is_pt_success(pt_response_body):
+        LOGGER.warning(f"PT rejected the batch of {len(pt_files)} files: {pt_response_body}, "
+                       f"posting them one at a time . . .")
+        for pt_file in pt_files:
+            post_pt_files(post_url, headers, [pt_file])
+        return
+    else:
+        pt_results = [pt_response_body] * len(pt_files)
+
+    for pt_file, pt_result in zip(pt_files, pt_results):
+        if _is_pt_success(pt_result):
+            emit_metadata_event(pt_file.metadata_event._replace(data_pipeline_stage="FILE_SENT"))
         else:
-            LOGGER.error(f"PT x-api-key not exist in secret manager")
-
-        if "samples" in json_body:
-            for sample in json_body["samples"]:
-                if "convertedEquipmentFaultCodes" in sample:
-                    converted_fc_params = sample["convertedEquipmentFaultCodes"]
-                    fault_codes_params = handle_fc_params(converted_fc_params)
-                    if fault_codes_params:
-                        sample["convertedEquipmentFaultCodes"] = fault_codes_params
-                    else:
-                        sample.pop("convertedEquipmentFaultCodes")
-                if "convertedDeviceParameters" in sample:
-                    converted_device_params = sample["convertedDeviceParameters"]
-                    store_device_health_params(converted_device_params, sample["dateTimestamp"],
-                                               json_body["telematicsDeviceId"], json_body["componentSerialNumber"])
-                    device_health_params = handle_hb_params(converted_device_params)
-                    if device_health_params:
-                        sample["convertedDeviceParameters"] = device_health_params
-                    else:
-                        sample.pop("convertedDeviceParameters")
+            LOGGER.error(f"ERROR! Posting PT : {pt_result}")
+            write_to_audit_table(pt_file.j1939_data_type, pt_result, pt_file.device_id)
+
+
+def queue_pt_file(post_url, headers, pt_payload, metadata_event, j1939_data_type, device_id):
+    """
+    Adds the serialized file to the PT batch of its URL and headers. The batch is posted by the calling thread once it
+    holds PT_BATCH_SIZE files, or before the file is added if it would exceed PT_BATCH_MAX_BYTES.
+    """
+    batch_key = (post_url, headers)
+    pt_file = PendingPtFile(pt_payload, len(pt_payload.encode('utf-8')), metadata_event, j1939_data_type, device_id)
+    full_batches = []
+    with PT_BATCH_LOCK:
+        pt_files = PENDING_PT_FILES.get(batch_key)
+        if pt_files and sum(pending_file.payload_size + 1 for pending_file in pt_files) + pt_file.payload_size + 1 \
+                > PT_BATCH_MAX_BYTES:
+            full_batches.append(PENDING_PT_FILES.pop(batch_key))
+        pt_files = PENDING_PT_FILES.setdefault(batch_key, [])
+        pt_files.append(pt_file)
+        if len(pt_files) >= PT_BATCH_SIZE:
+            full_batches.append(PENDING_PT_FILES.pop(batch_key))
+
+    for pt_files in full_batches:
+        post_pt_files(post_url, headers, pt_files)
+
+
+def flush_pt_files():
+    with PT_BATCH_LOCK:
+        pending_batches = list(PENDING_PT_FILES.items())
+        PENDING_PT_FILES.clear()
+
+    for (post_url, headers), pt_files in pending_batches:
+        LOGGER.info(f"Posting the batch of {len(pt_files)} files to PT . . .")
+        post_pt_files(post_url, headers, pt_files)
+
+
+def handle_kafka_delivery(j1939_data_type, device_id, error_message):
+    if error_message:
+        LOGGER.error(error_message)
+        write_to_audit_table(j1939_data_type, error_message, device_id)
+
+
+def send_to_pt(post_url, headers, json_body, metadata_event, j1939_data_type, j1939_type, file_uuid, device_id, esn):
+    try:
+        write_device_health_rows(transform_payload(json_body, TARGET_PT))
 
         # We are not sending payload to PT for Digital Cockpit Device
         if json_body["telematicsDeviceId"] != '192000000000101':
-            final_json_body = [json_body]
              # Send to Cluster
             if os.environ['publishKafka'].lower() == "true":
                 # file_sent 
 
-                file_sent_sqs_message = sqs_message_template \
-                    .replace("{FILE_METADATA_FILE_STAGE}", "FILE_SENT")
+                file_sent_metadata_event = metadata_event._replace(data_pipeline_stage="FILE_SENT")
                 topicInformation = json.loads(PT_TOPIC_INFO)
                 LOGGER.debug(f"topicInformation :{topicInformation}")
 
@@ -132,34 +154,18 @@ def send_to_pt(post_url, headers, json_body, sqs_message_template, j1939_data_ty
                 file_type = topicInformation["file_type"]
                 bu = topicInformation["bu"]
                 kafka_message = create_irs_message(file_uuid, json_body, device_id, esn, topic, file_type, bu,
-                                                      file_sent_sqs_message)
+                                                      file_sent_metadata_event.to_message())
                 LOGGER.debug(f"Data sent with IRS with kafka message :{kafka_message}, topic:{topic},fileType:{file_type},bu:{bu}")
 
-
-                try:
-                    publish_message(MSK_SECRET_ARN, MSK_CLUSTER_ARN, topic, kafka_message, kafka_args={'api_version': eval(KAFKA_API_VERSION_TUPLE)})
-                except Exception as e:
-                    error_message = f"Error while publishing the message to cluster: {e}"
-                    LOGGER.error(error_message)
-                    write_to_audit_table(j1939_data_type, error_message, kafka_message["telematicsDeviceId"])
+                # The long-lived producer batches the messages, they are flushed at the end of the SQS batch
+                publish_to_kafka(topic, device_id, kafka_message,
+                                 functools.partial(handle_kafka_delivery, j1939_data_type,
+                                                   kafka_message["telematicsDeviceId"]))
             else:
                 LOGGER.info("Data sent without IRS")
-                # file_sent with curdatetime
-                current_dt = datetime.datetime.now()
-                file_sent_sqs_message = sqs_message_template \
-                    .replace("{FILE_METADATA_CURRENT_DATE_TIME}",
-                             current_dt.strftime('%Y-%m-%d %H:%M:%S')) \
-                    .replace("{FILE_METADATA_FILE_STAGE}", "FILE_SENT")
-                pt_response = requests.post(url=post_url, data=json.dumps(final_json_body), headers=headers_json)
-                pt_response_body = pt_response.json()
-                pt_response_code = pt_response.status_code
-                LOGGER.debug(f"Post to PT response code: {pt_response_code}, body: {pt_response_body}")
-
-                if "statusCode" in pt_response_body and pt_response_body["statusCode"] == 200:
-                    sqs_send_message(os.environ["metaWriteQueueUrl"], file_sent_sqs_message)
-                else:
-                    LOGGER.error(f"ERROR! Posting PT : {pt_response_body}")
-                    write_to_audit_table(j1939_data_type, pt_response_body, json_body["telematicsDeviceId"])
+                # Posted together with the other PT files of the SQS batch, FILE_SENT is sent once PT accepted it
+                queue_pt_file(post_url, headers, json.dumps(json_body), metadata_event, j1939_data_type,
+                              json_body["telematicsDeviceId"])
 
     except Exception as e:
         error_message = f"An exception occurred while posting to PT endpoint: {e}"
@@ -0,0 +1,81 @@
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+
+    from utilities import circuit_breaker
+
+
+@patch("utilities.circuit_breaker.time.monotonic")
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Test module for utilities/circuit_breaker.py
+    """
+
+    def setUp(self):
+        self.breaker = circuit_breaker.CircuitBreaker("redis", failure_threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self, mock_monotonic):
+        """
+        Test for the breaker opening after 'failure_threshold' consecutive failures and logging the state change.
+        """
+        mock_monotonic.return_value = 100
+
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+        circuit_breaker.LOGGER.warning.assert_called()
+        self.assertIn("CircuitBreakerStateChange", circuit_breaker.LOGGER.warning.call_args[0][0])
+
+    def test_half_open_probe_closes_breaker(self, mock_monotonic):
+        """
+        Test for the breaker letting a single probe through after the reset timeout and closing on its success.
+        """
+        mock_monotonic.return_value = 100
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        mock_monotonic.return_value = 131
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.breaker.state, circuit_breaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.record_success()
+
+        self.assertEqual(self.breaker.state, circuit_breaker.CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_half_open_probe_failure_reopens_breaker(self, mock_monotonic):
+        """
+        Test for a failed probe opening the breaker for another reset timeout.
+        """
+        mock_monotonic.return_value = 100
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        mock_monotonic.return_value = 131
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, circuit_breaker.OPEN)
+        mock_monotonic.return_value = 160
+        self.assertFalse(self.breaker.allow_request())
+        mock_monotonic.return_value = 162
+        self.assertTrue(self.breaker.allow_request())
+
+
+if __name__ == '__main__':
+    unittest.main()
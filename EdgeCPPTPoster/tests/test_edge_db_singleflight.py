@@ -0,0 +1,106 @@
+import sys
+import time
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("edge_db_lambda_client")
+
+    from utilities import edge_db_singleflight
+
+
+class TestEdgeDbSingleflight(unittest.TestCase):
+    """
+    Test module for edge_db_singleflight.py
+    """
+
+    def _execute_concurrently(self, edge_db_client, query, number_of_callers, **kwargs):
+        results = [None] * number_of_callers
+
+        def _execute(index):
+            results[index] = edge_db_client.execute(query, **kwargs)
+
+        threads = [threading.Thread(target=_execute, args=(index,)) for index in range(number_of_callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_execute_identical_queries_share_one_execution(self):
+        """
+        Test for execute() running identical concurrent queries once and giving each caller its own result.
+        """
+        release_query = threading.Event()
+        mock_edge_db_client = MagicMock()
+        mock_edge_db_client.execute.side_effect = lambda query: release_query.wait() and [{"device_owner": "PSBU"}]
+        edge_db_client = edge_db_singleflight.SingleflightEdgeDbClient(mock_edge_db_client)
+
+        threads, results = self._execute_concurrently(edge_db_client, "SELECT 1", 5)
+        for _ in range(1000):
+            in_flight_queries = list(edge_db_client._in_flight.values())
+            if in_flight_queries and in_flight_queries[0].followers == 4:
+                break
+            time.sleep(0.001)
+        release_query.set()
+        for thread in threads:
+            thread.join()
+
+        mock_edge_db_client.execute.assert_called_once_with("SELECT 1")
+        self.assertEqual(results, [[{"device_owner": "PSBU"}]] * 5)
+        self.assertEqual(len({id(result) for result in results}), 5)
+
+    def test_execute_writes_not_shared(self):
+        """
+        Test for execute() always running the writes and the calls that opted out.
+        """
+        mock_edge_db_client = MagicMock()
+        edge_db_client = edge_db_singleflight.SingleflightEdgeDbClient(mock_edge_db_client)
+        edge_db_client._in_flight[("UPDATE 1", (), (("method", "WRITE"),))] = MagicMock()
+        edge_db_client._in_flight[("SELECT 1", (), ())] = MagicMock()
+
+        edge_db_client.execute("UPDATE 1", method="WRITE")
+        edge_db_client.execute("SELECT 1", singleflight=False)
+
+        self.assertEqual(mock_edge_db_client.execute.call_count, 2)
+        mock_edge_db_client.execute.assert_called_with("SELECT 1")
+
+    def test_execute_error_raised_and_not_cached(self):
+        """
+        Test for execute() raising the error of the query and running the query again on the next call.
+        """
+        mock_edge_db_client = MagicMock()
+        mock_edge_db_client.execute.side_effect = [Exception("Mock db exception"), [{"test": "value"}]]
+        edge_db_client = edge_db_singleflight.SingleflightEdgeDbClient(mock_edge_db_client)
+
+        with self.assertRaises(Exception):
+            edge_db_client.execute("SELECT 1")
+
+        self.assertEqual(edge_db_client.execute("SELECT 1"), [{"test": "value"}])
+
+    @patch("utilities.edge_db_singleflight.LOGGER")
+    def test_log_metrics_per_query_shape(self, mock_logger):
+        """
+        Test for log_metrics() logging the queries grouped by their shape and resetting the metrics.
+        """
+        edge_db_client = edge_db_singleflight.SingleflightEdgeDbClient(MagicMock())
+
+        edge_db_client.execute("SELECT * FROM device_information WHERE device_id = '1' AND attempts = 2")
+        edge_db_client.execute("SELECT * FROM device_information WHERE device_id = '2' AND attempts = 3")
+        edge_db_client.log_metrics()
+        edge_db_client.log_metrics()
+
+        mock_logger.info.assert_called_once()
+        self.assertIn('"query_shape": "SELECT * FROM device_information WHERE device_id = ? AND attempts = ?"',
+                      mock_logger.info.call_args[0][0])
+        self.assertIn('"executed": 2', mock_logger.info.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
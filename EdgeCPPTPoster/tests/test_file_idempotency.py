@@ -0,0 +1,87 @@
+import sys
+import unittest
+from unittest.mock import patch, ANY
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("utilities.redis_utility")
+
+    import file_idempotency
+
+
+class TestFileIdempotency(unittest.TestCase):
+    """
+    Test module for file_idempotency.py
+    """
+
+    def test_get_file_idempotency_key_successful(self):
+        """
+        Test for get_file_idempotency_key() keying the file by its S3 key and ETag.
+        """
+        self.assertEqual(file_idempotency.get_file_idempotency_key("bucket", "ConvertedFiles/file.json", '"etag"'),
+                         "poster_file@@bucket/ConvertedFiles/file.json@@etag")
+        self.assertIsNone(file_idempotency.get_file_idempotency_key("bucket", "ConvertedFiles/file.json", None))
+
+    @patch("file_idempotency.get_redis_values")
+    def test_get_completed_files_successful(self, mock_get_redis_values):
+        """
+        Test for get_completed_files() returning the keys of the lines of a compacted file that are DONE.
+        """
+        mock_get_redis_values.return_value = {"key#0": {"state": "DONE"}, "key#1": {"state": "IN_PROGRESS"}}
+
+        self.assertEqual(file_idempotency.get_completed_files(["key#0", "key#1", "key#2"]), {"key#0"})
+        self.assertEqual(file_idempotency.get_line_idempotency_key("key", 2), "key#2")
+
+    @patch("file_idempotency.set_redis_value_if_absent")
+    def test_claim_file_claimed(self, mock_set_redis_value_if_absent):
+        """
+        Test for claim_file() claiming a file delivered for the first time.
+        """
+        mock_set_redis_value_if_absent.return_value = (True, {"state": "IN_PROGRESS"})
+
+        self.assertEqual(file_idempotency.claim_file("key"), file_idempotency.FILE_STATE_CLAIMED)
+        mock_set_redis_value_if_absent.assert_called_with("key", {"state": "IN_PROGRESS", "claimed_at": ANY},
+                                                          file_idempotency.FILE_IN_PROGRESS_TTL)
+
+    @patch("file_idempotency.set_redis_value_if_absent")
+    def test_claim_file_duplicate(self, mock_set_redis_value_if_absent):
+        """
+        Test for claim_file() returning the state left by the delivery that claimed the file first.
+        """
+        for file_state in [file_idempotency.FILE_STATE_IN_PROGRESS, file_idempotency.FILE_STATE_DONE]:
+            mock_set_redis_value_if_absent.return_value = (False, {"state": file_state})
+
+            self.assertEqual(file_idempotency.claim_file("key"), file_state)
+
+    @patch("file_idempotency.set_redis_value_if_absent")
+    def test_claim_file_redis_unavailable(self, mock_set_redis_value_if_absent):
+        """
+        Test for claim_file() letting the file be processed when Redis is unavailable.
+        """
+        mock_set_redis_value_if_absent.return_value = None
+
+        self.assertEqual(file_idempotency.claim_file("key"), file_idempotency.FILE_STATE_CLAIMED)
+
+    @patch("file_idempotency.delete_redis_key")
+    @patch("file_idempotency.set_redis_values")
+    def test_complete_and_release_file(self, mock_set_redis_values, mock_delete_redis_key):
+        """
+        Test for complete_files() and release_file() running successfully.
+        """
+        file_idempotency.complete_files(["key", "other-key"])
+        file_idempotency.release_file("key")
+
+        mock_set_redis_values.assert_called_with({"key": {"state": "DONE", "completed_at": ANY},
+                                                  "other-key": {"state": "DONE", "completed_at": ANY}},
+                                                 file_idempotency.FILE_DONE_TTL)
+        mock_delete_redis_key.assert_called_with("key")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import sys
+import random
+import unittest
+from unittest.mock import patch
+
+sys.path.append('../')
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("edge_gps_utility_layer")
+    from edge_shared_utilities import gps_utility
+
+
+def scalar_gps_coordinates(latitude, longitude, deobfuscate=False):
+    # Stands in for the layer: any deterministic function of the pair, its type and the direction
+    offset = -0.5 if deobfuscate else 0.5
+    if isinstance(latitude, str):
+        return str(round(float(latitude) + offset, 7)), str(round(float(longitude) - offset, 7))
+    if isinstance(latitude, list):
+        return [latitude[0] + offset], [longitude[0] - offset]
+    if isinstance(latitude, int):
+        return latitude + int(offset * 2), longitude - int(offset * 2)
+    return round(latitude + offset, 7), round(longitude - offset, 7)
+
+
+class TestGpsUtility(unittest.TestCase):
+    """
+    Test module for edge_shared_utilities/gps_utility.py
+    """
+
+    def setUp(self):
+        gps_utility.clear_gps_cache()
+
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_transform_gps_coordinates_same_as_scalar_path(self, mock_handle_gps_coordinates):
+        """
+        Test for transform_gps_coordinates() giving the same pairs, of the same types, as handle_gps_coordinates() one
+        pair at a time.
+        """
+        mock_handle_gps_coordinates.side_effect = scalar_gps_coordinates
+        random_generator = random.Random(1939)
+        distinct_coordinates = [(round(random_generator.uniform(-90, 90), 7),
+                                 round(random_generator.uniform(-180, 180), 7)) for _ in range(50)]
+        distinct_coordinates += [(str(latitude), str(longitude)) for latitude, longitude in distinct_coordinates[:10]]
+        distinct_coordinates += [(1, 2), (1.0, 2.0), ("1", "2"), ([1.5], [2.5])]
+        coordinates = [random_generator.choice(distinct_coordinates) for _ in range(500)]
+
+        for deobfuscate in (False, True):
+            result = gps_utility.transform_gps_coordinates(coordinates, deobfuscate=deobfuscate)
+            # repr() tells 2 from 2.0, the pairs that only differ by their types are not served each other's result
+            self.assertEqual([repr(transformed_coordinate) for transformed_coordinate in result],
+                             [repr(scalar_gps_coordinates(latitude, longitude, deobfuscate=deobfuscate))
+                              for latitude, longitude in coordinates])
+
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_transform_gps_coordinates_repeated_pairs_transformed_once(self, mock_handle_gps_coordinates):
+        """
+        Test for transform_gps_coordinates() transforming every distinct pair once per direction.
+        """
+        mock_handle_gps_coordinates.side_effect = scalar_gps_coordinates
+        coordinates = [("39.2029", "-85.8867")] * 20 + [("39.2030", "-85.8867")] * 5
+
+        gps_utility.transform_gps_coordinates(coordinates)
+        gps_utility.transform_gps_coordinates(coordinates)
+        gps_utility.transform_gps_coordinates(coordinates, deobfuscate=True)
+
+        self.assertEqual(mock_handle_gps_coordinates.call_count, 4)
+
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_transform_gps_coordinate_shares_the_cache(self, mock_handle_gps_coordinates):
+        """
+        Test for transform_gps_coordinate() serving the pairs transformed by transform_gps_coordinates() from the cache.
+        """
+        mock_handle_gps_coordinates.side_effect = scalar_gps_coordinates
+
+        gps_utility.transform_gps_coordinates([("39.2029", "-85.8867")], deobfuscate=True)
+        result = gps_utility.transform_gps_coordinate("39.2029", "-85.8867", deobfuscate=True)
+
+        self.assertEqual(result, scalar_gps_coordinates("39.2029", "-85.8867", deobfuscate=True))
+        mock_handle_gps_coordinates.assert_called_once()
+
+    @patch('edge_shared_utilities.gps_utility.GPS_CACHE_SIZE', 2)
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_transform_gps_coordinates_least_recent_pair_evicted(self, mock_handle_gps_coordinates):
+        """
+        Test for transform_gps_coordinates() evicting the least recently used pair when the cache is full.
+        """
+        mock_handle_gps_coordinates.side_effect = scalar_gps_coordinates
+
+        gps_utility.transform_gps_coordinates([(1.0, 1.0), (2.0, 2.0), (1.0, 1.0), (3.0, 3.0)])
+        mock_handle_gps_coordinates.reset_mock()
+        gps_utility.transform_gps_coordinates([(1.0, 1.0), (2.0, 2.0)])
+
+        mock_handle_gps_coordinates.assert_called_once_with(2.0, 2.0, deobfuscate=False)
+
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_transform_gps_coordinates_error_raised_and_not_cached(self, mock_handle_gps_coordinates):
+        """
+        Test for transform_gps_coordinates() raising the error of the pair and transforming it again on the next call.
+        """
+        mock_handle_gps_coordinates.side_effect = [Exception("Invalid coordinates"), ("1.5", "2.5")]
+
+        with self.assertRaises(Exception):
+            gps_utility.transform_gps_coordinates([("1", "2")])
+
+        self.assertEqual(gps_utility.transform_gps_coordinates([("1", "2")]), [("1.5", "2.5")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+import sys
+import json
+import unittest
+from collections import namedtuple
+from unittest.mock import patch, MagicMock
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug",
+    "mskSecretArn": "mskSecretArn",
+    "mskClusterArn": "mskClusterArn",
+    "KafkaApiVersionTuple": "(2, 6, 0)",
+    "KafkaCompressionType": "zstd"
+}):
+    cda_module_mock_context.mock_module("boto3")
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("kafka")
+    cda_module_mock_context.mock_module("utilities.secrets_utility")
+
+    import kafka_producer
+
+RecordMetadata = namedtuple("RecordMetadata", ["topic", "partition", "offset"])
+
+
+class FakeFuture:
+
+    def __init__(self):
+        self.is_done = False
+        self._callbacks = []
+        self._errbacks = []
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def add_errback(self, errback):
+        self._errbacks.append(errback)
+
+    def success(self, record_metadata):
+        self.is_done = True
+        for callback in self._callbacks:
+            callback(record_metadata)
+
+    def failure(self, error):
+        self.is_done = True
+        for errback in self._errbacks:
+            errback(error)
+
+
+class FakeKafkaBroker:
+    """
+    In-process stand in for the MSK cluster. It mimics the KafkaProducer API: sent messages stay in flight until
+    flush() acknowledges them, the partition is derived from the key and the topics listed in 'failing_topics' fail.
+    """
+
+    def __init__(self, partitions=3, failing_topics=(), acknowledge_on_flush=True):
+        self.partitions = partitions
+        self.failing_topics = failing_topics
+        self.acknowledge_on_flush = acknowledge_on_flush
+        self.producer_kwargs = None
+        self.in_flight = []
+        self.log = {}  # (topic, partition) -> [(key, value)]
+        self.flush_count = 0
+
+    def __call__(self, **producer_kwargs):
+        self.producer_kwargs = producer_kwargs
+        return self
+
+    def send(self, topic, key=None, value=None):
+        future = FakeFuture()
+        self.in_flight.append((topic, self.producer_kwargs["key_serializer"](key),
+                               self.producer_kwargs["value_serializer"](value), future))
+        return future
+
+    def flush(self, timeout=None):
+        self.flush_count += 1
+        if not self.acknowledge_on_flush:
+            return
+        in_flight, self.in_flight = self.in_flight, []
+        for topic, key, value, future in in_flight:
+            if topic in self.failing_topics:
+                future.failure(Exception("UnknownTopicOrPartitionError"))
+                continue
+            partition = sum(key) % self.partitions
+            messages = self.log.setdefault((topic, partition), [])
+            messages.append((key, value))
+            future.success(RecordMetadata(topic, partition, len(messages) - 1))
+
+    def close(self, timeout=None):
+        pass
+
+
+class TestKafkaProducer(unittest.TestCase):
+    """
+    Test module for kafka_producer.py
+    """
+
+    def setUp(self):
+        self.broker = FakeKafkaBroker()
+        kafka_producer.PRODUCER = None
+        del kafka_producer.PENDING_DELIVERIES[:]
+        self.patchers = [
+            patch("kafka_producer.KafkaProducer", self.broker),
+            patch("kafka_producer.get_cached_secret",
+                  return_value={"username": "user", "password": "password"}),
+            patch("kafka_producer.boto3")
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        kafka_producer.boto3.client.return_value.get_bootstrap_brokers.return_value = {
+            "BootstrapBrokerStringSaslScram": "b-1:9096,b-2:9096"
+        }
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_get_kafka_producer_created_once(self):
+        """
+        Test for get_kafka_producer() creating one configured producer per container.
+        """
+        producer = kafka_producer.get_kafka_producer()
+
+        self.assertIs(producer, kafka_producer.get_kafka_producer())
+        kafka_producer.get_cached_secret.assert_called_once_with("mskSecretArn")
+        self.assertEqual(self.broker.producer_kwargs["bootstrap_servers"], ["b-1:9096", "b-2:9096"])
+        self.assertEqual(self.broker.producer_kwargs["api_version"], (2, 6, 0))
+        self.assertEqual(self.broker.producer_kwargs["compression_type"], "zstd")
+        self.assertEqual(self.broker.producer_kwargs["sasl_plain_username"], "user")
+
+    @patch("kafka_producer.KAFKA_SASL_MECHANISM", "SCRAM-SHA-256")
+    @patch("kafka_producer.KAFKA_BOOTSTRAP_BROKER_STRING", "BootstrapBrokerStringPublicSaslScram")
+    def test_get_kafka_producer_configured_authentication(self):
+        """
+        Test for get_kafka_producer() connecting with the configured SASL mechanism and bootstrap broker string.
+        """
+        kafka_producer.boto3.client.return_value.get_bootstrap_brokers.return_value = {
+            "BootstrapBrokerStringSaslScram": "b-1:9096",
+            "BootstrapBrokerStringPublicSaslScram": "b-1-public:9196"
+        }
+
+        kafka_producer.get_kafka_producer()
+
+        self.assertEqual(self.broker.producer_kwargs["bootstrap_servers"], ["b-1-public:9196"])
+        self.assertEqual(self.broker.producer_kwargs["security_protocol"], "SASL_SSL")
+        self.assertEqual(self.broker.producer_kwargs["sasl_mechanism"], "SCRAM-SHA-256")
+
+    def test_publish_message_serialized(self):
+        """
+        Test for publish_to_kafka() sending the message as UTF-8 JSON keyed by the device ID.
+        """
+        message = {"telematicsDeviceId": "device-1", "samples": [{"Latitude": 39.2, "Name": "Bénard"}]}
+
+        kafka_producer.publish_to_kafka("pt-topic", "device-1", message, MagicMock())
+
+        _, key, value, _ = self.broker.in_flight[0]
+        self.assertEqual(key, b"device-1")
+        self.assertEqual(json.loads(value.decode("utf-8")), message)
+
+    def test_publish_and_flush_delivered(self):
+        """
+        Test for publish_to_kafka() keeping the messages of a device in order on one partition until the flush.
+        """
+        on_delivery = MagicMock()
+
+        for sequence in range(3):
+            kafka_producer.publish_to_kafka("pt-topic", "device-1", {"sequence": sequence}, on_delivery)
+        on_delivery.assert_not_called()
+
+        kafka_producer.flush_kafka_producer()
+
+        self.assertEqual(len(self.broker.log), 1)
+        messages = list(self.broker.log.values())[0]
+        self.assertEqual([key for key, _ in messages], [b"device-1"] * 3)
+        self.assertEqual([json.loads(value)["sequence"] for _, value in messages], [0, 1, 2])
+        self.assertEqual(on_delivery.call_count, 3)
+        on_delivery.assert_called_with(None)
+
+    def test_publish_and_flush_failed(self):
+        """
+        Test for publish_to_kafka() reporting the failure of each message.
+        """
+        self.broker.failing_topics = ("missing-topic",)
+        delivered, failed = MagicMock(), MagicMock()
+
+        kafka_producer.publish_to_kafka("pt-topic", "device-1", {"sequence": 1}, delivered)
+        kafka_producer.publish_to_kafka("missing-topic", "device-1", {"sequence": 2}, failed)
+        kafka_producer.flush_kafka_producer()
+
+        delivered.assert_called_once_with(None)
+        failed.assert_called_once()
+        self.assertIn("UnknownTopicOrPartitionError", failed.call_args[0][0])
+
+    def test_flush_reports_unacknowledged_messages(self):
+        """
+        Test for flush_kafka_producer() reporting the messages that are still in flight after the flush.
+        """
+        self.broker.acknowledge_on_flush = False
+        on_delivery = MagicMock()
+
+        kafka_producer.publish_to_kafka("pt-topic", "device-1", {"sequence": 1}, on_delivery)
+        kafka_producer.flush_kafka_producer()
+
+        on_delivery.assert_called_once()
+        self.assertIn("not acknowledged", on_delivery.call_args[0][0])
+
+    def test_flush_without_messages(self):
+        """
+        Test for flush_kafka_producer() not flushing when nothing was published in the batch.
+        """
+        kafka_producer.get_kafka_producer()
+
+        kafka_producer.flush_kafka_producer()
+
+        self.assertEqual(self.broker.flush_count, 0)
+
+    def test_publish_send_exception(self):
+        """
+        Test for publish_to_kafka() reporting a send error and dropping the producer so the next message recreates it.
+        """
+        on_delivery = MagicMock()
+        kafka_producer.get_kafka_producer()
+        self.broker.send = MagicMock(side_effect=Exception("KafkaTimeoutError"))
+
+        kafka_producer.publish_to_kafka("pt-topic", "device-1", {"sequence": 1}, on_delivery)
+
+        self.assertIsNone(kafka_producer.PRODUCER)
+        on_delivery.assert_called_once()
+        self.assertIn("KafkaTimeoutError", on_delivery.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+import sys
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug",
+    "MaxAttempts": "3"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("utilities.kinesis_utility")
+
+    import kinesis_producer
+
+
+class FakeKinesisStream:
+    """
+    Local stand in for a Kinesis stream, the first 'failures' PutRecords entries are rejected as throttled.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.put_records_calls = []
+        self.records = []
+
+    def put_records(self, StreamARN, Records):  # noqa
+        self.put_records_calls.append(Records)
+        response_records = []
+        for record in Records:
+            if self.failures:
+                self.failures -= 1
+                response_records.append({"ErrorCode": "ProvisionedThroughputExceededException",
+                                         "ErrorMessage": "Rate exceeded"})
+            else:
+                self.records.append(record)
+                response_records.append({"SequenceNumber": str(len(self.records)), "ShardId": "shardId-000000000000"})
+        failed_record_count = len([record for record in response_records if "ErrorCode" in record])
+        return {"FailedRecordCount": failed_record_count, "Records": response_records}
+
+
+def _hb_file(device_id, number_of_samples, sample_size=10):
+    return {
+        "telematicsDeviceId": device_id,
+        "componentSerialNumber": "64200027",
+        "numberOfSamples": number_of_samples,
+        "samples": [{"dateTimestamp": "2024-01-17T05:54:00.503Z", "convertedDeviceParameters": {"pad": "x" * sample_size}}
+                    for _ in range(number_of_samples)]
+    }
+
+
+@patch("kinesis_producer.time.sleep", MagicMock())
+class TestKinesisProducer(unittest.TestCase):
+    """
+    Test module for kinesis_producer.py
+    """
+
+    def setUp(self):
+        self.stream = FakeKinesisStream()
+        self.get_kinesis_client_patcher = patch("kinesis_producer.get_kinesis_client", return_value=self.stream)
+        self.get_kinesis_client_patcher.start()
+
+    def tearDown(self):
+        self.get_kinesis_client_patcher.stop()
+
+    def test_split_payload_small_file(self):
+        """
+        Test for split_payload() keeping a file that fits in one record whole and compact.
+        """
+        json_body = _hb_file("123", 2)
+
+        payloads = kinesis_producer.split_payload(json_body, "123-J1939_HB")
+
+        self.assertEqual(payloads, [json.dumps(json_body, separators=(",", ":")).encode('utf-8')])
+
+    @patch("kinesis_producer.MAX_RECORD_BYTES", 1000)
+    def test_split_payload_large_file(self):
+        """
+        Test for split_payload() splitting an oversized file by sample.
+        """
+        json_body = _hb_file("123", 8, sample_size=200)
+
+        payloads = kinesis_producer.split_payload(json_body, "123-J1939_HB")
+        parts = [json.loads(payload) for payload in payloads]
+
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(all(len(payload) <= 1000 for payload in payloads))
+        self.assertEqual(sum(part["numberOfSamples"] for part in parts), 8)
+        self.assertEqual([sample for part in parts for sample in part["samples"]], json_body["samples"])
+        self.assertTrue(all(part["telematicsDeviceId"] == "123" for part in parts))
+
+    @patch("kinesis_producer.MAX_RECORD_BYTES", 100)
+    def test_put_single_sample_too_large(self):
+        """
+        Test for put() reporting a file that cannot be split below the record limit.
+        """
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        producer.put(_hb_file("123", 1, sample_size=200), "123-J1939_HB", on_delivery)
+        producer.flush()
+
+        on_delivery.assert_called_once()
+        self.assertIn("cannot be split", on_delivery.call_args[0][0])
+        self.assertEqual(self.stream.put_records_calls, [])
+
+    def test_put_batches_files_until_flush(self):
+        """
+        Test for put() buffering the files of a batch and flush() sending them with one PutRecords call.
+        """
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        for device_id in ["1", "2", "3"]:
+            producer.put(_hb_file(device_id, 1), device_id + "-J1939_HB", on_delivery)
+        on_delivery.assert_not_called()
+
+        producer.flush()
+
+        self.assertEqual(len(self.stream.put_records_calls), 1)
+        self.assertEqual([record["PartitionKey"] for record in self.stream.records],
+                         ["1-J1939_HB", "2-J1939_HB", "3-J1939_HB"])
+        self.assertEqual(on_delivery.call_count, 3)
+        on_delivery.assert_called_with(None)
+
+    @patch("kinesis_producer.MAX_BATCH_RECORDS", 2)
+    def test_put_sends_full_batch(self):
+        """
+        Test for put() sending the buffered records once the PutRecords record limit is reached.
+        """
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        for device_id in ["1", "2", "3"]:
+            producer.put(_hb_file(device_id, 1), device_id + "-J1939_HB", MagicMock())
+
+        self.assertEqual([len(records) for records in self.stream.put_records_calls], [2])
+        producer.flush()
+        self.assertEqual([len(records) for records in self.stream.put_records_calls], [2, 1])
+
+    def test_flush_retries_failed_records_only(self):
+        """
+        Test for flush() retrying only the entries that failed in a partially failed PutRecords call.
+        """
+        self.stream.failures = 1
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        producer.put(_hb_file("1", 1), "1-J1939_HB", on_delivery)
+        producer.put(_hb_file("2", 1), "2-J1939_HB", on_delivery)
+        producer.flush()
+
+        self.assertEqual([len(records) for records in self.stream.put_records_calls], [2, 1])
+        self.assertEqual([record["PartitionKey"] for record in self.stream.records], ["2-J1939_HB", "1-J1939_HB"])
+        self.assertEqual(on_delivery.call_count, 2)
+        on_delivery.assert_called_with(None)
+
+    def test_flush_reports_records_failing_every_attempt(self):
+        """
+        Test for flush() reporting the error of the files whose records failed on every attempt.
+        """
+        self.stream.failures = 3
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        producer.put(_hb_file("1", 1), "1-J1939_HB", on_delivery)
+        producer.flush()
+
+        self.assertEqual(len(self.stream.put_records_calls), 3)
+        on_delivery.assert_called_once()
+        self.assertIn("ProvisionedThroughputExceededException", on_delivery.call_args[0][0])
+
+    @patch("kinesis_producer.invalidate_role_credentials")
+    def test_flush_expired_token(self, mock_invalidate_role_credentials):
+        """
+        Test for flush() dropping the cached role credentials when Kinesis rejects them as expired.
+        """
+        self.stream.put_records = MagicMock(side_effect=[Exception("ExpiredTokenException"),
+                                                         {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1"}]}])
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        producer.put(_hb_file("1", 1), "1-J1939_HB", on_delivery)
+        producer.flush()
+
+        mock_invalidate_role_credentials.assert_called_once_with("role-arn")
+        on_delivery.assert_called_once_with(None)
+
+    @patch("kinesis_producer.MAX_RECORD_BYTES", 1000)
+    def test_split_file_delivered_once(self):
+        """
+        Test for a split file calling its delivery callback once, after all of its records were sent.
+        """
+        on_delivery = MagicMock()
+        producer = kinesis_producer.KinesisProducer("stream-arn", "role-arn", "us-east-1")
+
+        producer.put(_hb_file("1", 8, sample_size=200), "1-J1939_HB", on_delivery)
+        producer.flush()
+
+        self.assertGreater(len(self.stream.records), 1)
+        self.assertTrue(all(record["PartitionKey"] == "1-J1939_HB" for record in self.stream.records))
+        on_delivery.assert_called_once_with(None)
+
+    def test_get_kinesis_producer_and_flush(self):
+        """
+        Test for get_kinesis_producer() reusing one producer per stream and flush_kinesis_producers() flushing it.
+        """
+        producer = kinesis_producer.get_kinesis_producer("stream-arn", "role-arn", "us-east-1")
+        self.assertIs(producer, kinesis_producer.get_kinesis_producer("stream-arn", "role-arn", "us-east-1"))
+
+        producer.put(_hb_file("1", 1), "1-J1939_HB", MagicMock())
+        kinesis_producer.flush_kinesis_producers()
+
+        self.assertEqual(len(self.stream.records), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
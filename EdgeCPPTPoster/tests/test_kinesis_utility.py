@@ -0,0 +1,118 @@
+import sys
+import datetime
+import unittest
+from unittest.mock import patch, MagicMock
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("boto3")
+
+    from utilities import kinesis_utility
+
+
+def _credentials(access_key, expires_in_seconds):
+    return {
+        "AccessKeyId": access_key,
+        "SecretAccessKey": "secret-key",
+        "SessionToken": "session-token",
+        "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in_seconds)
+    }
+
+
+class TestKinesisUtility(unittest.TestCase):
+    """
+    Test module for utilities/kinesis_utility.py
+    """
+
+    def setUp(self):
+        kinesis_utility.ROLE_CREDENTIALS.clear()
+        kinesis_utility.KINESIS_CLIENTS.clear()
+
+    @patch("utilities.kinesis_utility.STS_CLIENT")
+    def test_get_role_credentials_cached(self, mock_sts_client):
+        """
+        Test for get_role_credentials() assuming the role only once while the credentials are valid.
+        """
+        mock_sts_client.assume_role.return_value = {"Credentials": _credentials("key-1", 3600)}
+
+        first_response = kinesis_utility.get_role_credentials("role-arn")
+        second_response = kinesis_utility.get_role_credentials("role-arn")
+
+        self.assertEqual(first_response["AccessKeyId"], "key-1")
+        self.assertIs(first_response, second_response)
+        mock_sts_client.assume_role.assert_called_once_with(RoleArn="role-arn",
+                                                            RoleSessionName="PCC_J1939_KinesisSession")
+
+    @patch("utilities.kinesis_utility.STS_CLIENT")
+    def test_get_role_credentials_refreshed_before_expiration(self, mock_sts_client):
+        """
+        Test for get_role_credentials() refreshing credentials that expire within the refresh window.
+        """
+        mock_sts_client.assume_role.side_effect = [{"Credentials": _credentials("key-1", 60)},
+                                                   {"Credentials": _credentials("key-2", 3600)}]
+
+        kinesis_utility.get_role_credentials("role-arn")
+        response = kinesis_utility.get_role_credentials("role-arn")
+
+        self.assertEqual(response["AccessKeyId"], "key-2")
+        self.assertEqual(mock_sts_client.assume_role.call_count, 2)
+
+    @patch("utilities.kinesis_utility.boto3")
+    @patch("utilities.kinesis_utility.get_role_credentials")
+    def test_get_kinesis_client_pooled_per_role_and_region(self, mock_get_role_credentials, mock_boto3):
+        """
+        Test for get_kinesis_client() reusing one client per (role ARN, region).
+        """
+        mock_get_role_credentials.return_value = _credentials("key-1", 3600)
+        mock_boto3.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        pcc_client = kinesis_utility.get_kinesis_client("pcc-role-arn", "us-east-1")
+        same_pcc_client = kinesis_utility.get_kinesis_client("pcc-role-arn", "us-east-1")
+        pcc2_client = kinesis_utility.get_kinesis_client("pcc2-role-arn", "us-east-1")
+
+        self.assertIs(pcc_client, same_pcc_client)
+        self.assertIsNot(pcc_client, pcc2_client)
+        self.assertEqual(mock_boto3.client.call_count, 2)
+        mock_boto3.client.assert_called_with("kinesis", aws_access_key_id="key-1",
+                                             aws_secret_access_key="secret-key",
+                                             aws_session_token="session-token",
+                                             region_name="us-east-1")
+
+    @patch("utilities.kinesis_utility.boto3")
+    @patch("utilities.kinesis_utility.get_role_credentials")
+    def test_get_kinesis_client_rebuilt_after_credentials_refresh(self, mock_get_role_credentials, mock_boto3):
+        """
+        Test for get_kinesis_client() building a new client once the role credentials were refreshed.
+        """
+        mock_get_role_credentials.side_effect = [_credentials("key-1", 3600), _credentials("key-2", 3600)]
+        mock_boto3.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        first_client = kinesis_utility.get_kinesis_client("role-arn", "us-east-1")
+        second_client = kinesis_utility.get_kinesis_client("role-arn", "us-east-1")
+
+        self.assertIsNot(first_client, second_client)
+        self.assertEqual(mock_boto3.client.call_count, 2)
+
+    def test_invalidate_role_credentials(self):
+        """
+        Test for invalidate_role_credentials() dropping the credentials and the clients of the role only.
+        """
+        kinesis_utility.ROLE_CREDENTIALS["role-arn"] = _credentials("key-1", 3600)
+        kinesis_utility.ROLE_CREDENTIALS["other-role-arn"] = _credentials("key-2", 3600)
+        kinesis_utility.KINESIS_CLIENTS[("role-arn", "us-east-1")] = (MagicMock(), "key-1")
+        kinesis_utility.KINESIS_CLIENTS[("other-role-arn", "us-east-1")] = (MagicMock(), "key-2")
+
+        kinesis_utility.invalidate_role_credentials("role-arn")
+
+        self.assertEqual(list(kinesis_utility.ROLE_CREDENTIALS), ["other-role-arn"])
+        self.assertEqual(list(kinesis_utility.KINESIS_CLIENTS), [("other-role-arn", "us-east-1")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import copy
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("edge_gps_utility_layer")
+
+    import payload_transformer
+    from edge_shared_utilities.gps_utility import clear_gps_cache
+
+
+def _hb_file(number_of_samples):
+    return {
+        "telematicsDeviceId": "192999999999954",
+        "componentSerialNumber": "64200027",
+        "vin": "TESTVIN19299954",
+        "numberOfSamples": number_of_samples,
+        "samples": [{
+            "convertedDeviceParameters": {
+                "messageID": f"message-{index}",
+                "CPU_temperature": "40.3",
+                "Latitude": "39.202938",
+                "Longitude": "-85.88672",
+                "Altitude": "165.236",
+                "LTE_RSSI": "99"
+            },
+            "convertedEquipmentParameters": [{"protocol": "J1939", "parameters": {"190": "1200"}}],
+            "convertedEquipmentFaultCodes": [{
+                "protocol": "J1939",
+                "activeFaultCodes": [{"spn": "100", "fmi": "4", "count": 1}],
+                "inactiveFaultCodes": [{"spn": "101", "fmi": "4", "count": 2}],
+                "pendingFaultCodes": [{"spn": "102", "fmi": "4", "count": 3}]
+            }],
+            "dateTimestamp": "2024-01-17T05:54:00.503Z"
+        } for index in range(number_of_samples)]
+    }
+
+
+@patch("edge_shared_utilities.gps_utility.handle_gps_coordinates",
+       lambda latitude, longitude, deobfuscate: ("lat", "long"))
+class TestPayloadTransformer(unittest.TestCase):
+    """
+    Test module for payload_transformer.py
+    """
+
+    def setUp(self):
+        clear_gps_cache()
+
+    def test_transform_payload_pt(self):
+        """
+        Test for transform_payload() applying the PT rules to the samples.
+        """
+        json_body = _hb_file(1)
+
+        health_rows = payload_transformer.transform_payload(json_body, payload_transformer.TARGET_PT)
+
+        sample = json_body["samples"][0]
+        self.assertEqual(sample["convertedDeviceParameters"],
+                         {"latitude": "lat", "longitude": "long", "altitude": "165.236"})
+        self.assertEqual(sample["convertedEquipmentFaultCodes"],
+                         [{"protocol": "J1939", "activeFaultCodes": [{"spn": "100", "fmi": "4",
+                                                                      "occurenceCount": "1"}]}])
+        self.assertEqual(health_rows, [("message-0", "40.3", None, "39.202938", "-85.88672", "165.236", None, None,
+                                        "99", None, None, None, None, None, None, "2024-01-17 05:54:00",
+                                        "192999999999954", "64200027")])
+        self.assertNotIn("rel_smn", json_body)
+
+    def test_transform_payload_pcc(self):
+        """
+        Test for transform_payload() applying the PCC rules to the samples and the file.
+        """
+        json_body = _hb_file(1)
+
+        health_rows = payload_transformer.transform_payload(json_body, payload_transformer.TARGET_PCC, "X15")
+
+        sample = json_body["samples"][0]
+        self.assertEqual(sample["convertedDeviceParameters"]["Latitude"], "lat")
+        self.assertEqual(sample["convertedDeviceParameters"]["CPU_temperature"], "40.3")
+        fault_codes = sample["convertedEquipmentFaultCodes"][0]
+        self.assertEqual([fault_codes[fault_code_type][0]["occurenceCount"]
+                          for fault_code_type in payload_transformer.FAULT_CODE_TYPES], ["1", "2", "3"])
+        self.assertEqual(len(health_rows), 1)
+        self.assertEqual(json_body["rel_smn"], "X15")
+        self.assertEqual(json_body["equipmentId"], "TESTVIN19299954")
+
+    def test_transform_payload_cd(self):
+        """
+        Test for transform_payload() leaving the samples of a CD file as they are.
+        """
+        json_body = _hb_file(1)
+
+        health_rows = payload_transformer.transform_payload(json_body, payload_transformer.TARGET_CD)
+
+        self.assertEqual(json_body, _hb_file(1))
+        self.assertEqual(health_rows, [])
+
+    def test_transform_payload_empty_params_removed(self):
+        """
+        Test for transform_payload() dropping the fault codes and device parameters left empty.
+        """
+        json_body = {"telematicsDeviceId": "1", "componentSerialNumber": "2",
+                     "samples": [{"convertedEquipmentFaultCodes": [], "convertedDeviceParameters": {"PDOP": "1"},
+                                  "dateTimestamp": "2024-01-17T05:54:00.503Z"}]}
+
+        health_rows = payload_transformer.transform_payload(json_body, payload_transformer.TARGET_PT)
+
+        self.assertEqual(json_body["samples"], [{"dateTimestamp": "2024-01-17T05:54:00.503Z"}])
+        self.assertEqual(health_rows, [])
+
+    def test_get_device_health_row_timestamp(self):
+        """
+        Test for get_device_health_row() formatting the timestamps like strptime/strftime did.
+        """
+        for sample_time_stamp in ["2024-01-17T05:54:00.5Z", "2024-01-17T05:54:00.503123Z", "2024-1-7T5:54:00.503Z"]:
+            health_row = payload_transformer.get_device_health_row({"messageID": "1"}, sample_time_stamp, "1", "2")
+            self.assertEqual(health_row[-3][:10], "2024-01-17" if "-01-" in sample_time_stamp else "2024-01-07")
+            self.assertEqual(len(health_row[-3]), 19)
+
+        with self.assertRaises(ValueError):
+            payload_transformer.get_device_health_row({"messageID": "1"}, "2024-01-17 05:54:00", "1", "2")
+
+    def test_transform_payload_1000_samples(self):
+        """
+        Test for transform_payload() on a 1,000 sample HB file, the size used by benchmarks/bench_payload_transformer.
+        """
+        json_body = _hb_file(1000)
+        pcc_json_body = copy.deepcopy(json_body)
+
+        health_rows = payload_transformer.transform_payload(json_body, payload_transformer.TARGET_PT)
+        pcc_health_rows = payload_transformer.transform_payload(pcc_json_body, payload_transformer.TARGET_PCC)
+
+        self.assertEqual([health_row[0] for health_row in health_rows], [f"message-{index}" for index in range(1000)])
+        self.assertEqual(health_rows, pcc_health_rows)
+        self.assertTrue(all(len(sample["convertedDeviceParameters"]) == 3 for sample in json_body["samples"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ import json
 
 sys.path.append("../")
 import unittest
-from unittest.mock import patch, MagicMock, call
+from unittest.mock import patch, MagicMock, ANY
 
 
 from tests.cda_module_mock_context import CDAModuleMockingContext
@@ -30,8 +30,11 @@ with  CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.en
     cda_module_mock_context.mock_module("utility")
     cda_module_mock_context.mock_module("edge_sqs_utility_layer")
     cda_module_mock_context.mock_module("pt_poster")
+    cda_module_mock_context.mock_module("kinesis_producer")
+    cda_module_mock_context.mock_module("payload_transformer")
 
     import pcc_poster
+    from utilities.metadata_emitter import MetadataEvent
 
 
 class PCCPoster(unittest.TestCase):
@@ -55,6 +58,9 @@ class PCCPoster(unittest.TestCase):
         "Altitude": "165.236"
     }
 
+    metadata_event = MetadataEvent("uuid", "123456789", "file-name", 10, "2021-02-09 12:30:00", "J1939_HB",
+                                   "FILE_RECEIVED", "esn", "SC8091", None, "", "", "")
+
     fc_params = [
         {
             "protocol": "J1939",
@@ -117,40 +123,49 @@ class PCCPoster(unittest.TestCase):
 
     @patch.dict('os.environ',
                 {'metaWriteQueueUrl': 'test'})
-    @patch("pcc_poster.sqs_send_message")
-    @patch("pcc_poster.handle_hb_params")
-    @patch("pcc_poster.boto3.client")
-    def test_send_to_pcc_given(self, mock_client, hb_params: MagicMock(), sqs_send_message: MagicMock):
-        hb_params.return_value = self.hb_params
-
-        response = pcc_poster.send_to_pcc(self.json_body, "123456789", "J1939-HB", "None","null","claimed@pcc2.0")
+    @patch("pcc_poster.emit_metadata_event")
+    @patch("pcc_poster.write_device_health_rows")
+    @patch("pcc_poster.transform_payload")
+    @patch("pcc_poster.get_kinesis_producer")
+    def test_send_to_pcc_given(self, mock_get_kinesis_producer, mock_transform_payload: MagicMock,
+                               mock_write_device_health_rows: MagicMock, mock_emit_metadata_event: MagicMock):
+        mock_transform_payload.return_value = [("message-1",)]
+
+        response = pcc_poster.send_to_pcc(self.json_body, "123456789", "J1939-HB", self.metadata_event, "null",
+                                          "claimed@pcc2.0")
         print(response)
-        assert call().put_record(StreamARN='test', Data=json.dumps(self.json_body, indent=2).encode('utf-8'),
-                                 PartitionKey='123456789-J1939-HB') in mock_client.mock_calls
-        pcc_poster.sqs_send_message.assert_called()
+        mock_transform_payload.assert_called_once_with(self.json_body, pcc_poster.TARGET_PCC, "null")
+        mock_write_device_health_rows.assert_called_once_with([("message-1",)])
+        mock_get_kinesis_producer.assert_called_with("test", "test", "us-east-1")
+        mock_producer = mock_get_kinesis_producer.return_value
+        mock_producer.put.assert_called_once_with(self.json_body, '123456789-J1939-HB', ANY)
+
+        on_delivery = mock_producer.put.call_args[0][2]
+        on_delivery(None)
+        mock_emit_metadata_event.assert_called()
+
+    @patch("pcc_poster.emit_metadata_event")
+    def test_handle_pcc_delivery_successful(self, mock_emit_metadata_event: MagicMock):
+        """
+        Test for handle_pcc_delivery() sending the FILE_SENT metadata message once the file is delivered.
+        """
+        pcc_poster.handle_pcc_delivery(self.metadata_event, "J1939-HB", "123456789", None)
 
+        mock_emit_metadata_event.assert_called_once()
+        file_sent_event = mock_emit_metadata_event.call_args[0][0]
+        self.assertEqual(file_sent_event.data_pipeline_stage, "FILE_SENT")
+        self.assertNotEqual(file_sent_event.file_date_time, self.metadata_event.file_date_time)
+        self.assertEqual(file_sent_event.to_message()[-3:], ",,,")
 
-    def test_handle_fc_params_successful(self):
+    @patch("pcc_poster.emit_metadata_event")
+    def test_handle_pcc_delivery_failed(self, mock_emit_metadata_event: MagicMock):
         """
-        Test for handle_fc_params() running successfully.
+        Test for handle_pcc_delivery() writing to the audit table when the file could not be delivered.
         """
-        converted_fc_params = [
-            {
-                "protocol": "J1939",
-                "networkId": "CAN1",
-                "deviceId": "0",
-                "activeFaultCodes": [
-                    {"spn": "100", "fmi": "4", "occurenceCount": "1"},
-                    {"spn": "101", "fmi": "4", "occurenceCount": "1"}
-                ],
-                "inactiveFaultCodes": [{"spn": "100", "fmi": "4", "occurenceCount": "1"}],
-                "pendingFaultCodes": [{"spn": "100", "fmi": "4", "occurenceCount": "1"}]
-            }
-        ]
-
-        response = pcc_poster.handle_fc_params(self.fc_params)
+        pcc_poster.handle_pcc_delivery(self.metadata_event, "J1939-HB", "123456789", "delivery error")
 
-        self.assertEqual(response, converted_fc_params)
+        pcc_poster.util.write_to_audit_table.assert_called_with("J1939-HB", "delivery error", "123456789")
+        mock_emit_metadata_event.assert_not_called()
 
 
 if __name__ == '__main__':
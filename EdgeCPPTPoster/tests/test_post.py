@@ -15,12 +15,15 @@ with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.env
     cda_module_mock_context.mock_module("pt_poster")
 
     import post
+    from utilities.metadata_emitter import MetadataEvent
 
 
 class TestPost(unittest.TestCase):
     """
     Test module for post.py
     """
+    metadata_event = MetadataEvent("uuid", "device-id", "file", 10, "2024-01-17 05:54:03", "J1939_HB", "CD_PT_POSTED",
+                                   "esn", "SC8153", None)
 
     def test_check_endpoint_file_exists_successful(self):
         """
@@ -42,7 +45,7 @@ class TestPost(unittest.TestCase):
 
     
     @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
-    @patch("post.sqs_send_message")
+    @patch("post.emit_metadata_event")
     @patch("post.write_to_audit_table")
     @patch("post.check_endpoint_file_exists")
     @patch("post.pt_poster")
@@ -51,7 +54,7 @@ class TestPost(unittest.TestCase):
         mock_pt_poster,
         mock_check_endpoint_file_exists,
         mock_write_to_audit_table,
-        mock_sqs_send_message
+        mock_emit_metadata_event
     ):
         """
         Test for send_to_cd() running successfully for SDK format.
@@ -69,7 +72,7 @@ class TestPost(unittest.TestCase):
             "Y",
             {"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"},
             "uuid",
-            "CD_PT_POSTED",
+            self.metadata_event,
             "csv"
         )
 
@@ -79,14 +82,14 @@ class TestPost(unittest.TestCase):
             Body=json.dumps({"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"}).encode(),
             Metadata={"j1939type": "HB", "uuid": "uuid"}
         )
-        mock_sqs_send_message.assert_called_with("queue-url", "CD_PT_POSTED")
+        mock_emit_metadata_event.assert_called_with(self.metadata_event)
         mock_write_to_audit_table.assert_not_called()
         mock_check_endpoint_file_exists.assert_not_called()
         mock_pt_poster.send_to_pt.assert_not_called()
 
 
     @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
-    @patch("post.sqs_send_message")
+    @patch("post.emit_metadata_event")
     @patch("post.write_to_audit_table")
     @patch("post.check_endpoint_file_exists")
     @patch("post.pt_poster")
@@ -95,7 +98,7 @@ class TestPost(unittest.TestCase):
         mock_pt_poster,
         mock_check_endpoint_file_exists,
         mock_write_to_audit_table,
-        mock_sqs_send_message
+        mock_emit_metadata_event
     ):
         """
         Test for send_to_cd() when it throws an exception for SDK format.
@@ -114,19 +117,95 @@ class TestPost(unittest.TestCase):
             "Y",
             {"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"},
             "uuid",
-            "CD_PT_POSTED",
+            self.metadata_event,
             "csv"
         )
 
         mock_write_to_audit_table.assert_called_with("csv", ANY, "device-id")
         
-        mock_sqs_send_message.assert_not_called()
+        mock_emit_metadata_event.assert_not_called()
         mock_check_endpoint_file_exists.assert_not_called()
         mock_pt_poster.send_to_pt.assert_not_called()
 
+
+    @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
+    @patch("post.ARCHIVE_HANDED_OFF_FILES", True)
+    @patch("post.CD_HANDOFF_MODE", "invoke")
+    @patch("post.NGDI_CONVERSION_LAMBDA", "conversion-lambda")
+    @patch("post.lambda_client")
+    @patch("post.emit_metadata_event")
+    @patch("post.write_to_audit_table")
+    def test_send_to_cd_sdk_handed_off(self, mock_write_to_audit_table, mock_emit_metadata_event, mock_lambda_client):
+        """
+        Test for send_to_cd() handing off the SDK file to the conversion lambda and archiving it in the background.
+        """
+        mock_client = MagicMock()
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        json_body = {"telematicsDeviceId": "device-id", "samples": [{"sample": 1}], "componentSerialNumber": "esn"}
+
+        post.send_to_cd("bucket", "ConvertedFiles/test", "SDK", mock_client, "HB", "bucket", "file", "Y", json_body,
+                        "uuid", self.metadata_event, "csv")
+        post.flush_ngdi_archives()
+
+        invoke_kwargs = mock_lambda_client.invoke.call_args[1]
+        payload = json.loads(invoke_kwargs["Payload"])
+        self.assertEqual(invoke_kwargs["FunctionName"], "conversion-lambda")
+        self.assertEqual(invoke_kwargs["InvocationType"], "Event")
+        self.assertEqual(payload["j1939_file"], json_body)
+        self.assertEqual(payload["handoff"]["file_key"], "NGDI/test")
+        self.assertEqual(payload["handoff"]["metadata"], {"j1939type": "HB", "uuid": "uuid"})
+        mock_client.put_object.assert_called_once_with(
+            Bucket="bucket",
+            Key="ArchivedNGDI/test",
+            Body=json.dumps(json_body).encode(),
+            Metadata={"j1939type": "HB", "uuid": "uuid"}
+        )
+        mock_emit_metadata_event.assert_called_with(self.metadata_event)
+        mock_write_to_audit_table.assert_not_called()
+
+
+    @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
+    @patch("post.CD_HANDOFF_MAX_PAYLOAD_BYTES", 100)
+    @patch("post.CD_HANDOFF_MODE", "invoke")
+    @patch("post.lambda_client")
+    @patch("post.emit_metadata_event")
+    def test_send_to_cd_sdk_too_large_to_hand_off(self, mock_emit_metadata_event, mock_lambda_client):
+        """
+        Test for send_to_cd() posting the SDK file to the NGDI folder when it is too large to be handed off.
+        """
+        mock_client = MagicMock()
+        json_body = {"telematicsDeviceId": "device-id", "samples": [{"sample": "x" * 100}]}
+
+        post.send_to_cd("bucket", "ConvertedFiles/test", "SDK", mock_client, "HB", "bucket", "file", "Y", json_body,
+                        "uuid", self.metadata_event, "csv")
+
+        mock_lambda_client.invoke.assert_not_called()
+        mock_client.put_object.assert_called_once_with(
+            Bucket="bucket",
+            Key="NGDI/test",
+            Body=json.dumps(json_body).encode(),
+            Metadata={"j1939type": "HB", "uuid": "uuid"}
+        )
+        mock_emit_metadata_event.assert_called_with(self.metadata_event)
+
+
+    @patch("post.write_to_audit_table")
+    def test_flush_ngdi_archives_on_error(self, mock_write_to_audit_table):
+        """
+        Test for flush_ngdi_archives() auditing the archive copies that failed.
+        """
+        mock_client = MagicMock()
+        mock_client.put_object.side_effect = Exception("Mock S3 exception")
+
+        post.archive_ngdi_file(mock_client, "bucket", "ArchivedNGDI/test", b"{}", {}, "csv", "device-id")
+        post.flush_ngdi_archives()
+
+        mock_write_to_audit_table.assert_called_once_with("csv", ANY, "device-id")
+        self.assertEqual(post.PENDING_NGDI_ARCHIVES, [])
+
     
     @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
-    @patch("post.sqs_send_message")
+    @patch("post.emit_metadata_event")
     @patch("post.write_to_audit_table")
     @patch("post.check_endpoint_file_exists")
     @patch("post.pt_poster")
@@ -135,7 +214,7 @@ class TestPost(unittest.TestCase):
         mock_pt_poster,
         mock_check_endpoint_file_exists,
         mock_write_to_audit_table,
-        mock_sqs_send_message
+        mock_emit_metadata_event
     ):
         """
         Test for send_to_cd() running successfully for NGDI format.
@@ -153,20 +232,20 @@ class TestPost(unittest.TestCase):
             "Y",
             {"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"},
             "uuid",
-            "CD_PT_POSTED",
+            self.metadata_event,
             "csv"
         )
 
         mock_check_endpoint_file_exists.assert_called_with("bucket", "file")
 
         mock_client.put_object.assert_not_called()
-        mock_sqs_send_message.assert_not_called()
+        mock_emit_metadata_event.assert_not_called()
         mock_write_to_audit_table.assert_not_called()
         mock_pt_poster.send_to_pt.assert_not_called()
 
 
     @patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
-    @patch("post.sqs_send_message")
+    @patch("post.emit_metadata_event")
     @patch("post.write_to_audit_table")
     @patch("post.check_endpoint_file_exists")
     @patch("post.pt_poster")
@@ -175,7 +254,7 @@ class TestPost(unittest.TestCase):
         mock_pt_poster,
         mock_check_endpoint_file_exists,
         mock_write_to_audit_table,
-        mock_sqs_send_message
+        mock_emit_metadata_event
     ):
         """
         Test for send_to_cd() NOT using endpoint bucket for NGDI format.
@@ -193,7 +272,7 @@ class TestPost(unittest.TestCase):
             "N",
             {"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"},
             "uuid",
-            "CD_PT_POSTED",
+            self.metadata_event,
             "csv"
         )
 
@@ -201,7 +280,7 @@ class TestPost(unittest.TestCase):
             "post-url",
             "header",
             {"telematicsDeviceId": "device-id", "componentSerialNumber": "esn"},
-            "FILE_SENT",
+            self.metadata_event._replace(data_pipeline_stage="FILE_SENT"),
             "csv",
             "HB",
             "uuid",
@@ -210,6 +289,6 @@ class TestPost(unittest.TestCase):
         )
 
         mock_client.put_object.assert_not_called()
-        mock_sqs_send_message.assert_not_called()
+        mock_emit_metadata_event.assert_not_called()
         mock_write_to_audit_table.assert_not_called()
         mock_check_endpoint_file_exists.assert_not_called()
@@ -1,5 +1,6 @@
 import io
 import sys
+import gzip
 import json
 import unittest
 from unittest.mock import ANY, patch, MagicMock
@@ -53,6 +54,7 @@ with  CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.en
     cda_module_mock_context.mock_module("edge_db_lambda_client"),
     cda_module_mock_context.mock_module("edge_sqs_utility_layer")
     cda_module_mock_context.mock_module("update_scheduler")
+    cda_module_mock_context.mock_module("file_idempotency")
     cda_module_mock_context.mock_module("EdgeDbLambdaClient")
 
     import PosterLambda
@@ -87,7 +89,8 @@ class TestPosterLambda(unittest.TestCase):
                     }
                 },
                 "body": json.dumps({"test": "body"}),
-                "receiptHandle": "test-receipt-handle"
+                "receiptHandle": "test-receipt-handle",
+                "messageId": "test-message-id"
             }
         ]
     }
@@ -164,18 +167,93 @@ class TestPosterLambda(unittest.TestCase):
     }
 
     
-    @patch.dict("os.environ", {"QueueUrl": "test-url"})
-    @patch("PosterLambda.boto3.client")
-    def test_delete_message_from_sqs_queue_successful(self, mock_client):
+    @patch("PosterLambda.route_file")
+    @patch("PosterLambda.s3_client")
+    def test_process_file_gzip_compressed(self, mock_s3_client, mock_route_file):
         """
-        Test for delete_message_from_sqs_queue() running successfully.
+        Test for process_file() decompressing the file stored gzip compressed by the GPS obfuscation lambda.
         """
-        mock_client.return_value.delete_message.return_value = "test-response"
+        mock_s3_client.get_object.return_value = {
+            'LastModified': "1981-08-03T01:17:04.000Z",
+            'ContentEncoding': 'gzip',
+            'Metadata': {'raw_size': '100', 'stored_size': '80'},
+            'Body': io.BytesIO(gzip.compress(json.dumps(self.serialized_file).encode("utf-8")))
+        }
+        mock_route_file.return_value = PosterLambda.RoutedFile(None, None)
+
+        self.assertTrue(PosterLambda.process_file(self.bucket_name, self.file_key, 80, "test-receipt-handle").processed)
+
+        self.assertEqual(mock_route_file.call_args[0][5], self.serialized_file)
+
+    @patch("PosterLambda.route_file")
+    @patch("PosterLambda.s3_client")
+    def test_process_file_compacted(self, mock_s3_client, mock_route_file):
+        """
+        Test for process_file() routing every HB file of a compacted file under its own name.
+        """
+        json_bodies = [{"telematicsDeviceId": self.sample_device_id, "index": index} for index in range(3)]
+        mock_s3_client.get_object.return_value = {
+            'LastModified': "1981-08-03T01:17:04.000Z",
+            'Metadata': {'compacted': 'Y', 'messages': '3'},
+            'Body': io.BytesIO(b"".join(json.dumps(json_body).encode() + b"\n" for json_body in json_bodies))
+        }
+        mock_route_file.return_value = PosterLambda.RoutedFile(None, ("request-id", self.sample_device_id))
 
-        response = PosterLambda.delete_message_from_sqs_queue("test-handle")
+        record_result = PosterLambda.process_file(self.bucket_name, "ConvertedFiles/EDGE_1_2_SC5004_3_0.json", 80,
+                                                  "test-receipt-handle")
 
-        mock_client.return_value.delete_message.assert_called_with(QueueUrl="test-url", ReceiptHandle="test-handle")
-        self.assertEqual(response, "test-response")
+        self.assertTrue(record_result.processed)
+        self.assertEqual(len(record_result.routed_files), 3)
+
+        self.assertEqual([call_args[0][1] for call_args in mock_route_file.call_args_list],
+                         [f"ConvertedFiles/EDGE_1_2_SC5004_3_0_{index}.json" for index in range(3)])
+        self.assertEqual([call_args[0][5] for call_args in mock_route_file.call_args_list], json_bodies)
+        self.assertEqual({call_args[0][6] for call_args in mock_route_file.call_args_list}, {"test-receipt-handle"})
+
+    @patch("PosterLambda.get_completed_files")
+    @patch("PosterLambda.get_line_idempotency_key", lambda idempotency_key, index: f"{idempotency_key}#{index}")
+    @patch("PosterLambda.route_file")
+    @patch("PosterLambda.s3_client")
+    def test_process_file_compacted_retried(self, mock_s3_client, mock_route_file, mock_get_completed_files):
+        """
+        Test for process_file() skipping the HB files of a compacted file that an earlier delivery already routed.
+        """
+        json_bodies = [{"telematicsDeviceId": self.sample_device_id, "index": index} for index in range(3)]
+        mock_s3_client.get_object.return_value = {
+            'LastModified': "1981-08-03T01:17:04.000Z",
+            'Metadata': {'compacted': 'Y', 'messages': '3'},
+            'Body': io.BytesIO(b"".join(json.dumps(json_body).encode() + b"\n" for json_body in json_bodies))
+        }
+        mock_get_completed_files.return_value = {"key#0", "key#2"}
+        mock_route_file.return_value = PosterLambda.RoutedFile(None, None)
+
+        record_result = PosterLambda.process_file(self.bucket_name, "ConvertedFiles/EDGE_1_2_SC5004_3_0.json", 80,
+                                                  "test-receipt-handle", "key")
+
+        mock_get_completed_files.assert_called_once_with(["key#0", "key#1", "key#2"])
+        mock_route_file.assert_called_once()
+        self.assertEqual(mock_route_file.call_args[0][1], "ConvertedFiles/EDGE_1_2_SC5004_3_0_1.json")
+        self.assertEqual(record_result, PosterLambda.RecordResult(True, None, [PosterLambda.RoutedFile("key#1", None)]))
+
+    @patch("PosterLambda.write_to_audit_table")
+    @patch("PosterLambda.route_file")
+    @patch("PosterLambda.s3_client")
+    def test_process_file_compacted_file_not_routed(self, mock_s3_client, mock_route_file, mock_write_to_audit_table):
+        """
+        Test for process_file() routing the other HB files of a compacted file and failing the message when one fails.
+        """
+        mock_s3_client.get_object.return_value = {
+            'LastModified': "1981-08-03T01:17:04.000Z",
+            'Metadata': {'compacted': 'Y', 'messages': '2'},
+            'Body': io.BytesIO(b'{"telematicsDeviceId": "1"}\n{"telematicsDeviceId": "2"}\n')
+        }
+        mock_route_file.side_effect = [RuntimeError("Invalid 'j1939type'"), PosterLambda.RoutedFile(None, None)]
+
+        self.assertFalse(PosterLambda.process_file(self.bucket_name, "ConvertedFiles/EDGE_1_2_SC5004_3_0.json", 80,
+                                                   "test-receipt-handle").processed)
+
+        self.assertEqual(mock_route_file.call_count, 2)
+        mock_write_to_audit_table.assert_called_once()
 
 
     @patch("PosterLambda.EDGE_DB_CLIENT")
@@ -234,20 +312,22 @@ class TestPosterLambda(unittest.TestCase):
             "metaWriteQueueUrl": "queue-url"
         }
     )
-    @patch("PosterLambda.delete_message_from_sqs_queue")
     @patch("PosterLambda.ssm_client")
     @patch("PosterLambda.get_device_info")
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.claim_file")
     @patch("PosterLambda.data_quality")
     @patch("PosterLambda.s3_client")
     @patch("PosterLambda.post")
     @patch("PosterLambda.pt_poster")
     @patch("PosterLambda.pcc_poster")
     @patch("PosterLambda.get_request_id_from_consumption_view")
-    @patch("PosterLambda.update_scheduler_table")
-    @patch("PosterLambda.sqs_send_message")
+    @patch("PosterLambda.coalesce_scheduler_update")
+    @patch("PosterLambda.emit_metadata_event")
     def test_retrieve_and_process_file_hb_pcc_claimed(
         self,
-        mock_sqs_send_message,
+        mock_emit_metadata_event,
         mock_update_scheduler,
         mock_get_request_id,
         mock_pcc_poster,
@@ -255,9 +335,11 @@ class TestPosterLambda(unittest.TestCase):
         mock_post,
         mock_s3_client,
         mock_data_quality,
+        mock_claim_file,
+        mock_complete_files,
+        mock_release_file,
         mock_get_device_info,
-        mock_ssm_client,
-        mock_delete_sqs_message
+        mock_ssm_client
     ):
         """
         Test for retrieve_and_process_file() when:
@@ -266,8 +348,6 @@ class TestPosterLambda(unittest.TestCase):
         - device owner is present
         - PCC claim status is `claimed`
         """
-        s3_event_str = json.dumps(self.s3_event_body)
-
         mock_s3_client.get_object.return_value = self.file_object
         mock_post.get_cspec_req_id.return_value = ("config-spec-name", "req-id")
         mock_get_request_id.return_value = "request-id"
@@ -289,9 +369,11 @@ class TestPosterLambda(unittest.TestCase):
             }
         }
 
-        PosterLambda.retrieve_and_process_file(self.s3_event_body, "test-receipt-handle")
+        self.assertEqual(PosterLambda.retrieve_and_process_file(self.s3_event_body, "test-receipt-handle"),
+                         PosterLambda.RecordResult(True, PosterLambda.get_file_idempotency_key.return_value,
+                                                   [PosterLambda.RoutedFile(None, ("request-id", "352953081637849"))]))
 
-        mock_data_quality.assert_called_with(s3_event_str)
+        mock_data_quality.assert_not_called()
         mock_s3_client.get_object.assert_called_with(Bucket=self.bucket_name, Key=self.file_key)
         mock_post.get_cspec_req_id.assert_called_with("SC8091")
         device_info = {'device_owner': 'PSBU', 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id',
@@ -299,19 +381,107 @@ class TestPosterLambda(unittest.TestCase):
         mock_get_request_id.assert_called_with("J1939_HB", "EDGE_352953081637849_64200027_config-spec-name", device_info)
         mock_update_scheduler.assert_called_with("request-id", "352953081637849", device_info)
 
-        mock_sqs_send_message.assert_called()
+        mock_emit_metadata_event.assert_called_once()
+        file_received_event = mock_emit_metadata_event.call_args[0][0]
+        self.assertEqual(file_received_event.data_pipeline_stage, "FILE_RECEIVED")
+        self.assertTrue(file_received_event.to_message().endswith(",64200027,config-spec-name,request-id,,,"))
         mock_pt_poster.send_to_pt.assert_not_called()
         mock_post.send_to_cd.assert_not_called()
         mock_pcc_poster.send_to_pcc.assert_called()
-        mock_delete_sqs_message.assert_called()
+        mock_claim_file.assert_called_with(PosterLambda.get_file_idempotency_key.return_value)
+        # Completed by the handler once the data of the batch is sent
+        mock_complete_files.assert_not_called()
+        mock_release_file.assert_not_called()
+
+    @patch.dict(
+        "os.environ",
+        {
+            "cd_device_owners": json.dumps({"CD": True}),
+            "psbu_device_owner": json.dumps({"PSBU": True}),
+            "metaWriteQueueUrl": "queue-url"
+        }
+    )
+    @patch("PosterLambda.LOGGER")
+    @patch("PosterLambda.get_device_info")
+    @patch("PosterLambda.s3_client")
+    @patch("PosterLambda.post")
+    @patch("PosterLambda.emit_metadata_event")
+    def test_process_converted_file_cd_device(self, mock_emit_metadata_event, mock_post, mock_s3_client,
+                                              mock_get_device_info, mock_logger):
+        """
+        Test for process_converted_file() routing the FC file handed off by the CSV converter without S3 or SQS.
+        """
+        mock_post.get_cspec_req_id.return_value = ("SC8153", None)
+        mock_get_device_info.return_value = {"device_owner": "CD", "cust_ref": "cust-ref"}
+        json_body = {"telematicsDeviceId": self.sample_device_id, "componentSerialNumber": "64200027",
+                     "telematicsPartnerName": "Cummins", "samples": []}
+        converted_file_event = {
+            "converted_file": {"bucket_name": self.bucket_name, "file_key": self.file_key, "file_size": 10,
+                               "file_date_time": "2024-01-17 05:54:03",
+                               "metadata": {"j1939type": "FC", "uuid": "uuid", "convertedat": "1705470843.0"}},
+            "json_body": json_body
+        }
 
+        self.assertTrue(PosterLambda.process_converted_file(converted_file_event))
 
-    @patch("PosterLambda.boto3.client")
-    def test_data_quality_successful(self, mock_boto3_client):
+        mock_s3_client.get_object.assert_not_called()
+        mock_post.send_to_cd.assert_called_once()
+        self.assertEqual(mock_post.send_to_cd.call_args[0][:2], (self.bucket_name, self.file_key))
+        self.assertEqual(mock_post.send_to_cd.call_args[0][8]["customerReference"], "cust-ref")
+        self.assertTrue(any('"event": "FcRoutingLatency", "mode": "fused"' in logged[0][0]
+                            for logged in mock_logger.info.call_args_list))
+
+    @patch("PosterLambda.process_file")
+    @patch("PosterLambda.claim_file")
+    def test_retrieve_and_process_file_already_processed(self, mock_claim_file, mock_process_file):
+        """
+        Test for retrieve_and_process_file() acknowledging the message of a file that was already processed.
+        """
+        mock_claim_file.return_value = PosterLambda.FILE_STATE_DONE
+
+        self.assertEqual(PosterLambda.retrieve_and_process_file(self.s3_event_body, "test-receipt-handle"),
+                         PosterLambda.RecordResult(True, None, []))
+
+        PosterLambda.get_file_idempotency_key.assert_called_with(self.bucket_name, self.file_key,
+                                                                 "2a80137307ca8181f3758b99884cbd3f")
+        mock_process_file.assert_not_called()
+
+    @patch("PosterLambda.process_file")
+    @patch("PosterLambda.claim_file")
+    def test_retrieve_and_process_file_in_progress(self, mock_claim_file, mock_process_file):
+        """
+        Test for retrieve_and_process_file() leaving the message of a file being processed by another invocation.
+        """
+        mock_claim_file.return_value = PosterLambda.FILE_STATE_IN_PROGRESS
+
+        self.assertEqual(PosterLambda.retrieve_and_process_file(self.s3_event_body, "test-receipt-handle"),
+                         PosterLambda.RecordResult(False, None, []))
+
+        mock_process_file.assert_not_called()
+
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.process_file")
+    @patch("PosterLambda.claim_file")
+    def test_retrieve_and_process_file_failed(self, mock_claim_file, mock_process_file, mock_complete_files,
+                                              mock_release_file):
+        """
+        Test for retrieve_and_process_file() releasing the claim of a file that could not be processed.
+        """
+        mock_process_file.side_effect = Exception("Mock process file exception")
+
+        with self.assertRaises(Exception):
+            PosterLambda.retrieve_and_process_file(self.s3_event_body, "test-receipt-handle")
+
+        mock_complete_files.assert_not_called()
+        mock_release_file.assert_called_with(PosterLambda.get_file_idempotency_key.return_value)
+
+
+    @patch("PosterLambda.lambda_client")
+    def test_data_quality_successful(self, mock_lambda_client):
         """
         Test for data_quality() running successfully.
         """
-        mock_lambda_client = mock_boto3_client.return_value
         mock_lambda_client.invoke.return_value = {"StatusCode": 200}
         
         with self.assertRaises(RuntimeError):
@@ -324,19 +494,273 @@ class TestPosterLambda(unittest.TestCase):
         )
 
 
-    @patch("PosterLambda.Process")
-    def test_lambda_handler_successful(self, mock_process):
+    @patch("PosterLambda.data_quality")
+    def test_invoke_data_quality_one_event_per_file(self, mock_data_quality):
+        """
+        Test for invoke_data_quality() sending every S3 event as it was received and skipping the other bodies.
+        """
+        PosterLambda.invoke_data_quality([self.s3_event_body, {"Event": "s3:TestEvent"}, self.s3_event_body])
+
+        self.assertEqual(mock_data_quality.call_count, 2)
+        self.assertEqual({call_args[0][0] for call_args in mock_data_quality.call_args_list},
+                         {json.dumps(self.s3_event_body)})
+
+    @patch("PosterLambda.DATA_QUALITY_MERGE_EVENTS", True)
+    @patch("PosterLambda.data_quality")
+    def test_invoke_data_quality_one_payload(self, mock_data_quality):
+        """
+        Test for invoke_data_quality() merging the S3 events of the batch into one data quality payload.
+        """
+        PosterLambda.invoke_data_quality([self.s3_event_body, self.s3_event_body])
+
+        mock_data_quality.assert_called_once_with(
+            json.dumps({"Records": self.s3_event_body["Records"] + self.s3_event_body["Records"]}))
+
+
+    @patch("PosterLambda.DATA_QUALITY_MERGE_EVENTS", True)
+    @patch("PosterLambda.DATA_QUALITY_MAX_PAYLOAD_BYTES", 1500)
+    @patch("PosterLambda.LOGGER")
+    @patch("PosterLambda.data_quality")
+    def test_invoke_data_quality_chunked_failure(self, mock_data_quality, mock_logger):
+        """
+        Test for invoke_data_quality() splitting the batch at the payload limit and logging the failed events.
+        """
+        mock_data_quality.side_effect = [None, RuntimeError("An error occurred while invoking the data quality lambda")]
+        first_s3_event_body = {"Records": [{"s3": {"object": {"key": "first", "pad": "x" * 1000}}}]}
+        second_s3_event_body = {"Records": [{"s3": {"object": {"key": "second", "pad": "x" * 1000}}}]}
+
+        PosterLambda.invoke_data_quality([first_s3_event_body, second_s3_event_body])
+
+        self.assertEqual(mock_data_quality.call_count, 2)
+        self.assertTrue(all(len(call[0][0]) <= 1500 for call in mock_data_quality.call_args_list))
+        mock_logger.error.assert_called_once()
+        self.assertIn("'second'", mock_logger.error.call_args[0][0])
+
+
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.post")
+    @patch("PosterLambda.pt_poster")
+    @patch("PosterLambda.flush_scheduler_updates")
+    @patch("PosterLambda.invoke_data_quality")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_successful(self, mock_retrieve_and_process_file, mock_invoke_data_quality,
+                                       mock_flush_scheduler_updates, mock_pt_poster, mock_post, mock_complete_files,
+                                       mock_release_file):
         """
         Test for lambda_handler() running successfully.
         """
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(True, "idempotency-key", [])
+
+        response = PosterLambda.lambda_handler(self.s3_event_body, None)
+
+        self.assertEqual(response, {"batchItemFailures": []})
+        mock_retrieve_and_process_file.assert_called_with({"test": "body"}, "test-receipt-handle")
+        mock_invoke_data_quality.assert_called_once_with([{"test": "body"}])
+        mock_flush_scheduler_updates.assert_called_once()
+        mock_pt_poster.flush_pt_files.assert_called_once()
+        mock_post.flush_ngdi_archives.assert_called_once()
+        mock_complete_files.assert_called_once_with(["idempotency-key"])
+        mock_release_file.assert_not_called()
+
+    @patch("PosterLambda.post", MagicMock())
+    @patch("PosterLambda.pt_poster", MagicMock())
+    @patch("PosterLambda.flush_scheduler_updates", MagicMock(return_value=[]))
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.complete_files", MagicMock())
+    @patch("PosterLambda.MAX_WORKERS", 2)
+    @patch("PosterLambda.ThreadPoolExecutor", wraps=PosterLambda.ThreadPoolExecutor)
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_workers_capped(self, mock_retrieve_and_process_file, mock_thread_pool_executor):
+        """
+        Test for lambda_handler() processing a batch larger than MAX_WORKERS with MAX_WORKERS threads.
+        """
+        records = [dict(self.s3_event_body["Records"][0], messageId=f"message-id-{index}") for index in range(3)]
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(True, None, [])
+
+        response = PosterLambda.lambda_handler({"Records": records}, None)
+
+        self.assertEqual(response, {"batchItemFailures": []})
+        mock_thread_pool_executor.assert_called_once_with(max_workers=2)
+        self.assertEqual(mock_retrieve_and_process_file.call_count, 3)
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.traceback", MagicMock())
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.post")
+    @patch("PosterLambda.pt_poster")
+    @patch("PosterLambda.flush_scheduler_updates")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_flush_failed(self, mock_retrieve_and_process_file, mock_flush_scheduler_updates,
+                                         mock_pt_poster, mock_post, mock_complete_files, mock_release_file):
+        """
+        Test for lambda_handler() releasing the files of the batch and failing their messages when a flush fails.
+        """
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(True, "idempotency-key", [])
+        mock_pt_poster.flush_pt_files.side_effect = Exception("Mock flush exception")
+
+        response = PosterLambda.lambda_handler(self.s3_event_body, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "test-message-id"}]})
+        # The flushes after the one that failed still run
+        mock_post.flush_ngdi_archives.assert_called_once()
+        mock_flush_scheduler_updates.assert_called_once()
+        mock_release_file.assert_called_once_with("idempotency-key")
+        mock_complete_files.assert_called_once_with([])
+
+
+    @patch("PosterLambda.post", MagicMock())
+    @patch("PosterLambda.pt_poster", MagicMock())
+    @patch("PosterLambda.flush_scheduler_updates", MagicMock())
+    @patch("PosterLambda.invoke_data_quality")
+    @patch("PosterLambda.process_converted_file")
+    def test_lambda_handler_converted_file(self, mock_process_converted_file, mock_invoke_data_quality):
+        """
+        Test for lambda_handler() routing the file handed off by the CSV converter.
+        """
+        converted_file_event = {"converted_file": {"file_key": "file-key"}, "json_body": {}}
+
+        response = PosterLambda.lambda_handler(converted_file_event, None)
+
+        mock_process_converted_file.assert_called_once_with(converted_file_event)
+        self.assertEqual(response, {"batchItemFailures": []})
+        mock_invoke_data_quality.assert_not_called()
+
+
+    @patch("PosterLambda.post", MagicMock())
+    @patch("PosterLambda.pt_poster", MagicMock())
+    @patch("PosterLambda.flush_scheduler_updates", MagicMock(return_value=[]))
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.process_converted_file")
+    def test_lambda_handler_converted_file_not_routed(self, mock_process_converted_file):
+        """
+        Test for lambda_handler() raising when the file handed off by the CSV converter is not routed, so that the
+        asynchronous invocation is retried.
+        """
+        converted_file_event = {"converted_file": {"file_key": "file-key"}, "json_body": {}}
+        mock_process_converted_file.return_value = None
+
+        with self.assertRaises(RuntimeError):
+            PosterLambda.lambda_handler(converted_file_event, None)
+
+
+    @patch("PosterLambda.post", MagicMock())
+    @patch("PosterLambda.pt_poster", MagicMock())
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.flush_scheduler_updates")
+    @patch("PosterLambda.process_converted_file")
+    def test_lambda_handler_converted_file_scheduler_update_failed(self, mock_process_converted_file,
+                                                                   mock_flush_scheduler_updates):
+        """
+        Test for lambda_handler() raising when the request of the converted file was not moved to 'Data Rx In
+        Progress'.
+        """
+        converted_file_event = {"converted_file": {"file_key": "file-key"}, "json_body": {}}
+        mock_process_converted_file.return_value = PosterLambda.RoutedFile(None, ("request-id", "device-id"))
+        mock_flush_scheduler_updates.return_value = [("request-id", "device-id")]
+
+        with self.assertRaises(RuntimeError):
+            PosterLambda.lambda_handler(converted_file_event, None)
+
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.flush_scheduler_updates")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_scheduler_update_failed(self, mock_retrieve_and_process_file,
+                                                    mock_flush_scheduler_updates, mock_complete_files,
+                                                    mock_release_file):
+        """
+        Test for lambda_handler() retrying the messages of the files whose request was not moved to 'Data Rx In
+        Progress'.
+        """
+        other_record = dict(self.s3_event_body["Records"][0], messageId="other-message-id",
+                            receiptHandle="other-receipt-handle")
+        record_results = {
+            "test-receipt-handle": PosterLambda.RecordResult(True, "idempotency-key",
+                                                             [PosterLambda.RoutedFile(None, ("REQ1", "111"))]),
+            "other-receipt-handle": PosterLambda.RecordResult(True, "other-idempotency-key",
+                                                              [PosterLambda.RoutedFile(None, ("REQ2", "222"))])}
+        mock_retrieve_and_process_file.side_effect = lambda _, receipt_handle: record_results[receipt_handle]
+        mock_flush_scheduler_updates.return_value = [("REQ1", "111")]
+
+        response = PosterLambda.lambda_handler({"Records": self.s3_event_body["Records"] + [other_record]}, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "test-message-id"}]})
+        mock_release_file.assert_called_once_with("idempotency-key")
+        mock_complete_files.assert_called_once_with(["other-idempotency-key"])
+
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.release_file")
+    @patch("PosterLambda.complete_files")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_compacted_file_not_routed(self, mock_retrieve_and_process_file, mock_complete_files,
+                                                      mock_release_file):
+        """
+        Test for lambda_handler() completing the routed lines of a compacted file whose message is retried.
+        """
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(
+            False, None, [PosterLambda.RoutedFile("key#0", None), PosterLambda.RoutedFile("key#2", None)])
+
+        response = PosterLambda.lambda_handler(self.s3_event_body, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "test-message-id"}]})
+        mock_complete_files.assert_called_once_with(["key#0", "key#2"])
+        mock_release_file.assert_not_called()
+
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.traceback")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_record_exception(self, mock_retrieve_and_process_file, mock_traceback):
+        """
+        Test for lambda_handler() logging the exception raised while processing a record.
+        """
+        mock_retrieve_and_process_file.side_effect = Exception("Mock processing exception")
+
+        response = PosterLambda.lambda_handler(self.s3_event_body, None)
+
+        mock_retrieve_and_process_file.assert_called_once()
+        mock_traceback.print_exception.assert_called_once()
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "test-message-id"}]})
+
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_record_not_processed(self, mock_retrieve_and_process_file):
+        """
+        Test for lambda_handler() reporting the message of a file that was not processed for a retry.
+        """
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(False, None, [])
+
+        response = PosterLambda.lambda_handler(self.s3_event_body, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "test-message-id"}]})
+
+
+    @patch("PosterLambda.invoke_data_quality", MagicMock())
+    @patch("PosterLambda.write_to_audit_table")
+    @patch("PosterLambda.flush_metadata_events")
+    @patch("PosterLambda.retrieve_and_process_file")
+    def test_lambda_handler_metadata_events_lost(self, mock_retrieve_and_process_file, mock_flush_metadata_events,
+                                                 mock_write_to_audit_table):
+        """
+        Test for lambda_handler() auditing the metadata events of the batch that could not be sent.
+        """
+        mock_retrieve_and_process_file.return_value = PosterLambda.RecordResult(True, None, [])
+        mock_flush_metadata_events.return_value = [
+            PosterLambda.MetadataEvent("uuid", "device-id", "file-name", 10, "2024-01-17 05:54:03", "J1939_HB",
+                                       "FILE_SENT", "esn", "SC8091", None)]
+
         PosterLambda.lambda_handler(self.s3_event_body, None)
 
-        mock_process.assert_called_with(
-            target=PosterLambda.retrieve_and_process_file,
-            args=({"test": "body"}, "test-receipt-handle")
-        )
-        mock_process.return_value.start.assert_called()
-        mock_process.return_value.join.assert_called()
+        mock_flush_metadata_events.assert_called_once()
+        mock_write_to_audit_table.assert_called_once_with("J1939_HB", ANY, "device-id")
+        self.assertIn("uuid,device-id,file-name,10,2024-01-17 05:54:03,J1939_HB,FILE_SENT,esn,SC8091,None,None, , ",
+                      mock_write_to_audit_table.call_args[0][1])
 
 
 if __name__ == '__main__':
@@ -1,9 +1,10 @@
 import copy
+import json
 import sys
 
 sys.path.append("../")
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 
 
 from tests.cda_module_mock_context import CDAModuleMockingContext
@@ -28,11 +29,13 @@ with  CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.en
     cda_module_mock_context.mock_module("update_scheduler")
     cda_module_mock_context.mock_module("edge_sqs_utility_layer")
     cda_module_mock_context.mock_module("edge_kafka_utility_layer")
+    cda_module_mock_context.mock_module("kafka_producer")
     cda_module_mock_context.mock_module("edge_gps_utility_layer")
     cda_module_mock_context.mock_module("edge_db_simple_layer")
-    cda_module_mock_context.mock_module("edge_secretsmanager_utility_layer")
+    cda_module_mock_context.mock_module("utilities.secrets_utility")
 
     import pt_poster
+    from utilities.metadata_emitter import MetadataEvent
 
 class MyTestCase(unittest.TestCase):
     """
@@ -122,110 +125,69 @@ class MyTestCase(unittest.TestCase):
 
     device_id = "192999999999954"
 
-    config_spec_and_req_id = "1234"
+    config_spec_name = "SC1234"
+    request_id = "1234"
 
     file_name = "TestKafka"
     file_size = "10"
     esn = "CMMNS**19299954**************************************************************"
-    sqs_message_template = \
-        f"{file_uuid},{device_id},{file_name},{str(file_size)}," \
-        f"{'{FILE_METADATA_CURRENT_DATE_TIME}'},{j1939_data_type}," \
-        f"{'{FILE_METADATA_FILE_STAGE}'},{esn},{config_spec_and_req_id}"
+    metadata_event = MetadataEvent(file_uuid, device_id, file_name, file_size, "2024-01-17 05:54:03", j1939_data_type,
+                                   "FILE_SENT", esn, config_spec_name, request_id)
 
     headers_json = {"x-api-key": "12345"}
 
+    def setUp(self):
+        pt_poster.PENDING_PT_FILES.clear()
 
-    def test_handle_fc_params_successful(self):
+    @patch("pt_poster.write_health_parameter_to_database_v2")
+    def test_write_device_health_rows_successful(self, mock_write_health_params):
         """
-        Test for handle_fc_params() running successfully.
+        Test for write_device_health_rows() writing every collected health row.
         """
-        converted_fc_params = [
-            {
-                "protocol": "J1939",
-                "networkId": "CAN1",
-                "deviceId": "0",
-                "activeFaultCodes": [
-                    {"spn": "100", "fmi": "4", "occurenceCount": "1"},
-                    {"spn": "101", "fmi": "4", "occurenceCount": "1"}
-                ]
-            }
-        ]
-
-        response = pt_poster.handle_fc_params(self.fc_params)
-
-        self.assertEqual(response, converted_fc_params)
+        pt_poster.write_device_health_rows([("message-1", "40.3"), ("message-2", "40.4")])
 
+        self.assertEqual(mock_write_health_params.call_count, 2)
+        mock_write_health_params.assert_called_with("message-2", "40.4")
 
-    @patch("pt_poster.handle_gps_coordinates")
-    def test_handle_hb_params_successful(self, mock_handle_gps_coords):
+    @patch.dict('os.environ', {'publishKafka': 'False'})
+    @patch("pt_poster.requests")
+    @patch("pt_poster.write_device_health_rows")
+    @patch("pt_poster.transform_payload")
+    @patch("pt_poster.get_cached_secret")
+    def test_send_to_pt_transforms_payload_for_pt(self, mock_get_cached_secret: MagicMock,
+                                                  mock_transform_payload: MagicMock,
+                                                  mock_write_device_health_rows: MagicMock, _):
         """
-        Test for handle_hb_params() running successfully.
+        Test for send_to_pt() transforming the file for PT and writing the collected health rows.
         """
-        converted_hb_params = {
-            "latitude": "lat",
-            "longitude": "long",
-            "altitude": "165.236"
-        }
-
-        mock_handle_gps_coords.return_value = ("lat", "long")
+        mock_get_cached_secret.return_value = self.headers_json
+        mock_transform_payload.return_value = [("message-1",)]
+        json_body = copy.deepcopy(self.json_body)
 
-        response = pt_poster.handle_hb_params(copy.deepcopy(self.hb_params))
+        pt_poster.send_to_pt(self.post_url, self.headers, json_body, self.metadata_event, self.j1939_data_type,
+                             self.j1939_type, self.file_uuid, self.device_id, self.esn)
 
-        mock_handle_gps_coords.assert_called_with("39.202938", "-85.88672", deobfuscate=True)
-        self.assertEqual(response, converted_hb_params)
-
-
-    @patch("pt_poster.write_health_parameter_to_database_v2")
-    def test_store_device_health_params_successful(self, mock_write_health_params):
-        """
-        Test for store_device_health_params running successfully.
-        """
-        pt_poster.store_device_health_params(
-            self.hb_params,
-            "2024-01-17T05:54:00.503Z",
-            self.device_id,
-            self.esn
-        )
-        
-        mock_write_health_params.assert_called_with(
-            "8c5a1650-048e-4620-9950-bc14fa4b46b7",
-            "40.3",
-            "33.25",
-            "39.202938",
-            "-85.88672",
-            "165.236",
-            "1.159999967",
-            "20",
-            "99",
-            "255",
-            "-6",
-            "-107",
-            "2.02",
-            None,
-            None,
-            "2024-01-17 05:54:00",
-            self.device_id,
-            self.esn
-        )
+        mock_transform_payload.assert_called_once_with(json_body, "PT")
+        mock_write_device_health_rows.assert_called_once_with([("message-1",)])
 
 
     @patch.dict('os.environ', {'publishKafka': 'False'})
     @patch("pt_poster.requests")
     @patch("pt_poster.LOGGER")
-    @patch("pt_poster.publish_message")
+    @patch("pt_poster.publish_to_kafka")
     @patch("pt_poster.create_irs_message")
-    @patch("pt_poster.store_device_health_params")
-    @patch("pt_poster.handle_hb_params")
-    @patch("pt_poster.get_json_value_from_secrets_manager")
+    @patch("pt_poster.write_device_health_rows")
+    @patch("pt_poster.transform_payload")
+    @patch("pt_poster.get_cached_secret")
     def test_send_to_pt_given(self, mocK_sec_client: MagicMock,
                               hb_params: MagicMock(), health_params: MagicMock,
                               create_kafka: MagicMock, publish_message: MagicMock,
                               mock_logger: MagicMock, mock_requests: MagicMock):
         mocK_sec_client.return_value = self.headers_json
-        hb_params.return_value = self.hb_params
+        hb_params.return_value = []
 
         pt_poster.send_to_pt(self.post_url,
-                             self.headers, self.json_body, self.sqs_message_template, self.j1939_data_type,
+                             self.headers, self.json_body, self.metadata_event, self.j1939_data_type,
                              self.j1939_type,
                              self.file_uuid, self.device_id, self.esn)
         create_kafka.assert_not_called()
@@ -234,23 +196,170 @@ class MyTestCase(unittest.TestCase):
     @patch.dict('os.environ', {'publishKafka': 'True'})
     @patch("pt_poster.LOGGER")
     @patch("pt_poster.requests")
-    @patch("pt_poster.publish_message")
+    @patch("pt_poster.publish_to_kafka")
     @patch("pt_poster.create_irs_message")
-    @patch("pt_poster.store_device_health_params")
-    @patch("pt_poster.handle_hb_params")
-    @patch("pt_poster.get_json_value_from_secrets_manager")
+    @patch("pt_poster.write_device_health_rows")
+    @patch("pt_poster.transform_payload")
+    @patch("pt_poster.get_cached_secret")
     def test_send_to_pt_given_publish_kafka_then_publish_message(self, mocK_sec_client: MagicMock,
                                                                  hb_params: MagicMock(), health_params: MagicMock,
                                                                  create_kafka: MagicMock, publish_message: MagicMock,
                                                                  mock_requests: MagicMock, mock_util: MagicMock):
         mocK_sec_client.return_value = self.headers_json
-        hb_params.return_value = self.hb_params
+        hb_params.return_value = []
         pt_poster.send_to_pt(self.post_url,
-                             self.headers, self.json_body, self.sqs_message_template, self.j1939_data_type,
+                             self.headers, self.json_body, self.metadata_event, self.j1939_data_type,
                              self.j1939_type,
                              self.file_uuid, self.device_id, self.esn)
         create_kafka.assert_called_once()
-        publish_message.assert_called_once()
+        self.assertEqual(create_kafka.call_args[0][7], self.metadata_event.to_message())
+        publish_message.assert_called_once_with("nimbuspt_j1939-j1939-pt-topic", self.device_id,
+                                                create_kafka.return_value, ANY)
+
+    @patch.dict('os.environ', {'publishKafka': 'False', 'metaWriteQueueUrl': 'queue-url'})
+    @patch("pt_poster.emit_metadata_event")
+    @patch("pt_poster.requests")
+    @patch("pt_poster.write_device_health_rows")
+    @patch("pt_poster.transform_payload")
+    @patch("pt_poster.get_cached_secret")
+    def test_send_to_pt_given_rejected_api_key_then_refresh_and_retry(self, mock_get_cached_secret: MagicMock,
+                                                                      hb_params: MagicMock, health_params: MagicMock,
+                                                                      mock_requests: MagicMock,
+                                                                      mock_emit_metadata_event: MagicMock):
+        """
+        Test for send_to_pt() refreshing the cached x-api-key and retrying once when PT returns 401.
+        """
+        mock_get_cached_secret.side_effect = [{"x-api-key": "rotated-key"}, {"x-api-key": "current-key"}]
+        hb_params.return_value = []
+        rejected_response, accepted_response = MagicMock(status_code=401), MagicMock(status_code=200)
+        rejected_response.json.return_value = {"message": "Unauthorized"}
+        accepted_response.json.return_value = {"statusCode": 200}
+        mock_requests.post.side_effect = [rejected_response, accepted_response]
+
+        pt_poster.send_to_pt(self.post_url, self.headers, copy.deepcopy(self.json_body), self.metadata_event,
+                             self.j1939_data_type, self.j1939_type, self.file_uuid, self.device_id, self.esn)
+        pt_poster.flush_pt_files()
+
+        mock_get_cached_secret.assert_called_with("123123", force_refresh=True)
+        self.assertEqual(mock_requests.post.call_count, 2)
+        self.assertEqual(mock_requests.post.call_args[1]["headers"]["x-api-key"], "current-key")
+        mock_emit_metadata_event.assert_called_once()
+
+    @patch.dict('os.environ', {'publishKafka': 'False', 'metaWriteQueueUrl': 'queue-url'})
+    @patch("pt_poster.write_to_audit_table")
+    @patch("pt_poster.emit_metadata_event")
+    @patch("pt_poster.requests")
+    @patch("pt_poster.write_device_health_rows", MagicMock())
+    @patch("pt_poster.transform_payload", MagicMock())
+    @patch("pt_poster.get_cached_secret")
+    def test_send_to_pt_batches_files(self, mock_get_cached_secret: MagicMock, mock_requests: MagicMock,
+                                      mock_emit_metadata_event: MagicMock, mock_write_to_audit_table: MagicMock):
+        """
+        Test for send_to_pt() posting the files of the batch together once PT_BATCH_SIZE files are queued.
+        """
+        mock_get_cached_secret.return_value = self.headers_json
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.json.return_value = {"statusCode": 200}
+
+        with patch("pt_poster.PT_BATCH_SIZE", 3):
+            for _ in range(4):
+                pt_poster.send_to_pt(self.post_url, self.headers, copy.deepcopy(self.json_body),
+                                     self.metadata_event, self.j1939_data_type, self.j1939_type, self.file_uuid,
+                                     self.device_id, self.esn)
+            self.assertEqual(mock_requests.post.call_count, 1)
+            pt_poster.flush_pt_files()
+
+        self.assertEqual(mock_requests.post.call_count, 2)
+        self.assertEqual(len(json.loads(mock_requests.post.call_args_list[0][1]["data"])), 3)
+        self.assertEqual(len(json.loads(mock_requests.post.call_args_list[1][1]["data"])), 1)
+        self.assertEqual(mock_emit_metadata_event.call_count, 4)
+        mock_emit_metadata_event.assert_called_with(self.metadata_event)
+        mock_write_to_audit_table.assert_not_called()
+
+    @patch("pt_poster.post_pt_files")
+    def test_queue_pt_file_bounded_by_bytes(self, mock_post_pt_files: MagicMock):
+        """
+        Test for queue_pt_file() posting the batch before a file would make it exceed PT_BATCH_MAX_BYTES.
+        """
+        with patch("pt_poster.PT_BATCH_MAX_BYTES", 25):
+            pt_poster.queue_pt_file(self.post_url, self.headers, '{"file": 1}', "template-1", "FC", "device-1")
+            pt_poster.queue_pt_file(self.post_url, self.headers, '{"file": 2}', "template-2", "FC", "device-2")
+            mock_post_pt_files.assert_not_called()
+            pt_poster.queue_pt_file(self.post_url, self.headers, '{"file": 3}', "template-3", "FC", "device-3")
+
+        mock_post_pt_files.assert_called_once()
+        self.assertEqual([pt_file.device_id for pt_file in mock_post_pt_files.call_args[0][2]],
+                         ["device-1", "device-2"])
+
+    @patch.dict('os.environ', {'metaWriteQueueUrl': 'queue-url'})
+    @patch("pt_poster.write_to_audit_table")
+    @patch("pt_poster.emit_metadata_event")
+    @patch("pt_poster.requests")
+    @patch("pt_poster.get_cached_secret")
+    def test_post_pt_files_maps_results_per_file(self, mock_get_cached_secret: MagicMock, mock_requests: MagicMock,
+                                                 mock_emit_metadata_event: MagicMock,
+                                                 mock_write_to_audit_table: MagicMock):
+        """
+        Test for post_pt_files() mapping a response with one result per file back to the files.
+        """
+        mock_get_cached_secret.return_value = self.headers_json
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.json.return_value = [{"statusCode": 200}, {"statusCode": 400}]
+        pt_files = [pt_poster.PendingPtFile('{"file": 1}', 11, self.metadata_event._replace(file_name="file-1"),
+                                            "FC", "device-1"),
+                    pt_poster.PendingPtFile('{"file": 2}', 11, self.metadata_event._replace(file_name="file-2"),
+                                            "FC", "device-2")]
+
+        pt_poster.post_pt_files(self.post_url, self.headers, pt_files)
+
+        mock_requests.post.assert_called_once_with(url=self.post_url, data='[{"file": 1},{"file": 2}]', headers=ANY)
+        mock_emit_metadata_event.assert_called_once_with(self.metadata_event._replace(file_name="file-1"))
+        mock_write_to_audit_table.assert_called_once_with("FC", {"statusCode": 400}, "device-2")
+
+    @patch.dict('os.environ', {'metaWriteQueueUrl': 'queue-url'})
+    @patch("pt_poster.write_to_audit_table")
+    @patch("pt_poster.emit_metadata_event")
+    @patch("pt_poster.requests")
+    @patch("pt_poster.get_cached_secret")
+    def test_post_pt_files_rejected_batch_posted_per_file(self, mock_get_cached_secret: MagicMock,
+                                                          mock_requests: MagicMock, mock_emit_metadata_event: MagicMock,
+                                                          mock_write_to_audit_table: MagicMock):
+        """
+        Test for post_pt_files() posting the files one at a time when PT rejects the batch as a whole.
+        """
+        mock_get_cached_secret.return_value = self.headers_json
+        responses = [MagicMock(status_code=400), MagicMock(status_code=200), MagicMock(status_code=400)]
+        for response, response_body in zip(responses, [{"statusCode": 400}, {"statusCode": 200}, {"statusCode": 400}]):
+            response.json.return_value = response_body
+        mock_requests.post.side_effect = responses
+        pt_files = [pt_poster.PendingPtFile('{"file": 1}', 11, self.metadata_event._replace(file_name="file-1"),
+                                            "FC", "device-1"),
+                    pt_poster.PendingPtFile('{"file": 2}', 11, self.metadata_event._replace(file_name="file-2"),
+                                            "FC", "device-2")]
+
+        pt_poster.post_pt_files(self.post_url, self.headers, pt_files)
+
+        self.assertEqual(mock_requests.post.call_count, 3)
+        mock_emit_metadata_event.assert_called_once_with(self.metadata_event._replace(file_name="file-1"))
+        mock_write_to_audit_table.assert_called_once_with("FC", {"statusCode": 400}, "device-2")
+
+    @patch("pt_poster.write_to_audit_table")
+    def test_handle_kafka_delivery_failed(self, mock_write_to_audit_table: MagicMock):
+        """
+        Test for handle_kafka_delivery() writing a failed delivery to the audit table.
+        """
+        pt_poster.handle_kafka_delivery(self.j1939_data_type, self.device_id, "delivery error")
+
+        mock_write_to_audit_table.assert_called_with(self.j1939_data_type, "delivery error", self.device_id)
+
+    @patch("pt_poster.write_to_audit_table")
+    def test_handle_kafka_delivery_successful(self, mock_write_to_audit_table: MagicMock):
+        """
+        Test for handle_kafka_delivery() not auditing a delivered message.
+        """
+        pt_poster.handle_kafka_delivery(self.j1939_data_type, self.device_id, None)
+
+        mock_write_to_audit_table.assert_not_called()
 
 
 if __name__ == '__main__':
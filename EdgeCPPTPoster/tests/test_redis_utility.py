@@ -1,6 +1,8 @@
 import sys
+import time
 import unittest
-from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock, call
 
 sys.path.append("../")
 
@@ -15,13 +17,24 @@ with  CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.en
     cda_module_mock_context.mock_module("edge_db_lambda_client"),
     cda_module_mock_context.mock_module("rediscluster")
     cda_module_mock_context.mock_module("boto3")
-    cda_module_mock_context.mock_module("edge_secretsmanager_utility_layer")
+    cda_module_mock_context.mock_module("utilities.secrets_utility")
 
-    from utilities.redis_utility import get_redis_connection, get_set_redis_value
+    import utilities.redis_utility as redis_utility
+    from utilities.redis_utility import get_redis_connection, get_set_redis_value, get_redis_values, \
+        get_set_redis_values, get_key_slot
 
 
 class TestRedisUtility(unittest.TestCase):
 
+    def setUp(self):
+        redis_utility.NEAR_CACHE.clear()
+        self.breaker_patcher = patch("utilities.redis_utility.REDIS_BREAKER",
+                                     redis_utility.CircuitBreaker("redis", 3, 30))
+        self.breaker_patcher.start()
+
+    def tearDown(self):
+        self.breaker_patcher.stop()
+
     @patch("utilities.redis_utility.RedisCluster")
     def test_getRedisConnection_whenGetRedisConnectionIsCalledAndExceptionOccurs_thenNoneIsReturned(self,
                                                                                                     mock_redis_cluster):
@@ -65,20 +78,316 @@ class TestRedisUtility(unittest.TestCase):
         mock_get_redis_connection.assert_not_called()
         mock_read_from_the_edge_database.execute.assert_not_called()
 
+    @patch("utilities.redis_utility.get_redis_connection")
+    def test_getRedisClient_whenCalledConcurrently_thenConnectedOnce(self, mock_get_redis_connection):
+        print("<---test_getRedisClient_whenCalledConcurrently_thenConnectedOnce--->")
+
+        def get_redis_connection():
+            time.sleep(0.05)
+            return MagicMock()
+        mock_get_redis_connection.side_effect = get_redis_connection
+
+        with patch("utilities.redis_utility.REDIS_CLIENT", None):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                redis_clients = list(executor.map(lambda _: redis_utility._get_redis_client(), range(4)))
+
+        mock_get_redis_connection.assert_called_once()
+        self.assertTrue(all(redis_client is redis_clients[0] for redis_client in redis_clients))
+
     @patch("utilities.redis_utility.EDGE_DB_CLIENT")
     @patch("utilities.redis_utility.get_redis_connection")
-    def test_getSetRedisValue_whenGetSetRedisValueIsCalledAndErrorOccurred_thenExceptionOccurred(
+    def test_getSetRedisValue_whenGetSetRedisValueIsCalledAndConnectionFailed_thenDBFallbackUsed(
             self, mock_get_redis_connection, mock_read_from_the_edge_database):
-        print("<---test_getSetRedisValue_whenGetSetRedisValueIsCalledAndErrorOccurred_thenExceptionOccurred--->")
+        print("<---test_getSetRedisValue_whenGetSetRedisValueIsCalledAndConnectionFailed_thenDBFallbackUsed--->")
 
         mock_get_redis_connection.return_value = None
+        mock_read_from_the_edge_database.execute.return_value = [{"test": "test"}]
 
         with patch("utilities.redis_utility.REDIS_CLIENT", None):
-            get_set_redis_value("test_key", "test_query", 3600)
+            result = get_set_redis_value("test_key", "test_query", 3600)
 
-        self.assertRaises(Exception)
+        self.assertEqual(result, [{"test": "test"}])
         mock_get_redis_connection.assert_called()
-        mock_read_from_the_edge_database.execute.assert_not_called()
+        mock_read_from_the_edge_database.execute.assert_called_once_with("test_query")
+        self.assertEqual(redis_utility.REDIS_BREAKER.consecutive_failures, 1)
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.get_redis_connection")
+    def test_getSetRedisValue_whenBreakerIsOpen_thenRedisNotConnected(self, mock_get_redis_connection,
+                                                                      mock_read_from_the_edge_database):
+        print("<---test_getSetRedisValue_whenBreakerIsOpen_thenRedisNotConnected--->")
+
+        mock_get_redis_connection.return_value = None
+        mock_read_from_the_edge_database.execute.return_value = []
+
+        with patch("utilities.redis_utility.REDIS_CLIENT", None):
+            for index in range(5):
+                get_set_redis_value(f"test_key_{index}", "test_query", 3600)
+
+        self.assertEqual(mock_get_redis_connection.call_count, 3)
+        self.assertEqual(redis_utility.REDIS_BREAKER.state, "OPEN")
+        self.assertEqual(mock_read_from_the_edge_database.execute.call_count, 5)
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisValue_whenRedisCommandFails_thenDBFallbackUsed(self, mock_redis_client,
+                                                                       mock_read_from_the_edge_database):
+        print("<---test_getSetRedisValue_whenRedisCommandFails_thenDBFallbackUsed--->")
+
+        mock_redis_client.get.side_effect = Exception("Mock redis timeout")
+        mock_read_from_the_edge_database.execute.return_value = [{"test": "test"}]
+
+        result = get_set_redis_value("test_key", "test_query", 3600)
+
+        self.assertEqual(result, [{"test": "test"}])
+        mock_redis_client.set.assert_not_called()
+        self.assertEqual(redis_utility.REDIS_BREAKER.consecutive_failures, 1)
+
+    @patch("utilities.redis_utility.DB_FALLBACK_RATE", 1)
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.get_redis_connection")
+    def test_getSetRedisValue_whenDBFallbackRateExceeded_thenExceptionRaised(self, mock_get_redis_connection,
+                                                                             mock_read_from_the_edge_database):
+        print("<---test_getSetRedisValue_whenDBFallbackRateExceeded_thenExceptionRaised--->")
+
+        mock_get_redis_connection.return_value = None
+        mock_read_from_the_edge_database.execute.return_value = []
+
+        with patch("utilities.redis_utility.REDIS_CLIENT", None), \
+                patch("utilities.redis_utility.DB_FALLBACK_TOKENS", 1):
+            get_set_redis_value("test_key_1", "test_query", 3600)
+            with self.assertRaises(RuntimeError):
+                get_set_redis_value("test_key_2", "test_query", 3600)
+
+        mock_read_from_the_edge_database.execute.assert_called_once_with("test_query")
+
+    def test_getKeySlot_whenKeysAreHashed_thenRedisClusterSlotsReturned(self):
+        print("<---test_getKeySlot_whenKeysAreHashed_thenRedisClusterSlotsReturned--->")
+
+        self.assertEqual(get_key_slot("foo"), 12182)
+        self.assertEqual(get_key_slot("{user1000}.following"), get_key_slot("{user1000}.followers"))
+        self.assertEqual(get_key_slot("foo{bar}"), get_key_slot("bar"))
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getRedisValues_whenKeysAreInDifferentSlots_thenOneMGETPerSlotPipelined(self, mock_redis_client):
+        print("<---test_getRedisValues_whenKeysAreInDifferentSlots_thenOneMGETPerSlotPipelined--->")
+
+        mock_pipeline = mock_redis_client.pipeline.return_value
+        mock_pipeline.execute.return_value = [['{"state": "DONE"}', None], [None]]
+
+        result = get_redis_values(["{x}a", "{x}b", "{y}c"])
+
+        self.assertEqual(result, {"{x}a": {"state": "DONE"}})
+        self.assertEqual(mock_pipeline.execute_command.call_args_list,
+                         [call("MGET", "{x}a", "{x}b"), call("MGET", "{y}c")])
+        mock_pipeline.execute.assert_called_once()
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisValues_whenSomeKeysAreMissed_thenOneMGETPerSlotAndOneDBQuery(self, mock_redis_client,
+                                                                                   mock_invoke_db_reader):
+        print("<---test_getSetRedisValues_whenSomeKeysAreMissed_thenOneMGETPerSlotAndOneDBQuery--->")
+
+        mock_pipeline = mock_redis_client.pipeline.return_value
+        mock_pipeline.execute.side_effect = [[['[{"request_id": "cached"}]', None], [None]], [True, True]]
+        query_misses = MagicMock(return_value={"{x}b": [{"request_id": "from-db"}], "{y}c": []})
+
+        result = get_set_redis_values(["{x}a", "{x}b", "{y}c"], query_misses, 3600)
+
+        self.assertEqual(result, {"{x}a": [{"request_id": "cached"}], "{x}b": [{"request_id": "from-db"}],
+                                  "{y}c": []})
+        self.assertEqual(mock_pipeline.execute_command.call_args_list,
+                         [call("MGET", "{x}a", "{x}b"), call("MGET", "{y}c")])
+        query_misses.assert_called_once_with(["{x}b", "{y}c"])
+        self.assertEqual(mock_pipeline.set.call_args_list,
+                         [call("{x}b", '[{"request_id": "from-db"}]', ex=3600), call("{y}c", '[]', ex=3600)])
+        self.assertEqual(mock_pipeline.execute.call_count, 2)
+        mock_redis_client.get.assert_not_called()
+        mock_invoke_db_reader.execute.assert_not_called()
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisValues_whenKeysAreInNearCache_thenRedisNotCalled(self, mock_redis_client):
+        print("<---test_getSetRedisValues_whenKeysAreInNearCache_thenRedisNotCalled--->")
+
+        redis_utility.set_near_cache_value("test_key", [], 3600)
+        query_misses = MagicMock()
+
+        self.assertEqual(get_set_redis_values(["test_key"], query_misses, 3600), {"test_key": []})
+        mock_redis_client.pipeline.assert_not_called()
+        query_misses.assert_not_called()
+
+    @patch("utilities.redis_utility.get_redis_connection")
+    def test_getSetRedisValues_whenRedisIsUnavailable_thenMissesQueriedOnce(self, mock_get_redis_connection):
+        print("<---test_getSetRedisValues_whenRedisIsUnavailable_thenMissesQueriedOnce--->")
+
+        mock_get_redis_connection.return_value = None
+        query_misses = MagicMock(return_value={"a": [{"request_id": "from-db"}], "b": []})
+
+        with patch("utilities.redis_utility.REDIS_CLIENT", None):
+            result = get_set_redis_values(["a", "b"], query_misses, 3600)
+
+        self.assertEqual(result, {"a": [{"request_id": "from-db"}], "b": []})
+        query_misses.assert_called_once_with(["a", "b"])
+
+    @patch("utilities.redis_utility.get_redis_connection")
+    def test_getRedisValues_whenRedisIsUnavailable_thenEmptyDictReturned(self, mock_get_redis_connection):
+        print("<---test_getRedisValues_whenRedisIsUnavailable_thenEmptyDictReturned--->")
+
+        mock_get_redis_connection.return_value = None
+
+        with patch("utilities.redis_utility.REDIS_CLIENT", None):
+            self.assertEqual(get_redis_values(["test_key"]), {})
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisValue_whenValueIsInNearCache_thenRedisNotCalled(self, mock_redis_client,
+                                                                        mock_invoke_db_reader):
+        print("<---test_getSetRedisValue_whenValueIsInNearCache_thenRedisNotCalled--->")
+
+        mock_redis_client.get.return_value = '[{"request_id": "cached"}]'
+
+        first_result = get_set_redis_value("test_key", "test_query", 3600)
+        second_result = get_set_redis_value("test_key", "test_query", 3600)
+
+        self.assertEqual(first_result, second_result)
+        mock_redis_client.get.assert_called_once_with("test_key")
+        mock_invoke_db_reader.execute.assert_not_called()
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisValue_whenNearCacheEntryExpired_thenRedisCalled(self, mock_redis_client):
+        print("<---test_getSetRedisValue_whenNearCacheEntryExpired_thenRedisCalled--->")
+
+        mock_redis_client.get.return_value = '[{"request_id": "cached"}]'
+
+        with patch("utilities.redis_utility.NEAR_CACHE_TTL", 0):
+            get_set_redis_value("test_key", "test_query", 3600)
+            get_set_redis_value("test_key", "test_query", 3600)
+
+        self.assertEqual(mock_redis_client.get.call_count, 2)
+
+    def test_setNearCacheValue_whenCacheIsFull_thenLeastRecentlyUsedEvicted(self):
+        print("<---test_setNearCacheValue_whenCacheIsFull_thenLeastRecentlyUsedEvicted--->")
+
+        with patch("utilities.redis_utility.NEAR_CACHE_SIZE", 2):
+            redis_utility.set_near_cache_value("key_1", "value_1", 3600)
+            redis_utility.set_near_cache_value("key_2", "value_2", 3600)
+            redis_utility.get_near_cache_value("key_1")
+            redis_utility.set_near_cache_value("key_3", "value_3", 3600)
+
+        self.assertEqual(list(redis_utility.NEAR_CACHE), ["key_1", "key_3"])
+
+    def test_invalidateNearCache_whenDeviceKeysCached_thenOnlyDeviceKeysDropped(self):
+        print("<---test_invalidateNearCache_whenDeviceKeysCached_thenOnlyDeviceKeysDropped--->")
+
+        redis_utility.set_near_cache_value("req_id@@j1939_hb@@edge_111_64200027_sc8091", "value_1", 3600)
+        redis_utility.set_near_cache_value("req_id@@j1939_fc@@edge_111_64200027_sc8092", "value_2", 3600)
+        redis_utility.set_near_cache_value("req_id@@j1939_hb@@edge_1112_64200028_sc8091", "value_3", 3600)
+
+        redis_utility.invalidate_near_cache("@@edge_111_")
+
+        self.assertEqual(list(redis_utility.NEAR_CACHE), ["req_id@@j1939_hb@@edge_1112_64200028_sc8091"])
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisHash_whenHashIsMissing_thenHashBuiltFromDBAndStored(self, mock_redis_client,
+                                                                            mock_invoke_db_reader):
+        print("<---test_getSetRedisHash_whenHashIsMissing_thenHashBuiltFromDBAndStored--->")
+
+        mock_redis_client.hgetall.return_value = {}
+        mock_invoke_db_reader.execute.return_value = [{"field": "a", "value": 1}]
+        mock_pipeline = mock_redis_client.pipeline.return_value
+
+        result = redis_utility.get_set_redis_hash("test_key", "test_query", 3600,
+                                                  lambda rows: {row["field"]: row["value"] for row in rows})
+
+        self.assertEqual(result, {"a": 1})
+        mock_pipeline.hset.assert_any_call("test_key", "@@loaded", "1")
+        mock_pipeline.hset.assert_any_call("test_key", "a", "1")
+        mock_pipeline.expire.assert_called_once_with("test_key", 3600)
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisHash_whenHashIsStored_thenDBNotCalled(self, mock_redis_client, mock_invoke_db_reader):
+        print("<---test_getSetRedisHash_whenHashIsStored_thenDBNotCalled--->")
+
+        mock_redis_client.hgetall.return_value = {"@@loaded": "1", "a": '[{"request_id": "req-id"}]'}
+
+        result = redis_utility.get_set_redis_hash("test_key", "test_query", 3600, MagicMock())
+
+        self.assertEqual(result, {"a": [{"request_id": "req-id"}]})
+        mock_invoke_db_reader.execute.assert_not_called()
+
+    @patch("utilities.redis_utility.EDGE_DB_CLIENT")
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_getSetRedisHash_whenHashIsNotLoaded_thenHashBuiltFromDB(self, mock_redis_client, mock_invoke_db_reader):
+        print("<---test_getSetRedisHash_whenHashIsNotLoaded_thenHashBuiltFromDB--->")
+
+        mock_redis_client.hgetall.return_value = {"a": "[]"}
+        mock_invoke_db_reader.execute.return_value = [{"field": "a", "value": 1}]
+
+        result = redis_utility.get_set_redis_hash("test_key", "test_query", 3600,
+                                                  lambda rows: {row["field"]: row["value"] for row in rows})
+
+        self.assertEqual(result, {"a": 1})
+        mock_invoke_db_reader.execute.assert_called_once_with("test_query")
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_setRedisHashField_whenHashIsStored_thenFieldWritten(self, mock_redis_client):
+        print("<---test_setRedisHashField_whenHashIsStored_thenFieldWritten--->")
+
+        redis_utility.set_near_cache_value("test_key", {"a": 1}, 3600)
+
+        redis_utility.set_redis_hash_field("test_key", "b", [])
+
+        mock_redis_client.hset.assert_called_once_with("test_key", "b", "[]")
+        self.assertEqual(redis_utility.get_near_cache_value("test_key"), {"a": 1, "b": []})
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_deleteRedisHashFields_whenHashIsStored_thenMatchingFieldsDeleted(self, mock_redis_client):
+        print("<---test_deleteRedisHashFields_whenHashIsStored_thenMatchingFieldsDeleted--->")
+
+        mock_redis_client.hgetall.return_value = {"@@loaded": "1", "a": "1", "b": "[]", "c": "[]"}
+        redis_utility.set_near_cache_value("test_key", {"a": 1, "b": [], "c": []}, 3600)
+
+        redis_utility.delete_redis_hash_fields("test_key", lambda value: value == [])
+
+        mock_redis_client.hdel.assert_called_once_with("test_key", "b", "c")
+        self.assertEqual(redis_utility.get_near_cache_value("test_key"), {"a": 1})
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_updateRedisHash_whenHashIsStored_thenChangedFieldsWritten(self, mock_redis_client):
+        print("<---test_updateRedisHash_whenHashIsStored_thenChangedFieldsWritten--->")
+
+        mock_redis_client.hgetall.return_value = {"@@loaded": "1", "a": "1", "b": "2"}
+        mock_pipeline = mock_redis_client.pipeline.return_value
+        redis_utility.set_near_cache_value("test_key", {"a": 1, "b": 2}, 3600)
+
+        redis_utility.update_redis_hash("test_key", lambda value: value * 10 if value == 1 else None)
+
+        mock_pipeline.hset.assert_called_once_with("test_key", "a", "10")
+        self.assertEqual(redis_utility.get_near_cache_value("test_key"), {"a": 10, "b": 2})
+
+    @patch("utilities.redis_utility.REDIS_CLIENT")
+    def test_setRedisValueIfAbsent_whenKeyExists_thenStoredValueReturned(self, mock_redis_client):
+        print("<---test_setRedisValueIfAbsent_whenKeyExists_thenStoredValueReturned--->")
+
+        mock_pipeline = mock_redis_client.pipeline.return_value
+        mock_pipeline.execute.return_value = [None, '{"state": "DONE"}']
+
+        result = redis_utility.set_redis_value_if_absent("test_key", {"state": "IN_PROGRESS"}, 900)
+
+        mock_pipeline.set.assert_called_with("test_key", '{"state": "IN_PROGRESS"}', nx=True, ex=900)
+        mock_pipeline.get.assert_called_with("test_key")
+        self.assertEqual(result, (False, {"state": "DONE"}))
+
+    @patch("utilities.redis_utility.get_redis_connection")
+    @patch("utilities.redis_utility.REDIS_CLIENT", None)
+    def test_setRedisValueIfAbsent_whenRedisIsUnavailable_thenNoneReturned(self, mock_get_redis_connection):
+        print("<---test_setRedisValueIfAbsent_whenRedisIsUnavailable_thenNoneReturned--->")
+
+        mock_get_redis_connection.return_value = None
+
+        self.assertIsNone(redis_utility.set_redis_value_if_absent("test_key", {"state": "IN_PROGRESS"}, 900))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+import sys
+import json
+import unittest
+from unittest.mock import patch
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug",
+    "SecretCacheTtl": "300"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("boto3")
+
+    from utilities import secrets_utility
+
+
+def _secret_value(value, version_id):
+    return {"SecretString": json.dumps(value), "VersionId": version_id}
+
+
+@patch("utilities.secrets_utility.SECRETS_MANAGER_CLIENT")
+class TestSecretsUtility(unittest.TestCase):
+    """
+    Test module for utilities/secrets_utility.py
+    """
+
+    def setUp(self):
+        secrets_utility.SECRETS_CACHE.clear()
+
+    def test_get_cached_secret_within_ttl(self, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() retrieving the secret once while it is within the TTL.
+        """
+        mock_secrets_manager_client.get_secret_value.return_value = _secret_value({"x-api-key": "key-1"}, "v1")
+
+        first_response = secrets_utility.get_cached_secret("pt_xapi_key")
+        second_response = secrets_utility.get_cached_secret("pt_xapi_key")
+
+        self.assertEqual(first_response, {"x-api-key": "key-1"})
+        self.assertEqual(second_response, first_response)
+        mock_secrets_manager_client.get_secret_value.assert_called_once_with(SecretId="pt_xapi_key")
+        mock_secrets_manager_client.describe_secret.assert_not_called()
+
+    @patch("utilities.secrets_utility.time.monotonic")
+    def test_get_cached_secret_after_ttl_same_version(self, mock_monotonic, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() keeping the cached value after the TTL when the current version did not change.
+        """
+        mock_monotonic.side_effect = [0, 600, 600]
+        mock_secrets_manager_client.get_secret_value.return_value = _secret_value({"x-api-key": "key-1"}, "v1")
+        mock_secrets_manager_client.describe_secret.return_value = {
+            "VersionIdsToStages": {"v0": ["AWSPREVIOUS"], "v1": ["AWSCURRENT"]}
+        }
+
+        secrets_utility.get_cached_secret("pt_xapi_key")
+        response = secrets_utility.get_cached_secret("pt_xapi_key")
+
+        self.assertEqual(response, {"x-api-key": "key-1"})
+        mock_secrets_manager_client.get_secret_value.assert_called_once()
+        mock_secrets_manager_client.describe_secret.assert_called_once_with(SecretId="pt_xapi_key")
+
+    @patch("utilities.secrets_utility.time.monotonic")
+    def test_get_cached_secret_after_ttl_new_version(self, mock_monotonic, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() retrieving the value again after the TTL when the secret was rotated.
+        """
+        mock_monotonic.side_effect = [0, 600, 600]
+        mock_secrets_manager_client.get_secret_value.side_effect = [_secret_value({"x-api-key": "key-1"}, "v1"),
+                                                                    _secret_value({"x-api-key": "key-2"}, "v2")]
+        mock_secrets_manager_client.describe_secret.return_value = {
+            "VersionIdsToStages": {"v1": ["AWSPREVIOUS"], "v2": ["AWSCURRENT"]}
+        }
+
+        secrets_utility.get_cached_secret("pt_xapi_key")
+        response = secrets_utility.get_cached_secret("pt_xapi_key")
+
+        self.assertEqual(response, {"x-api-key": "key-2"})
+        self.assertEqual(mock_secrets_manager_client.get_secret_value.call_count, 2)
+
+    def test_get_cached_secret_force_refresh(self, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() skipping the cache when a refresh is forced.
+        """
+        mock_secrets_manager_client.get_secret_value.side_effect = [_secret_value({"x-api-key": "key-1"}, "v1"),
+                                                                    _secret_value({"x-api-key": "key-2"}, "v2")]
+
+        secrets_utility.get_cached_secret("pt_xapi_key")
+        response = secrets_utility.get_cached_secret("pt_xapi_key", force_refresh=True)
+
+        self.assertEqual(response, {"x-api-key": "key-2"})
+        mock_secrets_manager_client.describe_secret.assert_not_called()
+
+    def test_get_cached_secret_exception(self, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() returning None when the secret was never retrieved and the stale value otherwise.
+        """
+        mock_secrets_manager_client.get_secret_value.side_effect = [Exception("Mock secrets manager exception"),
+                                                                    _secret_value({"x-api-key": "key-1"}, "v1"),
+                                                                    Exception("Mock secrets manager exception")]
+
+        self.assertIsNone(secrets_utility.get_cached_secret("pt_xapi_key"))
+        secrets_utility.get_cached_secret("pt_xapi_key")
+        response = secrets_utility.get_cached_secret("pt_xapi_key", force_refresh=True)
+
+        self.assertEqual(response, {"x-api-key": "key-1"})
+
+
+    def test_get_cached_secret_retrieved_without_lock(self, mock_secrets_manager_client):
+        """
+        Test for get_cached_secret() calling the Secrets Manager without holding the cache lock.
+        """
+        def get_secret_value(**_):
+            self.assertTrue(secrets_utility.CACHE_LOCK.acquire(blocking=False))
+            secrets_utility.CACHE_LOCK.release()
+            return _secret_value({"x-api-key": "key-1"}, "v1")
+        mock_secrets_manager_client.get_secret_value.side_effect = get_secret_value
+
+        response = secrets_utility.get_cached_secret("pt_xapi_key")
+
+        self.assertEqual(response, {"x-api-key": "key-1"})
+        self.assertEqual(secrets_utility.SECRETS_CACHE["pt_xapi_key"]["version_id"], "v1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append("../")
+
+from tests.cda_module_mock_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
+    "LoggingLevel": "debug"
+}):
+    cda_module_mock_context.mock_module("utility")
+    cda_module_mock_context.mock_module("boto3")
+
+    from utilities import sqs_utility
+
+ENTRIES = [{"Id": "0", "MessageBody": "message-0"}, {"Id": "1", "MessageBody": "message-1"}]
+
+
+class TestSqsUtility(unittest.TestCase):
+    """
+    Test module for utilities/sqs_utility.py
+    """
+
+    @patch("utilities.sqs_utility.SQS_CLIENT")
+    def test_sqs_send_message_batch(self, mock_sqs_client):
+        """
+        Test for sqs_send_message_batch() returning the response with the failed entries to the caller.
+        """
+        response = {"Successful": [{"Id": "0"}], "Failed": [{"Id": "1", "SenderFault": False}]}
+        mock_sqs_client.send_message_batch.return_value = response
+
+        self.assertEqual(sqs_utility.sqs_send_message_batch("queue-url", ENTRIES), response)
+        mock_sqs_client.send_message_batch.assert_called_once_with(QueueUrl="queue-url", Entries=ENTRIES)
+
+    @patch("utilities.sqs_utility.LOGGER")
+    @patch("utilities.sqs_utility.SQS_CLIENT")
+    def test_sqs_send_message_batch_logs_and_raises(self, mock_sqs_client, mock_logger):
+        """
+        Test for sqs_send_message_batch() logging the error of SendMessageBatch and raising it again.
+        """
+        mock_sqs_client.send_message_batch.side_effect = Exception("Mock SQS exception")
+
+        with self.assertRaisesRegex(Exception, "Mock SQS exception"):
+            sqs_utility.sqs_send_message_batch("queue-url", ENTRIES)
+        mock_logger.error.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
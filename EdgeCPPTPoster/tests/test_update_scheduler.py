@@ -1,7 +1,8 @@
 import sys
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from tests.cda_module_mock_context import CDAModuleMockingContext
 
@@ -87,14 +88,18 @@ class TestUpdateScheduler(unittest.TestCase):
         self.assertEqual(response, expected_response)
 
 
+    @patch("update_scheduler.get_near_cache_value", MagicMock(return_value=None))
     @patch("update_scheduler._get_request_id_from_consumption_view_query")
-    @patch("update_scheduler.get_set_redis_value")
-    def test_get_request_id_from_consumption_view_successful(self, mock_get_set_redis_value, mock_query_fn):
+    @patch("update_scheduler.EDGE_DB_CLIENT")
+    @patch("update_scheduler.get_set_redis_values")
+    def test_get_request_id_from_consumption_view_successful(self, mock_get_set_redis_values, mock_db_client,
+                                                             mock_query_fn):
         """
         Test for get_request_id_from_consumption_view() running successfully.
         """
         mock_query_fn.return_value = "query"
-        mock_get_set_redis_value.return_value = [{"request_id": "req-id"}]
+        mock_db_client.execute.return_value = [{"request_id": "req-id"}]
+        mock_get_set_redis_values.side_effect = lambda redis_keys, query_misses, _: query_misses(redis_keys)
         device_info = {'device_owner': 'PSBU', 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id',
                        'vin': 'vin'}
 
@@ -103,101 +108,299 @@ class TestUpdateScheduler(unittest.TestCase):
             "EDGE_357649070803120_64100016_SC5079", device_info
         )
 
-        mock_get_set_redis_value.assert_called_with(
-            "req_id@@j1939_hb@@edge_357649070803120_64100016_sc5079",
-            "query",
-            self.REDIS_EXPIRY
-        )
+        self.assertEqual(mock_get_set_redis_values.call_args[0][0],
+                         ["req_id@@j1939_hb@@edge_357649070803120_64100016_sc5079"])
+        self.assertEqual(mock_get_set_redis_values.call_args[0][2], self.REDIS_EXPIRY)
+        mock_query_fn.assert_called_once_with("J1939_HB", "EDGE_357649070803120_64100016_SC5079", device_info)
+        mock_db_client.execute.assert_called_once_with("query")
         self.assertEqual(response, "req-id")
 
-    @patch("update_scheduler._get_request_id_from_consumption_view_query")
-    @patch("update_scheduler.get_set_redis_value")
-    def test_get_request_id_from_consumption_view_on_error(self, mock_get_set_redis_value, mock_query_fn):
+    @patch("update_scheduler.get_near_cache_value", MagicMock(return_value=None))
+    @patch("update_scheduler.get_set_redis_values")
+    def test_get_request_id_from_consumption_view_on_error(self, mock_get_set_redis_values):
         """
         Test for get_request_id_from_consumption_view() when it throws an exception.
         """
-        mock_query_fn.return_value = "query"
-        mock_get_set_redis_value.side_effect = Exception
+        mock_get_set_redis_values.side_effect = Exception
 
         with self.assertRaises(Exception):
             update_scheduler.get_request_id_from_consumption_view(
                 "J1939_HB",
-                "EDGE_357649070803120_64100016_SC5079"
+                "EDGE_357649070803120_64100016_SC5079", None
             )
 
-    @patch("update_scheduler.get_update_scheduler_query")
-    @patch("update_scheduler.EDGE_DB_CLIENT")
-    def test_update_scheduler_table_successful(self, mock_db_client, mock_scheduler):
+    @patch("update_scheduler.get_near_cache_value")
+    @patch("update_scheduler.get_set_redis_values")
+    def test_get_request_id_from_consumption_view_near_cached(self, mock_get_set_redis_values,
+                                                              mock_get_near_cache_value):
         """
-        Test for update_scheduler_table() running successfully.
+        Test for get_request_id_from_consumption_view() returning a near cached request ID without waiting.
         """
-        mock_scheduler.return_value = "query"
+        mock_get_near_cache_value.return_value = [{"request_id": "req-id"}]
 
-        update_scheduler.update_scheduler_table("REQ1233", "102900000000003", {'device_owner': 'PSBU', 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id', 'vin': 'vin'})
+        response = update_scheduler.get_request_id_from_consumption_view(
+            "J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
 
-        mock_db_client.execute.assert_called_with("query", method="WRITE")
+        self.assertEqual(response, "req-id")
+        mock_get_set_redis_values.assert_not_called()
 
-    @patch("update_scheduler.get_update_scheduler_query")
     @patch("update_scheduler.EDGE_DB_CLIENT")
-    def test_update_scheduler_table_on_error(self, mock_db_client, mock_scheduler):
+    @patch("update_scheduler.get_set_redis_values")
+    def test_get_request_ids_from_consumption_view_misses_queried_once(self, mock_get_set_redis_values,
+                                                                       mock_db_client):
         """
-        Test for update_scheduler_table() when it throws an exception.
+        Test for get_request_ids_from_consumption_view() querying the request IDs missing in Redis with one query.
         """
-        mock_scheduler.return_value = "query"
-        mock_db_client.execute.side_effect = Exception
+        mock_get_set_redis_values.side_effect = lambda redis_keys, query_misses, _: dict(
+            query_misses(redis_keys[1:]), **{redis_keys[0]: [{"request_id": "cached"}]})
+        mock_db_client.execute.return_value = [
+            {"request_id": "req-2", "data_type": "J1939_CD_HB", "device_id": "357649070803121",
+             "engine_serial_number": "64100017", "config_spec_prefix": "SC5079"}
+        ]
+
+        response = update_scheduler.get_request_ids_from_consumption_view([
+            ("J1939_HB", "EDGE_357649070803120_64100016_SC5079", None),
+            ("J1939_HB", "EDGE_357649070803121_64100017_sc5079", None),
+            ("J1939_HB", "EDGE_357649070803122_64100018_SC5079", {'device_owner': 'EBU'}),
+            ("J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
+        ])
+
+        self.assertEqual(response, ["cached", "req-2", None, "cached"])
+        self.assertEqual(mock_get_set_redis_values.call_args[0][0], [
+            "req_id@@j1939_hb@@edge_357649070803120_64100016_sc5079",
+            "req_id@@j1939_hb@@edge_357649070803121_64100017_sc5079",
+            "req_id@@j1939_hb@@edge_357649070803122_64100018_sc5079"
+        ])
+        mock_db_client.execute.assert_called_once()
+        query = mock_db_client.execute.call_args[0][0]
+        self.assertIn("IN (('J1939_CD_HB','357649070803121','64100017','sc5079'))", query)
+        self.assertIn("IN (('J1939_CD_HB','357649070803122','64100018','SC5079'))", query)
+        self.assertIn("'Config Rejected','Config Association Failed'", query)
+
+    @patch("update_scheduler.REQUEST_ID_LOOKUP_WINDOW", 0.2)
+    @patch("update_scheduler.get_near_cache_value", MagicMock(return_value=None))
+    @patch("update_scheduler.get_set_redis_values")
+    def test_get_request_id_from_consumption_view_concurrent_lookups_batched(self, mock_get_set_redis_values):
+        """
+        Test for get_request_id_from_consumption_view() resolving the lookups of the worker threads together.
+        """
+        mock_get_set_redis_values.side_effect = lambda redis_keys, query_misses, _: {
+            redis_key: [{"request_id": "req@" + redis_key.split("_")[-2]}] for redis_key in redis_keys}
 
-        with self.assertRaises(Exception):
-            update_scheduler.update_scheduler_table("REQ1233", "102900000000003")
-
-    def test_get_update_scheduler_query_given_request_id_deviceid_then_return_query(self):
-        time_format = '%Y-%m-%d %H:%M:%S'
-        time_default_format = time.localtime()
-        current_date_time = time.strftime(time_format, time_default_format)
-        response = update_scheduler.get_update_scheduler_query(
-            "REQ12345",
-            "357649070803120",
-            {'device_owner': 'PSBU', 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id', 'vin': 'vin'}
-        )
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(
+                lambda esn: update_scheduler.get_request_id_from_consumption_view(
+                    "J1939_HB", f"EDGE_357649070803120_{esn}_SC5079", None),
+                ["64100016", "64100017", "64100018"]))
 
-        expected_response = "UPDATE da_edge_olympus.scheduler " + \
-                            "SET status='Data Rx In Progress',updated_date_time='"+current_date_time+"',updated_by='lambda' " + \
-                            "WHERE request_id='REQ12345' " + \
-                            "AND device_id='357649070803120' " + \
-                            "AND status IN ('Config Accepted','Config Sent')"
-        self.assertEqual(response, expected_response)
+        self.assertEqual(responses, ["req@64100016", "req@64100017", "req@64100018"])
+        mock_get_set_redis_values.assert_called_once()
 
+    def test_get_scheduler_prefetch_query_successful(self):
+        """
+        Test for _get_scheduler_prefetch_query() selecting all the active scheduler rows of the device.
+        """
+        response = update_scheduler._get_scheduler_prefetch_query("357649070803120", {'device_owner': 'PSBU'})
 
-    def test_get_update_scheduler_query_given_request_id_deviceid_ebu_device_owner_then_return_query(self):
-        time_format = '%Y-%m-%d %H:%M:%S'
-        time_default_format = time.localtime()
-        current_date_time = time.strftime(time_format, time_default_format)
-        response = update_scheduler.get_update_scheduler_query(
-            "REQ12345",
-            "357649070803120",
-            {'device_owner': 'EBU', 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id', 'vin': 'vin'}
-        )
+        expected_response = "SELECT da_edge_olympus.scheduler.request_id," + \
+            "da_edge_olympus.data_requester_information.data_type," + \
+            "da_edge_olympus.scheduler.engine_serial_number," + \
+            "SUBSTRING(da_edge_olympus.scheduler.config_spec_file_name,1,6) config_spec_prefix," + \
+            "da_edge_olympus.scheduler.status " + \
+            "FROM da_edge_olympus.data_requester_information " + \
+            "JOIN da_edge_olympus.scheduler " + \
+            "ON da_edge_olympus.data_requester_information.request_id=da_edge_olympus.scheduler.request_id " + \
+            "WHERE da_edge_olympus.scheduler.device_id='357649070803120' " + \
+            "AND da_edge_olympus.scheduler.status IN ('Config Accepted','Data Rx In Progress','Config Sent')"
 
-        expected_response = "UPDATE da_edge_olympus.scheduler " + \
-                            "SET status='Data Rx In Progress',updated_date_time='"+current_date_time+"',updated_by='lambda' " + \
-                            "WHERE request_id='REQ12345' " + \
-                            "AND device_id='357649070803120' " + \
-                            "AND status IN ('Config Accepted','Config Sent','Config Rejected','Config Association Failed')"
         self.assertEqual(response, expected_response)
 
+    def test_to_scheduler_hash_successful(self):
+        """
+        Test for _to_scheduler_hash() keying the scheduler rows by data type, ESN and config spec prefix.
+        """
+        response = update_scheduler._to_scheduler_hash([
+            {"request_id": "req-1", "data_type": "J1939_CD_HB", "engine_serial_number": "64100016",
+             "config_spec_prefix": "SC5079", "status": "Config Sent"},
+            {"request_id": "req-2", "data_type": "J1939_CD_HB", "engine_serial_number": "64100016",
+             "config_spec_prefix": "SC5080", "status": "Data Rx In Progress"}
+        ])
+
+        self.assertEqual(response, {
+            "J1939_CD_HB@@64100016@@SC5079": [{"request_id": "req-1", "status": "Config Sent"}],
+            "J1939_CD_HB@@64100016@@SC5080": [{"request_id": "req-2", "status": "Data Rx In Progress"}]
+        })
+
+    @patch("update_scheduler.SCHEDULER_PREFETCH", True)
+    @patch("update_scheduler.get_set_redis_values")
+    @patch("update_scheduler.get_set_redis_hash")
+    def test_get_request_id_from_consumption_view_prefetched(self, mock_get_set_redis_hash,
+                                                             mock_get_set_redis_values):
+        """
+        Test for get_request_id_from_consumption_view() resolving the request ID from the prefetched scheduler rows.
+        """
+        mock_get_set_redis_hash.return_value = {
+            "J1939_CD_HB@@64100016@@SC5079": [{"request_id": "req-id", "status": "Config Sent"}]
+        }
 
-    def test_get_update_scheduler_query_given_request_id_deviceid_null_device_owner_then_return_query(self):
-        time_format = '%Y-%m-%d %H:%M:%S'
-        time_default_format = time.localtime()
-        current_date_time = time.strftime(time_format, time_default_format)
-        response = update_scheduler.get_update_scheduler_query(
-            "REQ12345",
-            "357649070803120",
-            {'device_owner': None, 'pcc_claim_status': 'CLAIMED', 'cust_ref': 'cust-ref', 'equip_id': 'equip-id', 'vin': 'vin'}
-        )
+        response = update_scheduler.get_request_id_from_consumption_view(
+            "J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
+
+        self.assertEqual(response, "req-id")
+        self.assertEqual(mock_get_set_redis_hash.call_args[0][0], "scheduler@@357649070803120")
+        mock_get_set_redis_values.assert_not_called()
+
+    @patch("update_scheduler.SCHEDULER_PREFETCH", True)
+    @patch("update_scheduler.set_redis_hash_field")
+    @patch("update_scheduler.get_set_redis_values")
+    @patch("update_scheduler.get_set_redis_hash")
+    def test_get_request_id_from_consumption_view_not_prefetched(self, mock_get_set_redis_hash,
+                                                                 mock_get_set_redis_values, mock_set_redis_hash_field):
+        """
+        Test for get_request_id_from_consumption_view() caching a config spec missing in the prefetched rows as
+        having no active request, without looking it up on its own.
+        """
+        mock_get_set_redis_hash.return_value = {}
+
+        response = update_scheduler.get_request_id_from_consumption_view(
+            "J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
+
+        self.assertIsNone(response)
+        mock_set_redis_hash_field.assert_called_once_with("scheduler@@357649070803120",
+                                                          "J1939_CD_HB@@64100016@@SC5079", [])
+        mock_get_set_redis_values.assert_not_called()
+
+    @patch("update_scheduler.SCHEDULER_PREFETCH", True)
+    @patch("update_scheduler.set_redis_hash_field")
+    @patch("update_scheduler.get_set_redis_values")
+    @patch("update_scheduler.get_set_redis_hash")
+    def test_get_request_id_from_consumption_view_cached_without_request(self, mock_get_set_redis_hash,
+                                                                         mock_get_set_redis_values,
+                                                                         mock_set_redis_hash_field):
+        """
+        Test for get_request_id_from_consumption_view() returning None for a config spec cached without request.
+        """
+        mock_get_set_redis_hash.return_value = {"J1939_CD_HB@@64100016@@SC5079": []}
+
+        response = update_scheduler.get_request_id_from_consumption_view(
+            "J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
+
+        self.assertIsNone(response)
+        mock_set_redis_hash_field.assert_not_called()
+        mock_get_set_redis_values.assert_not_called()
+
+    @patch("update_scheduler.SCHEDULER_PREFETCH", True)
+    @patch("update_scheduler.get_near_cache_value", MagicMock(return_value=None))
+    @patch("update_scheduler.get_set_redis_values")
+    @patch("update_scheduler.get_set_redis_hash")
+    def test_get_request_id_from_consumption_view_prefetch_failed(self, mock_get_set_redis_hash,
+                                                                  mock_get_set_redis_values):
+        """
+        Test for get_request_id_from_consumption_view() looking the request ID up on its own if the prefetch failed.
+        """
+        mock_get_set_redis_hash.side_effect = Exception
+        mock_get_set_redis_values.side_effect = lambda redis_keys, query_misses, _: {
+            redis_keys[0]: [{"request_id": "req-id"}]}
+
+        response = update_scheduler.get_request_id_from_consumption_view(
+            "J1939_HB", "EDGE_357649070803120_64100016_SC5079", None)
+
+        self.assertEqual(response, "req-id")
+        mock_get_set_redis_values.assert_called_once()
+
+    @patch("update_scheduler.time.localtime", return_value=time.struct_time((2024, 1, 17, 5, 54, 0, 2, 17, 0)))
+    def test_get_update_scheduler_batch_query_successful(self, _):
+        """
+        Test for get_update_scheduler_batch_query() updating many requests with one statement.
+        """
+        response = update_scheduler.get_update_scheduler_batch_query([("REQ1", "111"), ("REQ2", "222")],
+                                                                     ['Config Accepted', 'Config Sent'])
+
+        self.assertEqual(response, "UPDATE da_edge_olympus.scheduler SET status='Data Rx In Progress',"
+                                   "updated_date_time='2024-01-17 05:54:00',updated_by='lambda' "
+                                   "WHERE (request_id,device_id) IN (('REQ1','111'),('REQ2','222')) "
+                                   "AND status IN ('Config Accepted','Config Sent')")
+
+    @patch("update_scheduler.update_redis_hash")
+    @patch("update_scheduler.invalidate_near_cache")
+    @patch("update_scheduler.set_redis_values")
+    @patch("update_scheduler.get_redis_values")
+    @patch("update_scheduler.get_update_scheduler_batch_query")
+    @patch("update_scheduler.EDGE_DB_CLIENT")
+    def test_flush_scheduler_updates_coalesced(self, mock_db_client, mock_batch_query, mock_get_redis_values,
+                                               mock_set_redis_values, *_):
+        """
+        Test for flush_scheduler_updates() sending the queued updates with one statement per status list and skipping
+        the requests already in progress.
+        """
+        update_scheduler.IN_PROGRESS_PAIRS.clear()
+        mock_batch_query.side_effect = ["query-psbu", "query-ebu"]
+        mock_get_redis_values.return_value = {"rx_in_progress@@REQ3@@333": 1}
+
+        for _ in range(3):
+            update_scheduler.coalesce_scheduler_update("REQ1", "111", {"device_owner": "PSBU"})
+        update_scheduler.coalesce_scheduler_update("REQ2", "222", None)
+        update_scheduler.coalesce_scheduler_update("REQ3", "333", None)
+        update_scheduler.coalesce_scheduler_update("REQ4", "444", {"device_owner": "EBU"})
+        self.assertEqual(update_scheduler.flush_scheduler_updates(), [])
+
+        self.assertEqual(mock_batch_query.call_args_list[0][0], ([("REQ1", "111"), ("REQ2", "222")],
+                                                                 ['Config Accepted', 'Config Sent']))
+        self.assertEqual(mock_batch_query.call_args_list[1][0][0], [("REQ4", "444")])
+        self.assertEqual(mock_db_client.execute.call_count, 2)
+        mock_set_redis_values.assert_any_call({"rx_in_progress@@REQ1@@111": 1, "rx_in_progress@@REQ2@@222": 1},
+                                              update_scheduler.IN_PROGRESS_MEMORY_TTL)
+
+        # The requests are now remembered as in progress, so nothing is sent for their next files
+        mock_db_client.execute.reset_mock()
+        for req_id, device_id in [("REQ1", "111"), ("REQ2", "222"), ("REQ3", "333"), ("REQ4", "444")]:
+            update_scheduler.coalesce_scheduler_update(req_id, device_id, None)
+        update_scheduler.flush_scheduler_updates()
+        mock_db_client.execute.assert_not_called()
+
+    @patch("update_scheduler.SCHEDULER_PREFETCH", True)
+    @patch("update_scheduler.delete_redis_hash_fields")
+    @patch("update_scheduler.update_redis_hash")
+    @patch("update_scheduler.invalidate_near_cache")
+    @patch("update_scheduler.set_redis_values", MagicMock())
+    @patch("update_scheduler.get_redis_values", MagicMock(return_value={}))
+    @patch("update_scheduler.EDGE_DB_CLIENT", MagicMock())
+    def test_flush_scheduler_updates_refreshes_prefetched_rows(self, mock_invalidate_near_cache,
+                                                               mock_update_redis_hash, mock_delete_redis_hash_fields):
+        """
+        Test for flush_scheduler_updates() moving the prefetched rows of the request to 'Data Rx In Progress'.
+        """
+        update_scheduler.IN_PROGRESS_PAIRS.clear()
+
+        update_scheduler.coalesce_scheduler_update("REQ1233", "102900000000003", None)
+        update_scheduler.flush_scheduler_updates()
+
+        mock_invalidate_near_cache.assert_called_once_with("@@edge_102900000000003_")
+        redis_key, update_value = mock_update_redis_hash.call_args[0]
+        self.assertEqual(redis_key, "scheduler@@102900000000003")
+        self.assertEqual(update_value([{"request_id": "REQ1233", "status": "Config Sent"},
+                                       {"request_id": "REQ1234", "status": "Config Sent"}]),
+                         [{"request_id": "REQ1233", "status": "Data Rx In Progress"},
+                          {"request_id": "REQ1234", "status": "Config Sent"}])
+        self.assertIsNone(update_value([{"request_id": "REQ1233", "status": "Data Rx In Progress"}]))
+        redis_key, is_deleted = mock_delete_redis_hash_fields.call_args[0]
+        self.assertEqual(redis_key, "scheduler@@102900000000003")
+        self.assertTrue(is_deleted([]))
+        self.assertFalse(is_deleted([{"request_id": "REQ1234", "status": "Config Sent"}]))
+
+    @patch("update_scheduler.set_redis_values")
+    @patch("update_scheduler.get_redis_values", return_value={})
+    @patch("update_scheduler.get_update_scheduler_batch_query", return_value="query")
+    @patch("update_scheduler.EDGE_DB_CLIENT")
+    def test_flush_scheduler_updates_on_error(self, mock_db_client, _, __, mock_set_redis_values):
+        """
+        Test for flush_scheduler_updates() returning, and not remembering, the requests whose update failed.
+        """
+        update_scheduler.IN_PROGRESS_PAIRS.clear()
+        mock_db_client.execute.side_effect = Exception
+
+        update_scheduler.coalesce_scheduler_update("REQ1", "111", None)
+        self.assertEqual(update_scheduler.flush_scheduler_updates(), [("REQ1", "111")])
 
-        expected_response = "UPDATE da_edge_olympus.scheduler " + \
-                            "SET status='Data Rx In Progress',updated_date_time='"+current_date_time+"',updated_by='lambda' " + \
-                            "WHERE request_id='REQ12345' " + \
-                            "AND device_id='357649070803120' " + \
-                            "AND status IN ('Config Accepted','Config Sent')"
-        self.assertEqual(response, expected_response)
\ No newline at end of file
+        mock_set_redis_values.assert_not_called()
+        self.assertEqual(len(update_scheduler.IN_PROGRESS_PAIRS), 0)
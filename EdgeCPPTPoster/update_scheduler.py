@@ -1,16 +1,46 @@
 import os
+import threading
+from collections import OrderedDict
 
-from pypika import Query, Table, functions as fn
+from pypika import Criterion, Query, Table, Tuple, functions as fn
 
 import utility as util
-from utilities.redis_utility import get_set_redis_value
-from edge_db_lambda_client import EdgeDbLambdaClient
+from utilities.redis_utility import get_set_redis_values, get_set_redis_hash, update_redis_hash, \
+    set_redis_hash_field, delete_redis_hash_fields, get_near_cache_value, invalidate_near_cache, get_redis_values, \
+    set_redis_values
+from utilities.edge_db_singleflight import EDGE_DB_CLIENT
 import time
 
 LOGGER = util.get_logger(__name__)
 REDIS_EXPIRY = 5 * 24 * 60 * 60  # expire after 5 days
-EDGE_DB_CLIENT = EdgeDbLambdaClient()
 LAMBDA_FUNCTION_NAME = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
+# Load all the active scheduler rows of a device at once into a Redis hash instead of one query per config spec
+SCHEDULER_PREFETCH = os.getenv("SchedulerPrefetch", "false").lower() == "true"
+DATA_RX_IN_PROGRESS = 'Data Rx In Progress'
+# The request ID lookups the worker threads make within this window are resolved together, with one MGET per Redis
+# hash slot and one query for the keys Redis does not have
+REQUEST_ID_LOOKUP_WINDOW = float(os.getenv("RequestIdLookupWindowMs", 10)) / 1000
+REQUEST_ID_LOOKUPS_LOCK = threading.Lock()
+PENDING_REQUEST_ID_LOOKUPS = None  # The _RequestIdLookups that the lookups of the current window are added to
+
+# (request_id, device_id) pairs already moved to 'Data Rx In Progress', remembered in Redis and in the container so
+# that the following files of a request skip the UPDATE. The memory expires in case the request is re-configured.
+IN_PROGRESS_MEMORY_TTL = int(os.getenv("SchedulerInProgressMemoryTtl", 60 * 60))
+IN_PROGRESS_MEMORY_SIZE = 10000
+SCHEDULER_UPDATES_LOCK = threading.Lock()
+IN_PROGRESS_PAIRS = OrderedDict()  # (request_id, device_id) -> remembered until
+PENDING_SCHEDULER_UPDATES = {}  # (request_id, device_id) -> device_info of the updates to send at the next flush
+
+
+def _get_active_status_values(device_info):
+    device_owner = device_info.get("device_owner") if device_info else None
+    if device_owner and device_owner.lower() == 'ebu':
+        return ['Config Accepted', 'Data Rx In Progress', 'Config Sent', 'Config Rejected', 'Config Association Failed']
+    return ['Config Accepted', 'Data Rx In Progress', 'Config Sent']
+
+
+def _get_data_type(data_protocol):
+    return data_protocol.split("_")[0] + "_CD_" + data_protocol.split("_")[1]
 
 
 # noinspection PyTypeChecker
@@ -18,17 +48,9 @@ def _get_request_id_from_consumption_view_query(data_protocol, data_config_filen
     data_requester_information = Table('da_edge_olympus.data_requester_information')
     scheduler = Table('da_edge_olympus.scheduler')
     split_config_filename = data_config_filename.split("_")
-    data_type = data_protocol.split("_")[0] + "_CD_" + data_protocol.split("_")[1]
+    data_type = _get_data_type(data_protocol)
 
-    device_owner = None
-    if device_info:
-        device_owner = device_info["device_owner"] if "device_owner" in device_info else None
-    # Define status arrays based on device_owner
-    if device_owner and device_owner.lower() == 'ebu':
-        status_values = ['Config Accepted', 'Data Rx In Progress', 'Config Sent', 'Config Rejected',
-                         'Config Association Failed']
-    else:
-        status_values = ['Config Accepted', 'Data Rx In Progress', 'Config Sent']
+    status_values = _get_active_status_values(device_info)
     query = Query.from_(data_requester_information) \
         .join(scheduler) \
         .on(data_requester_information.request_id == scheduler.request_id) \
@@ -41,64 +63,316 @@ def _get_request_id_from_consumption_view_query(data_protocol, data_config_filen
     return query.get_sql(quote_char=None)
 
 
-def get_request_id_from_consumption_view(data_protocol, data_config_filename, device_info):
-    query = _get_request_id_from_consumption_view_query(data_protocol, data_config_filename, device_info)
+def _get_request_id_redis_key(data_protocol, data_config_filename):
+    return "req_id@@" + data_protocol.lower() + "@@" + data_config_filename.lower()
 
-    redis_key = "req_id@@" + data_protocol.lower() + "@@" + data_config_filename.lower()
-    LOGGER.debug(f"Redis Key for request_id and consumption_view: '{redis_key}'")
 
-    try:
+# noinspection PyTypeChecker
+def _get_scheduler_prefetch_query(device_id, device_info):
+    data_requester_information = Table('da_edge_olympus.data_requester_information')
+    scheduler = Table('da_edge_olympus.scheduler')
+    query = Query.from_(data_requester_information) \
+        .join(scheduler) \
+        .on(data_requester_information.request_id == scheduler.request_id) \
+        .select(scheduler.request_id, data_requester_information.data_type, scheduler.engine_serial_number,
+                fn.Substring(scheduler.config_spec_file_name, 1, 6).as_('config_spec_prefix'), scheduler.status) \
+        .where(scheduler.device_id == device_id) \
+        .where(scheduler.status.isin(_get_active_status_values(device_info)))
+    return query.get_sql(quote_char=None)
 
-        response = get_set_redis_value(redis_key, query, REDIS_EXPIRY)
-        LOGGER.debug(f"Get Req ID Response: '{response}'")
 
-        if response:
-            request_id = response[0]['request_id']
-            return request_id
+def _get_scheduler_redis_key(device_id):
+    return "scheduler@@" + str(device_id)
 
-        LOGGER.info(f'Successfully fetched the request id from view')
-    except Exception as exception:
+
+def _get_scheduler_hash_field(data_type, esn, config_spec_prefix):
+    return "@@".join([str(data_type), str(esn), str(config_spec_prefix)])
+
+
+def _to_scheduler_hash(scheduler_rows):
+    scheduler_hash = {}
+    for row in scheduler_rows or []:
+        field = _get_scheduler_hash_field(row['data_type'], row['engine_serial_number'], row['config_spec_prefix'])
+        scheduler_hash.setdefault(field, []).append({'request_id': row['request_id'], 'status': row['status']})
+    return scheduler_hash
+
+
+def get_prefetched_request_id(data_protocol, data_config_filename, device_info):
+    """
+    Looks the request ID up in the prefetched scheduler rows of the device, None if the device has no active row
+    for the ESN and config spec. The loaded rows are all the active rows of the device, so a missing field is cached
+    as an empty list (no active request) until the rows of the device are refreshed.
+    """
+    split_config_filename = data_config_filename.split("_")
+    device_id = split_config_filename[1]
+    data_type = _get_data_type(data_protocol)
+
+    scheduler_redis_key = _get_scheduler_redis_key(device_id)
+    scheduler_hash = get_set_redis_hash(scheduler_redis_key, _get_scheduler_prefetch_query(device_id, device_info),
+                                        REDIS_EXPIRY, _to_scheduler_hash)
+    scheduler_hash_field = _get_scheduler_hash_field(data_type, split_config_filename[2], split_config_filename[3])
+    scheduler_rows = scheduler_hash.get(scheduler_hash_field)
+    if scheduler_rows is None:
+        set_redis_hash_field(scheduler_redis_key, scheduler_hash_field, [])
+    return scheduler_rows[0]['request_id'] if scheduler_rows else None
+
+
+# noinspection PyTypeChecker
+def _get_request_ids_from_consumption_view_query(request_id_lookups):
+    """
+    One query for the active scheduler rows of every (data_protocol, data_config_filename, device_info) lookup, the
+    lookups of the devices whose owner has the same active statuses being matched together.
+    """
+    data_requester_information = Table('da_edge_olympus.data_requester_information')
+    scheduler = Table('da_edge_olympus.scheduler')
+    config_spec_prefix = fn.Substring(scheduler.config_spec_file_name, 1, 6)
+
+    lookups_by_status_values = {}
+    for data_protocol, data_config_filename, device_info in request_id_lookups:
+        split_config_filename = data_config_filename.split("_")
+        lookups_by_status_values.setdefault(tuple(_get_active_status_values(device_info)), []).append(
+            (_get_data_type(data_protocol), split_config_filename[1], split_config_filename[2],
+             split_config_filename[3]))
+
+    query = Query.from_(data_requester_information) \
+        .join(scheduler) \
+        .on(data_requester_information.request_id == scheduler.request_id) \
+        .select(scheduler.request_id, data_requester_information.data_type, scheduler.device_id,
+                scheduler.engine_serial_number, config_spec_prefix.as_('config_spec_prefix')) \
+        .where(Criterion.any([
+            Tuple(data_requester_information.data_type, scheduler.device_id, scheduler.engine_serial_number,
+                  config_spec_prefix).isin([Tuple(*lookup) for lookup in lookups]) &
+            scheduler.status.isin(list(status_values))
+            for status_values, lookups in lookups_by_status_values.items()]))
+    return query.get_sql(quote_char=None)
+
+
+def _query_request_ids(request_id_lookups):
+    # Returns the scheduler rows of each lookup by its Redis key, [] for the ones without an active row. A single
+    # lookup keeps the query of get_request_id_from_consumption_view(), the rows of which need no matching.
+    redis_keys_by_row_key = {}
+    for data_protocol, data_config_filename, _ in request_id_lookups:
+        split_config_filename = data_config_filename.split("_")
+        row_key = "@@".join([_get_data_type(data_protocol)] + split_config_filename[1:4]).lower()
+        redis_keys_by_row_key[row_key] = _get_request_id_redis_key(data_protocol, data_config_filename)
+
+    query = _get_request_id_from_consumption_view_query(*request_id_lookups[0]) if len(request_id_lookups) == 1 \
+        else _get_request_ids_from_consumption_view_query(request_id_lookups)
+    try:
+        scheduler_rows = EDGE_DB_CLIENT.execute(query) or []
+    except Exception:
         # Using logging level 'info' in case exception occurred due to invalid query
         LOGGER.info(f"Get Request ID From Consumption View Query: {query}")
-        LOGGER.error(f'Failed to fetch request id from consumption view: {exception}')
+        raise
+
+    if len(request_id_lookups) == 1:
+        return {redis_key: [{'request_id': row['request_id']} for row in scheduler_rows]
+                for redis_key in redis_keys_by_row_key.values()}
+    responses = {redis_key: [] for redis_key in redis_keys_by_row_key.values()}
+    for row in scheduler_rows:
+        row_key = "@@".join(str(row[column]) for column in
+                            ['data_type', 'device_id', 'engine_serial_number', 'config_spec_prefix']).lower()
+        if row_key in redis_keys_by_row_key:
+            responses[redis_keys_by_row_key[row_key]].append({'request_id': row['request_id']})
+    return responses
+
+
+def get_request_ids_from_consumption_view(request_id_lookups):
+    """
+    Batch variant of get_request_id_from_consumption_view(). 'request_id_lookups' is a list of
+    (data_protocol, data_config_filename, device_info) tuples, the request IDs are returned in the same order.
+    """
+    lookups_by_redis_key = {_get_request_id_redis_key(data_protocol, data_config_filename):
+                            (data_protocol, data_config_filename, device_info)
+                            for data_protocol, data_config_filename, device_info in request_id_lookups}
+    LOGGER.debug(f"Redis Keys for request_id and consumption_view: {list(lookups_by_redis_key)}")
+
+    try:
+        responses = get_set_redis_values(
+            list(lookups_by_redis_key),
+            lambda missed_keys: _query_request_ids([lookups_by_redis_key[redis_key] for redis_key in missed_keys]),
+            REDIS_EXPIRY)
+        LOGGER.debug(f"Get Req IDs Response: '{responses}'")
+    except Exception as exception:
+        LOGGER.error(f'Failed to fetch request ids from consumption view: {exception}')
         raise exception
-    return None
+    return [_get_first_request_id(responses.get(_get_request_id_redis_key(data_protocol, data_config_filename)))
+            for data_protocol, data_config_filename, _ in request_id_lookups]
 
 
-def get_update_scheduler_query(req_id, device_id, device_info):
-    time_format = '%Y-%m-%d %H:%M:%S'
-    time_default_format = time.localtime()
-    current_date_time = time.strftime(time_format, time_default_format)
-    device_owner = None
+def _get_first_request_id(response):
+    return response[0]['request_id'] if response else None
 
-    if device_info:
-        device_owner = device_info["device_owner"] if "device_owner" in device_info else None
-    # Define status arrays based on device_owner
-    if device_owner and device_owner.lower() == 'ebu':
-        status_values = ['Config Accepted', 'Config Sent', 'Config Rejected', 'Config Association Failed']
+
+class _RequestIdLookups:
+    # The lookups of one window, resolved by the first worker thread that made one of them
+    def __init__(self):
+        self.lookups = []
+        self.request_ids = None
+        self.error = None
+        self.resolved = threading.Event()
+
+
+def _look_request_id_up(data_protocol, data_config_filename, device_info):
+    global PENDING_REQUEST_ID_LOOKUPS
+    with REQUEST_ID_LOOKUPS_LOCK:
+        request_id_lookups = PENDING_REQUEST_ID_LOOKUPS
+        is_resolving_thread = request_id_lookups is None
+        if is_resolving_thread:
+            request_id_lookups = PENDING_REQUEST_ID_LOOKUPS = _RequestIdLookups()
+        lookup_index = len(request_id_lookups.lookups)
+        request_id_lookups.lookups.append((data_protocol, data_config_filename, device_info))
+
+    if is_resolving_thread:
+        if REQUEST_ID_LOOKUP_WINDOW > 0:
+            time.sleep(REQUEST_ID_LOOKUP_WINDOW)
+        with REQUEST_ID_LOOKUPS_LOCK:
+            PENDING_REQUEST_ID_LOOKUPS = None
+        try:
+            request_id_lookups.request_ids = get_request_ids_from_consumption_view(request_id_lookups.lookups)
+        except Exception as exception:
+            request_id_lookups.error = exception
+        finally:
+            request_id_lookups.resolved.set()
     else:
-        status_values = ['Config Accepted', 'Config Sent']
+        request_id_lookups.resolved.wait()
+
+    if request_id_lookups.error is not None:
+        raise request_id_lookups.error
+    return request_id_lookups.request_ids[lookup_index]
+
+
+def get_request_id_from_consumption_view(data_protocol, data_config_filename, device_info):
+    if SCHEDULER_PREFETCH:
+        try:
+            return get_prefetched_request_id(data_protocol, data_config_filename, device_info)
+        except Exception as exception:
+            LOGGER.error(f'Failed to fetch request id from the prefetched scheduler rows: {exception}')
+        # The request ID is still looked up on its own if the rows of the device could not be loaded
+
+    # The files of a request mostly find their request ID in the near cache, without waiting for the window
+    response = get_near_cache_value(_get_request_id_redis_key(data_protocol, data_config_filename))
+    if response is not None:
+        LOGGER.debug(f"Get Req ID Response: '{response}'")
+        return _get_first_request_id(response)
+    return _look_request_id_up(data_protocol, data_config_filename, device_info)
+
+
+def _get_update_status_values(device_info):
+    device_owner = device_info.get("device_owner") if device_info else None
+    if device_owner and device_owner.lower() == 'ebu':
+        return ['Config Accepted', 'Config Sent', 'Config Rejected', 'Config Association Failed']
+    return ['Config Accepted', 'Config Sent']
+
 
+# noinspection PyTypeChecker
+def get_update_scheduler_batch_query(request_device_ids, status_values):
+    current_date_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
     scheduler = Table('da_edge_olympus.scheduler')
-    query = (Query.update(scheduler).set(scheduler.status, 'Data Rx In Progress').set(scheduler.updated_date_time,
-                                                                                      current_date_time
-                                                                                      ).set(scheduler.updated_by,
-                                                                                            LAMBDA_FUNCTION_NAME).where(
-        scheduler.request_id == req_id
-        ).where(scheduler.device_id == device_id
-                ).where(scheduler.status.isin(status_values)))
+    query = Query.update(scheduler) \
+        .set(scheduler.status, DATA_RX_IN_PROGRESS) \
+        .set(scheduler.updated_date_time, current_date_time) \
+        .set(scheduler.updated_by, LAMBDA_FUNCTION_NAME) \
+        .where(Tuple(scheduler.request_id, scheduler.device_id).isin(
+            [Tuple(req_id, device_id) for req_id, device_id in request_device_ids])) \
+        .where(scheduler.status.isin(status_values))
     return query.get_sql(quote_char=None)
 
 
-def update_scheduler_table(req_id, device_id, device_info):
-    LOGGER.debug(f'updating scheduler table')
-    query = get_update_scheduler_query(req_id, device_id, device_info)
+def _set_request_in_progress(scheduler_rows, req_id):
+    if not any(row['request_id'] == req_id and row['status'] != DATA_RX_IN_PROGRESS for row in scheduler_rows):
+        return None
+    return [dict(row, status=DATA_RX_IN_PROGRESS) if row['request_id'] == req_id else row for row in scheduler_rows]
 
-    try:
-        EDGE_DB_CLIENT.execute(query, method='WRITE')
-        LOGGER.info(f'Successfully updated scheduler table')
-    except Exception as exception:
-        # Using logging level 'info' in case exception occurred due to invalid query
-        LOGGER.info(f"Updating Scheduler Table Query: {query}")
-        LOGGER.error(f'Failed to update scheduler table: {exception}')
-        raise exception
+
+def _refresh_cached_scheduler_rows(req_id, device_id):
+    # The request ID keys of the device are 'req_id@@<protocol>@@edge_<device_id>_<esn>_<config>'
+    invalidate_near_cache(f"@@edge_{device_id}_".lower())
+    if SCHEDULER_PREFETCH:
+        # The scheduler of the device changed, so the 'no active request' fields are dropped with the near cached
+        # request IDs, and looked up again in the loaded rows at the next file
+        delete_redis_hash_fields(_get_scheduler_redis_key(device_id), lambda scheduler_rows: not scheduler_rows)
+        update_redis_hash(_get_scheduler_redis_key(device_id),
+                          lambda scheduler_rows: _set_request_in_progress(scheduler_rows, req_id))
+
+
+def _get_in_progress_redis_key(req_id, device_id):
+    return "rx_in_progress@@" + str(req_id) + "@@" + str(device_id)
+
+
+def _is_remembered_in_progress(request_device_id, now):
+    remembered_until = IN_PROGRESS_PAIRS.get(request_device_id)
+    if remembered_until is None:
+        return False
+    if remembered_until <= now:
+        del IN_PROGRESS_PAIRS[request_device_id]
+        return False
+    return True
+
+
+def _remember_in_progress(request_device_ids):
+    remembered_until = time.monotonic() + IN_PROGRESS_MEMORY_TTL
+    with SCHEDULER_UPDATES_LOCK:
+        for request_device_id in request_device_ids:
+            IN_PROGRESS_PAIRS[request_device_id] = remembered_until
+            IN_PROGRESS_PAIRS.move_to_end(request_device_id)
+        while len(IN_PROGRESS_PAIRS) > IN_PROGRESS_MEMORY_SIZE:
+            IN_PROGRESS_PAIRS.popitem(last=False)
+
+
+def coalesce_scheduler_update(req_id, device_id, device_info):
+    """
+    Queues the move of the request to 'Data Rx In Progress' for the next flush_scheduler_updates(), unless it is
+    already known to be in progress.
+    """
+    request_device_id = (req_id, device_id)
+    with SCHEDULER_UPDATES_LOCK:
+        if _is_remembered_in_progress(request_device_id, time.monotonic()):
+            LOGGER.debug(f"Request: '{req_id}' of the device: '{device_id}' is already in progress")
+            return
+        PENDING_SCHEDULER_UPDATES[request_device_id] = device_info
+
+
+def flush_scheduler_updates():
+    """
+    Sends the queued scheduler updates of the batch, one UPDATE statement per status list, and skips the requests
+    that another container already moved to 'Data Rx In Progress'. Returns the (request_id, device_id) pairs whose
+    update failed, so that the messages of their files are retried.
+    """
+    with SCHEDULER_UPDATES_LOCK:
+        pending_updates = dict(PENDING_SCHEDULER_UPDATES)
+        PENDING_SCHEDULER_UPDATES.clear()
+    if not pending_updates:
+        return []
+
+    remembered_in_redis = get_redis_values([_get_in_progress_redis_key(*request_device_id)
+                                            for request_device_id in pending_updates])
+    updates_by_status_values = {}
+    skipped_updates = []
+    for request_device_id, device_info in pending_updates.items():
+        if _get_in_progress_redis_key(*request_device_id) in remembered_in_redis:
+            skipped_updates.append(request_device_id)
+            continue
+        status_values = tuple(_get_update_status_values(device_info))
+        updates_by_status_values.setdefault(status_values, []).append(request_device_id)
+    _remember_in_progress(skipped_updates)
+
+    failed_updates = []
+    for status_values, request_device_ids in updates_by_status_values.items():
+        query = get_update_scheduler_batch_query(request_device_ids, list(status_values))
+        try:
+            EDGE_DB_CLIENT.execute(query, method='WRITE')
+            LOGGER.info(f'Successfully updated scheduler table for {len(request_device_ids)} requests')
+        except Exception as exception:
+            # Not remembered, so the retried files of these requests try again
+            LOGGER.info(f"Updating Scheduler Table Query: {query}")
+            LOGGER.error(f'Failed to update scheduler table: {exception}')
+            failed_updates.extend(request_device_ids)
+            continue
+
+        _remember_in_progress(request_device_ids)
+        set_redis_values({_get_in_progress_redis_key(*request_device_id): 1
+                          for request_device_id in request_device_ids}, IN_PROGRESS_MEMORY_TTL)
+        for req_id, device_id in request_device_ids:
+            _refresh_cached_scheduler_rows(req_id, device_id)
+    return failed_updates
@@ -0,0 +1,68 @@
+import json
+import time
+import threading
+
+import utility as util
+LOGGER = util.get_logger(__name__)
+
+CLOSED = "CLOSED"
+OPEN = "OPEN"
+HALF_OPEN = "HALF_OPEN"
+
+
+class CircuitBreaker:
+    """
+    Fails fast while a dependency is down. After 'failure_threshold' consecutive failures the breaker opens and
+    allow_request() returns False. Once 'reset_timeout' seconds have passed a single probe request is let through
+    (half-open), its outcome either closes the breaker again or re-opens it for another 'reset_timeout'.
+    Every request that was allowed must report its outcome with record_success() or record_failure().
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self._lock = threading.Lock()
+
+    def _change_state(self, new_state):
+        LOGGER.warning(json.dumps({"event": "CircuitBreakerStateChange", "breaker": self.name,
+                                   "from_state": self.state, "to_state": new_state,
+                                   "consecutive_failures": self.consecutive_failures}))
+        self.state = new_state
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self._change_state(HALF_OPEN)
+                self.probe_started_at = now
+                return True
+
+            # Half-open: only one probe at a time, unless the previous probe never reported back
+            if now - self.probe_started_at < self.reset_timeout:
+                return False
+            self.probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._change_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self._change_state(OPEN)
+                self.opened_at = time.monotonic()
@@ -0,0 +1,104 @@
+import re
+import copy
+import json
+import time
+import threading
+
+import utility as util
+from edge_db_lambda_client import EdgeDbLambdaClient
+
+LOGGER = util.get_logger(__name__)
+
+QUERY_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def get_query_shape(query):
+    # Queries that only differ by their literal values (device ID, ESN, ...) share a shape
+    return " ".join(QUERY_LITERAL_PATTERN.sub("?", str(query)).split())
+
+
+class _InFlightQuery:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+class SingleflightEdgeDbClient:
+    """
+    Wraps EdgeDbLambdaClient so that concurrent execute() calls with the same query share one execution and its
+    result, each caller gets its own copy of the result. Writes (method='WRITE') and calls made with
+    singleflight=False are always executed. The time spent per query shape is collected for log_metrics().
+    """
+
+    def __init__(self, edge_db_client):
+        self._edge_db_client = edge_db_client
+        self._lock = threading.Lock()
+        self._in_flight = {}  # (query, args, kwargs) -> _InFlightQuery
+        self._metrics = {}  # query shape -> {"executed", "shared", "total_ms", "max_ms"}
+
+    def _record(self, query, elapsed_ms, shared):
+        query_shape = get_query_shape(query)
+        with self._lock:
+            metrics = self._metrics.setdefault(query_shape, {"executed": 0, "shared": 0, "total_ms": 0, "max_ms": 0})
+            if shared:
+                metrics["shared"] += 1
+                return
+            metrics["executed"] += 1
+            metrics["total_ms"] += elapsed_ms
+            metrics["max_ms"] = max(metrics["max_ms"], elapsed_ms)
+
+    def _timed_execute(self, query, args, kwargs):
+        started_at = time.perf_counter()
+        try:
+            return self._edge_db_client.execute(query, *args, **kwargs)
+        finally:
+            self._record(query, round((time.perf_counter() - started_at) * 1000, 2), shared=False)
+
+    def execute(self, query, *args, singleflight=True, **kwargs):
+        if not singleflight or str(kwargs.get("method", "")).upper() == "WRITE":
+            return self._timed_execute(query, args, kwargs)
+
+        in_flight_key = (str(query), args, tuple(sorted(kwargs.items())))
+        with self._lock:
+            in_flight_query = self._in_flight.get(in_flight_key)
+            is_leader = in_flight_query is None
+            if is_leader:
+                in_flight_query = self._in_flight[in_flight_key] = _InFlightQuery()
+            else:
+                in_flight_query.followers += 1
+
+        if not is_leader:
+            in_flight_query.done.wait()
+            self._record(query, 0, shared=True)
+            if in_flight_query.error is not None:
+                raise in_flight_query.error
+            return copy.deepcopy(in_flight_query.result)
+
+        result = None
+        try:
+            result = self._timed_execute(query, args, kwargs)
+        except Exception as error:
+            in_flight_query.error = error
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(in_flight_key, None)
+                has_followers = in_flight_query.followers > 0
+            if has_followers and in_flight_query.error is None:
+                # The followers copy this snapshot, so that the caller is free to modify the result it returns
+                in_flight_query.result = copy.deepcopy(result)
+            in_flight_query.done.set()
+        return result
+
+    def log_metrics(self):
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+        for query_shape, query_metrics in metrics.items():
+            LOGGER.info(json.dumps({"event": "EdgeDbQueryMetrics", "query_shape": query_shape, **query_metrics}))
+
+
+# One client per container, shared by the modules so that the same query from any of them is executed once
+EDGE_DB_CLIENT = SingleflightEdgeDbClient(EdgeDbLambdaClient())
@@ -0,0 +1,68 @@
+import os
+import sys
+import datetime
+import threading
+
+import utility as util
+LOGGER = util.get_logger(__name__)
+
+sys.path.insert(1, './lib')
+sys.path.insert(1, '../lib')
+import boto3
+
+ROLE_SESSION_NAME = 'PCC_J1939_KinesisSession'
+# Refresh the assumed role credentials this many seconds before their 'Expiration'
+CREDENTIAL_REFRESH_WINDOW = int(os.getenv("StsCredentialRefreshWindow", 5 * 60))
+
+# The caches are shared by every worker thread of the container, so all reads and writes go through the lock
+CACHE_LOCK = threading.RLock()
+STS_CLIENT = None
+ROLE_CREDENTIALS = {}  # role_arn -> STS 'Credentials'
+KINESIS_CLIENTS = {}  # (role_arn, region) -> (kinesis client, AccessKeyId the client was built with)
+
+
+def _get_sts_client():
+    global STS_CLIENT
+    if STS_CLIENT is None:
+        STS_CLIENT = boto3.client('sts')
+    return STS_CLIENT
+
+
+def _credentials_expiring(credentials):
+    time_left = credentials['Expiration'] - datetime.datetime.now(datetime.timezone.utc)
+    return time_left.total_seconds() <= CREDENTIAL_REFRESH_WINDOW
+
+
+def get_role_credentials(role_arn):
+    with CACHE_LOCK:
+        credentials = ROLE_CREDENTIALS.get(role_arn)
+        if credentials is None or _credentials_expiring(credentials):
+            LOGGER.info(f"Getting STS credentials for the role: '{role_arn}'")
+            sts_credentials = _get_sts_client().assume_role(RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)
+            credentials = sts_credentials['Credentials']
+            ROLE_CREDENTIALS[role_arn] = credentials
+            LOGGER.debug(f"Successfully retrieved STS credentials expiring at: '{credentials['Expiration']}'")
+        return credentials
+
+
+def get_kinesis_client(role_arn, region):
+    with CACHE_LOCK:
+        credentials = get_role_credentials(role_arn)
+        kinesis_client, access_key = KINESIS_CLIENTS.get((role_arn, region), (None, None))
+
+        # A refresh of the role credentials invalidates the client built with the previous ones
+        if kinesis_client is None or access_key != credentials['AccessKeyId']:
+            LOGGER.info(f"Creating Kinesis client for the role: '{role_arn}' in the region: '{region}'")
+            kinesis_client = boto3.client('kinesis', aws_access_key_id=credentials['AccessKeyId'],
+                                          aws_secret_access_key=credentials['SecretAccessKey'],
+                                          aws_session_token=credentials['SessionToken'],
+                                          region_name=region)
+            KINESIS_CLIENTS[(role_arn, region)] = (kinesis_client, credentials['AccessKeyId'])
+        return kinesis_client
+
+
+def invalidate_role_credentials(role_arn):
+    with CACHE_LOCK:
+        ROLE_CREDENTIALS.pop(role_arn, None)
+        for client_key in [client_key for client_key in KINESIS_CLIENTS if client_key[0] == role_arn]:
+            KINESIS_CLIENTS.pop(client_key)
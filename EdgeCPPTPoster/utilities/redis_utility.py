@@ -1,6 +1,10 @@
 import json
 import os
 import sys
+import time
+import binascii
+import threading
+from collections import OrderedDict
 import boto3
 
 import utility as util
@@ -8,19 +12,37 @@ LOGGER = util.get_logger(__name__)
 
 sys.path.insert(1, './lib')
 sys.path.insert(1, '../lib')
-from edge_db_lambda_client import EdgeDbLambdaClient
-from edge_secretsmanager_utility_layer import get_json_value_from_secrets_manager
+from utilities.edge_db_singleflight import EDGE_DB_CLIENT
+from utilities.secrets_utility import get_cached_secret
+from utilities.circuit_breaker import CircuitBreaker
 from rediscluster import RedisCluster
 
 REDIS_CLIENT = None
+REDIS_CLUSTER_SLOTS = 16384
+REDIS_CLIENT_LOCK = threading.Lock()
+HASH_LOADED_FIELD = "@@loaded"  # Always written with a hash so that an empty result is cached as well
 SECRET_NAME = os.environ['RedisSecretName']
 REGION = os.environ['region']
-EDGE_DB_CLIENT = EdgeDbLambdaClient()
+
+# In-process (L1) cache in front of Redis, its TTL is kept much shorter than the Redis expiry so that a change made
+# by another container is picked up within minutes even without an explicit invalidation
+NEAR_CACHE_SIZE = int(os.getenv("RedisNearCacheSize", 1024))
+NEAR_CACHE_TTL = int(os.getenv("RedisNearCacheTtl", 5 * 60))
+NEAR_CACHE_LOCK = threading.Lock()
+NEAR_CACHE = OrderedDict()  # redis_key -> (value, expires_at), least recently used first
+
+# While Redis is failing the lookups go straight to the Data Base, at no more than 'RedisDbFallbackRate' per second
+REDIS_BREAKER = CircuitBreaker("redis", int(os.getenv("RedisBreakerFailureThreshold", 3)),
+                               int(os.getenv("RedisBreakerResetTimeout", 30)))
+DB_FALLBACK_RATE = float(os.getenv("RedisDbFallbackRate", 20))
+DB_FALLBACK_LOCK = threading.Lock()
+DB_FALLBACK_TOKENS = max(DB_FALLBACK_RATE, 1)
+DB_FALLBACK_REFILLED_AT = time.monotonic()
 
 
 def get_redis_connection():
     try:
-        secret_params = get_json_value_from_secrets_manager(SECRET_NAME)
+        secret_params = get_cached_secret(SECRET_NAME)
 
         redis_client = RedisCluster(startup_nodes=[{"host": secret_params['redis_host'],
                                                     "port": secret_params['redis_port']}],
@@ -32,27 +54,373 @@ def get_redis_connection():
         return None
 
 
-def get_set_redis_value(redis_key, sql_query, redis_expiry):
-    try:
-        global REDIS_CLIENT
+def get_near_cache_value(redis_key):
+    with NEAR_CACHE_LOCK:
+        cached_value = NEAR_CACHE.get(redis_key)
+        if cached_value is None:
+            return None
+        if cached_value[1] <= time.monotonic():
+            del NEAR_CACHE[redis_key]
+            return None
+        NEAR_CACHE.move_to_end(redis_key)
+        return cached_value[0]
+
+
+def set_near_cache_value(redis_key, value, redis_expiry):
+    if value is None or NEAR_CACHE_SIZE <= 0:
+        return
+    with NEAR_CACHE_LOCK:
+        NEAR_CACHE[redis_key] = (value, time.monotonic() + min(NEAR_CACHE_TTL, redis_expiry))
+        NEAR_CACHE.move_to_end(redis_key)
+        while len(NEAR_CACHE) > NEAR_CACHE_SIZE:
+            NEAR_CACHE.popitem(last=False)
+
+
+def invalidate_near_cache(redis_key_fragment):
+    """
+    Drops the near cache entries whose key contains 'redis_key_fragment', e.g. the keys of a device after its
+    scheduler rows were updated.
+    """
+    with NEAR_CACHE_LOCK:
+        for redis_key in [redis_key for redis_key in NEAR_CACHE if redis_key_fragment in redis_key]:
+            del NEAR_CACHE[redis_key]
+
+
+def _get_redis_client():
+    # None while the breaker is open or if Redis cannot be connected to
+    global REDIS_CLIENT
+    if not REDIS_BREAKER.allow_request():
+        return None
+    # The worker threads share one client, the first one to need it connects while the others wait
+    with REDIS_CLIENT_LOCK:
         if REDIS_CLIENT is None:
             REDIS_CLIENT = get_redis_connection()
+            if REDIS_CLIENT is None:
+                REDIS_BREAKER.record_failure()
+        return REDIS_CLIENT
+
 
-        redis_response = REDIS_CLIENT.get(redis_key)
-        response = json.loads(redis_response) if redis_response else None
-        LOGGER.debug(f"Value from Redis: {response}")
+def _take_db_fallback_token():
+    global DB_FALLBACK_TOKENS, DB_FALLBACK_REFILLED_AT
+    with DB_FALLBACK_LOCK:
+        now = time.monotonic()
+        DB_FALLBACK_TOKENS = min(max(DB_FALLBACK_RATE, 1),
+                                 DB_FALLBACK_TOKENS + (now - DB_FALLBACK_REFILLED_AT) * DB_FALLBACK_RATE)
+        DB_FALLBACK_REFILLED_AT = now
+        if DB_FALLBACK_TOKENS < 1:
+            raise RuntimeError("Redis is unavailable and the Data Base fallback rate limit was reached")
+        DB_FALLBACK_TOKENS -= 1
 
-        if response is None:
-            LOGGER.info(
-                f"Could not find the Request ID for the key: '{redis_key}' in the Redis Cache. "
-                f"Retrieving it from the Data Base with the query: '{sql_query}'."
-            )
-            response = EDGE_DB_CLIENT.execute(sql_query)
-            REDIS_CLIENT.set(redis_key, json.dumps(response), ex=redis_expiry)
 
-        LOGGER.info(f"Attempting to force DB connection with query {sql_query}")
-        LOGGER.info("DB connection returned")
+def _query_db_fallback(sql_query):
+    _take_db_fallback_token()
+    return EDGE_DB_CLIENT.execute(sql_query)
 
+
+def get_set_redis_value(redis_key, sql_query, redis_expiry):
+    """
+    Returns the value of the key from the near cache, Redis or, on a miss, from the Data Base with 'sql_query'.
+    Raises the error if the value could not be retrieved from the Data Base either.
+    """
+    response = get_near_cache_value(redis_key)
+    if response is not None:
+        LOGGER.debug(f"Value from the near cache: {response}")
         return response
+
+    redis_client = _get_redis_client()
+    redis_response = None
+    if redis_client is not None:
+        try:
+            redis_response = redis_client.get(redis_key)
+            REDIS_BREAKER.record_success()
+        except Exception as error:
+            LOGGER.error(f"An error occurred while getting the value from Redis: {error}")
+            REDIS_BREAKER.record_failure()
+            redis_client = None
+
+    if redis_client is None:
+        LOGGER.warning(f"Redis is unavailable, retrieving the value of the key: '{redis_key}' from the Data Base.")
+        response = _query_db_fallback(sql_query)
+        set_near_cache_value(redis_key, response, redis_expiry)
+        return response
+
+    response = json.loads(redis_response) if redis_response else None
+    LOGGER.debug(f"Value from Redis: {response}")
+
+    if response is None:
+        LOGGER.info(
+            f"Could not find the Request ID for the key: '{redis_key}' in the Redis Cache. "
+            f"Retrieving it from the Data Base with the query: '{sql_query}'."
+        )
+        response = EDGE_DB_CLIENT.execute(sql_query)
+        try:
+            redis_client.set(redis_key, json.dumps(response), ex=redis_expiry)
+        except Exception as error:
+            LOGGER.error(f"An error occurred while setting the value in Redis: {error}")
+            REDIS_BREAKER.record_failure()
+
+    set_near_cache_value(redis_key, response, redis_expiry)
+    return response
+
+
+def get_key_slot(redis_key):
+    # Redis Cluster hash slot: CRC16 (XMODEM) of the key, or of its hash tag when the key has a non-empty '{...}'
+    tag_start = redis_key.find("{")
+    if tag_start != -1:
+        tag_end = redis_key.find("}", tag_start + 1)
+        if tag_end > tag_start + 1:
+            redis_key = redis_key[tag_start + 1:tag_end]
+    return binascii.crc_hqx(redis_key.encode('utf-8'), 0) % REDIS_CLUSTER_SLOTS
+
+
+def _get_redis_values(redis_client, redis_keys):
+    # One MGET per hash slot, all of them sent through one cluster pipeline (one round trip per node). The cluster
+    # pipeline blocks mget() as its keys could span slots, while execute_command() routes the command to the node of
+    # the slot of its first key, which is the slot of every key of the MGET.
+    keys_by_slot = {}
+    for redis_key in redis_keys:
+        keys_by_slot.setdefault(get_key_slot(redis_key), []).append(redis_key)
+
+    pipeline = redis_client.pipeline()
+    slot_keys = list(keys_by_slot.values())
+    for keys in slot_keys:
+        pipeline.execute_command("MGET", *keys)
+
+    redis_values = {}
+    for keys, values in zip(slot_keys, pipeline.execute()):
+        for redis_key, redis_value in zip(keys, values):
+            redis_values[redis_key] = json.loads(redis_value) if redis_value else None
+    return redis_values
+
+
+def get_set_redis_values(redis_keys, query_misses, redis_expiry):
+    """
+    Batch variant of get_set_redis_value(). Resolves the keys from the near cache, then from Redis with one MGET per
+    hash slot. 'query_misses' is called once with the keys found in neither, and returns a dict of those keys to their
+    value from the Data Base. The values of the misses are written back with one pipelined SET with the expiry.
+    Returns a dict of every key to its value, None for the keys 'query_misses' did not resolve. Raises the error of
+    'query_misses', as get_set_redis_value() does.
+    """
+    redis_values = {redis_key: get_near_cache_value(redis_key) for redis_key in redis_keys}
+    missed_keys = [redis_key for redis_key, value in redis_values.items() if value is None]
+    if not missed_keys:
+        return redis_values
+
+    redis_client = _get_redis_client()
+    if redis_client is not None:
+        try:
+            redis_values.update(_get_redis_values(redis_client, missed_keys))
+            REDIS_BREAKER.record_success()
+        except Exception as error:
+            LOGGER.error(f"An error occurred while getting the values from Redis: {error}")
+            REDIS_BREAKER.record_failure()
+            redis_client = None
+        missed_keys = [redis_key for redis_key in missed_keys if redis_values[redis_key] is None]
+
+    missed_values = {}
+    if missed_keys:
+        if redis_client is None:
+            LOGGER.warning(f"Redis is unavailable, retrieving the values of {len(missed_keys)} keys from the Data Base.")
+            _take_db_fallback_token()
+        else:
+            LOGGER.info(f"Could not find {len(missed_keys)} keys in the Redis Cache, retrieving them from the Data Base.")
+        missed_values = {redis_key: value for redis_key, value in query_misses(missed_keys).items()
+                         if value is not None}
+        redis_values.update(missed_values)
+
+    if redis_client is not None:
+        set_redis_values(missed_values, redis_expiry)
+
+    for redis_key, value in redis_values.items():
+        set_near_cache_value(redis_key, value, redis_expiry)
+    return redis_values
+
+
+def get_set_redis_hash(redis_key, sql_query, redis_expiry, to_hash):
+    """
+    Returns the hash stored at the key as a dict of its fields to their JSON values. On a miss the hash is built from
+    the result of 'sql_query' with 'to_hash' and written to Redis with the expiry.
+    """
+    redis_hash = get_near_cache_value(redis_key)
+    if redis_hash is not None:
+        return redis_hash
+
+    redis_client = _get_redis_client()
+    stored_hash = None
+    if redis_client is not None:
+        try:
+            stored_hash = redis_client.hgetall(redis_key)
+            REDIS_BREAKER.record_success()
+        except Exception as error:
+            LOGGER.error(f"An error occurred while getting the hash from Redis: {error}")
+            REDIS_BREAKER.record_failure()
+            redis_client = None
+
+    if redis_client is None:
+        LOGGER.warning(f"Redis is unavailable, retrieving the hash: '{redis_key}' from the Data Base.")
+        redis_hash = to_hash(_query_db_fallback(sql_query))
+    elif HASH_LOADED_FIELD in stored_hash:
+        redis_hash = {field: json.loads(value) for field, value in stored_hash.items() if field != HASH_LOADED_FIELD}
+    else:
+        LOGGER.info(f"Could not find the hash: '{redis_key}' in the Redis Cache. "
+                    f"Retrieving it from the Data Base with the query: '{sql_query}'.")
+        redis_hash = to_hash(EDGE_DB_CLIENT.execute(sql_query))
+        try:
+            pipeline = redis_client.pipeline()
+            pipeline.hset(redis_key, HASH_LOADED_FIELD, "1")
+            for field, value in redis_hash.items():
+                pipeline.hset(redis_key, field, json.dumps(value))
+            pipeline.expire(redis_key, redis_expiry)
+            pipeline.execute()
+        except Exception as error:
+            LOGGER.error(f"An error occurred while setting the hash in Redis: {error}")
+            REDIS_BREAKER.record_failure()
+
+    set_near_cache_value(redis_key, redis_hash, redis_expiry)
+    return redis_hash
+
+
+def update_redis_hash(redis_key, update_value):
+    """
+    Updates the fields of a stored hash, and of its near cache entry, in place. 'update_value' is called with the
+    value of each field and returns its new value, or None to leave the field as it is.
+    """
+    with NEAR_CACHE_LOCK:
+        cached_value = NEAR_CACHE.get(redis_key)
+        if cached_value is not None:
+            updated_hash = dict(cached_value[0])
+            for field, value in cached_value[0].items():
+                new_value = update_value(value)
+                if new_value is not None:
+                    updated_hash[field] = new_value
+            NEAR_CACHE[redis_key] = (updated_hash, cached_value[1])
+
+    redis_client = _get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        updated_fields = {}
+        for field, value in redis_client.hgetall(redis_key).items():
+            new_value = update_value(json.loads(value)) if field != HASH_LOADED_FIELD else None
+            if new_value is not None:
+                updated_fields[field] = json.dumps(new_value)
+        if updated_fields:
+            pipeline = redis_client.pipeline()
+            for field, value in updated_fields.items():
+                pipeline.hset(redis_key, field, value)
+            pipeline.execute()
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while updating the hash: '{redis_key}' in Redis: {error}")
+        REDIS_BREAKER.record_failure()
+
+
+def set_redis_hash_field(redis_key, field, value):
+    """
+    Adds a field to a stored hash and to its near cache entry. A field written after the hash expired leaves a hash
+    without the loaded field, which get_set_redis_hash() builds again from the Data Base.
+    """
+    with NEAR_CACHE_LOCK:
+        cached_value = NEAR_CACHE.get(redis_key)
+        if cached_value is not None:
+            NEAR_CACHE[redis_key] = (dict(cached_value[0], **{field: value}), cached_value[1])
+
+    redis_client = _get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.hset(redis_key, field, json.dumps(value))
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while setting the field: '{field}' of the hash: '{redis_key}' in Redis: "
+                     f"{error}")
+        REDIS_BREAKER.record_failure()
+
+
+def delete_redis_hash_fields(redis_key, is_deleted):
+    """
+    Deletes the fields of a stored hash, and of its near cache entry, for the values of which 'is_deleted' is True.
+    """
+    with NEAR_CACHE_LOCK:
+        cached_value = NEAR_CACHE.get(redis_key)
+        if cached_value is not None:
+            NEAR_CACHE[redis_key] = ({field: value for field, value in cached_value[0].items()
+                                      if not is_deleted(value)}, cached_value[1])
+
+    redis_client = _get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        deleted_fields = [field for field, value in redis_client.hgetall(redis_key).items()
+                          if field != HASH_LOADED_FIELD and is_deleted(json.loads(value))]
+        if deleted_fields:
+            redis_client.hdel(redis_key, *deleted_fields)
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while deleting the fields of the hash: '{redis_key}' in Redis: {error}")
+        REDIS_BREAKER.record_failure()
+
+
+def get_redis_values(redis_keys):
+    """
+    Returns the values of the keys that are stored in Redis, an empty dict if Redis is unavailable.
+    """
+    redis_client = _get_redis_client() if redis_keys else None
+    if redis_client is None:
+        return {}
+    try:
+        redis_values = _get_redis_values(redis_client, redis_keys)
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while getting the values from Redis: {error}")
+        REDIS_BREAKER.record_failure()
+        return {}
+    return {redis_key: value for redis_key, value in redis_values.items() if value is not None}
+
+
+def set_redis_values(redis_values, redis_expiry):
+    redis_client = _get_redis_client() if redis_values else None
+    if redis_client is None:
+        return
+    try:
+        pipeline = redis_client.pipeline()
+        for redis_key, value in redis_values.items():
+            pipeline.set(redis_key, json.dumps(value), ex=redis_expiry)
+        pipeline.execute()
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while setting the values in Redis: {error}")
+        REDIS_BREAKER.record_failure()
+
+
+def set_redis_value_if_absent(redis_key, value, redis_expiry):
+    """
+    Atomically stores the value unless the key already exists (SET NX) and reads the key back in the same round trip.
+    Returns a tuple of whether the value was stored and the value found at the key, None if Redis is unavailable.
+    """
+    redis_client = _get_redis_client()
+    if redis_client is None:
+        return None
+    try:
+        pipeline = redis_client.pipeline()
+        pipeline.set(redis_key, json.dumps(value), nx=True, ex=redis_expiry)
+        pipeline.get(redis_key)
+        stored, redis_value = pipeline.execute()
+        REDIS_BREAKER.record_success()
+    except Exception as error:
+        LOGGER.error(f"An error occurred while setting the value of the key: '{redis_key}' in Redis: {error}")
+        REDIS_BREAKER.record_failure()
+        return None
+    return bool(stored), json.loads(redis_value) if redis_value else None
+
+
+def delete_redis_key(redis_key):
+    redis_client = _get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(redis_key)
+        REDIS_BREAKER.record_success()
     except Exception as error:
-        LOGGER.error(f"An error occurred while getting and setting value from Redis: {error}")
+        LOGGER.error(f"An error occurred while deleting the key: '{redis_key}' from Redis: {error}")
+        REDIS_BREAKER.record_failure()
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import time
+import threading
+
+import utility as util
+LOGGER = util.get_logger(__name__)
+
+sys.path.insert(1, './lib')
+sys.path.insert(1, '../lib')
+import boto3
+
+# After the TTL the cached value is only fetched again if the secret has a new AWSCURRENT version
+SECRET_CACHE_TTL = int(os.getenv("SecretCacheTtl", 60 * 60))
+
+CACHE_LOCK = threading.Lock()
+SECRETS_MANAGER_CLIENT = None
+SECRETS_CACHE = {}  # secret_id -> {"value": dict, "version_id": str, "checked_at": float}
+
+
+def _get_secrets_manager_client():
+    global SECRETS_MANAGER_CLIENT
+    with CACHE_LOCK:
+        if SECRETS_MANAGER_CLIENT is None:
+            SECRETS_MANAGER_CLIENT = boto3.client('secretsmanager')
+        return SECRETS_MANAGER_CLIENT
+
+
+def _get_current_version_id(secret_id):
+    secret_description = _get_secrets_manager_client().describe_secret(SecretId=secret_id)
+    for version_id, version_stages in secret_description["VersionIdsToStages"].items():
+        if "AWSCURRENT" in version_stages:
+            return version_id
+    return None
+
+
+def get_cached_secret(secret_id, force_refresh=False):
+    """
+    Returns the JSON value of the secret, or None if it could not be retrieved. 'force_refresh' skips the cache, e.g.
+    after the credentials were rejected by the service they are for.
+    """
+    # The lock only guards the cache, the Secrets Manager calls are made without it so that a slow call does not hold
+    # up the threads reading the other secrets
+    with CACHE_LOCK:
+        cached_secret = SECRETS_CACHE.get(secret_id)
+        if cached_secret and not force_refresh and \
+                time.monotonic() - cached_secret["checked_at"] < SECRET_CACHE_TTL:
+            return cached_secret["value"]
+
+    try:
+        if cached_secret and not force_refresh and _get_current_version_id(secret_id) == cached_secret["version_id"]:
+            with CACHE_LOCK:
+                cached_secret["checked_at"] = time.monotonic()
+            return cached_secret["value"]
+
+        LOGGER.info(f"Retrieving the secret: '{secret_id}' from the Secrets Manager")
+        secret_value_response = _get_secrets_manager_client().get_secret_value(SecretId=secret_id)
+        retrieved_secret = {"value": json.loads(secret_value_response["SecretString"]),
+                            "version_id": secret_value_response["VersionId"],
+                            "checked_at": time.monotonic()}
+    except Exception as secrets_manager_exception:
+        LOGGER.error(f"An error occurred while retrieving the secret: '{secret_id}': {secrets_manager_exception}")
+        # A stale value is more useful than none while the Secrets Manager is unavailable
+        return cached_secret["value"] if cached_secret else None
+
+    with CACHE_LOCK:
+        SECRETS_CACHE[secret_id] = retrieved_secret
+    return retrieved_secret["value"]
@@ -0,0 +1,29 @@
+import boto3
+
+import utility as util
+
+LOGGER = util.get_logger(__name__)
+
+SQS_CLIENT = None
+
+
+def _get_sqs_client():
+    global SQS_CLIENT
+    if SQS_CLIENT is None:
+        SQS_CLIENT = boto3.client('sqs')
+    return SQS_CLIENT
+
+
+def sqs_send_message_batch(queue_url, entries):
+    """
+    SendMessageBatch counterpart of edge_sqs_utility_layer.sqs_send_message, logs and re-raises the errors.
+    Returns the response, the caller handles its 'Failed' entries.
+    """
+    try:
+        response = _get_sqs_client().send_message_batch(QueueUrl=queue_url, Entries=entries)
+    except Exception as e:
+        LOGGER.error(f"An error occurred while sending {len(entries)} messages to the queue: {queue_url}: {e}")
+        raise
+    LOGGER.debug(f"Sent {len(entries) - len(response.get('Failed') or [])} of {len(entries)} messages to the queue: "
+                 f"{queue_url}")
+    return response
@@ -11,8 +11,10 @@ try:
     import boto3
     import datetime
     import utility as util
-    from multiprocessing import Process
-    from edge_sqs_utility_layer import sqs_send_message
+    from multiprocessing import Process, Pipe
+    from concurrent.futures import ThreadPoolExecutor
+    from metadata_emitter import MetadataEvent, emit_metadata_event, flush_metadata_events, \
+        send_metadata_events_to, receive_metadata_events_from
     from edge_db_lambda_client import EdgeDbLambdaClient
     import re
     from botocore.exceptions import ClientError
@@ -32,14 +34,11 @@ MAX_ATTEMPTS = int(os.environ["MaxAttempts"])
 EDGE_DB_CLIENT = EdgeDbLambdaClient()
 APP_ENV = os.environ["APPLICATION_ENVIRONMENT"]
 TABLE_NAME = os.environ["J1939ActiveFaultCodeTable"]
-
-
-def delete_message_from_sqs_queue(receipt_handle):
-    queue_url = os.environ["QueueUrl"]
-    sqs_client = boto3.client('sqs')  # noqa
-    sqs_message_deletion_response = sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-    LOGGER.debug(f"SQS message deletion response: '{sqs_message_deletion_response}'. . .")
-    return sqs_message_deletion_response
+# 'yes' hands the converted FC files straight to the poster instead of routing them through ConvertedFiles and SQS
+FUSED_FC_ROUTING = os.getenv("FusedFcRouting", "no").lower() == "yes"
+POSTER_LAMBDA = os.getenv("PosterLambda")
+POSTER_MAX_PAYLOAD_BYTES = 256 * 1024  # Asynchronous invocation payload limit
+lambda_client = boto3.client('lambda')
 
 
 def process_ss(ss_rows, ss_dict, ngdi_json_template, ss_converted_prot_header, ss_converted_device_parameters):
@@ -223,6 +222,47 @@ def get_cspec_req_id(sc_number):
     return config_spec_name, req_id
 
 
+def hand_off_to_poster(store_file_path, file_body, file_metadata, file_date_time):
+    """
+    Invokes the poster with the converted file in the payload, to be routed without the ConvertedFiles S3 write, the
+    S3 event and the download. The file is archived outside of ConvertedFiles (so that it does not reach the poster a
+    second time) in parallel with the invocation. Returns False if the file has to go through ConvertedFiles instead.
+    """
+    converted_file = {
+        "bucket_name": cp_post_bucket,
+        "file_key": store_file_path,
+        "file_size": len(file_body),
+        "file_date_time": file_date_time,
+        "metadata": file_metadata
+    }
+    # The file is already serialized, it is spliced into the payload instead of being serialized again
+    payload = b'{"converted_file": ' + json.dumps(converted_file).encode() + b', "json_body": ' + file_body + b'}'
+    if len(payload) > POSTER_MAX_PAYLOAD_BYTES:
+        LOGGER.info(f"The file: '{store_file_path}' is too large to be handed off to the poster . . .")
+        return False
+
+    archive_key = store_file_path.replace("ConvertedFiles/", "ArchivedConvertedFiles/", 1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        archive_future = executor.submit(s3_client.put_object, Bucket=cp_post_bucket, Key=archive_key, Body=file_body,
+                                         Metadata=file_metadata)
+        try:
+            response = lambda_client.invoke(FunctionName=POSTER_LAMBDA, InvocationType='Event', Payload=payload)
+            handed_off = response['StatusCode'] == 202
+            if not handed_off:
+                LOGGER.error(f"The poster invocation returned the status code: {response['StatusCode']}")
+        except Exception as e:
+            LOGGER.error(f"An exception occurred while handing off the file: '{store_file_path}' to the poster: {e}")
+            handed_off = False
+
+    archive_exception = archive_future.exception()
+    if archive_exception:
+        error_message = f"An exception occurred while archiving the file: '{archive_key}': {archive_exception}"
+        LOGGER.error(error_message)
+        util.write_to_audit_table(error_message)
+
+    return handed_off
+
+
 def retrieve_and_process_file(uploaded_file_object):
     bucket_name = uploaded_file_object["source_bucket_name"]
     file_key = uploaded_file_object["file_key"]
@@ -243,10 +283,8 @@ def retrieve_and_process_file(uploaded_file_object):
     esn = file_name.split('_')[2]
     config_spec_name, req_id = get_cspec_req_id(file_name.split('_')[3])
 
-    sqs_message = str(fc_uuid) + "," + str(device_id) + "," + str(file_name) + "," + str(file_size) + "," + str(
-        file_date_time) + "," + str('J1939_FC') + "," + str('CSV_JSON_CONVERTED') + "," + str(esn) + "," + str(
-        config_spec_name) + "," + str(req_id) + "," + str(None) + "," + " " + "," + " "
-    sqs_send_message(os.environ["metaWriteQueueUrl"], sqs_message)
+    emit_metadata_event(MetadataEvent(fc_uuid, device_id, file_name, file_size, file_date_time, 'J1939_FC',
+                                      'CSV_JSON_CONVERTED', esn, config_spec_name, req_id))
 
     ngdi_json_template = json.loads(os.environ["NGDIBody"])
 
@@ -452,16 +490,24 @@ def retrieve_and_process_file(uploaded_file_object):
 
     LOGGER.info(f"New Filename: {store_file_path}")
 
+    file_body = json.dumps(ngdi_json_template).encode()
+    # The poster logs the time from here to the routing of the file, to compare the fused and the S3 routing
+    file_metadata = {'j1939type': 'FC', 'uuid': fc_uuid, 'convertedat': str(round(time.time(), 3))}
+
+    if FUSED_FC_ROUTING and hand_off_to_poster(store_file_path, file_body, file_metadata,
+                                               datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")):
+        LOGGER.info(f"Handed off the file: '{store_file_path}' to the poster")
+        return True
+
     store_file_response = s3_client.put_object(Bucket=cp_post_bucket,
                                                Key=store_file_path,
-                                               Body=json.dumps(ngdi_json_template).encode(),
-                                               Metadata={'j1939type': 'FC', 'uuid': fc_uuid})
+                                               Body=file_body,
+                                               Metadata=file_metadata)
 
     LOGGER.debug(f"Store File Response: {store_file_response}")
 
-    if store_file_response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-        # Delete message from Queue after success
-        delete_message_from_sqs_queue(uploaded_file_object["sqs_receipt_handle"])
+    # The message is only deleted from the queue after success
+    return store_file_response["ResponseMetadata"]["HTTPStatusCode"] == 200
 
 
 def lambda_handler(lambda_event, context):  # noqa
@@ -475,24 +521,46 @@ def lambda_handler(lambda_event, context):  # noqa
         uploaded_file_object = dict(
             source_bucket_name=s3_event['bucket']['name'],
             file_key=s3_event['object']['key'].replace("%", ":").replace("3A", ""),
-            file_size=s3_event['object']['size'],
-            sqs_receipt_handle=record["receiptHandle"]
+            file_size=s3_event['object']['size']
         )
         LOGGER.debug(f"Uploaded File Object: {uploaded_file_object}.")
 
         # Retrieve the uploaded file from the s3 bucket and process the uploaded file
-        process = Process(target=retrieve_and_process_file, args=(uploaded_file_object,))
+        # The process hands its metadata events over through the pipe, to be sent with the ones of the whole batch
+        metadata_events_receiver, metadata_events_sender = Pipe(duplex=False)
+        process = Process(target=process_record, args=(uploaded_file_object, metadata_events_sender))
 
         # Make a list of all process to wait and terminate at the end
-        processes.append(process)
+        processes.append((record["messageId"], process, metadata_events_receiver))
 
         # Start process
         process.start()
+        # Only the process holds the sending end now, so that a process that dies closes the pipe
+        metadata_events_sender.close()
 
-    # Make sure that all processes have finished
-    for process in processes:
+    # Make sure that all processes have finished, the events are received first so that no process waits on the pipe
+    for _, process, metadata_events_receiver in processes:
+        receive_metadata_events_from(metadata_events_receiver)
         process.join()
 
+    for lost_event in flush_metadata_events():
+        util.write_to_audit_table(f"The metadata event: {lost_event.to_message()} could not be sent to the metaWrite "
+                                  f"queue")
+
+    # Partial batch response, SQS deletes the messages of the files that were processed
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id, process, _ in processes
+                                  if process.exitcode != 0]}
+
+
+def process_record(uploaded_file_object, metadata_events_sender):
+    # Runs in the process of the record, the exit code tells the handler whether the message is to be retried
+    try:
+        file_processed = retrieve_and_process_file(uploaded_file_object)
+    finally:
+        send_metadata_events_to(metadata_events_sender)
+    if not file_processed:
+        sys.exit(1)
+
 
 def get_active_fault_codes_from_dynamodb(esn):
     dynamodb = boto3.resource('dynamodb')
@@ -248,21 +248,6 @@ class TestConverterLambda(unittest.TestCase):
         self.assertTrue(response)
 
 
-    @patch.dict("os.environ", {"QueueUrl": "url"})
-    @patch("ConverterLambda.boto3.client")
-    def test_delete_message_from_sqs_queue_successful(self, mock_boto3_client):
-        """
-        Test for delete_message_from_sqs_queue() running successfully.
-        """
-        mock_sqs_client = mock_boto3_client.return_value
-        mock_sqs_client.delete_message.return_value = "response"
-
-        response = ConverterLambda.delete_message_from_sqs_queue("receipt-handle")
-
-        mock_sqs_client.delete_message.assert_called_with(QueueUrl="url", ReceiptHandle="receipt-handle")
-        self.assertEqual(response, "response")
-
-
     def test_process_ss_successful(self):
         """
         Test for process_ss() running successfully.
@@ -454,7 +439,7 @@ class TestConverterLambda(unittest.TestCase):
     })
     @patch("ConverterLambda.s3")
     @patch("ConverterLambda.get_cspec_req_id")
-    @patch("ConverterLambda.sqs_send_message")
+    @patch("ConverterLambda.emit_metadata_event")
     @patch("ConverterLambda.csv")
     @patch("ConverterLambda.util")
     @patch("ConverterLambda.process_ss")
@@ -463,10 +448,8 @@ class TestConverterLambda(unittest.TestCase):
     @patch("ConverterLambda.get_tsp_and_cust_ref")
     @patch("ConverterLambda.datetime", wraps=datetime)
     @patch("ConverterLambda.s3_client")
-    @patch("ConverterLambda.delete_message_from_sqs_queue")
     def test_retrieve_and_process_file(
         self,
-        mock_delete_message_from_sqs_queue,
         mock_s3_client,
         mock_datetime_now,
         mock_get_tsp_and_cust_ref,
@@ -475,7 +458,7 @@ class TestConverterLambda(unittest.TestCase):
         mock_process_ss,
         mock_util,
         mock_csv,
-        mock_sqs_send_message,
+        mock_emit_metadata_event,
         mock_get_cspec_req_id,
         mock_s3
     ):
@@ -490,8 +473,7 @@ class TestConverterLambda(unittest.TestCase):
         uploaded_file_object = {
             "source_bucket_name": "source-bucket-name",
             "file_key": file_key,
-            "file_size": "file-size",
-            "sqs_receipt_handle": "receipt-handle"
+            "file_size": "file-size"
         }
 
         mock_s3.get_object.return_value = {
@@ -531,10 +513,11 @@ class TestConverterLambda(unittest.TestCase):
 
         mock_s3_client.put_object.return_value = {"ResponseMetadata": {"HTTPStatusCode": 200}}
 
-        ConverterLambda.retrieve_and_process_file(uploaded_file_object)
+        self.assertTrue(ConverterLambda.retrieve_and_process_file(uploaded_file_object))
 
-        mock_sqs_send_message.assert_called_with(
-            "url",
+        mock_emit_metadata_event.assert_called_once()
+        self.assertEqual(
+            mock_emit_metadata_event.call_args[0][0].to_message(),
             f"uuid,device-id,0_device-id_esn_{datetime_str}.csv,file-size,{last_modified_date_str[:19]},J1939_FC,CSV_JSON_CONVERTED,esn,config-spec-name,req-id,None, , "
         )
 
@@ -561,16 +544,67 @@ class TestConverterLambda(unittest.TestCase):
             Bucket="CP_file_DUMP",
             Key=f"ConvertedFiles/component-serial-number/telematics-box-id/{('%02d' % datetime_now.year)}/{('%02d' % datetime_now.month)}/{('%02d' % datetime_now.day)}/FILENAME/0_device-id_esn_{datetime_str}.json",
             Body=json.dumps(converted_ngdi).encode(),
-            Metadata={"j1939type": "FC", "uuid": "uuid"}
+            Metadata={"j1939type": "FC", "uuid": "uuid", "convertedat": ANY}
         )
 
         mock_util.write_to_audit_table.assert_not_called()
         mock_datetime_now.assert_not_called()
-        mock_delete_message_from_sqs_queue.assert_called_with("receipt-handle")
 
 
+    @patch("ConverterLambda.POSTER_LAMBDA", "poster-lambda")
+    @patch("ConverterLambda.util")
+    @patch("ConverterLambda.lambda_client")
+    @patch("ConverterLambda.s3_client")
+    def test_hand_off_to_poster_successful(self, mock_s3_client, mock_lambda_client, mock_util):
+        """
+        Test for hand_off_to_poster() invoking the poster with the converted file and archiving the file.
+        """
+        mock_lambda_client.invoke.return_value = {"StatusCode": 202}
+        converted_ngdi = {"telematicsDeviceId": "device-id", "samples": [{"dateTimestamp": "timestamp"}]}
+        file_metadata = {"j1939type": "FC", "uuid": "uuid", "convertedat": "1.0"}
+
+        handed_off = ConverterLambda.hand_off_to_poster("ConvertedFiles/esn/device-id/file.json",
+                                                        json.dumps(converted_ngdi).encode(), file_metadata,
+                                                        "2023-04-24 06:49:25")
+
+        self.assertTrue(handed_off)
+        invoke_kwargs = mock_lambda_client.invoke.call_args[1]
+        payload = json.loads(invoke_kwargs["Payload"])
+        self.assertEqual(invoke_kwargs["FunctionName"], "poster-lambda")
+        self.assertEqual(invoke_kwargs["InvocationType"], "Event")
+        self.assertEqual(payload["json_body"], converted_ngdi)
+        self.assertEqual(payload["converted_file"]["file_key"], "ConvertedFiles/esn/device-id/file.json")
+        self.assertEqual(payload["converted_file"]["metadata"], file_metadata)
+        mock_s3_client.put_object.assert_called_once_with(
+            Bucket="CP_file_DUMP",
+            Key="ArchivedConvertedFiles/esn/device-id/file.json",
+            Body=json.dumps(converted_ngdi).encode(),
+            Metadata=file_metadata
+        )
+        mock_util.write_to_audit_table.assert_not_called()
+
+    @patch("ConverterLambda.POSTER_MAX_PAYLOAD_BYTES", 100)
+    @patch("ConverterLambda.lambda_client")
+    @patch("ConverterLambda.s3_client")
+    def test_hand_off_to_poster_when_file_is_too_large(self, mock_s3_client, mock_lambda_client):
+        """
+        Test for hand_off_to_poster() leaving the file that does not fit in the payload to ConvertedFiles.
+        """
+        file_body = json.dumps({"samples": ["x" * 100]}).encode()
+
+        handed_off = ConverterLambda.hand_off_to_poster("ConvertedFiles/file.json", file_body, {}, "")
+
+        self.assertFalse(handed_off)
+        mock_lambda_client.invoke.assert_not_called()
+        mock_s3_client.put_object.assert_not_called()
+
+    @patch("ConverterLambda.util")
+    @patch("ConverterLambda.flush_metadata_events")
+    @patch("ConverterLambda.receive_metadata_events_from")
+    @patch("ConverterLambda.Pipe")
     @patch("ConverterLambda.Process")
-    def test_lambda_handler(self, mock_process):
+    def test_lambda_handler(self, mock_process, mock_pipe, mock_receive_metadata_events_from,
+                            mock_flush_metadata_events, mock_util):
         """
         Test for lambda_handler() running successfully.
         """
@@ -587,22 +621,57 @@ class TestConverterLambda(unittest.TestCase):
                             }
                         ]
                     }),
-                    "receiptHandle": "receipt-handle"
+                    "messageId": "message-id"
                 }
             ]
         }
+        mock_process.return_value.exitcode = 0
+        mock_metadata_events_receiver, mock_metadata_events_sender = MagicMock(), MagicMock()
+        mock_pipe.return_value = (mock_metadata_events_receiver, mock_metadata_events_sender)
+        mock_flush_metadata_events.return_value = []
 
-        ConverterLambda.lambda_handler(lambda_invoke_event, None)
+        response = ConverterLambda.lambda_handler(lambda_invoke_event, None)
 
         mock_process.assert_called_with(
-            target=ConverterLambda.retrieve_and_process_file,
+            target=ConverterLambda.process_record,
             args=(
                 {
                     "source_bucket_name": "bucket",
                     "file_key": "file-key",
-                    "file_size": 100,
-                    "sqs_receipt_handle": "receipt-handle"
+                    "file_size": 100
                 },
+                mock_metadata_events_sender
             )
         )
         mock_process.return_value.start.assert_called()
+        mock_metadata_events_sender.close.assert_called_once()
+        mock_receive_metadata_events_from.assert_called_once_with(mock_metadata_events_receiver)
+        mock_flush_metadata_events.assert_called_once()
+        mock_util.write_to_audit_table.assert_not_called()
+        self.assertEqual(response, {"batchItemFailures": []})
+
+        mock_process.return_value.exitcode = 1
+        mock_flush_metadata_events.return_value = [MagicMock()]
+
+        response = ConverterLambda.lambda_handler(lambda_invoke_event, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "message-id"}]})
+        mock_util.write_to_audit_table.assert_called_once()
+
+    @patch("ConverterLambda.send_metadata_events_to")
+    @patch("ConverterLambda.retrieve_and_process_file")
+    def test_process_record(self, mock_retrieve_and_process_file, mock_send_metadata_events_to):
+        """
+        Test for process_record() handing its metadata events over and exiting with an error code when the file was
+        not converted.
+        """
+        mock_retrieve_and_process_file.return_value = True
+        ConverterLambda.process_record({"file_key": "file-key"}, "metadata-events-sender")
+
+        mock_send_metadata_events_to.assert_called_once_with("metadata-events-sender")
+
+        mock_retrieve_and_process_file.return_value = None
+        with self.assertRaises(SystemExit) as context:
+            ConverterLambda.process_record({"file_key": "file-key"}, "metadata-events-sender")
+        self.assertEqual(context.exception.code, 1)
+        self.assertEqual(mock_send_metadata_events_to.call_count, 2)
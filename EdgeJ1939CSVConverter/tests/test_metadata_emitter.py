@@ -0,0 +1,116 @@
+import sys
+import unittest
+from unittest.mock import patch, MagicMock
+
+from resources.cda_module_mocking_context import CDAModuleMockingContext
+
+with CDAModuleMockingContext(sys) as cda_module_mocking_context:
+    cda_module_mocking_context.mock_module("boto3")
+    cda_module_mocking_context.mock_module("utility")
+
+    import metadata_emitter
+
+
+def get_metadata_event(index):
+    return metadata_emitter.MetadataEvent(f"uuid-{index}", "device-id", f"file-{index}", 10, "2024-01-17 05:54:03",
+                                          "J1939_HB", "FILE_SENT", "esn", "SC8091", None)
+
+
+@patch.dict("os.environ", {"metaWriteQueueUrl": "queue-url"})
+class TestMetadataEmitter(unittest.TestCase):
+    """
+    Test module for metadata_emitter.py
+    """
+
+    def setUp(self):
+        metadata_emitter._reset_after_fork()
+
+    def test_to_message_same_as_the_csv_line(self):
+        """
+        Test for to_message() writing the fields in the order of the comma separated line of the metaWrite queue.
+        """
+        metadata_event = get_metadata_event(1)
+
+        self.assertEqual(metadata_event.to_message(),
+                         "uuid-1,device-id,file-1,10,2024-01-17 05:54:03,J1939_HB,FILE_SENT,esn,SC8091,None,None, , ")
+        self.assertEqual(metadata_event._replace(consumption_per_request="", reserved_1="", reserved_2="").to_message(),
+                         "uuid-1,device-id,file-1,10,2024-01-17 05:54:03,J1939_HB,FILE_SENT,esn,SC8091,None,,,")
+
+    @patch("metadata_emitter.sqs_client")
+    def test_emit_metadata_event_sends_full_batches(self, mock_sqs_client):
+        """
+        Test for emit_metadata_event() sending the buffer with SendMessageBatch once it holds a full batch.
+        """
+        mock_sqs_client.send_message_batch.return_value = {"Successful": []}
+
+        for index in range(23):
+            metadata_emitter.emit_metadata_event(get_metadata_event(index))
+        self.assertEqual(mock_sqs_client.send_message_batch.call_count, 2)
+        lost_events = metadata_emitter.flush_metadata_events()
+
+        self.assertEqual(lost_events, [])
+        self.assertEqual([len(call_args[1]["Entries"]) for call_args in mock_sqs_client.send_message_batch.call_args_list],
+                         [10, 10, 3])
+        self.assertEqual(mock_sqs_client.send_message_batch.call_args[1]["QueueUrl"], "queue-url")
+        self.assertEqual(mock_sqs_client.send_message_batch.call_args[1]["Entries"][0],
+                         {"Id": "0", "MessageBody": get_metadata_event(20).to_message()})
+
+    @patch("metadata_emitter.sqs_client")
+    def test_flush_metadata_events_retries_failed_entries(self, mock_sqs_client):
+        """
+        Test for flush_metadata_events() sending the failed entries again and returning the ones that were lost.
+        """
+        mock_sqs_client.send_message_batch.side_effect = [
+            {"Failed": [{"Id": "0", "SenderFault": False, "Code": "InternalError"},
+                        {"Id": "1", "SenderFault": True, "Code": "InvalidMessageContents"}]},
+            Exception("Mock SQS exception")
+        ]
+
+        for index in range(3):
+            metadata_emitter.emit_metadata_event(get_metadata_event(index))
+        lost_events = metadata_emitter.flush_metadata_events()
+
+        self.assertEqual(mock_sqs_client.send_message_batch.call_count, 2)
+        self.assertEqual(mock_sqs_client.send_message_batch.call_args[1]["Entries"],
+                         [{"Id": "0", "MessageBody": get_metadata_event(0).to_message()}])
+        self.assertEqual(lost_events, [get_metadata_event(1), get_metadata_event(0)])
+        self.assertEqual(metadata_emitter.flush_metadata_events(), [])
+
+    @patch("metadata_emitter.METADATA_BACKGROUND_FLUSH", True)
+    @patch("metadata_emitter.sqs_client")
+    def test_flush_metadata_events_waits_for_background_sends(self, mock_sqs_client):
+        """
+        Test for flush_metadata_events() waiting for the batches sent from the background thread.
+        """
+        mock_sqs_client.send_message_batch.return_value = {"Failed": [{"Id": "9", "SenderFault": True}]}
+
+        for index in range(10):
+            metadata_emitter.emit_metadata_event(get_metadata_event(index))
+        lost_events = metadata_emitter.flush_metadata_events()
+
+        mock_sqs_client.send_message_batch.assert_called_once()
+        self.assertEqual(lost_events, [get_metadata_event(9)])
+
+    def test_metadata_events_handed_over_through_pipe(self):
+        """
+        Test for send_metadata_events_to() and receive_metadata_events_from() moving the buffer of a record process.
+        """
+        mock_connection = MagicMock()
+        metadata_emitter.emit_metadata_event(get_metadata_event(1))
+
+        metadata_emitter.send_metadata_events_to(mock_connection)
+
+        mock_connection.send.assert_called_once_with([get_metadata_event(1)])
+        self.assertEqual(metadata_emitter.take_metadata_events(), [])
+
+        mock_connection.recv.return_value = [get_metadata_event(2)]
+        metadata_emitter.receive_metadata_events_from(mock_connection)
+        mock_connection.recv.side_effect = EOFError
+        metadata_emitter.receive_metadata_events_from(mock_connection)
+
+        self.assertEqual(metadata_emitter.take_metadata_events(), [get_metadata_event(2)])
+        self.assertEqual(mock_connection.close.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
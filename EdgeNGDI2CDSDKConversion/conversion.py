@@ -7,7 +7,7 @@ import traceback
 
 import uuid
 
-from multiprocessing import Process
+from multiprocessing import Process, Pipe
 sys.path.insert(1, './lib')
 
 try:
@@ -15,8 +15,6 @@ try:
     import requests
     from utility import write_to_audit_table, get_logger
     from edge_db_simple_layer import write_health_parameter_to_database_v2
-    from edge_gps_utility_layer import handle_gps_coordinates
-    from edge_sqs_utility_layer import sqs_send_message
     from aws_utils import spn_file_json
 
     from cd_sdk_conversion.cd_sdk import map_ngdi_sample_to_cd_payload
@@ -24,6 +22,10 @@ try:
 
     from authtoken_jfrog_artifacts import generate_auth_token
     import audit_utility as audit_utility
+    from json_stream_utility import read_json_file
+    from edge_shared_utilities.gps_utility import transform_gps_coordinate
+    from metadata_emitter import MetadataEvent, emit_metadata_event, flush_metadata_events, send_metadata_events_to, \
+        receive_metadata_events_from
 except Exception as e:
     traceback.print_exc()
     raise e
@@ -51,14 +53,6 @@ MAX_ATTEMPTS = int(os.environ["MaxAttempts"])
 s3_client = boto3.client('s3')
 
 
-def delete_message_from_sqs_queue(receipt_handle):
-    queue_url = os.environ["QueueUrl"]
-    sqs_client = boto3.client('sqs')  # noqa
-    sqs_message_deletion_response = sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt_handle)
-    LOGGER.debug(f"SQS message deletion response: '{sqs_message_deletion_response}'. . .")
-    return sqs_message_deletion_response
-
-
 def get_metadata_info(j1939_file):
     j1939_file_val = j1939_file
     try:
@@ -70,6 +64,27 @@ def get_metadata_info(j1939_file):
         return False
 
 
+def get_streamed_metadata_keys(fc_or_hb):
+    # The metadata read unconditionally for every sample, it has to be known before the first sample can be sent. The
+    # other keys of the class_arg_map are optional, they are only mapped when they are in the file
+    metadata_keys = {"telematicsDeviceId", "componentSerialNumber", "telematicsPartnerName"}
+    if fc_or_hb.lower() == "hb":
+        metadata_keys.add("dataSamplingConfigId")
+    return metadata_keys
+
+
+def warn_on_late_metadata(samples, j1939_file, file_key):
+    # Yields the streamed samples, then reports the optional metadata that was only found after them
+    streamed_keys = set(j1939_file)
+    yield from samples
+    late_keys = set(j1939_file).difference(streamed_keys)
+    if type(class_arg_map) == dict:
+        late_keys.intersection_update(class_arg_map)
+    if late_keys:
+        LOGGER.warning(f"The metadata: {sorted(late_keys)} of the file: '{file_key}' is after the samples, it was not "
+                       f"sent with them")
+
+
 def _post_cd_message(url, data):
     # In order to reattempt requests.post when we get sporadic network errors. Our current retry limit is 3
     retry_post_attempts = 0
@@ -273,12 +288,12 @@ def handle_hb(converted_device_params, converted_equip_params, converted_equip_f
         LOGGER.debug(f"HB CD SDK Class Variable Dict: {var_dict}")
         hb_sdk_object = map_ngdi_sample_to_cd_payload(var_dict)
 
-        # de-obfuscate GPS co-ordinates
+        # de-obfuscate GPS co-ordinates, the samples are streamed so the repeated co-ordinates are served by the cache
         if ("Latitude" in hb_sdk_object) and ("Longitude" in hb_sdk_object):
             latitude = hb_sdk_object["Latitude"]
             longitude = hb_sdk_object["Longitude"]
             hb_sdk_object["Latitude"], hb_sdk_object["Longitude"] = \
-                handle_gps_coordinates(latitude, longitude, deobfuscate=True)
+                transform_gps_coordinate(latitude, longitude, deobfuscate=True)
 
         LOGGER.info(f"Posting Sample to CD...")
         post_cd_message(hb_sdk_object)
@@ -359,45 +374,80 @@ def send_sample(sample, metadata, fc_or_hb, tsp_name):
         handle_fc(converted_device_params, converted_equip_params, converted_equip_fc, metadata, time_stamp)
 
 
-def _handle_metadata(metadata, samples, fc_or_hb, device_id, data_protocol, uploaded_file_object, j1939_file, tsp_name):
+def _handle_metadata(metadata, samples, fc_or_hb, device_id, data_protocol, j1939_file, tsp_name):
     if metadata:
-        if samples:
-            for sample in samples:
-                LOGGER.info("Sending HB sample data")
-                send_sample(sample, metadata, fc_or_hb, tsp_name)
-        else:
+        number_of_samples = 0
+        for sample in samples or []:
+            LOGGER.info("Sending HB sample data")
+            send_sample(sample, metadata, fc_or_hb, tsp_name)
+            number_of_samples += 1
+        if not number_of_samples:
             error_message = f"There are no samples in this file for the device: {device_id}."
             LOGGER.error(error_message)
             process_audit_error(error_message=error_message, data_protocol=data_protocol,
                                 meta_data=metadata, device_id=device_id)
-        delete_message_from_sqs_queue(uploaded_file_object["sqs_receipt_handle"])
-    else:
-        error_message = f"Metadata retrieval failed for the device: {device_id}."
-        LOGGER.error(error_message)
-        process_audit_error(error_message=error_message, data_protocol=data_protocol,
-                            meta_data=j1939_file, device_id=device_id)
+        return True
+    error_message = f"Metadata retrieval failed for the device: {device_id}."
+    LOGGER.error(error_message)
+    process_audit_error(error_message=error_message, data_protocol=data_protocol,
+                        meta_data=j1939_file, device_id=device_id)
+    return False
 
 
 def retrieve_and_process_file(uploaded_file_object):
     bucket = uploaded_file_object["source_bucket_name"]
     key = uploaded_file_object["file_key"]
-    file_size = uploaded_file_object["file_size"]
     LOGGER.info(f"Retrieving the JSON file from the NGDI folder")
     j1939_file_object = s3_client.get_object(Bucket=bucket, Key=key)
     file_metadata = j1939_file_object["Metadata"]
     LOGGER.info(f"File Metadata: {file_metadata}")
-    fc_or_hb = file_metadata['j1939type'] if "j1939type" in file_metadata else None
-    uuid = file_metadata['uuid']
+    if "j1939type" not in file_metadata:
+        LOGGER.error(f"Error! Cannot determine if this is an FC of an HB file. Check file metadata!")
+        return False
     file_date_time = str(j1939_file_object['LastModified'])[:19]
+    # The samples are parsed and sent one at a time, as the file is downloaded
+    j1939_file, samples = read_json_file(j1939_file_object['Body'])
+    if samples is not None:
+        missing_metadata_keys = get_streamed_metadata_keys(file_metadata["j1939type"]).difference(j1939_file)
+        if missing_metadata_keys:
+            LOGGER.warning(f"The metadata: {sorted(missing_metadata_keys)} is after the samples, reading all the "
+                           f"samples before sending them")
+            samples = list(samples)
+        else:
+            samples = warn_on_late_metadata(samples, j1939_file, key)
+    return process_file(uploaded_file_object, file_metadata, file_date_time, j1939_file, samples)
+
+
+def process_handed_off_file(handoff_event):
+    """
+    Processes a file the poster handed off in the invocation payload instead of writing it to the NGDI folder. The
+    event carries what the S3 object would have: the object metadata, the upload time and the file itself.
+    """
+    handoff = handoff_event["handoff"]
+    uploaded_file_object = dict(
+        source_bucket_name=handoff["source_bucket_name"],
+        file_key=handoff["file_key"],
+        file_size=handoff["file_size"]
+    )
+    LOGGER.info(f"Handed Off File Object: {uploaded_file_object}.")
+    file_metadata = handoff["metadata"]
+    if "j1939type" not in file_metadata:
+        LOGGER.error(f"Error! Cannot determine if this is an FC of an HB file. Check file metadata!")
+        return False
+    j1939_file = handoff_event["j1939_file"]
+    samples = j1939_file.pop("samples") if type(j1939_file.get("samples")) == list else None
+    return process_file(uploaded_file_object, file_metadata, handoff["file_date_time"], j1939_file, samples)
+
+
+def process_file(uploaded_file_object, file_metadata, file_date_time, j1939_file, samples):
+    key = uploaded_file_object["file_key"]
+    file_size = uploaded_file_object["file_size"]
+    fc_or_hb = file_metadata['j1939type']
+    uuid = file_metadata['uuid']
     file_name = key.split('/')[-1]
     device_id = file_name.split('_')[1]
     LOGGER.info(f"FC or HB: {fc_or_hb}")
-    if not fc_or_hb:
-        LOGGER.error(f"Error! Cannot determine if this is an FC of an HB file. Check file metadata!")
-        return
-    j1939_file_stream = j1939_file_object['Body'].read()
-    j1939_file = json.loads(j1939_file_stream)
-    LOGGER.debug(f"File as JSON: {j1939_file}")
+    LOGGER.debug(f"File Metadata as JSON: {j1939_file}")
     if fc_or_hb.lower() == 'hb':
         LOGGER.info("This is an hb file")
         esn = j1939_file['componentSerialNumber']
@@ -416,16 +466,24 @@ def retrieve_and_process_file(uploaded_file_object):
     consumption_per_request = None
     request_id = None
 
-    sqs_message = uuid + "," + str(device_id) + "," + str(file_name) + "," + str(file_size) + "," + str(
-        file_date_time) + "," + str(data_protocol) + "," + 'FILE_SENT' + "," + str(esn) + "," + str(
-        config_spec_name) + "," + str(request_id) + "," + str(consumption_per_request) + "," + " " + "," + " "
-    sqs_send_message(os.environ["metaWriteQueueUrl"], sqs_message)
-    samples = j1939_file["samples"] if "samples" in j1939_file else None
-    metadata = get_metadata_info(j1939_file)
-    _handle_metadata(metadata, samples, fc_or_hb, device_id, data_protocol, uploaded_file_object, j1939_file, tsp_name)
+    emit_metadata_event(MetadataEvent(uuid, device_id, file_name, file_size, file_date_time, data_protocol, 'FILE_SENT',
+                                      esn, config_spec_name, request_id, consumption_per_request))
+    # A file without a samples array goes through get_metadata_info() to be audited like before
+    metadata = j1939_file if samples is not None else get_metadata_info(j1939_file)
+    return _handle_metadata(metadata, samples, fc_or_hb, device_id, data_protocol, j1939_file, tsp_name)
 
 
 def lambda_handler(event, context):
+    if "handoff" in event:
+        # Invoked directly by the poster with the file in the payload
+        file_processed = process_handed_off_file(event)
+        flush_and_audit_metadata_events()
+        # There is no SQS message to retry, raise so that the asynchronous invocation is retried and then sent to the
+        # on failure destination
+        if not file_processed:
+            raise RuntimeError(f"Failed to process the handed off file: '{event['handoff']['file_key']}'")
+        return
+
     records = event.get("Records", [])
     processes = []
     LOGGER.debug(f"Received SQS Records: {records}.")
@@ -436,24 +494,50 @@ def lambda_handler(event, context):
         uploaded_file_object = dict(
             source_bucket_name=s3_event['bucket']['name'],
             file_key=s3_event['object']['key'].replace("%", ":").replace("3A", ""),
-            file_size=s3_event['object']['size'],
-            sqs_receipt_handle=record["receiptHandle"]
+            file_size=s3_event['object']['size']
         )
         LOGGER.info(f"Uploaded File Object: {uploaded_file_object}.")
 
         # Retrieve the uploaded file from the s3 bucket and process the uploaded file
-        process = Process(target=retrieve_and_process_file, args=(uploaded_file_object,))
+        # The process hands its metadata events over through the pipe, to be sent with the ones of the whole batch
+        metadata_events_receiver, metadata_events_sender = Pipe(duplex=False)
+        process = Process(target=process_record, args=(uploaded_file_object, metadata_events_sender))
 
         # Make a list of all process to wait and terminate at the end
-        processes.append(process)
+        processes.append((record["messageId"], process, metadata_events_receiver))
 
         # Start process
         process.start()
+        # Only the process holds the sending end now, so that a process that dies closes the pipe
+        metadata_events_sender.close()
 
-    # Make sure that all processes have finished
-    for process in processes:
+    # Make sure that all processes have finished, the events are received first so that no process waits on the pipe
+    for _, process, metadata_events_receiver in processes:
+        receive_metadata_events_from(metadata_events_receiver)
         process.join()
 
+    flush_and_audit_metadata_events()
+
+    # Partial batch response, SQS deletes the messages of the files that were processed
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id, process, _ in processes
+                                  if process.exitcode != 0]}
+
+
+def process_record(uploaded_file_object, metadata_events_sender):
+    # Runs in the process of the record, the exit code tells the handler whether the message is to be retried
+    try:
+        file_processed = retrieve_and_process_file(uploaded_file_object)
+    finally:
+        send_metadata_events_to(metadata_events_sender)
+    if not file_processed:
+        sys.exit(1)
+
+
+def flush_and_audit_metadata_events():
+    for lost_event in flush_metadata_events():
+        write_to_audit_table(lost_event.data_protocol, f"The metadata event: {lost_event.to_message()} could not be "
+                                                       f"sent to the metaWrite queue", lost_event.device_id)
+
 
 def resolve_value_from_converted_device_parameters(converted_device_params, key):
     if key in converted_device_params:
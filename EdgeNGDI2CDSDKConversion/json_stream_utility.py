@@ -0,0 +1,107 @@
+import json
+import codecs
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+DECODER = json.JSONDecoder()
+
+
+class JsonStreamReader:
+    """
+    Reads JSON values one at a time from a binary stream (e.g. the S3 'Body' StreamingBody), keeping only the value
+    being parsed and the unread part of the last chunk in memory.
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._position = 0
+        self._end_of_stream = False
+
+    def _fill(self):
+        # Reads at least as much as is already buffered, so that a large value is re-parsed a logarithmic number of times
+        if self._end_of_stream:
+            return False
+        chunk = self._stream.read(max(self._chunk_size, len(self._buffer) - self._position))
+        if not chunk:
+            self._end_of_stream = True
+        self._buffer = self._buffer[self._position:] + self._text_decoder.decode(chunk or b"", final=not chunk)
+        self._position = 0
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                raise ValueError("Unexpected end of the JSON document")
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError(f"Expecting '{character}' but found '{self.peek()}' in the JSON document")
+        self._position += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._position = end
+            return value
+
+
+def _read_members(reader, metadata, samples_key):
+    # Reads the object members into 'metadata' up to the samples array (True) or the end of the object (False)
+    while True:
+        next_character = reader.peek()
+        if next_character == "}":
+            reader.expect("}")
+            return False
+        if next_character == ",":
+            reader.expect(",")
+            continue
+        key = reader.read_value()
+        reader.expect(":")
+        if key == samples_key and reader.peek() == "[":
+            reader.expect("[")
+            return True
+        metadata[key] = reader.read_value()
+
+
+def _iter_samples(reader, metadata, samples_key):
+    while True:
+        next_character = reader.peek()
+        if next_character == "]":
+            reader.expect("]")
+            break
+        if next_character == ",":
+            reader.expect(",")
+            continue
+        yield reader.read_value()
+    # Members written after the samples are only known once all the samples were read
+    _read_members(reader, metadata, samples_key)
+
+
+def read_json_file(stream, samples_key="samples", chunk_size=CHUNK_SIZE):
+    """
+    Parses a JSON file object incrementally. Returns the top-level members found before the samples array and an
+    iterator over the samples, or None if the file has no samples array. Members written after the samples array are
+    added to the metadata once the iterator is exhausted, so the producers write 'samples' as the last member.
+    """
+    reader = JsonStreamReader(stream, chunk_size)
+    reader.expect("{")
+    metadata = {}
+    if not _read_members(reader, metadata, samples_key):
+        return metadata, None
+    return metadata, _iter_samples(reader, metadata, samples_key)
@@ -0,0 +1,162 @@
+import os
+import json
+import atexit
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+import utility as util
+
+LOGGER = util.get_logger(__name__)
+
+METADATA_BATCH_SIZE = 10  # SendMessageBatch limit
+METADATA_SEND_ATTEMPTS = int(os.getenv("MetadataSendAttempts", 2))
+# 'Y' sends the full batches from a background thread, so that the workers do not wait for SQS
+METADATA_BACKGROUND_FLUSH = os.getenv("MetadataBackgroundFlush", "N").lower() == "y"
+
+sqs_client = boto3.client('sqs')
+
+
+class MetadataEvent(namedtuple("MetadataEvent", [
+    "file_uuid", "device_id", "file_name", "file_size", "file_date_time", "data_protocol", "data_pipeline_stage",
+    "esn", "config_spec_name", "request_id", "consumption_per_request", "reserved_1", "reserved_2"
+], defaults=(None, " ", " "))):
+    """
+    The metadata of a file at one stage of the pipeline, sent to the metaWrite queue as one comma separated line.
+    """
+    __slots__ = ()
+
+    def to_message(self):
+        return ",".join(str(field) for field in self)
+
+
+_lock = threading.Lock()
+_pending_events = []  # MetadataEvent buffered until the batch is full or flushed
+_pending_sends = []  # futures of the batches sent from the background thread
+_lost_events = []  # MetadataEvent that could not be sent, returned by the next flush
+_executor = None
+
+
+def _reset_after_fork():
+    # A forked record process starts with its own empty buffer, see take_metadata_events()
+    global _lock, _pending_events, _pending_sends, _lost_events, _executor
+    _lock = threading.Lock()
+    _pending_events, _pending_sends, _lost_events = [], [], []
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _send_batch(metadata_events):
+    entries = {str(index): metadata_event for index, metadata_event in enumerate(metadata_events)}
+    lost_events = []
+    for attempt in range(1, METADATA_SEND_ATTEMPTS + 1):
+        try:
+            response = sqs_client.send_message_batch(
+                QueueUrl=os.environ["metaWriteQueueUrl"],
+                Entries=[{"Id": entry_id, "MessageBody": metadata_event.to_message()}
+                         for entry_id, metadata_event in entries.items()])
+        except Exception as e:
+            LOGGER.error(f"An error occurred while sending {len(entries)} metadata events, attempt: {attempt}: {e}")
+            continue
+
+        failed_entries = {}
+        for failed_entry in response.get("Failed") or []:
+            metadata_event = entries[failed_entry["Id"]]
+            LOGGER.error(f"The metadata event: {metadata_event.to_message()} was not sent, attempt: {attempt}: "
+                         f"{failed_entry.get('Code')}: {failed_entry.get('Message')}")
+            # Only the entries SQS could not take are sent again, the ones it rejected would fail the same way
+            if failed_entry.get("SenderFault"):
+                lost_events.append(metadata_event)
+            else:
+                failed_entries[failed_entry["Id"]] = metadata_event
+        entries = failed_entries
+        if not entries:
+            break
+    lost_events.extend(entries.values())
+
+    if lost_events:
+        with _lock:
+            _lost_events.extend(lost_events)
+
+
+def _submit_batch(metadata_events):
+    global _executor
+    if not METADATA_BACKGROUND_FLUSH:
+        _send_batch(metadata_events)
+        return
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1)
+        _pending_sends.append(_executor.submit(_send_batch, metadata_events))
+
+
+def emit_metadata_event(metadata_event):
+    """
+    Buffers the event, the calling thread (or the background thread) sends the buffer once it holds a full batch.
+    """
+    with _lock:
+        _pending_events.append(metadata_event)
+        if len(_pending_events) < METADATA_BATCH_SIZE:
+            return
+        full_batch = _pending_events[:]
+        _pending_events.clear()
+    _submit_batch(full_batch)
+
+
+def take_metadata_events():
+    # For the record processes, the events are handed over to the parent that sends the batches of the invocation
+    with _lock:
+        metadata_events = _pending_events[:]
+        _pending_events.clear()
+    return metadata_events
+
+
+def send_metadata_events_to(connection):
+    try:
+        connection.send(take_metadata_events())
+    finally:
+        connection.close()
+
+
+def receive_metadata_events_from(connection):
+    try:
+        metadata_events = connection.recv()
+    except EOFError:
+        LOGGER.error("The record process exited without handing its metadata events over, they are lost")
+        metadata_events = []
+    finally:
+        connection.close()
+    for metadata_event in metadata_events:
+        emit_metadata_event(metadata_event)
+
+
+def flush_metadata_events():
+    """
+    Sends the buffered events in batches of METADATA_BATCH_SIZE and waits for the batches sent in the background.
+    Returns the events that could not be sent, so that the caller can audit them.
+    """
+    metadata_events = take_metadata_events()
+    for index in range(0, len(metadata_events), METADATA_BATCH_SIZE):
+        _send_batch(metadata_events[index:index + METADATA_BATCH_SIZE])
+
+    with _lock:
+        pending_sends = _pending_sends[:]
+        _pending_sends.clear()
+    for pending_send in pending_sends:
+        pending_send.result()
+
+    with _lock:
+        lost_events = _lost_events[:]
+        _lost_events.clear()
+    if lost_events:
+        LOGGER.error(json.dumps({"event": "MetadataEventsLost", "lost": len(lost_events),
+                                 "messages": [lost_event.to_message() for lost_event in lost_events]}))
+    return lost_events
+
+
+# The handlers flush at the end of each invocation, this sends what is left when the interpreter exits
+atexit.register(flush_metadata_events)
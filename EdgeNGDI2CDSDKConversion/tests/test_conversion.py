@@ -1,8 +1,8 @@
+import io
 import json
-import os
 import sys
 import unittest
-from unittest.mock import ANY, patch, MagicMock
+from unittest.mock import ANY, call, patch, MagicMock
 
 from tests.cda_module_mock_context import CDAModuleMockingContext
 
@@ -31,15 +31,16 @@ with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.env
     cda_module_mock_context.mock_module('edge_db_simple_layer')
 
     import conversion
+    from edge_shared_utilities.gps_utility import clear_gps_cache
+    from metadata_emitter import take_metadata_events
 
 
 class TestConversion(unittest.TestCase):
 
     @patch("conversion.s3_client")
-    @patch("conversion.json")
     @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
                                'QueueUrl': 'QueueUrl'})
-    def test_retrieve_and_process_file_when_no_samples(self, json, s3_client):
+    def test_retrieve_and_process_file_when_no_samples(self, s3_client):
         print("<---------- test_retrieve_and_process_file_when_no_samples ---------->")
 
         body = {
@@ -55,26 +56,23 @@ class TestConversion(unittest.TestCase):
             "numberOfSamples": 1,
             "samples": []
         }
-        patch("builtins.open", MagicMock())
-        fetch_cs_reg_payload = open(os.path.join("tests", "test.json"), "r")
+        fetch_cs_reg_payload = io.BytesIO(json.dumps(body).encode())
 
         uploaded_file_object = {"source_bucket_name": "test",
                                 "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
-                                "file_size": "1", "sqs_receipt_handle": "sqs_receipt_handle"}
+                                "file_size": "1"}
         s3_object = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "FC"},
                      "LastModified": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
                      "Body": fetch_cs_reg_payload,
                      "sqs_receipt_handle": "sqs_receipt_handle"
                      }
         s3_client.get_object.return_value = s3_object
-        json.loads.return_value = body
         conversion.retrieve_and_process_file(uploaded_file_object)
 
     @patch("conversion.s3_client")
-    @patch("conversion.json")
     @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
                                'QueueUrl': 'QueueUrl'})
-    def test_retrieve_and_process_file_when_no_meta_data(self, json, s3_client):
+    def test_retrieve_and_process_file_when_no_meta_data(self, s3_client):
         print("<---------- test_retrieve_and_process_file_when_no_meta_data ---------->")
 
         body = {
@@ -90,20 +88,17 @@ class TestConversion(unittest.TestCase):
             "numberOfSamples": 1,
             "sample": []
         }
-        patch("builtins.open", MagicMock())
-
-        fetch_cs_reg_payload = open(os.path.join("tests", "test.json"), "r")
+        fetch_cs_reg_payload = io.BytesIO(json.dumps(body).encode())
 
         uploaded_file_object = {"source_bucket_name": "test",
                                 "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
-                                "file_size": "1", "sqs_receipt_handle": "sqs_receipt_handle"}
+                                "file_size": "1"}
         s3_object = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "FC"},
                      "LastModified": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
                      "Body": fetch_cs_reg_payload,
                      "sqs_receipt_handle": "sqs_receipt_handle"
                      }
         s3_client.get_object.return_value = s3_object
-        json.loads.return_value = body
         conversion.get_metadata_info.return_value = None
 
         conversion.retrieve_and_process_file(uploaded_file_object)
@@ -127,6 +122,24 @@ class TestConversion(unittest.TestCase):
         conversion.map_ngdi_sample_to_cd_payload.return_value = Exception
         conversion.handle_hb(converted_device_params, converted_equip_params, converted_fc, meta_data, "")
 
+    @patch("conversion.post_cd_message")
+    @patch("conversion.map_ngdi_sample_to_cd_payload")
+    @patch("conversion.process_hb_fc")
+    @patch("edge_shared_utilities.gps_utility.handle_gps_coordinates")
+    def test_handle_hb_deobfuscates_gps_coordinates(self, mock_handle_gps_coordinates, mock_process_hb_fc,
+                                                    mock_map_ngdi_sample_to_cd_payload, mock_post_cd_message):
+        print("<---------- test_handle_hb_deobfuscates_gps_coordinates ---------->")
+        clear_gps_cache()
+        mock_process_hb_fc.return_value = ({}, False)
+        mock_map_ngdi_sample_to_cd_payload.side_effect = lambda var_dict: {"Latitude": "1.5", "Longitude": "2.5"}
+        mock_handle_gps_coordinates.return_value = ("39.202938", "-85.88672")
+
+        conversion.handle_hb({}, {}, {}, {}, "")
+        conversion.handle_hb({}, {}, {}, {}, "")
+
+        mock_handle_gps_coordinates.assert_called_once_with("1.5", "2.5", deobfuscate=True)
+        mock_post_cd_message.assert_called_with({"Latitude": "39.202938", "Longitude": "-85.88672"})
+
     @patch("conversion.LOGGER")
     @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
                                'QueueUrl': 'QueueUrl', 'class_arg_map': ''})
@@ -158,10 +171,9 @@ class TestConversion(unittest.TestCase):
         conversion.handle_fc(converted_device_params, converted_equip_params, converted_fc, meta_data, "")
 
     @patch("conversion.s3_client")
-    @patch("conversion.json")
     @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
                                'QueueUrl': 'QueueUrl'})
-    def test_retrieve_and_process_file_when_cust_ref_is_cummins(self, json, s3_client):
+    def test_retrieve_and_process_file_when_cust_ref_is_cummins(self, s3_client):
         print("<---------- test_retrieve_and_process_file_when_cust_ref_is_cummins ---------->")
 
         body = {
@@ -177,27 +189,24 @@ class TestConversion(unittest.TestCase):
             "numberOfSamples": 1,
             "samples": []
         }
-        patch("builtins.open", MagicMock())
-        fetch_cs_reg_payload = open(os.path.join("tests", "test.json"), "r")
+        fetch_cs_reg_payload = io.BytesIO(json.dumps(body).encode())
 
         uploaded_file_object = {"source_bucket_name": "test",
                                 "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
-                                "file_size": "1", "sqs_receipt_handle": "sqs_receipt_handle"}
+                                "file_size": "1"}
         s3_object = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "FC"},
                      "LastModified": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
                      "Body": fetch_cs_reg_payload,
                      "sqs_receipt_handle": "sqs_receipt_handle"
                      }
         s3_client.get_object.return_value = s3_object
-        json.loads.return_value = body
         conversion.retrieve_and_process_file(uploaded_file_object)
 
     @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
                                'QueueUrl': 'QueueUrl'})
     @patch('conversion.handle_hb')
     @patch("conversion.s3_client.get_object")
-    @patch("conversion.json.loads")
-    def test_retrieve_and_process_file_when_tsp_name_is_cospa(self, json, mock_s3_client, mock_handle_hb):
+    def test_retrieve_and_process_file_when_tsp_name_is_cospa(self, mock_s3_client, mock_handle_hb):
         print("<---------- test_retrieve_and_process_file_when_tsp_name_is_cospa ---------->")
 
         body = {
@@ -214,19 +223,17 @@ class TestConversion(unittest.TestCase):
             "samples": [{"dateTimestamp": "2020-10-08T14:26:58.456Z",
                          "convertedDeviceParameters": {"messageID": "message_id", "Longitude": "30.9876543"}}]
         }
-        patch("builtins.open", MagicMock())
-        fetch_cs_reg_payload = open(os.path.join("tests", "test.json"), "r")
+        fetch_cs_reg_payload = io.BytesIO(json.dumps(body).encode())
 
         uploaded_file_object = {"source_bucket_name": "test",
                                 "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
-                                "file_size": "1", "sqs_receipt_handle": "sqs_receipt_handle"}
+                                "file_size": "1"}
         s3_object = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "HB"},
                      "LastModified": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
                      "Body": fetch_cs_reg_payload,
                      "sqs_receipt_handle": "sqs_receipt_handle"
                      }
         mock_s3_client.return_value = s3_object
-        json.return_value = body
         conversion.retrieve_and_process_file(uploaded_file_object)
         mock_handle_hb.assert_not_called()
 
@@ -234,8 +241,7 @@ class TestConversion(unittest.TestCase):
                                'QueueUrl': 'QueueUrl'})
     @patch('conversion.handle_hb')
     @patch("conversion.s3_client.get_object")
-    @patch("conversion.json.loads")
-    def test_retrieve_and_process_file_when_tsp_name_is_not_cospa(self, json, mock_s3_client, mock_handle_hb):
+    def test_retrieve_and_process_file_when_tsp_name_is_not_cospa(self, mock_s3_client, mock_handle_hb):
         print("<---------- test_retrieve_and_process_file_when_tsp_name_is_not_cospa ---------->")
 
         body = {
@@ -252,35 +258,173 @@ class TestConversion(unittest.TestCase):
             "samples": [{"dateTimestamp": "2020-10-08T14:26:58.456Z",
                          "convertedDeviceParameters": {"messageID": "message_id", "Longitude": "30.9876543"}}]
         }
-        patch("builtins.open", MagicMock())
-        fetch_cs_reg_payload = open(os.path.join("tests", "test.json"), "r")
+        fetch_cs_reg_payload = io.BytesIO(json.dumps(body).encode())
 
         uploaded_file_object = {"source_bucket_name": "test",
                                 "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
-                                "file_size": "1", "sqs_receipt_handle": "sqs_receipt_handle"}
+                                "file_size": "1"}
         s3_object = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "HB"},
                      "LastModified": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
                      "Body": fetch_cs_reg_payload,
                      "sqs_receipt_handle": "sqs_receipt_handle"
                      }
         mock_s3_client.return_value = s3_object
-        json.return_value = body
         conversion.retrieve_and_process_file(uploaded_file_object)
         mock_handle_hb.assert_called_once()
 
-    @patch.dict("os.environ", {"QueueUrl": "url"})
-    @patch("conversion.boto3.client")
-    def test_delete_message_from_sqs_queue_successful(self, mock_boto3_client):
+    @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
+                               'QueueUrl': 'QueueUrl'})
+    @patch("conversion.send_sample")
+    @patch("conversion.s3_client.get_object")
+    def test_retrieve_and_process_file_when_metadata_is_after_samples(self, mock_get_object, mock_send_sample):
+        """
+        Test for retrieve_and_process_file() sending the samples with the metadata written after them.
+        """
+        body = {
+            "componentSerialNumber": "30311606",
+            "telematicsDeviceId": "864337059675703",
+            "dataSamplingConfigId": "SC3078",
+            "samples": [{"dateTimestamp": "2020-10-08T14:26:58.456Z"}, {"dateTimestamp": "2020-10-08T14:27:58.456Z"}],
+            "telematicsPartnerName": "Accolade"
+        }
+        uploaded_file_object = {"source_bucket_name": "test",
+                                "file_key": "edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
+                                "file_size": "1"}
+        mock_get_object.return_value = {"Metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "HB"},
+                                        "LastModified": "2023-04-24 06:49:25+00:00",
+                                        "Body": io.BytesIO(json.dumps(body).encode())}
+
+        self.assertTrue(conversion.retrieve_and_process_file(uploaded_file_object))
+
+        metadata = {key: value for key, value in body.items() if key != "samples"}
+        self.assertEqual(mock_send_sample.call_args_list,
+                         [call(sample, metadata, "HB", "Accolade") for sample in body["samples"]])
+
+    def test_get_streamed_metadata_keys_successful(self):
+        """
+        Test for get_streamed_metadata_keys() requiring the data sampling config of the HB files only.
+        """
+        self.assertEqual(conversion.get_streamed_metadata_keys("HB"),
+                         {"telematicsDeviceId", "componentSerialNumber", "telematicsPartnerName", "dataSamplingConfigId"})
+        self.assertEqual(conversion.get_streamed_metadata_keys("FC"),
+                         {"telematicsDeviceId", "componentSerialNumber", "telematicsPartnerName"})
+
+    @patch("conversion.LOGGER")
+    @patch("conversion.class_arg_map", {"vin": "vin", "customerReference": "customer_reference"})
+    def test_warn_on_late_metadata_when_optional_metadata_is_after_samples(self, mock_logger):
         """
-        Test for delete_message_from_sqs_queue() running successfully.
+        Test for warn_on_late_metadata() reporting the optional metadata found after the samples were sent.
         """
-        mock_sqs_client = mock_boto3_client.return_value
-        mock_sqs_client.delete_message.return_value = "response"
+        j1939_file = {"telematicsDeviceId": "864337059675703"}
 
-        response = conversion.delete_message_from_sqs_queue("receipt-handle")
+        def samples():
+            yield {"dateTimestamp": "2020-10-08T14:26:58.456Z"}
+            j1939_file.update(vin="vin", numberOfSamples=1)
 
-        mock_sqs_client.delete_message.assert_called_with(QueueUrl="url", ReceiptHandle="receipt-handle")
-        self.assertEqual(response, "response")
+        self.assertEqual(list(conversion.warn_on_late_metadata(samples(), j1939_file, "file-key")),
+                         [{"dateTimestamp": "2020-10-08T14:26:58.456Z"}])
+        mock_logger.warning.assert_called_once()
+        self.assertIn("['vin']", mock_logger.warning.call_args[0][0])
+
+    @patch.dict('os.environ', {'metaWriteQueueUrl': 'metaWriteQueueUrl', 'AuditTrailQueueUrl': 'AuditTrailQueueUrl',
+                               'QueueUrl': 'QueueUrl'})
+    @patch("metadata_emitter.sqs_client")
+    @patch("conversion.send_sample")
+    @patch("conversion.s3_client.get_object")
+    def test_lambda_handler_when_file_handed_off(self, mock_get_object, mock_send_sample, mock_sqs_client):
+        """
+        Test for lambda_handler() processing the file handed off by the poster without reading it from S3.
+        """
+        take_metadata_events()  # Left by the other tests
+        samples = [{"dateTimestamp": "2020-10-08T14:26:58.456Z"}]
+        metadata = {"componentSerialNumber": "30311606", "telematicsDeviceId": "864337059675703",
+                    "dataSamplingConfigId": "SC3078", "telematicsPartnerName": "Accolade"}
+        handoff_event = {
+            "handoff": {"source_bucket_name": "test",
+                        "file_key": "NGDI/edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
+                        "file_size": 100, "file_date_time": "2023-04-24 06:49:25",
+                        "metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "HB"}},
+            "j1939_file": {**metadata, "samples": samples}
+        }
+
+        conversion.lambda_handler(handoff_event, None)
+
+        mock_get_object.assert_not_called()
+        mock_send_sample.assert_called_once_with(samples[0], metadata, "HB", "Accolade")
+        # The FILE_SENT metadata event is sent before the handler returns
+        mock_sqs_client.send_message_batch.assert_called_once()
+        self.assertIn(",100,2023-04-24 06:49:25,J1939_HB,FILE_SENT,",
+                      mock_sqs_client.send_message_batch.call_args[1]["Entries"][0]["MessageBody"])
+
+    @patch("conversion.flush_and_audit_metadata_events")
+    @patch("conversion.process_file")
+    def test_lambda_handler_when_handed_off_file_fails(self, mock_process_file, mock_flush_and_audit_metadata_events):
+        """
+        Test for lambda_handler() raising when the file handed off by the poster is not processed, so that the
+        asynchronous invocation is retried.
+        """
+        mock_process_file.return_value = False
+        handoff_event = {
+            "handoff": {"source_bucket_name": "test",
+                        "file_key": "NGDI/edge_864337059675703_30311606_20230424064925_SC3078_2023-04-24T06_49_25.956Z",
+                        "file_size": 100, "file_date_time": "2023-04-24 06:49:25",
+                        "metadata": {"uuid": "469448c0-e34e-11ed-b5ea-0242ac120002", "j1939type": "HB"}},
+            "j1939_file": {"samples": []}
+        }
+
+        with self.assertRaises(RuntimeError):
+            conversion.lambda_handler(handoff_event, None)
+
+        # The metadata events of the file are still sent
+        mock_flush_and_audit_metadata_events.assert_called_once()
+
+    @patch("conversion.write_to_audit_table")
+    @patch("conversion.flush_metadata_events")
+    @patch("conversion.receive_metadata_events_from")
+    @patch("conversion.Pipe")
+    @patch("conversion.Process")
+    def test_lambda_handler_reports_failed_records(self, mock_process, mock_pipe, mock_receive_metadata_events_from,
+                                                   mock_flush_metadata_events, mock_write_to_audit_table):
+        """
+        Test for lambda_handler() reporting the messages of the records whose process failed and auditing the metadata
+        events that could not be sent.
+        """
+        records = [{"messageId": f"message-{index}",
+                    "body": json.dumps({"Records": [{"s3": {"object": {"key": f"NGDI/file-{index}.json", "size": 100},
+                                                            "bucket": {"name": "bucket"}}}]})}
+                   for index in range(3)]
+        mock_process.side_effect = [MagicMock(exitcode=0), MagicMock(exitcode=1), MagicMock(exitcode=-9)]
+        mock_pipe.side_effect = [(f"receiver-{index}", MagicMock()) for index in range(3)]
+        mock_flush_metadata_events.return_value = [
+            conversion.MetadataEvent("uuid", "device-id", "file-0.json", 100, "2023-04-24 06:49:25", "J1939_HB",
+                                     "FILE_SENT", "esn", "SC3078", None)]
+
+        response = conversion.lambda_handler({"Records": records}, None)
+
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "message-1"},
+                                                          {"itemIdentifier": "message-2"}]})
+        mock_process.assert_called_with(target=conversion.process_record,
+                                        args=({"source_bucket_name": "bucket", "file_key": "NGDI/file-2.json",
+                                               "file_size": 100}, ANY))
+        self.assertEqual([call_args[0][0] for call_args in mock_receive_metadata_events_from.call_args_list],
+                         ["receiver-0", "receiver-1", "receiver-2"])
+        mock_write_to_audit_table.assert_called_once_with("J1939_HB", ANY, "device-id")
+
+    @patch("conversion.send_metadata_events_to")
+    @patch("conversion.retrieve_and_process_file")
+    def test_process_record_exits_on_failure(self, mock_retrieve_and_process_file, mock_send_metadata_events_to):
+        """
+        Test for process_record() handing its metadata events over and exiting with an error code when the file was
+        not processed.
+        """
+        mock_retrieve_and_process_file.return_value = True
+        conversion.process_record({"file_key": "file-key"}, "metadata-events-sender")
+
+        mock_retrieve_and_process_file.return_value = False
+        with self.assertRaises(SystemExit) as context:
+            conversion.process_record({"file_key": "file-key"}, "metadata-events-sender")
+        self.assertEqual(context.exception.code, 1)
+        self.assertEqual(mock_send_metadata_events_to.call_args_list, [call("metadata-events-sender")] * 2)
 
     def test_get_metadata_info_successful(self):
         """
@@ -761,43 +905,38 @@ class TestConversion(unittest.TestCase):
 
     @patch("conversion.send_sample")
     @patch("conversion.process_audit_error")
-    @patch("conversion.delete_message_from_sqs_queue")
-    def test_handle_metadata_successful(self, mock_delete_fn, mock_process_error, mock_send_sample):
+    def test_handle_metadata_successful(self, mock_process_error, mock_send_sample):
         """
         Test for _handle_metadata() running successfully.
         """
-        conversion._handle_metadata(
+        self.assertTrue(conversion._handle_metadata(
             "metadata",
             ["sample"],
             "hb",
             "device-id",
             "j1939",
-            {"sqs_receipt_handle": "receipt-handle"},
             "j1939-file",
             "tsp-name"
-        )
+        ))
 
         mock_send_sample.assert_called_with("sample", "metadata", "hb", "tsp-name")
-        mock_delete_fn.assert_called_with("receipt-handle")
         mock_process_error.assert_not_called()
 
     @patch("conversion.send_sample")
     @patch("conversion.process_audit_error")
-    @patch("conversion.delete_message_from_sqs_queue")
-    def test_handle_metadata_on_error(self, mock_delete_fn, mock_process_error, mock_send_sample):
+    def test_handle_metadata_on_error(self, mock_process_error, mock_send_sample):
         """
         Test for _handle_metadata() when sample or metadata is missing.
         """
-        conversion._handle_metadata(
+        self.assertFalse(conversion._handle_metadata(
             "",
             [],
             "hb",
             "device-id",
             "j1939",
-            {"sqs_receipt_handle": "receipt-handle"},
             "j1939-file",
             "tsp-name"
-        )
+        ))
 
         mock_process_error.assert_called_with(
             error_message=ANY,
@@ -805,19 +944,18 @@ class TestConversion(unittest.TestCase):
             meta_data="j1939-file",
             device_id="device-id"
         )
-        mock_delete_fn.assert_not_called()
         mock_send_sample.assert_not_called()
 
-        conversion._handle_metadata(
+        # A file without samples is audited and not retried
+        self.assertTrue(conversion._handle_metadata(
             "metadata",
             [],
             "hb",
             "device-id",
             "j1939",
-            {"sqs_receipt_handle": "receipt-handle"},
             "j1939-file",
             "tsp-name"
-        )
+        ))
 
         mock_process_error.assert_called_with(
             error_message=ANY,
@@ -825,7 +963,6 @@ class TestConversion(unittest.TestCase):
             meta_data="metadata",
             device_id="device-id"
         )
-        mock_delete_fn.assert_called_with("receipt-handle")
         mock_send_sample.assert_not_called()
 
     # @patch("conversion.boto3.client")
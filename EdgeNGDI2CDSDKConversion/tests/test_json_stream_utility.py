@@ -0,0 +1,89 @@
+import io
+import sys
+import json
+import unittest
+
+sys.path.append("../")
+
+import json_stream_utility
+
+
+def _file_stream(json_file):
+    return io.BytesIO(json.dumps(json_file, ensure_ascii=False).encode("utf-8"))
+
+
+class TestJsonStreamUtility(unittest.TestCase):
+    """
+    Test module for json_stream_utility.py
+    """
+
+    json_file = {
+        "telematicsDeviceId": "192999999999954",
+        "componentSerialNumber": "64200027",
+        "numberOfSamples": 3,
+        "samples": [
+            {"convertedDeviceParameters": {"messageID": "1", "Latitude": 39.202938}, "name": "température"},
+            {"convertedDeviceParameters": {"messageID": "2", "Latitude": -85.88672e-2}, "values": [1, None, True]},
+            {"convertedDeviceParameters": {"messageID": "3"}, "count": 1234567890}
+        ]
+    }
+
+    def test_read_json_file_successful(self):
+        """
+        Test for read_json_file() returning the metadata and the samples, with values split across the chunks.
+        """
+        for chunk_size in [1, 7, 64 * 1024]:
+            metadata, samples = json_stream_utility.read_json_file(_file_stream(self.json_file), chunk_size=chunk_size)
+
+            self.assertEqual(metadata, {"telematicsDeviceId": "192999999999954", "componentSerialNumber": "64200027",
+                                        "numberOfSamples": 3})
+            self.assertEqual(list(samples), self.json_file["samples"])
+
+    def test_read_json_file_samples_read_lazily(self):
+        """
+        Test for read_json_file() only reading the stream up to the sample being returned.
+        """
+        stream = _file_stream(self.json_file)
+
+        metadata, samples = json_stream_utility.read_json_file(stream, chunk_size=16)
+        next(samples)
+
+        self.assertEqual(metadata["numberOfSamples"], 3)
+        self.assertLess(stream.tell(), len(stream.getvalue()) - 16)
+
+    def test_read_json_file_members_after_samples(self):
+        """
+        Test for read_json_file() adding the members written after the samples once they were all read.
+        """
+        json_file = {"samples": [{"messageID": "1"}], "telematicsDeviceId": "1", "vin": "vin"}
+
+        metadata, samples = json_stream_utility.read_json_file(_file_stream(json_file), chunk_size=4)
+
+        self.assertEqual(metadata, {})
+        self.assertEqual(list(samples), [{"messageID": "1"}])
+        self.assertEqual(metadata, {"telematicsDeviceId": "1", "vin": "vin"})
+
+    def test_read_json_file_no_samples(self):
+        """
+        Test for read_json_file() returning no samples iterator when the file has no samples array.
+        """
+        metadata, samples = json_stream_utility.read_json_file(_file_stream({"telematicsDeviceId": "1",
+                                                                             "samples": None}))
+
+        self.assertEqual(metadata, {"telematicsDeviceId": "1", "samples": None})
+        self.assertIsNone(samples)
+
+    def test_read_json_file_invalid_json(self):
+        """
+        Test for read_json_file() raising an error on a truncated or invalid file, like json.loads() did.
+        """
+        with self.assertRaises(ValueError):
+            json_stream_utility.read_json_file(io.BytesIO(b'[{"telematicsDeviceId": "1"}]'))
+
+        _, samples = json_stream_utility.read_json_file(io.BytesIO(b'{"samples": [{"messageID": "1"}, {"messa'))
+        with self.assertRaises(ValueError):
+            list(samples)
+
+
+if __name__ == '__main__':
+    unittest.main()
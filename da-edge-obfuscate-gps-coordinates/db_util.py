@@ -1,7 +1,9 @@
 import utility as util
 from pypika import Query, Table
+import threading
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from edge_db_simple_layer import send_payload_to_edge, server_error, form_query_to_db_payload
 
@@ -10,6 +12,11 @@ logger = util.get_logger(__name__)
 region = os.getenv('region')
 time_format = os.getenv('TimeFormat')
 
+# A multi-row INSERT is sent once this many rows are buffered or the first of them has waited this long
+METADATA_BATCH_ROWS = int(os.getenv('MetadataBatchRows', 25))
+METADATA_BATCH_AGE_SECONDS = float(os.getenv('MetadataBatchAgeSeconds', 1))
+METADATA_INSERT_WORKERS = int(os.getenv('MetadataInsertWorkers', 2))
+
 
 def insert_into_metadata_Table(device_id, message_id, esn, config_id, file_name, file_size):
     query = insert_to_metadata_table_query(device_id, message_id, esn, config_id, file_name, file_size)
@@ -21,9 +28,19 @@ def insert_into_metadata_Table(device_id, message_id, esn, config_id, file_name,
         return server_error(str(e))
 
 
-def insert_to_metadata_table_query(device_id, message_id, esn, config_id, file_name, file_size):
+def get_metadata_row(device_id, message_id, esn, config_id, file_name, file_size):
     time_default_format = time.gmtime()
     current_date_time = time.strftime(time_format, time_default_format)
+    return (device_id, message_id, 'J1939_Emissions', 'FILE_RECEIVED', esn, config_id, file_name, file_size,
+            current_date_time, current_date_time)
+
+
+def insert_to_metadata_table_query(device_id, message_id, esn, config_id, file_name, file_size):
+    return insert_rows_to_metadata_table_query(
+        [get_metadata_row(device_id, message_id, esn, config_id, file_name, file_size)])
+
+
+def insert_rows_to_metadata_table_query(rows):
     da_edge_metadata = Table('da_edge_olympus.da_edge_metadata')
     query = Query.into(da_edge_metadata).columns(da_edge_metadata.device_id,
                                                  da_edge_metadata.uuid,
@@ -35,7 +52,87 @@ def insert_to_metadata_table_query(device_id, message_id, esn, config_id, file_n
                                                  da_edge_metadata.file_size,
                                                  da_edge_metadata.file_received_date,
                                                  da_edge_metadata.created_datetime)
-    query = query.insert(device_id, message_id, 'J1939_Emissions', 'FILE_RECEIVED', esn, config_id, file_name, file_size, current_date_time, current_date_time)
+    query = query.insert(*rows)
     logger.info(query.get_sql(quote_char=None))
     return query.get_sql(quote_char=None)
 
+
+class MetadataTableWriter:
+    """
+    Buffers the metadata rows of a batch and inserts them with multi-row INSERTs, sent in the background once
+    METADATA_BATCH_ROWS rows are buffered or the first buffered row is METADATA_BATCH_AGE_SECONDS old, so that they run
+    concurrently with the S3 uploads. The age is checked when a row is added and by a timer started with the first
+    buffered row, so that the rows are not held back by the uploads that come after them. close() inserts the
+    remaining rows, waits for all the INSERTs and returns the batch item identifiers (the message IDs of the rows added
+    without one) of the rows that could not be inserted, each of them is logged and audited.
+    """
+
+    def __init__(self, max_rows=METADATA_BATCH_ROWS, max_age_seconds=METADATA_BATCH_AGE_SECONDS):
+        self._max_rows = max_rows
+        self._max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._rows = []
+        self._first_row_at = None
+        self._age_timer = None
+        self._item_ids = {}  # message ID -> batch item identifier
+        self._executor = ThreadPoolExecutor(max_workers=METADATA_INSERT_WORKERS)
+        self._inserts = []
+
+    def _take_rows(self):
+        rows, self._rows, self._first_row_at = self._rows, [], None
+        if self._age_timer:
+            self._age_timer.cancel()
+            self._age_timer = None
+        return rows
+
+    def _insert_buffered_rows(self, force=False):
+        # Called with the lock held, sends the buffered rows if they are due, or all of them with 'force'
+        if not self._rows:
+            return
+        if not force and len(self._rows) < self._max_rows and \
+                time.monotonic() - self._first_row_at < self._max_age_seconds:
+            return
+        rows = self._take_rows()
+        self._inserts.append(self._executor.submit(self._insert_rows, rows))
+
+    def _insert_aged_rows(self):
+        with self._lock:
+            self._insert_buffered_rows()
+
+    def add(self, device_id, message_id, esn, config_id, file_name, file_size, item_id=None):
+        with self._lock:
+            self._rows.append(get_metadata_row(device_id, message_id, esn, config_id, file_name, file_size))
+            if item_id is not None:
+                self._item_ids[message_id] = item_id
+            if self._first_row_at is None:
+                self._first_row_at = time.monotonic()
+                if self._max_age_seconds > 0:
+                    self._age_timer = threading.Timer(self._max_age_seconds, self._insert_aged_rows)
+                    self._age_timer.daemon = True
+                    self._age_timer.start()
+            self._insert_buffered_rows()
+
+    def _insert_rows(self, rows):
+        try:
+            send_payload_to_edge(form_query_to_db_payload(insert_rows_to_metadata_table_query(rows), method='post'))
+            logger.info(f"{len(rows)} record(s) inserted into Metadata table successfully")
+            return []
+        except Exception as e:
+            if len(rows) == 1:
+                device_id, message_id, _, _, _, _, file_name = rows[0][:7]
+                error_message = f"Error inserting into metadata table the file: {file_name} of the device: " \
+                                f"{device_id}, message_id: {message_id}: {e}"
+                logger.error(error_message)
+                util.write_to_audit_table(error_message)
+                return [message_id]
+            # A single bad row fails the whole INSERT, the rows are inserted one at a time to report only the bad ones
+            logger.info(f"Error inserting {len(rows)} records into metadata table, inserting them one at a time")
+            return [message_id for row in rows for message_id in self._insert_rows([row])]
+
+    def close(self):
+        with self._lock:
+            self._insert_buffered_rows(force=True)
+            inserts, self._inserts = self._inserts, []
+        failed_message_ids = [message_id for insert in inserts for message_id in insert.result()]
+        self._executor.shutdown()
+        return [self._item_ids.get(message_id, message_id) for message_id in failed_message_ids]
@@ -4,8 +4,10 @@ sys.path.insert(1, './lib')
 
 import traceback
 try:
+    import json
+    import base64
     import utility as util
-    from obfuscate_gps_handler import obfuscate_gps
+    from obfuscate_gps_handler import obfuscate_gps, obfuscate_gps_batch
 except Exception as e:
     traceback.print_exc()
     raise e
@@ -13,7 +15,46 @@ except Exception as e:
 LOGGER = util.get_logger(__name__)
 
 
+def get_batch_item(record):
+    # SQS records carry the body as a JSON string, Kinesis records as base64 encoded JSON
+    if record.get("eventSource") == "aws:kinesis":
+        return record["kinesis"]["sequenceNumber"], json.loads(base64.b64decode(record["kinesis"]["data"]))
+    return record["messageId"], json.loads(record["body"])
+
+
+def get_arrival_time(record):
+    # Epoch seconds at which the record was sent to the queue or added to the stream, None if not given
+    if record.get("eventSource") == "aws:kinesis":
+        return record["kinesis"].get("approximateArrivalTimestamp")
+    sent_timestamp = record.get("attributes", {}).get("SentTimestamp")
+    return int(sent_timestamp) / 1000 if sent_timestamp else None
+
+
+def process_batch(records):
+    batch_items = []
+    arrival_times = {}
+    failed_item_ids = []
+    for record in records:
+        try:
+            batch_item = get_batch_item(record)
+            batch_items.append(batch_item)
+            arrival_time = get_arrival_time(record)
+            if arrival_time is not None:
+                arrival_times[batch_item[0]] = arrival_time
+        except Exception as e:
+            item_id = record.get("messageId") or record.get("kinesis", {}).get("sequenceNumber")
+            LOGGER.error(f"An error occurred while reading the batch item: {item_id}: {e}")
+            util.write_to_audit_table(e)
+            failed_item_ids.append(item_id)
+    failed_item_ids += obfuscate_gps_batch(batch_items, arrival_times)
+    # Partial batch response, only the failed items are retried by the event source mapping
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failed_item_ids]}
+
+
 def lambda_handler(event, context):  # noqa
+    if "Records" in event:
+        LOGGER.debug(f"Batch of {len(event['Records'])} record(s) posted to obfuscate lambda function")
+        return process_batch(event["Records"])
     try:
         body = event
         LOGGER.debug(f"Event posted to obfuscate lambda function is: {event}")
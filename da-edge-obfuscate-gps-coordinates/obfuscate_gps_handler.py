@@ -1,68 +1,232 @@
 import os
+import gzip
 import json
 import boto3
 import utility as util
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
 from uuid import uuid4
-from edge_gps_utility_layer import handle_gps_coordinates
-from db_util import insert_into_metadata_Table
+from edge_shared_utilities.gps_utility import transform_gps_coordinates
+from db_util import insert_into_metadata_Table, MetadataTableWriter
 
 LOGGER = util.get_logger(__name__)
 
+# Number of files of a batch that are put to S3 at the same time
+UPLOAD_WORKERS = int(os.getenv("ObfuscateUploadWorkers", 10))
+# The HB files of the j1939 bucket can be stored gzip compressed, the poster decompresses them on read
+COMPRESS_FILES = os.getenv("CompressObfuscatedFiles", "N") == "Y"
+# The HB files of a device, ESN and config can be stored as one newline-delimited object, with a manifest. A compacted
+# object holds at most COMPACTED_FILE_MAX_BYTES, and bodies that arrived at most COMPACTED_FILE_MAX_AGE_SECONDS after
+# the first of them. Nothing is buffered across invocations, so an object never covers more than the batch of one
+# invocation, i.e. the records the event source mapping collected within its batch size and batching window.
+COMPACT_FILES = os.getenv("CompactHbFiles", "N") == "Y"
+COMPACTED_FILE_MAX_BYTES = int(os.getenv("CompactedFileMaxBytes", 1024 * 1024))
+COMPACTED_FILE_MAX_AGE_SECONDS = float(os.getenv("CompactedFileMaxAgeSeconds", 60))
+
+s3_client = boto3.client("s3")
+
 
 def obfuscate_gps(body):
-    if "samples" in body:
-        for sample in body["samples"]:
-            if "convertedDeviceParameters" in sample:
-                converted_device_params = sample["convertedDeviceParameters"]
-                if "Latitude" in converted_device_params and "Longitude" in converted_device_params:
-                    latitude = converted_device_params["Latitude"]
-                    longitude = converted_device_params["Longitude"]
-                    LOGGER.info(f"Latitude: {latitude}, Longitude: {longitude}, before obfuscated gps coordinates")
-                    converted_device_params["Latitude"], converted_device_params["Longitude"] = \
-                        handle_gps_coordinates(latitude, longitude)
-                    LOGGER.info(f"Latitude: {converted_device_params['Latitude']}, "
-                                f"Longitude: {converted_device_params['Longitude']}, after obfuscated gps coordinates")
+    obfuscate_gps_coordinates(body)
     send_file_to_s3(body)
 
 
-def send_file_to_s3(body):
-    try:
-        s3_client = boto3.client("s3")
-        bucket_name = os.environ["j1939_end_bucket"]
-        emission_bucket_name = os.environ["j1939_emission_end_bucket"]
-        device_id = body["telematicsDeviceId"]
+def obfuscate_gps_batch(batch_items, arrival_times=None):
+    """
+    Obfuscates the bodies of an SQS/Kinesis batch, given as (item identifier, body) pairs, and puts their files to S3
+    concurrently. 'arrival_times' gives the epoch seconds at which the items arrived in the queue or stream by their
+    identifier, to bound the age of the compacted files. Returns the identifiers of the items that could not be
+    obfuscated or stored.
+    """
+    failed_item_ids = []
+    bodies_to_store = []
+    for item_id, body in batch_items:
+        try:
+            obfuscate_gps_coordinates(body)
+            bodies_to_store.append((item_id, body))
+        except Exception as e:
+            LOGGER.error(f"An error occurred while obfuscating gps coordinates of the batch item: {item_id}: {e}")
+            util.write_to_audit_table(e)
+            failed_item_ids.append(item_id)
+
+    if bodies_to_store:
+        # The metadata rows of the emission files are inserted together, while the files are being uploaded
+        metadata_writer = MetadataTableWriter()
+        uploads = get_uploads(bodies_to_store, metadata_writer, arrival_times or {})
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(uploads))) as executor:
+            stored = executor.map(lambda upload: upload[1](), uploads)
+            failed_item_ids += [item_id for (item_ids, _), is_stored in zip(uploads, stored) if not is_stored
+                                for item_id in item_ids]
+        # The items whose metadata row could not be inserted are retried like the ones whose file was not stored
+        failed_metadata_item_ids = metadata_writer.close()
+        if failed_metadata_item_ids:
+            LOGGER.error(f"The metadata rows of the batch item(s): {failed_metadata_item_ids} were not inserted")
+            failed_item_ids += [item_id for item_id in failed_metadata_item_ids if item_id not in failed_item_ids]
+    LOGGER.info(f"Obfuscated batch of {len(batch_items)} item(s), failed item(s): {failed_item_ids}")
+    return failed_item_ids
+
 
-        esn = body["componentSerialNumber"]
-        tsp_name = body["telematicsPartnerName"]
+def obfuscate_gps_coordinates(body):
+    gps_params = [sample["convertedDeviceParameters"] for sample in body.get("samples", [])
+                  if "Latitude" in sample.get("convertedDeviceParameters", {})
+                  and "Longitude" in sample["convertedDeviceParameters"]]
+    if not gps_params:
+        return
+    LOGGER.info(f"Obfuscating the gps coordinates of {len(gps_params)} sample(s)")
+    obfuscated_coordinates = transform_gps_coordinates(
+        [(converted_device_params["Latitude"], converted_device_params["Longitude"]) for converted_device_params in
+         gps_params])
+    for converted_device_params, (latitude, longitude) in zip(gps_params, obfuscated_coordinates):
+        converted_device_params["Latitude"], converted_device_params["Longitude"] = latitude, longitude
 
-        # Please note that the order is expected to be <Make>*<Model>***<ESN>**** for Improper PSBU ESN
-        if esn and "*" in esn:
-            esn = [esn_component for esn_component in esn.split("*") if esn_component][-1]
 
-        config_id = body["dataSamplingConfigId"]
-        current_dt = datetime.now()
-        if tsp_name == "COSPA":
-            LOGGER.debug("This is a COSMOS HB file")
-            file_name = "COSPA_{0}_{1}_{2}_{3}.json".format(device_id, esn, config_id, int(current_dt.timestamp()))
+def get_file_name_and_key(body, current_dt, unique_id=None):
+    """
+    The file name ends with the second of 'current_dt', followed by 'unique_id' if given, so that the files of a
+    device, ESN and config received in the same second are stored under different keys.
+    """
+    device_id = body["telematicsDeviceId"]
+
+    esn = body["componentSerialNumber"]
+    tsp_name = body["telematicsPartnerName"]
+
+    # Please note that the order is expected to be <Make>*<Model>***<ESN>**** for Improper PSBU ESN
+    if esn and "*" in esn:
+        esn = [esn_component for esn_component in esn.split("*") if esn_component][-1]
+
+    config_id = body["dataSamplingConfigId"]
+    timestamp = str(int(current_dt.timestamp())) if unique_id is None else f"{int(current_dt.timestamp())}_{unique_id}"
+    if tsp_name == "COSPA":
+        LOGGER.debug("This is a COSMOS HB file")
+        file_name = "COSPA_{0}_{1}_{2}_{3}.json".format(device_id, esn, config_id, timestamp)
+    else:
+        file_name = "EDGE_{0}_{1}_{2}_{3}.json".format(device_id, esn, config_id, timestamp)
+    file_key = "ConvertedFiles/{0}/{1}/{2}/{3}/{4}/{5}".format(
+        esn, device_id, current_dt.strftime("%Y"), current_dt.strftime("%m"), current_dt.strftime("%d"), file_name)
+    return config_id, file_name, file_key
+
+
+def get_uploads(bodies_to_store, metadata_writer, arrival_times):
+    """
+    Returns the uploads of the batch as (item identifiers, upload function) pairs. With COMPACT_FILES, the HB bodies of
+    the same device, ESN and config are stored, in the order they arrived, as compacted files bounded by
+    COMPACTED_FILE_MAX_BYTES and COMPACTED_FILE_MAX_AGE_SECONDS, the other bodies as a file each.
+    """
+    uploads = []
+    file_groups = {}  # file key -> [(item identifier, body)]
+    current_dt = datetime.now()
+    for item_id, body in bodies_to_store:
+        file_key = None
+        if COMPACT_FILES:
+            try:
+                config_id, _, file_key = get_file_name_and_key(body, current_dt)
+                # The emission files go to their own bucket with a metadata row each
+                file_key = None if config_id.startswith('SC9') else file_key
+            except Exception:
+                file_key = None  # send_file_to_s3() audits the body
+        if file_key:
+            file_groups.setdefault(file_key, []).append((item_id, body))
         else:
-            file_name = "EDGE_{0}_{1}_{2}_{3}.json".format(device_id, esn, config_id, int(current_dt.timestamp()))
-        file_key = "ConvertedFiles/{0}/{1}/{2}/{3}/{4}/{5}".format(
-            esn, device_id, current_dt.strftime("%Y"), current_dt.strftime("%m"), current_dt.strftime("%d"), file_name)
+            uploads.append(([item_id], partial(send_file_to_s3, body, metadata_writer, item_id)))
+
+    for file_key, batch_items in file_groups.items():
+        if len(batch_items) == 1:
+            uploads.append(([batch_items[0][0]], partial(send_file_to_s3, batch_items[0][1], metadata_writer,
+                                                         batch_items[0][0])))
+            continue
+        compacted_files = [[]]
+        compacted_file_size = 0
+        first_arrival_time = None
+        for item_id, body in sorted(batch_items, key=lambda batch_item: arrival_times.get(batch_item[0], 0)):
+            line = json.dumps(body).encode() + b"\n"
+            arrival_time = arrival_times.get(item_id, 0)
+            if compacted_files[-1] and (compacted_file_size + len(line) > COMPACTED_FILE_MAX_BYTES or
+                                        arrival_time - first_arrival_time > COMPACTED_FILE_MAX_AGE_SECONDS):
+                compacted_files.append([])
+                compacted_file_size = 0
+            if not compacted_files[-1]:
+                first_arrival_time = arrival_time
+            compacted_files[-1].append((item_id, line))
+            compacted_file_size += len(line)
+        for lines in compacted_files:
+            # Named after its first item, as another batch can compact files of the same device in the same second
+            compacted_file_key = f"{file_key[:-len('.json')]}_{lines[0][0]}.json"
+            uploads.append(([item_id for item_id, _ in lines],
+                            partial(send_compacted_file_to_s3, compacted_file_key, lines)))
+    return uploads
+
+
+def get_manifest_key(file_key):
+    # The manifests are not under ConvertedFiles, so that they do not notify the poster
+    return file_key.replace("ConvertedFiles", "CompactedManifests", 1)[:-len('.json')] + ".manifest.json"
+
+
+def send_compacted_file_to_s3(file_key, lines):
+    """
+    Stores the bodies as one newline-delimited JSON object, the poster routes every line of it as
+    <file name>_<line index>.json. The object is followed by its manifest, which gives the byte offset and length of
+    every body by its batch item identifier. The items fail if either of them could not be stored.
+    """
+    try:
+        bucket_name = os.environ["j1939_end_bucket"]
+        manifest = {"file_key": file_key, "messages": []}
+        offset = 0
+        for index, (item_id, line) in enumerate(lines):
+            manifest["messages"].append({"message_id": item_id,
+                                         "file_name": f"{file_key.split('/')[-1][:-len('.json')]}_{index}.json",
+                                         "offset": offset, "length": len(line)})
+            offset += len(line)
+        LOGGER.info(f"Compacted {len(lines)} files into the File Key: {file_key}")
+        s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=b"".join(line for _, line in lines),
+                             ContentType='application/x-ndjson',
+                             Metadata={'compacted': 'Y', 'messages': str(len(lines))})
+        s3_client.put_object(Bucket=bucket_name, Key=get_manifest_key(file_key), Body=json.dumps(manifest).encode(),
+                             ContentType='application/json')
+    except Exception as e:
+        LOGGER.error(f"An error occurred while sending compacted file to s3:  {e}")
+        util.write_to_audit_table(e)
+        return False
+    return True
+
+
+def send_file_to_s3(body, metadata_writer=None, item_id=None):
+    """
+    Stores the body under a key made unique by the identifier of its batch item, or by a random one for a body that is
+    not part of a batch.
+    """
+    try:
+        bucket_name = os.environ["j1939_end_bucket"]
+        emission_bucket_name = os.environ["j1939_emission_end_bucket"]
+        config_id, file_name, file_key = get_file_name_and_key(body, datetime.now(), item_id or uuid4().hex)
         LOGGER.info(f"File Name: {file_name}, File Key:  {file_key}")
         LOGGER.info(f"config_id: {config_id}")
+        # The body is serialized once, the same bytes are uploaded and their size is recorded
+        file_body = json.dumps(body).encode()
         # Depending on config_id insert to emission bucket else insert to j1939 bucket
         if config_id.startswith('SC9'):
             LOGGER.info(f"Starting additional processing as this is Emission data")
             uuid = str(uuid4())
-            insert_into_metadata_Table(body["telematicsDeviceId"], uuid, body["componentSerialNumber"], config_id,
-                                       file_name, len(str(body)))
-            send_to_s3_response = s3_client.put_object(Bucket=emission_bucket_name, Key=file_key,
-                                                       Body=json.dumps(body).encode(),
+            if metadata_writer:
+                metadata_writer.add(body["telematicsDeviceId"], uuid, body["componentSerialNumber"], config_id,
+                                    file_name, len(file_body), item_id)
+            else:
+                insert_into_metadata_Table(body["telematicsDeviceId"], uuid, body["componentSerialNumber"], config_id,
+                                           file_name, len(file_body))
+            send_to_s3_response = s3_client.put_object(Bucket=emission_bucket_name, Key=file_key, Body=file_body,
                                                        Metadata={'message_id': uuid})
+        elif COMPRESS_FILES:
+            stored_file_body = gzip.compress(file_body)
+            LOGGER.info(f"Compressed the file from {len(file_body)} to {len(stored_file_body)} bytes")
+            send_to_s3_response = s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=stored_file_body,
+                                                       ContentEncoding='gzip',
+                                                       Metadata={'raw_size': str(len(file_body)),
+                                                                 'stored_size': str(len(stored_file_body))})
         else:
-            send_to_s3_response = s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=json.dumps(body).encode())
+            send_to_s3_response = s3_client.put_object(Bucket=bucket_name, Key=file_key, Body=file_body)
         LOGGER.debug(f"Send to S3 Response: {send_to_s3_response}")
+        return True
     except Exception as e:
         LOGGER.error(f"An error occurred while sending file to s3:  {e}")
         util.write_to_audit_table(e)
+        return False
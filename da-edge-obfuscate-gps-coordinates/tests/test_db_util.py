@@ -1,6 +1,7 @@
 from unittest.mock import patch, MagicMock
 import unittest
 import sys
+import time
 from cda_module_mock_context import CDAModuleMockingContext
 
 with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
@@ -13,7 +14,7 @@ with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.env
     cda_module_mock_context.mock_module("edge_sqs_utility_layer")
     cda_module_mock_context.mock_module("edge_gps_utility_layer")
     cda_module_mock_context.mock_module("edge_db_simple_layer")
-    from db_util import insert_to_metadata_table_query, insert_into_metadata_Table
+    from db_util import insert_to_metadata_table_query, insert_into_metadata_Table, MetadataTableWriter
 
 
 class TestDbUtil(unittest.TestCase):
@@ -41,3 +42,76 @@ class TestDbUtil(unittest.TestCase):
         file_size = 22
         insert_into_metadata_Table(device_id, message_id, esn, config_id, file_name, file_size)
         mock_api_request.assert_called()
+
+    @patch('db_util.form_query_to_db_payload', lambda query, method: query)
+    @patch('db_util.send_payload_to_edge')
+    def test_metadata_table_writer_max_rows(self, mock_api_request):
+        metadata_writer = MetadataTableWriter(max_rows=2, max_age_seconds=60)
+        for index in range(5):
+            metadata_writer.add('357649072115903', f'message-{index}', '64505184', 'SC9004', f'file-{index}', 22)
+
+        failed_message_ids = metadata_writer.close()
+
+        self.assertEqual(failed_message_ids, [])
+        self.assertEqual(mock_api_request.call_count, 3)
+        self.assertEqual(sorted(call.args[0].count("'FILE_RECEIVED'") for call in mock_api_request.call_args_list),
+                         [1, 2, 2])
+
+    @patch('db_util.form_query_to_db_payload', lambda query, method: query)
+    @patch('db_util.send_payload_to_edge')
+    def test_metadata_table_writer_max_age(self, mock_api_request):
+        metadata_writer = MetadataTableWriter(max_rows=10, max_age_seconds=0)
+        metadata_writer.add('357649072115903', 'message-0', '64505184', 'SC9004', 'file-0', 22)
+        metadata_writer.add('357649072115903', 'message-1', '64505184', 'SC9004', 'file-1', 22)
+
+        metadata_writer.close()
+
+        self.assertEqual(mock_api_request.call_count, 2)
+
+    @patch('db_util.util.write_to_audit_table')
+    @patch('db_util.form_query_to_db_payload', lambda query, method: query)
+    @patch('db_util.send_payload_to_edge')
+    def test_metadata_table_writer_failed_rows_reported(self, mock_api_request, mock_write_to_audit_table):
+        def insert(query):
+            if "'message-1'" in query:
+                raise Exception("Mock db exception")
+        mock_api_request.side_effect = insert
+        metadata_writer = MetadataTableWriter(max_rows=10, max_age_seconds=60)
+        for index in range(3):
+            metadata_writer.add('357649072115903', f'message-{index}', '64505184', 'SC9004', f'file-{index}', 22)
+
+        failed_message_ids = metadata_writer.close()
+
+        self.assertEqual(failed_message_ids, ['message-1'])
+        self.assertEqual(mock_api_request.call_count, 4)
+        mock_write_to_audit_table.assert_called_once()
+        self.assertIn('file-1', mock_write_to_audit_table.call_args.args[0])
+
+    @patch('db_util.util.write_to_audit_table', MagicMock())
+    @patch('db_util.form_query_to_db_payload', lambda query, method: query)
+    @patch('db_util.send_payload_to_edge')
+    def test_metadata_table_writer_failed_rows_reported_by_item_id(self, mock_api_request):
+        def insert(query):
+            if "'message-1'" in query:
+                raise Exception("Mock db exception")
+        mock_api_request.side_effect = insert
+        metadata_writer = MetadataTableWriter(max_rows=10, max_age_seconds=60)
+        for index in range(3):
+            metadata_writer.add('357649072115903', f'message-{index}', '64505184', 'SC9004', f'file-{index}', 22,
+                                f'item-{index}')
+
+        self.assertEqual(metadata_writer.close(), ['item-1'])
+
+    @patch('db_util.form_query_to_db_payload', lambda query, method: query)
+    @patch('db_util.send_payload_to_edge')
+    def test_metadata_table_writer_aged_rows_inserted_without_add(self, mock_api_request):
+        metadata_writer = MetadataTableWriter(max_rows=10, max_age_seconds=0.05)
+        metadata_writer.add('357649072115903', 'message-0', '64505184', 'SC9004', 'file-0', 22)
+
+        time.sleep(0.3)
+        self.assertEqual(mock_api_request.call_count, 1)
+
+        metadata_writer.add('357649072115903', 'message-1', '64505184', 'SC9004', 'file-1', 22)
+        metadata_writer.close()
+
+        self.assertEqual(mock_api_request.call_count, 2)
@@ -1,3 +1,5 @@
+import json
+import base64
 import unittest
 from unittest.mock import patch
 import sys
@@ -50,3 +52,52 @@ class TestLambdaFunction(unittest.TestCase):
             print("Result: ", result)
             mock_obfuscate_gps.assert_called()
 
+    @patch('lambda_function.obfuscate_gps_batch')
+    @patch('lambda_function.obfuscate_gps')
+    def test_lambdaHandler_givenSqsBatch_thenReturnedFailedItems(self, mock_obfuscate_gps, mock_obfuscate_gps_batch):
+        print('<-----test_lambdaHandler_givenSqsBatch_thenReturnedFailedItems----->')
+        event = {"Records": [{"messageId": "message-1", "eventSource": "aws:sqs",
+                              "body": json.dumps({"telematicsDeviceId": "1234567890"}),
+                              "attributes": {"SentTimestamp": "1705470843250"}},
+                             {"messageId": "message-2", "eventSource": "aws:sqs",
+                              "body": json.dumps({"telematicsDeviceId": "1234567891"})}]}
+        mock_obfuscate_gps_batch.return_value = ["message-2"]
+
+        result = lambda_handler(event, None)
+        print("Result: ", result)
+
+        mock_obfuscate_gps.assert_not_called()
+        mock_obfuscate_gps_batch.assert_called_with([("message-1", {"telematicsDeviceId": "1234567890"}),
+                                                     ("message-2", {"telematicsDeviceId": "1234567891"})],
+                                                    {"message-1": 1705470843.25})
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "message-2"}]})
+
+    @patch('lambda_function.obfuscate_gps_batch')
+    def test_lambdaHandler_givenKinesisBatch_thenCalledObfuscateGPSBatch(self, mock_obfuscate_gps_batch):
+        print('<-----test_lambdaHandler_givenKinesisBatch_thenCalledObfuscateGPSBatch----->')
+        data = base64.b64encode(json.dumps({"telematicsDeviceId": "1234567890"}).encode()).decode()
+        event = {"Records": [{"eventSource": "aws:kinesis", "kinesis": {"sequenceNumber": "4955", "data": data,
+                                                                        "approximateArrivalTimestamp": 1705470843.25}}]}
+        mock_obfuscate_gps_batch.return_value = []
+
+        result = lambda_handler(event, None)
+        print("Result: ", result)
+
+        mock_obfuscate_gps_batch.assert_called_with([("4955", {"telematicsDeviceId": "1234567890"})],
+                                                    {"4955": 1705470843.25})
+        self.assertEqual(result, {"batchItemFailures": []})
+
+    @patch('lambda_function.util.write_to_audit_table')
+    @patch('lambda_function.obfuscate_gps_batch')
+    def test_lambdaHandler_givenBatchWithInvalidBody_thenReturnedInvalidItemAsFailed(self, mock_obfuscate_gps_batch,
+                                                                                     mock_write_to_audit_table):
+        print('<-----test_lambdaHandler_givenBatchWithInvalidBody_thenReturnedInvalidItemAsFailed----->')
+        event = {"Records": [{"messageId": "message-1", "eventSource": "aws:sqs", "body": "not json"}]}
+        mock_obfuscate_gps_batch.return_value = []
+
+        result = lambda_handler(event, None)
+        print("Result: ", result)
+
+        mock_obfuscate_gps_batch.assert_called_with([], {})
+        mock_write_to_audit_table.assert_called()
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "message-1"}]})
@@ -1,11 +1,16 @@
 import os
+import gzip
+import json
 import boto3
 import unittest
+from datetime import datetime
 from unittest.mock import patch
 from moto import mock_aws
 import sys
 from cda_module_mock_context import CDAModuleMockingContext
 
+sys.path.append('../')
+
 
 with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.environ", {
     "LoggingLevel": "debug",
@@ -19,12 +24,17 @@ with CDAModuleMockingContext(sys) as cda_module_mock_context, patch.dict("os.env
     cda_module_mock_context.mock_module("edge_gps_utility_layer")
     cda_module_mock_context.mock_module("edge_db_simple_layer")
 
-    from obfuscate_gps_handler import obfuscate_gps, send_file_to_s3
+    from obfuscate_gps_handler import obfuscate_gps, obfuscate_gps_batch, send_file_to_s3, send_compacted_file_to_s3, \
+        get_manifest_key
+    from edge_shared_utilities.gps_utility import clear_gps_cache
 
 
 class TestObfuscateGPSHandler(unittest.TestCase):
+    def setUp(self):
+        clear_gps_cache()
+
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenBodyWithoutSamples_thenNotCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenBodyWithoutSamples_thenNotCalledObfuscateGPSCoordinates----->")
@@ -35,7 +45,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         mock_send_file_to_s3.assert_called()
 
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenSamplesWithoutConvertedDeviceParameters_thenNotCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenSamplesWithoutConvertedDeviceParameters_"
@@ -47,7 +57,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         mock_send_file_to_s3.assert_called()
 
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenConvertedDeviceParametersWithoutLatitude_thenNotCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenConvertedDeviceParametersWithoutLatitude_"
@@ -61,7 +71,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         mock_send_file_to_s3.assert_called()
 
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenConvertedDeviceParametersWithoutLongitude_thenNotCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenConvertedDeviceParametersWithoutLongitude_"
@@ -75,7 +85,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         mock_send_file_to_s3.assert_called()
 
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenConvertedDeviceParametersWithLatLong_thenCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenConvertedDeviceParametersWithLatLong_"
@@ -91,7 +101,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         mock_send_file_to_s3.assert_called()
 
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_obfuscateGPS_givenMultipleSamplesWithLatLong_thenCalledObfuscateGPSCoordinates(
             self, mock_obfuscate_gps_coordinates, mock_send_file_to_s3):
         print("<-----test_obfuscate_gps_givenMultipleSamplesWithLatLong_thenCalledObfuscateGPSCoordinates----->")
@@ -157,7 +167,7 @@ class TestObfuscateGPSHandler(unittest.TestCase):
     @mock_aws
     @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket'})
     @patch('obfuscate_gps_handler.send_file_to_s3')
-    @patch('obfuscate_gps_handler.handle_gps_coordinates')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
     def test_sendFileToS3_givenValidBody_tsp_name_cospa_thenPutFileIntoBucket(self, mock_handle_gps_coordinates,
                                                                               mock_send_file_to_s3):
         print("<-----test_sendFileToS3_givenValidBody_tsp_name_cospa_thenPutFileIntoBucket----->")
@@ -186,3 +196,220 @@ class TestObfuscateGPSHandler(unittest.TestCase):
         result = send_file_to_s3(body)
         mock_insert_into_metadata_Table.assert_called()
         print("Result: ", result)
+
+    @patch('obfuscate_gps_handler.util.write_to_audit_table')
+    @patch('obfuscate_gps_handler.send_file_to_s3')
+    @patch('edge_shared_utilities.gps_utility.handle_gps_coordinates')
+    def test_obfuscateGPSBatch_givenBodies_thenReturnedFailedItems(self, mock_obfuscate_gps_coordinates,
+                                                                   mock_send_file_to_s3, mock_write_to_audit_table):
+        print("<-----test_obfuscateGPSBatch_givenBodies_thenReturnedFailedItems----->")
+        sample = {"dateTimestamp": "2020-10-08T14:26:58.456Z",
+                  "convertedDeviceParameters": {"Latitude": "-39.3456789", "Longitude": "30.9876543"}}
+        batch_items = [("message-1", {"telematicsDeviceId": "1", "samples": [dict(sample)]}),
+                       ("message-2", {"telematicsDeviceId": "2", "samples": [{"convertedDeviceParameters": {
+                           "Latitude": "bad", "Longitude": "bad"}}]}),
+                       ("message-3", {"telematicsDeviceId": "3", "samples": []})]
+        mock_obfuscate_gps_coordinates.side_effect = [("-12.345", "12.345"), Exception("Invalid coordinates")]
+        mock_send_file_to_s3.side_effect = lambda body, metadata_writer, item_id: body["telematicsDeviceId"] == "1"
+
+        result = obfuscate_gps_batch(batch_items)
+        print("Result: ", result)
+
+        self.assertEqual(sorted(result), ["message-2", "message-3"])
+        self.assertEqual(batch_items[0][1]["samples"][0]["convertedDeviceParameters"]["Latitude"], "-12.345")
+        self.assertEqual(mock_send_file_to_s3.call_count, 2)
+        mock_write_to_audit_table.assert_called_once()
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.datetime')
+    @patch('obfuscate_gps_handler.MetadataTableWriter')
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_obfuscateGPSBatch_givenSameDeviceBodiesInOneSecond_thenPutDistinctFiles(
+            self, mock_s3_client, mock_metadata_table_writer, mock_datetime):
+        print("<-----test_obfuscateGPSBatch_givenSameDeviceBodiesInOneSecond_thenPutDistinctFiles----->")
+        mock_datetime.now.return_value = datetime(2024, 1, 17, 5, 54, 0)
+        mock_metadata_table_writer.return_value.close.return_value = []
+        batch_items = [(f"message-{index}", {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                                             "telematicsDeviceId": "102900000000001",
+                                             "dataSamplingConfigId": "SC5004", "samples": [{"index": index}]})
+                       for index in range(2)]
+
+        result = obfuscate_gps_batch(batch_items)
+        print("Result: ", result)
+
+        put_objects = {call_args.kwargs["Key"]: json.loads(call_args.kwargs["Body"])
+                       for call_args in mock_s3_client.put_object.call_args_list}
+        self.assertEqual(result, [])
+        self.assertEqual(sorted(put_objects), [
+            f"ConvertedFiles/10290001/102900000000001/2024/01/17/EDGE_102900000000001_10290001_SC5004_"
+            f"{int(datetime(2024, 1, 17, 5, 54, 0).timestamp())}_message-{index}.json" for index in range(2)])
+        self.assertEqual(sorted(body["samples"][0]["index"] for body in put_objects.values()), [0, 1])
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.s3_client')
+    @patch('obfuscate_gps_handler.insert_into_metadata_Table')
+    def test_sendFileToS3_givenEmissionBody_thenRecordedSizeOfUploadedBytes(self, mock_insert_into_metadata_Table,
+                                                                            mock_s3_client):
+        print("<-----test_sendFileToS3_givenEmissionBody_thenRecordedSizeOfUploadedBytes----->")
+        body = {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                "telematicsDeviceId": "102900000000001", "dataSamplingConfigId": "SC9004",
+                "samples": [{"dateTimestamp": "2020-10-08T14:26:58.456Z", "convertedDeviceParameters": {
+                    "messageID": "message_id", "Latitude": "-39.3456789", "Longitude": "30.9876543", "Name": "é"}}]}
+
+        result = send_file_to_s3(body)
+        print("Result: ", result)
+
+        file_body = mock_s3_client.put_object.call_args.kwargs["Body"]
+        self.assertTrue(result)
+        self.assertEqual(file_body, json.dumps(body).encode())
+        self.assertEqual(mock_insert_into_metadata_Table.call_args.args[5], len(file_body))
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.COMPRESS_FILES', True)
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_sendFileToS3_givenCompressionEnabled_thenPutCompressedFileWithSizes(self, mock_s3_client):
+        print("<-----test_sendFileToS3_givenCompressionEnabled_thenPutCompressedFileWithSizes----->")
+        body = {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                "telematicsDeviceId": "102900000000001", "dataSamplingConfigId": "SC5004",
+                "samples": [{"dateTimestamp": "2020-10-08T14:26:58.456Z",
+                             "convertedDeviceParameters": {"messageID": "message_id", "Latitude": "-39.3456789",
+                                                           "Longitude": "30.9876543"}}] * 20}
+
+        result = send_file_to_s3(body)
+        print("Result: ", result)
+
+        put_object_kwargs = mock_s3_client.put_object.call_args.kwargs
+        self.assertTrue(result)
+        self.assertEqual(put_object_kwargs["Bucket"], "test_bucket")
+        self.assertEqual(put_object_kwargs["ContentEncoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(put_object_kwargs["Body"])), body)
+        self.assertEqual(put_object_kwargs["Metadata"], {"raw_size": str(len(json.dumps(body).encode())),
+                                                         "stored_size": str(len(put_object_kwargs["Body"]))})
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.s3_client')
+    @patch('obfuscate_gps_handler.insert_into_metadata_Table')
+    @patch('obfuscate_gps_handler.MetadataTableWriter')
+    def test_obfuscateGPSBatch_givenEmissionBodies_thenBufferedMetadataRows(self, mock_metadata_table_writer,
+                                                                            mock_insert_into_metadata_Table,
+                                                                            mock_s3_client):
+        print("<-----test_obfuscateGPSBatch_givenEmissionBodies_thenBufferedMetadataRows----->")
+        batch_items = [(f"message-{index}", {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                                             "telematicsDeviceId": f"10290000000000{index}",
+                                             "dataSamplingConfigId": "SC9004", "samples": []})
+                       for index in range(3)]
+        mock_metadata_table_writer.return_value.close.return_value = ["message-1"]
+
+        result = obfuscate_gps_batch(batch_items)
+        print("Result: ", result)
+
+        self.assertEqual(result, ["message-1"])
+        self.assertEqual(mock_metadata_table_writer.return_value.add.call_count, 3)
+        self.assertEqual(sorted(call_args.args[6] for call_args in
+                                mock_metadata_table_writer.return_value.add.call_args_list),
+                         ["message-0", "message-1", "message-2"])
+        mock_metadata_table_writer.return_value.close.assert_called_once()
+        mock_insert_into_metadata_Table.assert_not_called()
+        self.assertEqual(mock_s3_client.put_object.call_count, 3)
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.COMPACT_FILES', True)
+    @patch('obfuscate_gps_handler.COMPACTED_FILE_MAX_BYTES', 400)
+    @patch('obfuscate_gps_handler.insert_into_metadata_Table')
+    @patch('obfuscate_gps_handler.MetadataTableWriter')
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_obfuscateGPSBatch_givenCompactionEnabled_thenPutCompactedFilesWithManifests(
+            self, mock_s3_client, mock_metadata_table_writer, mock_insert_into_metadata_Table):
+        print("<-----test_obfuscateGPSBatch_givenCompactionEnabled_thenPutCompactedFilesWithManifests----->")
+
+        def hb_body(device_id, config_id="SC5004"):
+            return {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                    "telematicsDeviceId": device_id, "dataSamplingConfigId": config_id, "samples": []}
+        batch_items = [("message-1", hb_body("102900000000001")), ("message-2", hb_body("102900000000001")),
+                       ("message-3", hb_body("102900000000001")), ("message-4", hb_body("102900000000002")),
+                       ("message-5", hb_body("102900000000001", "SC9004"))]
+        mock_metadata_table_writer.return_value.close.return_value = []
+
+        result = obfuscate_gps_batch(batch_items)
+        print("Result: ", result)
+
+        put_objects = [call_args.kwargs for call_args in mock_s3_client.put_object.call_args_list]
+        compacted_files = {put_object["Key"]: put_object for put_object in put_objects
+                           if put_object.get("Metadata", {}).get("compacted")}
+        manifests = [json.loads(put_object["Body"]) for put_object in put_objects
+                     if put_object["Key"].startswith("CompactedManifests/")]
+        self.assertEqual(result, [])
+        self.assertEqual(len(put_objects), 6)
+        self.assertEqual(sorted(compacted_file["Metadata"]["messages"] for compacted_file in compacted_files.values()),
+                         ["1", "2"])
+        self.assertEqual(sorted(message["message_id"] for manifest in manifests for message in manifest["messages"]),
+                         ["message-1", "message-2", "message-3"])
+        for manifest in manifests:
+            compacted_file = compacted_files[manifest["file_key"]]
+            self.assertTrue(compacted_file["Key"].startswith("ConvertedFiles/10290001/102900000000001/"))
+            # Every object is put before its manifest
+            self.assertLess(put_objects.index(compacted_file), next(
+                index for index, put_object in enumerate(put_objects)
+                if put_object["Key"] == get_manifest_key(manifest["file_key"])))
+            for message in manifest["messages"]:
+                line = compacted_file["Body"][message["offset"]:message["offset"] + message["length"]]
+                self.assertEqual(json.loads(line), dict(batch_items)[message["message_id"]])
+        self.assertEqual(mock_metadata_table_writer.return_value.add.call_count, 1)
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'j1939_emission_end_bucket': 'test_emission_bucket'})
+    @patch('obfuscate_gps_handler.COMPACT_FILES', True)
+    @patch('obfuscate_gps_handler.COMPACTED_FILE_MAX_AGE_SECONDS', 30)
+    @patch('obfuscate_gps_handler.MetadataTableWriter')
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_obfuscateGPSBatch_givenBodiesArrivedApart_thenCompactedByAge(self, mock_s3_client,
+                                                                          mock_metadata_table_writer):
+        print("<-----test_obfuscateGPSBatch_givenBodiesArrivedApart_thenCompactedByAge----->")
+        batch_items = [(f"message-{index}", {"componentSerialNumber": "10290001", "telematicsPartnerName": "Cummins",
+                                             "telematicsDeviceId": "102900000000001",
+                                             "dataSamplingConfigId": "SC5004", "samples": []})
+                       for index in range(4)]
+        arrival_times = {"message-0": 1000, "message-1": 1045, "message-2": 1010, "message-3": 1050}
+        mock_metadata_table_writer.return_value.close.return_value = []
+
+        result = obfuscate_gps_batch(batch_items, arrival_times)
+        print("Result: ", result)
+
+        manifests = [json.loads(call_args.kwargs["Body"]) for call_args in mock_s3_client.put_object.call_args_list
+                     if call_args.kwargs["Key"].startswith("CompactedManifests/")]
+        self.assertEqual(result, [])
+        self.assertEqual(sorted([message["message_id"] for message in manifest["messages"]] for manifest in manifests),
+                         [["message-0", "message-2"], ["message-1", "message-3"]])
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'AuditTrailQueueUrl': 'https://testurl.com'})
+    @patch('obfuscate_gps_handler.util.write_to_audit_table')
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_sendCompactedFileToS3_givenErrorOccurredWhileStoringManifest_thenReturnedFalse(
+            self, mock_s3_client, mock_write_to_audit_table):
+        print("<-----test_sendCompactedFileToS3_givenErrorOccurredWhileStoringManifest_thenReturnedFalse----->")
+        mock_s3_client.put_object.side_effect = [{}, Exception("Mock S3 exception")]
+
+        result = send_compacted_file_to_s3("ConvertedFiles/10290001/1/2024/01/17/EDGE_1_10290001_SC5004_1_m1.json",
+                                           [("message-1", b"{}\n"), ("message-2", b"{}\n")])
+        print("Result: ", result)
+
+        self.assertFalse(result)
+        self.assertEqual([call_args.kwargs["Key"] for call_args in mock_s3_client.put_object.call_args_list], [
+            "ConvertedFiles/10290001/1/2024/01/17/EDGE_1_10290001_SC5004_1_m1.json",
+            "CompactedManifests/10290001/1/2024/01/17/EDGE_1_10290001_SC5004_1_m1.manifest.json"])
+        mock_write_to_audit_table.assert_called_once()
+
+    @patch.dict('os.environ', {'j1939_end_bucket': 'test_bucket', 'AuditTrailQueueUrl': 'https://testurl.com'})
+    @patch('obfuscate_gps_handler.util.write_to_audit_table')
+    @patch('obfuscate_gps_handler.s3_client')
+    def test_sendCompactedFileToS3_givenErrorOccurredWhileStoringFile_thenReturnedFalse(self, mock_s3_client,
+                                                                                       mock_write_to_audit_table):
+        print("<-----test_sendCompactedFileToS3_givenErrorOccurredWhileStoringFile_thenReturnedFalse----->")
+        mock_s3_client.put_object.side_effect = Exception("Mock S3 exception")
+
+        result = send_compacted_file_to_s3("ConvertedFiles/10290001/1/2024/01/17/EDGE_1_10290001_SC5004_1_0.json",
+                                           [("message-1", b"{}\n"), ("message-2", b"{}\n")])
+        print("Result: ", result)
+
+        self.assertFalse(result)
+        mock_s3_client.put_object.assert_called_once()
+        mock_write_to_audit_table.assert_called_once()
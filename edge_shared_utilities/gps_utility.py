@@ -0,0 +1,62 @@
+# Shared by the poster, the NGDI to CD conversion and the obfuscation lambdas, the build copies edge_shared_utilities
+# into the package of each of them
+import os
+import threading
+from collections import OrderedDict
+
+from edge_gps_utility_layer import handle_gps_coordinates
+
+# Parked and slow-moving assets report the same co-ordinates over and over, the recent pairs are kept per container
+GPS_CACHE_SIZE = int(os.getenv("GpsCoordinatesCacheSize", 1024))
+
+_gps_cache = OrderedDict()  # (latitude, longitude, deobfuscate) -> transformed (latitude, longitude)
+_gps_cache_lock = threading.Lock()
+
+
+def _get_cache_key(latitude, longitude, deobfuscate):
+    # The types are part of the key, so that "1.5" and 1.5 (or 1 and 1.0) are never served each other's result
+    cache_key = (type(latitude), latitude, type(longitude), longitude, deobfuscate)
+    try:
+        hash(cache_key)
+    except TypeError:
+        return None
+    return cache_key
+
+
+def transform_gps_coordinate(latitude, longitude, deobfuscate=False):
+    """
+    Obfuscates (or de-obfuscates) one (latitude, longitude) pair with handle_gps_coordinates(), serving the pairs seen
+    recently from the cache.
+    """
+    cache_key = _get_cache_key(latitude, longitude, deobfuscate)
+    if cache_key is None:
+        return handle_gps_coordinates(latitude, longitude, deobfuscate=deobfuscate)
+
+    with _gps_cache_lock:
+        if cache_key in _gps_cache:
+            _gps_cache.move_to_end(cache_key)
+            return _gps_cache[cache_key]
+
+    transformed_coordinate = handle_gps_coordinates(latitude, longitude, deobfuscate=deobfuscate)
+    with _gps_cache_lock:
+        _gps_cache[cache_key] = transformed_coordinate
+        if len(_gps_cache) > GPS_CACHE_SIZE:
+            _gps_cache.popitem(last=False)
+    return transformed_coordinate
+
+
+def transform_gps_coordinates(coordinates, deobfuscate=False):
+    """
+    Obfuscates (or de-obfuscates) a list of (latitude, longitude) pairs with handle_gps_coordinates(), transforming
+    every distinct pair once and serving the pairs seen recently from the cache. Returns the transformed pairs in the
+    order of the given ones.
+    """
+    transformed_coordinates = []
+    for latitude, longitude in coordinates:
+        transformed_coordinates.append(transform_gps_coordinate(latitude, longitude, deobfuscate))
+    return transformed_coordinates
+
+
+def clear_gps_cache():
+    with _gps_cache_lock:
+        _gps_cache.clear()